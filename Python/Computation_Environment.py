@@ -4,6 +4,9 @@
 
 import platform
 import os
+import sys
+import contextlib
+import multiprocessing
 
 PNET_OS = platform.system()
 
@@ -51,3 +54,78 @@ def set_computation_environment():
     os.system('export OPENBLAS_NUM_THREADS=1')
 
 
+def set_computation_thread(N_Thread=1):
+    """
+    Limit the number of threads used by numpy (BLAS and OpenMP) and PyTorch in the current process
+    It is used to initialize worker processes, so that workers x threads does not exceed the number of CPU cores
+    Environment variables only affect libraries loaded afterwards, and threadpoolctl limits those already loaded
+
+    :param N_Thread: positive integer, number of threads
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    N_Thread = int(N_Thread)
+    for key in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[key] = str(N_Thread)
+
+    try:
+        import threadpoolctl
+        threadpoolctl.threadpool_limits(limits=N_Thread)
+    except ImportError:
+        pass
+
+    # Only set PyTorch if it is already used, to avoid importing it in numpy workers
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(N_Thread)
+
+
+def check_main_process():
+    """
+    Check that pNet is not started by a worker process while it imports the main script
+    Worker processes of parallel computation are started by spawn, which imports the main script again in each worker
+    A script calling pNet at top level, without the if __name__ == '__main__': guard, would rerun the whole workflow in each worker and overwrite files used by the main process
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if getattr(multiprocessing.current_process(), '_inheriting', False):
+        raise ValueError("pNet is started again by a worker process importing the main script. Call pNet under if __name__ == '__main__': in the script")
+
+
+@contextlib.contextmanager
+def split_computation_thread(nParallel=1):
+    """
+    Split the threads currently used by numpy (BLAS and OpenMP) and PyTorch among nParallel concurrent tasks in the current process
+    Each task runs with max(1, N_Thread // nParallel) threads, so that concurrent tasks x threads does not exceed N_Thread
+    The previous limits are restored on exit
+
+    :param nParallel: positive integer, number of tasks running concurrently in threads
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    nParallel = int(max(nParallel, 1))
+    with contextlib.ExitStack() as stack:
+        # PyTorch shares the OpenMP runtime with threadpoolctl, so its thread number is read first
+        if 'torch' in sys.modules:
+            torch = sys.modules['torch']
+            N_Thread_torch = torch.get_num_threads()
+        else:
+            torch = None
+
+        try:
+            import threadpoolctl
+            controller = threadpoolctl.ThreadpoolController()
+            N_Thread = max([lib['num_threads'] for lib in controller.info()], default=0)
+            if N_Thread > 0:
+                stack.enter_context(controller.limit(limits=max(1, N_Thread // nParallel)))
+        except ImportError:
+            pass
+
+        # Only set PyTorch if it is already used, to avoid importing it in numpy workers
+        if torch is not None:
+            torch.set_num_threads(max(1, N_Thread_torch // nParallel))
+            stack.callback(torch.set_num_threads, N_Thread_torch)
+
+        yield
@@ -18,6 +18,8 @@ import torch
 import h5py
 import time
 import gzip
+import hashlib
+import concurrent.futures
 
 
 def load_matlab_array(file_matlab: str,
@@ -78,6 +80,26 @@ def load_matlab_single_array(file_matlab: str):
     return data
 
 
+def load_matlab_single_array_shape(file_matlab: str):
+    """
+    Get the shape of the variable in a matlab file with only one variable stored, without loading its content
+
+    :param file_matlab: string
+    :return: shape, a tuple
+
+    By Yuncong Ma, 11/9/2023
+    """
+    try:
+        list_shape = [item[1] for item in sio.whosmat(file_matlab) if not item[0].startswith('__')]
+    except NotImplementedError:
+        with h5py.File(file_matlab, 'r') as matlab_data:
+            list_shape = [matlab_data[name].shape[::-1] for name in matlab_data.keys() if not name.startswith('__') and not name.startswith('#')]
+    if len(list_shape) != 1:
+        raise ValueError('The MATLAB file ' + file_matlab + ' needs to contain only one variable')
+
+    return tuple(list_shape[0])
+
+
 def load_matlab_single_variable(file_matlab: str):
     """
     Load a matlab file with only one variable stored
@@ -282,6 +304,387 @@ def normalize_data(data,
     return pX
 
 
+def normalize_data_inplace(data, algorithm='vp', normalization='vmax'):
+    """
+    Normalize data in place, with the same results as normalize_data
+    It avoids copies of data, such as a block of concatenated scans
+
+    :param data: data in 2D matrix [dim_time, dim_space], in single or double precision
+    :param algorithm: 'vp'
+    :param normalization: 'vmax'
+    :return: data
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    if len(data.shape) != 2:
+        raise ValueError("data must be a 2D matrix")
+    if algorithm.lower() != 'vp' or normalization.lower() != 'vmax':
+        raise ValueError('Only supports in-place normalization with vp and vmax')
+    np_float, np_eps = set_data_precision(str(data.dtype))
+
+    # remove negative value voxel-wisely
+    data += np.abs(np.minimum(np.min(data, axis=0), 0))
+    # normalize each vector by its range
+    cmin = np.min(data, axis=0)
+    cmax = np.max(data, axis=0)
+    data -= cmin
+    data /= np.maximum(cmax - cmin, np_eps)
+
+    if np.isnan(data).any():
+        raise ValueError('  nan exists, check the preprocessed data')
+
+    return data
+
+
+def setup_cifti_grayordinate(cifti, part: str):
+    """
+    Get columns of grayordinates in a CIFTI file for its surface or volume part, using brain models of its grayordinate axis in the header
+
+    :param cifti: a CIFTI image loaded by nibabel, with grayordinates in its second dimension
+    :param part: 'Surface', 'Volume' or 'Surface-Volume'
+    :return: index, a slice if the grayordinates are contiguous, otherwise a 1D array of column indices
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    if part not in ('Surface', 'Volume', 'Surface-Volume'):
+        raise ValueError('Unknown part of CIFTI grayordinates: ' + str(part))
+
+    # Each brain model is a contiguous block of columns
+    mask = np.zeros(cifti.shape[1], dtype=bool)
+    for bm in cifti.header.get_index_map(1).brain_models:
+        if part == 'Surface-Volume' or (part == 'Surface') == (bm.model_type == 'CIFTI_MODEL_TYPE_SURFACE'):
+            mask[bm.index_offset:bm.index_offset + bm.index_count] = True
+
+    index = np.flatnonzero(mask)
+    if len(index) > 0 and index[-1] - index[0] + 1 == len(index):
+        index = slice(int(index[0]), int(index[-1]) + 1)
+    return index
+
+
+def load_cifti_grayordinate(file_cifti: str, part: str):
+    """
+    Load grayordinates of the surface or volume part of a CIFTI file into a 2D matrix [dim_time dim_space]
+    Contiguous columns are stored in a contiguous block of the file, which is read once into memory without loading other grayordinates
+
+    :param file_cifti: a CIFTI file ending with .dtseries.nii
+    :param part: 'Surface', 'Volume' or 'Surface-Volume'
+    :return: scan_data: a 2D NumPy array [dim_time dim_space] in np.float32
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    cifti = nib.load(file_cifti)  # [dim_time dim_space]
+    index = setup_cifti_grayordinate(cifti, part)
+    if isinstance(index, slice) and cifti.dataobj.order == 'F':
+        # Time points of each grayordinate are contiguous in the file
+        dim_time = cifti.dataobj.shape[0]
+        with nib.openers.ImageOpener(file_cifti) as fileobj:
+            scan_data = nib.volumeutils.array_from_file((dim_time, index.stop - index.start), cifti.dataobj.dtype, fileobj,
+                                                        offset=cifti.dataobj.offset + index.start * dim_time * cifti.dataobj.dtype.itemsize,
+                                                        order='F', mmap=False)
+        scan_data = nib.volumeutils.apply_read_scaling(scan_data, cifti.dataobj.slope, cifti.dataobj.inter).astype(np.float32, copy=False)
+    else:
+        scan_data = cifti.get_fdata(dtype=np.float32)[:, index]
+    return scan_data
+
+
+def load_fmri_scan_shape(file_scan: str, dataType: str, dataFormat: str, Reshape=False, Brain_Mask=None):
+    """
+    Get the size of an fMRI scan from its file header, without loading its content
+
+    :param file_scan: directory of a single scan, or two files separated by ';' for MGH surface data
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: 'HCP Surface (*.cifti, *.mat)', 'MGH Surface (*.mgh)', 'MGZ Surface (*.mgz)', 'Volume (*.nii, *.nii.gz, *.mat)', 'HCP Surface-Volume (*.cifti)', 'HCP Volume (*.cifti)'
+    :param Reshape: False or True, whether 4D volume-based fMRI data are reshaped to 2D
+    :param Brain_Mask: None or a brain mask [X Y Z]
+    :return: shape, a tuple (dim_time, dim_space) of the data from load_fmri_single_scan, or [X Y Z dim_time] for 4D volume data without reshape
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    if dataFormat == 'HCP Surface (*.cifti, *.mat)':
+        if file_scan.endswith('.dtseries.nii'):
+            cifti = nib.load(file_scan)  # [dim_time dim_space]
+            index = setup_cifti_grayordinate(cifti, 'Surface')
+            shape = (cifti.shape[0], len(range(cifti.shape[1])[index]))
+        elif file_scan.endswith('.mat'):
+            shape = (load_matlab_single_array_shape(file_scan)[1], 59412)  # [dim_space dim_time]
+        else:
+            raise ValueError('Unsupported data format ' + file_scan)
+
+    elif dataFormat in ('MGH Surface (*.mgh)', 'MGZ Surface (*.mgz)'):
+        # Squeezed [dim_space dim_time] of each hemisphere
+        list_shape = [[n for n in nib.load(file).shape if n != 1] for file in str.split(file_scan, ';')]
+        shape = (list_shape[0][1], sum([item[0] for item in list_shape]))
+
+    elif dataFormat == 'Volume (*.nii, *.nii.gz, *.mat)':
+        if file_scan.endswith('.nii') or file_scan.endswith('.nii.gz'):
+            shape = tuple(nib.load(file_scan).shape)
+        elif file_scan.endswith('.mat'):
+            shape = load_matlab_single_array_shape(file_scan)  # [X Y Z dim_time]
+        else:
+            raise ValueError('Unsupported data format ' + file_scan)
+        if Reshape:
+            if Brain_Mask is None:
+                raise ValueError('Brain_Mask must be provided when Reshape is enabled for 4D fMRI data')
+            shape = (shape[3], int(np.sum(Brain_Mask > 0)))
+
+    elif dataFormat == 'HCP Surface-Volume (*.cifti)':
+        shape = tuple(nib.load(file_scan).shape)  # [dim_time dim_space]
+
+    elif dataFormat == 'HCP Volume (*.cifti)':
+        cifti = nib.load(file_scan)  # [dim_time dim_space]
+        index = setup_cifti_grayordinate(cifti, 'Volume')
+        shape = (cifti.shape[0], len(range(cifti.shape[1])[index]))
+
+    else:
+        raise ValueError('Unsupported data format ' + dataFormat)
+
+    return shape
+
+
+def load_nifti_masked(file_nii: str, Brain_Mask: np.ndarray, slabSize='Automatic'):
+    """
+    Load voxels within a brain mask from a 4D NIfTI file into a 2D matrix [dim_time dim_space], the same as reshape_fmri_data on its full data
+    Data are read through the array proxy of nibabel a slab of time points at a time, which is memory-mapped for .nii and decompressed sequentially for .nii.gz, so that the full 4D data are not loaded into memory
+
+    :param file_nii: directory of a .nii or .nii.gz file
+    :param Brain_Mask: a brain mask [X Y Z]
+    :param slabSize: 'Automatic' or a positive integer, number of time points read at a time. 'Automatic' makes a slab of 4D data about the size of the output
+    :return: scan_data: a 2D NumPy array [dim_time dim_space] in np.float32
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    # The gzip stream is kept open so that slabs are decompressed once in order
+    nii = nib.load(file_nii, keep_file_open=True)
+    if len(nii.shape) != 4 or nii.shape[0:3] != Brain_Mask.shape:
+        raise ValueError('The shapes of Brain_Mask and scan_data are not the same when scan_data is a 4D matrix')
+    dim_time = nii.shape[3]
+    # Match colum based index used in MATLAB
+    index_mask = np.flatnonzero(Brain_Mask.flatten('F') > 0)
+    if slabSize == 'Automatic':
+        slabSize = int(np.ceil(dim_time * len(index_mask) / np.prod(Brain_Mask.shape)))
+    slabSize = int(np.maximum(slabSize, 1))
+
+    scan_data = np.empty((dim_time, len(index_mask)), dtype=np.float32)
+    for t in range(0, dim_time, slabSize):
+        slab = np.asarray(nii.dataobj[..., t:t+slabSize])  # [X Y Z slabSize]
+        slab = np.reshape(slab, (-1, slab.shape[3]), order='F')
+        scan_data[t:t+slab.shape[1], :] = slab[index_mask, :].T
+        del slab
+    del nii
+    return scan_data
+
+
+def load_fmri_single_scan(file_scan: str, dataType: str, dataFormat: str, Reshape=False, Brain_Mask=None):
+    """
+    Load a single fMRI scan
+
+    :param file_scan: directory of a single scan, or two files separated by ';' for MGH surface data
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: 'HCP Surface (*.cifti, *.mat)', 'MGH Surface (*.mgh)', 'MGZ Surface (*.mgz)', 'Volume (*.nii, *.nii.gz, *.mat)', 'HCP Surface-Volume (*.cifti)', 'HCP Volume (*.cifti)'
+    :param Reshape: False or True, whether to reshape 4D volume-based fMRI data to 2D
+    :param Brain_Mask: None or a brain mask [X Y Z]
+    :return: scan_data: a 2D NumPy array [dim_time dim_space], or 4D [X Y Z dim_time] for volume data without reshape
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    file_list = str.split(file_scan, ';')
+    for file in file_list:
+        if not os.path.isfile(file):
+            raise ValueError('The file does not exist: ' + file)
+
+    # Loading a single fMRI scan
+    # 2D or 4D matrix with dimension definition [dim_space dim_time] or [X, Y, Z, T]
+
+    # 'HCP Surface (*.cifti, *.mat)'
+    if dataFormat == 'HCP Surface (*.cifti, *.mat)':
+        if file_scan.endswith('.dtseries.nii'):
+            # Extract the cortical surface part of the data
+            scan_data = load_cifti_grayordinate(file_scan, 'Surface')
+            if scan_data.shape[1] != 59412:
+                raise ValueError('The CIFTI file contains ' + str(scan_data.shape[1]) + ' surface vertices instead of 59412 in file ' + file_scan)
+
+        elif file_scan.endswith('.mat'):
+            scan_data = load_matlab_single_array(file_scan)  # [dim_space dim_time]
+            if scan_data.shape[0] < 59412:
+                raise ValueError('The MATLAB file contains a 2D matrix with the spatial dimension smaller than 59412 in file ' + file_scan)
+            scan_data = np.ascontiguousarray(scan_data[:59412, :].T)
+
+        else:
+            raise ValueError('Unsupported data format ' + file_scan)
+
+    elif dataFormat == 'MGH Surface (*.mgh)':
+        # need to split each line to two directories for left and right hemispheres
+        if len(str.split(file_scan, ';')) != 2:
+            raise ValueError("For MGH surface data format, directories of two hemisphere data need to be combined into one line with ';' as separator")
+
+        # get files for two hemispheres
+        file_L = str.split(file_scan, ';')[0]
+        file_R = str.split(file_scan, ';')[1]
+
+        # check extension
+        if not file_L.endswith('.mgh') or not file_R.endswith('.mgh'):
+            raise ValueError('For MGH surface format, the file extension should be .mgh')
+
+        scan_data = np.array(nib.load(file_L).get_fdata(dtype=np.float32))  # [dim_space, _, _, dim_time]
+        scan_data = np.squeeze(scan_data)
+        scan_data = np.append(scan_data, np.squeeze(np.array(nib.load(file_R).get_fdata(dtype=np.float32))), axis=0)
+        scan_data = scan_data.T
+
+    elif dataFormat == 'MGZ Surface (*.mgz)':
+        mgz = nib.load(file_scan)
+        scan_data = mgz.get_fdata(dtype=np.float32)  # [dim_space dim_time]
+        scan_data = np.squeeze(np.array(scan_data)).T
+
+    elif dataFormat == 'Volume (*.nii, *.nii.gz, *.mat)':
+        if Reshape and Brain_Mask is None:
+            raise ValueError('Brain_Mask must be provided when Reshape is enabled for 4D fMRI data')
+        if (file_scan.endswith('.nii') or file_scan.endswith('.nii.gz')) and Reshape:
+            # Only voxels in Brain_Mask are read
+            scan_data = load_nifti_masked(file_scan, Brain_Mask)
+        elif file_scan.endswith('.nii') or file_scan.endswith('.nii.gz'):
+            nii = nib.load(file_scan)
+            scan_data = nii.get_fdata(dtype=np.float32)
+        elif file_scan.endswith('.mat'):
+            scan_data = load_matlab_single_array(file_scan)  # [X Y Z dim_time]
+            if Reshape:
+                scan_data = reshape_fmri_data(scan_data, dataType, Brain_Mask)
+        else:
+            raise ValueError('Unsupported data format ' + file_scan)
+
+    elif dataFormat == 'HCP Surface-Volume (*.cifti)':
+        if file_scan.endswith('.dtseries.nii'):
+            scan_data = load_cifti_grayordinate(file_scan, 'Surface-Volume')
+        else:
+            raise ValueError('Unsupported scan extension for data format HCP Surface-Volume')
+
+    elif dataFormat == 'HCP Volume (*.cifti)':
+        if file_scan.endswith('.dtseries.nii'):
+            # All voxels of the volume part, in the order of CIFTI_Volume.nii.gz from setup_cifti_volume
+            scan_data = load_cifti_grayordinate(file_scan, 'Volume')
+        else:
+            raise ValueError('Unsupported scan extension for data format HCP Volume')
+
+    else:
+        raise ValueError('Unsupported data format ' + dataFormat)
+
+    # scan_data should be in [dim_time dim_space]
+    # Convert to NumPy array, including a np.memmap from nibabel, which is taken as out-of-core data by gFN_NMF and pFN_NMF
+    if type(scan_data) is not np.ndarray:
+        scan_data = np.asarray(scan_data)
+
+    return scan_data
+
+
+def setup_scan_cache_file(file_scan: str, dataType: str, dataFormat: str, Reshape=False, Brain_Mask=None, Normalization=None, dir_cache=None):
+    """
+    Get the file of a preprocessed scan in a scan cache, addressed by the path, size and modification time of the scan files, the brain mask and preprocessing settings
+
+    :param file_scan: directory of a single scan, or two files separated by ';' for MGH surface data
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: 'HCP Surface (*.cifti, *.mat)', 'MGH Surface (*.mgh)', 'MGZ Surface (*.mgz)', 'Volume (*.nii, *.nii.gz, *.mat)', 'HCP Surface-Volume (*.cifti)', 'HCP Volume (*.cifti)'
+    :param Reshape: False or True, whether to reshape 4D volume-based fMRI data to 2D
+    :param Brain_Mask: None or a brain mask [X Y Z]
+    :param Normalization: None, False, 'vp-vmax'
+    :param dir_cache: directory of the scan cache
+    :return: file_cache, a .npy file in dir_cache
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    key = hashlib.sha1()
+    for file in str.split(file_scan, ';'):
+        stat = os.stat(file)
+        key.update(f'{os.path.abspath(file)}|{stat.st_size}|{stat.st_mtime_ns}|'.encode())
+    key.update(f'{dataType}|{dataFormat}|{bool(Reshape)}|{Normalization if Normalization else None}|'.encode())
+    # Brain_Mask is only used to reshape 4D volume data
+    if dataFormat == 'Volume (*.nii, *.nii.gz, *.mat)' and Reshape and Brain_Mask is not None:
+        key.update(str(np.shape(Brain_Mask)).encode())
+        key.update(np.packbits(np.asarray(Brain_Mask) > 0).tobytes())
+    return os.path.join(dir_cache, key.hexdigest() + '.npy')
+
+
+def evict_scan_cache(dir_cache: str, maxSize=None):
+    """
+    Remove least recently used files in a scan cache until its total size is within maxSize
+
+    :param dir_cache: directory of the scan cache
+    :param maxSize: None or a positive number in GB. None does not remove any file
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    if maxSize is None:
+        return
+    list_file = []
+    for file in os.listdir(dir_cache):
+        if file.endswith('.npy'):
+            try:
+                stat = os.stat(os.path.join(dir_cache, file))
+                list_file.append((stat.st_mtime, stat.st_size, os.path.join(dir_cache, file)))
+            except FileNotFoundError:
+                continue
+    size = sum([item[1] for item in list_file])
+    # Recently used files have newer modification time
+    for _, fileSize, file in sorted(list_file):
+        if size <= maxSize * 1024 ** 3:
+            break
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        size -= fileSize
+
+
+def load_fmri_single_scan_cache(file_scan: str, dataType: str, dataFormat: str, Reshape=False, Brain_Mask=None, Normalization=None, dir_cache=None, maxSize=None):
+    """
+    Load a single fMRI scan with optional normalization through a scan cache
+    A cached scan is memory-mapped in copy-on-write mode without reading or preprocessing its original files, and returned as a np.ndarray view. Otherwise, it is loaded by load_fmri_single_scan, normalized, and saved into the cache
+
+    :param file_scan: directory of a single scan, or two files separated by ';' for MGH surface data
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: 'HCP Surface (*.cifti, *.mat)', 'MGH Surface (*.mgh)', 'MGZ Surface (*.mgz)', 'Volume (*.nii, *.nii.gz, *.mat)', 'HCP Surface-Volume (*.cifti)', 'HCP Volume (*.cifti)'
+    :param Reshape: False or True, whether to reshape 4D volume-based fMRI data to 2D
+    :param Brain_Mask: None or a brain mask [X Y Z]
+    :param Normalization: None, False, 'vp-vmax'
+    :param dir_cache: directory of the scan cache, which can be shared by pNet result folders and processes
+    :param maxSize: None or a positive number in GB, maximum size of the scan cache. Least recently used scans are removed when it is exceeded
+    :return: scan_data: a 2D NumPy array [dim_time dim_space], or 4D [X Y Z dim_time] for volume data without reshape
+
+    By Yuncong Ma, 11/9/2023
+    """
+
+    file_cache = setup_scan_cache_file(file_scan, dataType, dataFormat, Reshape=Reshape, Brain_Mask=Brain_Mask, Normalization=Normalization, dir_cache=dir_cache)
+    if os.path.isfile(file_cache):
+        try:
+            # A plain np.ndarray view of the memory map, as a np.memmap is taken as out-of-core data by gFN_NMF and pFN_NMF
+            scan_data = np.asarray(np.load(file_cache, mmap_mode='c'))
+            # Mark as recently used
+            os.utime(file_cache)
+            return scan_data
+        except (OSError, ValueError):
+            # Removed by another process, or incomplete
+            pass
+
+    scan_data = load_fmri_single_scan(file_scan, dataType, dataFormat, Reshape=Reshape, Brain_Mask=Brain_Mask)
+    if Normalization == 'vp-vmax':
+        scan_data = normalize_data_inplace(scan_data, 'vp', 'vmax')
+
+    # A temporary file is renamed after writing, so that other processes never read an incomplete file
+    os.makedirs(dir_cache, exist_ok=True)
+    file_temp = file_cache[:-len('.npy')] + f'_{os.getpid()}_{id(scan_data)}.tmp'
+    with open(file_temp, 'wb') as file:
+        np.save(file, scan_data)
+    os.replace(file_temp, file_cache)
+    evict_scan_cache(dir_cache, maxSize)
+    return scan_data
+
+
 def load_fmri_scan(file_scan_list: str,
                    dataType: str,
                    dataFormat: str,
@@ -289,10 +692,15 @@ def load_fmri_scan(file_scan_list: str,
                    Brain_Mask=None,
                    Normalization=None,
                    Concatenation=True,
+                   Cache=None,
+                   file_memmap=None,
                    logFile=None):
     """
     Load one or multiple fMRI scans, and concatenate them into a single 2D matrix along the time dimension
     Optional normalization can be added for each scan before concatenation
+    Sizes of all scans are read from file headers first, so that the concatenated data are allocated once and each scan is copied and normalized in its rows
+    With a scan cache, preprocessed scans are read from the cache by load_fmri_single_scan_cache, and a single cached scan is returned as a np.ndarray view of a copy-on-write memory map
+    With file_memmap, the concatenated data are written into a .npy file one scan at a time and returned as a memory map, so that only one scan is kept in memory
 
     :param file_scan_list: Directory of a single txt file storing fMRI file directories, or a directory of a single scan file
     :param dataType: 'Surface', 'Volume', 'Surface-Volume'
@@ -301,8 +709,10 @@ def load_fmri_scan(file_scan_list: str,
     :param Brain_Mask: None or a brain mask [X Y Z]
     :param Normalization: False, 'vp-vmax'
     :param Concatenation: True, False
+    :param Cache: None or a dict {'Enable': True, 'dir_cache': directory of the scan cache, 'maxSize': None or maximum size in GB}
+    :param file_memmap: None or directory of a .npy file to store the concatenated data in 64-bit float, which requires Reshape for volume data
     :param logFile: a log file to save the output
-    :return: Data: a 2D or 4D NumPy array [dim_time dim_space]
+    :return: Data: a 2D or 4D NumPy array [dim_time dim_space], or a np.memmap with file_memmap
 
     By Yuncong Ma, 10/18/2023
     """
@@ -324,153 +734,178 @@ def load_fmri_scan(file_scan_list: str,
     else:
         scan_list = [file_scan_list]
 
+    # Scans after an empty line are not loaded
+    if '' in scan_list:
+        scan_list = scan_list[:scan_list.index('')]
+    if Normalization is not None and Normalization is not False and Normalization != 'vp-vmax':
+        raise ValueError('Unsupported data normalization: ' + Normalization)
+    if len(scan_list) > 1 and not Concatenation:
+        raise ValueError('Only supports to concatenate data for output')
+    if len(scan_list) > 1 and dataType == 'Volume' and Reshape is False:
+        raise ValueError('4D fMRI data must be reshaped to 2D first before concatenation')
+
+    flag_Cache = Cache is not None and Cache.get('Enable', False)
+
+    # Sizes of scans from their file headers, or from cached scans
+    list_shape = None
+    if len(scan_list) > 1 or file_memmap is not None:
+        list_shape = []
+        for scan in scan_list:
+            file_cache = None
+            if flag_Cache:
+                file_cache = setup_scan_cache_file(scan, dataType, dataFormat, Reshape=Reshape, Brain_Mask=Brain_Mask, Normalization=Normalization, dir_cache=Cache['dir_cache'])
+            if file_cache is not None and os.path.isfile(file_cache):
+                list_shape.append(np.load(file_cache, mmap_mode='r').shape)
+            else:
+                list_shape.append(load_fmri_scan_shape(scan, dataType, dataFormat, Reshape=Reshape, Brain_Mask=Brain_Mask))
+        for i in range(1, len(scan_list)):
+            if list_shape[i][1] != list_shape[0][1]:
+                raise ValueError('Scans have different spatial dimensions when loading scan: ' + scan_list[i])
+
     Data = None
+    t0 = 0
     for i in range(len(scan_list)):
-        if len(scan_list[i]) == 0:
-            break
-
         if logFile is not None:
             print(f' loading scan ' + scan_list[i], file=logFile)
 
-        file_list = str.split(scan_list[i], ';')
-        for file in file_list:
-            if not os.path.isfile(file):
-                raise ValueError('The file does not exist: ' + file)
-
-        # Loading a single fMRI scan
-        # 2D or 4D matrix with dimension definition [dim_space dim_time] or [X, Y, Z, T]
-
-        # 'HCP Surface (*.cifti, *.mat)'
-        if dataFormat == 'HCP Surface (*.cifti, *.mat)':
-            if scan_list[i].endswith('.dtseries.nii'):
-                cifti = nib.load(scan_list[i])  # [dim_time dim_space]
-                cifti_data = cifti.get_fdata(dtype=np.float32)
-                # Extract desired parts of the data
-                scan_data = cifti_data[:, range(59412)]
+        if flag_Cache:
+            # Cached scans are already normalized
+            scan_data = load_fmri_single_scan_cache(scan_list[i], dataType, dataFormat, Reshape=Reshape, Brain_Mask=Brain_Mask, Normalization=Normalization,
+                                                    dir_cache=Cache['dir_cache'], maxSize=Cache.get('maxSize', None))
+        else:
+            scan_data = load_fmri_single_scan(scan_list[i], dataType, dataFormat, Reshape=Reshape, Brain_Mask=Brain_Mask)
+        if logFile is not None:
+            print(f' loaded data size is ' + str(scan_data.shape), file=logFile)
 
-            elif scan_list[i].endswith('.mat'):
-                scan_data = load_matlab_single_array(scan_list[i])  # [dim_space dim_time]
-                if scan_data.shape[0] < 59412:
-                    raise ValueError('The MATLAB file contains a 2D matrix with the spatial dimension smaller than 59412 in file ' + scan_list[i])
-                scan_data = scan_data[range(59412), :].T
+        if list_shape is None:
+            # A single scan is normalized in place
+            Data = scan_data
+            if Normalization == 'vp-vmax' and not flag_Cache:
+                Data = normalize_data_inplace(Data, 'vp', 'vmax')
+            break
 
-            else:
-                raise ValueError('Unsupported data format ' + scan_list[i])
-
-        elif dataFormat == 'MGH Surface (*.mgh)':
-            # need to split each line to two directories for left and right hemispheres
-            if len(str.split(scan_list[i], ';')) != 2:
-                raise ValueError("For MGH surface data format, directories of two hemisphere data need to be combined into one line with ';' as separator")
-
-            # get files for two hemispheres
-            file_L = str.split(scan_list[i], ';')[0]
-            file_R = str.split(scan_list[i], ';')[1]
-
-            # check extension
-            if not file_L.endswith('.mgh') or not file_R.endswith('.mgh'):
-                raise ValueError('For MGH surface format, the file extension should be .mgh')
-
-            scan_data = np.array(nib.load(file_L).get_fdata(dtype=np.float32))  # [dim_space, _, _, dim_time]
-            scan_data = np.squeeze(scan_data)
-            scan_data = np.append(scan_data, np.squeeze(np.array(nib.load(file_R).get_fdata(dtype=np.float32))), axis=0)
-            scan_data = scan_data.T
-
-        elif dataFormat == 'MGZ Surface (*.mgz)':
-            mgz = nib.load(scan_list[i])
-            scan_data = mgz.get_fdata(dtype=np.float32)  # [dim_space dim_time]
-            scan_data = np.squeeze(np.array(scan_data)).T
-
-        elif dataFormat == 'Volume (*.nii, *.nii.gz, *.mat)':
-            if len(scan_list) > 1 and Reshape is False and Concatenation:
-                raise ValueError('4D fMRI data must be reshaped to 2D first before concatenation')
-
-            if scan_list[i].endswith('.nii') or scan_list[i].endswith('.nii.gz'):
-                nii = nib.load(scan_list[i])
-                scan_data = nii.get_fdata(dtype=np.float32)
-            elif scan_list[i].endswith('.mat'):
-                scan_data = load_matlab_single_array(scan_list[i])  # [X Y Z dim_time]
-            else:
-                raise ValueError('Unsupported data format ' + scan_list[i])
+        # Combine scans along the time dimension
+        # The Data will be permuted to [dim_time dim_space] for both 2D and 4D matrices
+        if scan_data.shape != tuple(list_shape[i]):
+            raise ValueError('The size of loaded data does not match the file header when loading scan: ' + scan_list[i])
+        if Data is None and file_memmap is not None:
+            # Concatenated data stay on disk
+            Data = np.lib.format.open_memmap(file_memmap, mode='w+', dtype=np.float64, shape=(sum([shape[0] for shape in list_shape]), list_shape[0][1]))
+        elif Data is None:
+            # Concatenated data use the data type of the first scan
+            Data = np.empty((sum([shape[0] for shape in list_shape]), list_shape[0][1]), dtype=scan_data.dtype)
+        elif not np.can_cast(scan_data.dtype, Data.dtype):
+            Data = Data.astype(np.result_type(Data.dtype, scan_data.dtype))
+        Data[t0:t0+scan_data.shape[0], :] = scan_data
+        if Normalization == 'vp-vmax' and not flag_Cache:
+            normalize_data_inplace(Data[t0:t0+scan_data.shape[0], :], 'vp', 'vmax')
+        t0 += scan_data.shape[0]
+        del scan_data
+
+    if file_memmap is not None:
+        Data.flush()
+    if logFile is not None:
+        print('\nConcatenated data is a 2D matrix with size ' + str(Data.shape), file=logFile)
+    return Data
 
-            if Reshape:
-                if Brain_Mask is None:
-                    raise ValueError('Brain_Mask must be provided when Reshape is enabled for 4D fMRI data')
-                scan_data = reshape_fmri_data(scan_data, dataType, Brain_Mask)
 
-        elif dataFormat == 'HCP Surface-Volume (*.cifti)':
-            if scan_list[i].endswith('.dtseries.nii'):
-                cifti = nib.load(scan_list[i])  # [dim_time dim_space]
-                cifti_data = cifti.get_fdata(dtype=np.float32)
-                scan_data = cifti_data
-            else:
-                raise ValueError('Unsupported scan extension for data format HCP Surface-Volume')
+def estimate_fmri_scan_memory(file_scan_list: str, dataType: str, dataFormat: str, Reshape=False, Brain_Mask=None):
+    """
+    Estimate the memory of data loaded by load_fmri_scan from file headers, assuming 8 bytes per element
 
-        elif dataFormat == 'HCP Volume (*.cifti)':
-            if scan_list[i].endswith('.dtseries.nii'):
-                cifti = nib.load(scan_list[i])  # [dim_time dim_space]
-                cifti_data = cifti.get_fdata(dtype=np.float32)
-                scan_data = cifti_data[:, 59412:-1]
-            else:
-                raise ValueError('Unsupported scan extension for data format HCP Volume')
+    :param file_scan_list: Directory of a single txt file storing fMRI file directories, or a directory of a single scan file
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: 'HCP Surface (*.cifti, *.mat)', 'MGH Surface (*.mgh)', 'MGZ Surface (*.mgz)', 'Volume (*.nii, *.nii.gz, *.mat)', 'HCP Surface-Volume (*.cifti)', 'HCP Volume (*.cifti)'
+    :param Reshape: False or True, whether to reshape 4D volume-based fMRI data to 2D
+    :param Brain_Mask: None or a brain mask [X Y Z]
+    :return: nByte, number of bytes
 
-        else:
-            raise ValueError('Unsupported data format ' + dataFormat)
+    By Yuncong Ma, 11/9/2023
+    """
 
-        # scan_data should be in [dim_time dim_space]
-        # Convert to NumPy array
-        if not isinstance(scan_data, np.ndarray):
-            scan_data = np.array(scan_data)
-        if logFile is not None:
-            print(f' loaded data size is ' + str(scan_data.shape), file=logFile)
+    if os.path.isfile(file_scan_list) and file_scan_list.endswith('.txt'):
+        scan_list = [line.replace('\n', '') for line in open(file_scan_list, "r")]
+    else:
+        scan_list = [file_scan_list]
+    if '' in scan_list:
+        scan_list = scan_list[:scan_list.index('')]
+
+    nByte = 0
+    for scan in scan_list:
+        nByte += 8 * int(np.prod(load_fmri_scan_shape(scan, dataType, dataFormat, Reshape=Reshape, Brain_Mask=Brain_Mask)))
+    return nByte
+
+
+def prefetch_fmri_scan(list_file_scan_list: list,
+                       dataType: str,
+                       dataFormat: str,
+                       Reshape=False,
+                       Brain_Mask=None,
+                       Normalization=None,
+                       nPrefetch=2,
+                       maxMemory=None,
+                       Cache=None,
+                       list_logFile=None):
+    """
+    A generator to load data of a list of scan lists using load_fmri_scan, in the order of the list
+    Up to nPrefetch scan lists are loaded in background threads while the caller computes on the data of the current one, so that reading and decompression of files overlap with computation
 
-        # Combine scans along the time dimension
-        # The Data will be permuted to [dim_time dim_space] for both 2D and 4D matrices
-        if i == 0:
-            if dataType in ('Surface', 'Surface-Volume'):
-                if Normalization is not None and Normalization is not False:
-                    if Normalization == 'vp-vmax':
-                        scan_data = normalize_data(scan_data, 'vp', 'vmax')
-                    else:
-                        raise ValueError('Unsupported data normalization: ' + Normalization)
-            elif dataType == 'Volume':
-                if Normalization is not None and Normalization is not False:
-                    if Normalization == 'vp-vmax':
-                        scan_data = normalize_data(scan_data, 'vp', 'vmax')
-                    else:
-                        raise ValueError('Unsupported data normalization: ' + Normalization)
-            Data = scan_data
+    :param list_file_scan_list: a list of inputs to load_fmri_scan, each a txt file storing fMRI file directories or a single scan file
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: 'HCP Surface (*.cifti, *.mat)', 'MGH Surface (*.mgh)', 'MGZ Surface (*.mgz)', 'Volume (*.nii, *.nii.gz, *.mat)', 'HCP Surface-Volume (*.cifti)', 'HCP Volume (*.cifti)'
+    :param Reshape: False or True, whether to reshape 4D volume-based fMRI data to 2D
+    :param Brain_Mask: None or a brain mask [X Y Z]
+    :param Normalization: False, 'vp-vmax'
+    :param nPrefetch: positive integer, maximum number of scan lists loaded ahead of the caller
+    :param maxMemory: None or a positive number in GB, maximum memory of data loaded ahead of the caller, estimated from file headers. One scan list is always loaded ahead even if it exceeds maxMemory
+    :param Cache: None or a dict of the scan cache used by load_fmri_scan
+    :param list_logFile: None or a list of log files, one for each scan list
+    :return: a generator yielding Data, a 2D or 4D NumPy array [dim_time dim_space], for each scan list in order. Errors of loading are raised when their data are reached
 
-        else:
-            if dataType in ('Surface', 'Surface-Volume'):
-                if Data is None or len(Data.shape) != 2 or scan_data.shape[1] != Data.shape[1]:
-                    raise ValueError('Scans have different spatial dimensions when loading scan: ' + scan_list[i])
-                if Normalization is not None and Normalization is not False:
-                    if Normalization == 'vp-vmax':
-                        scan_data = normalize_data(scan_data, 'vp', 'vmax')
-                    else:
-                        raise ValueError('Unsupported data normalization: ' + Normalization)
-
-            elif dataType == 'Volume':
-                if Data is None or len(Data.shape) != 2 or scan_data.shape[1] != Data.shape[1]:
-                    raise ValueError('Scans have different spatial dimensions when loading scan: ' + scan_list[i])
-                if Reshape is False:
-                    raise ValueError('4D volume-based fMRI scans need to be reshaped before concatenation')
-                if Normalization is not None and Normalization is not False:
-                    if Normalization == 'vp-vmax':
-                        scan_data = normalize_data(scan_data, 'vp', 'vmax')
-                    else:
-                        raise ValueError('Unsupported data normalization: ' + Normalization)
-            else:
-                raise ValueError('Unknown dataType: ' + dataType)
+    By Yuncong Ma, 11/9/2023
+    """
 
-            if Concatenation:
-                Data = np.append(Data, scan_data, axis=0)
-            else:
-                raise ValueError('Only supports to concatenate data for output')
+    if nPrefetch < 1:
+        raise ValueError('nPrefetch must be a positive integer')
+    if list_logFile is None:
+        list_logFile = [None] * len(list_file_scan_list)
 
-    if logFile is not None:
-        print('\nConcatenated data is a 2D matrix with size ' + str(Data.shape), file=logFile)
-    return Data
+    # Each entry is (future, estimated bytes) of a scan list loaded ahead, in the order of list_file_scan_list
+    list_pending = []
+    memory = 0
+    i_next = 0
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=nPrefetch + 1)
+    try:
+        for i in range(len(list_file_scan_list)):
+            if len(list_pending) == 0:
+                list_pending.append((executor.submit(load_fmri_scan, list_file_scan_list[i], dataType=dataType, dataFormat=dataFormat,
+                                                     Reshape=Reshape, Brain_Mask=Brain_Mask, Normalization=Normalization, Cache=Cache,
+                                                     logFile=list_logFile[i]), 0))
+                i_next = i + 1
+            future, nByte = list_pending.pop(0)
+            memory -= nByte
+
+            # Submit next scan lists until reaching nPrefetch or maxMemory, while the current one is loaded and used by the caller
+            while i_next < len(list_file_scan_list) and len(list_pending) < nPrefetch:
+                nByte = 0
+                if maxMemory is not None:
+                    nByte = estimate_fmri_scan_memory(list_file_scan_list[i_next], dataType, dataFormat, Reshape=Reshape, Brain_Mask=Brain_Mask)
+                    if len(list_pending) > 0 and memory + nByte > maxMemory * 1024 ** 3:
+                        break
+                list_pending.append((executor.submit(load_fmri_scan, list_file_scan_list[i_next], dataType=dataType, dataFormat=dataFormat,
+                                                     Reshape=Reshape, Brain_Mask=Brain_Mask, Normalization=Normalization, Cache=Cache,
+                                                     logFile=list_logFile[i_next]), nByte))
+                memory += nByte
+                i_next += 1
+
+            Data = future.result()
+            yield Data
+            del Data
+    finally:
+        # Loading ahead is stopped if the caller stops early
+        for future, _ in list_pending:
+            future.cancel()
+        executor.shutdown(wait=True)
 
 
 def compute_brain_surface(file_surfL: str,
@@ -1025,12 +1460,11 @@ def setup_cifti_volume(file_cifti: str,
     for bm in brain_models:
         if bm.model_type == 'CIFTI_MODEL_TYPE_VOXELS':
             print_log('Extracting from ' + bm.brain_structure, logFile=logFile)
-            voxel_indices = bm._voxel_indices_ijk
+            voxel_indices = np.array(bm.voxel_indices_ijk, dtype=np.int64).reshape((-1, 3))
             if volume_mask is None:
                 volume_mask = np.zeros((91, 109, 91), dtype=np.int32)
-            for voxel in voxel_indices:
-                volume_mask[voxel[0], voxel[1], voxel[2]] = count
-                count += 1
+            volume_mask[voxel_indices[:, 0], voxel_indices[:, 1], voxel_indices[:, 2]] = np.arange(count, count + voxel_indices.shape[0])
+            count += voxel_indices.shape[0]
 
     nib.save(nib.Nifti1Image(volume_mask, np.eye(4)), file_output)
     print_log('Created a NIFTI file for CIFTI volume part, the mask value represents the index order', stop=False, logFile=logFile)
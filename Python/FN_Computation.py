@@ -8,63 +8,128 @@ import scipy
 import scipy.io as sio
 import os
 import re
+import shutil
+import json
+import hashlib
 import time
+import socket
+import threading
+import multiprocessing
+import concurrent.futures
 
 # other functions of pNet
 from Data_Input import *
+from Computation_Environment import set_computation_thread, split_computation_thread, check_main_process
 
 
-def mat_corr(X, Y=None, dataPrecision='double'):
+def standardize_column(X, dataPrecision='double'):
     """
-    mat_corr(X, Y=None, dataPrecision='double')
-    Perform corr as in MATLAB, pair-wise Pearson correlation between columns in X and Y
+    standardize_column(X, dataPrecision='double')
+    Center each column and scale it to unit norm, so that Pearson correlations between columns become dot products
+    Columns without variation are filled with NaN, consistent to np.corrcoef
 
-    :param X: 1D or 2D matrix
-    :param Y: 1D or 2D matrix, or None
+    :param X: 1D or 2D matrix, [dim_time, N]
     :param dataPrecision: 'double' or 'single'
+    :return: Z, a 2D matrix [dim_time, N] in the working precision
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+    Z = np.array(X, dtype=np_float)
+    if len(Z.shape) == 1:
+        Z = Z[:, np.newaxis]
+    Z -= np.mean(Z, axis=0, keepdims=True)
+    normZ = np.sqrt(np.sum(Z * Z, axis=0, keepdims=True))
+    normZ[normZ == 0] = np.nan
+    Z /= normZ
+    return Z
+
+
+def mat_corr(X, Y=None, dataPrecision='double', pairwise=False, maxM=12500000):
+    """
+    mat_corr(X, Y=None, dataPrecision='double', pairwise=False, maxM=12500000)
+    Perform corr as in MATLAB, pair-wise Pearson correlation between columns in X and Y
+    Columns of X are standardized once, and only the requested cross block is computed by matrix multiplication over blocks of Y columns
+    Each block of Y holds at most maxM elements, so Y can be a np.memmap (e.g. from np.load(file, mmap_mode='r')) read block by block
+    Without Y, the symmetric correlation matrix of X is computed over blocks of X columns in the same way
+
+    :param X: 1D or 2D matrix, or a 2D np.memmap when Y is None
+    :param Y: 1D or 2D matrix, np.memmap, or None
+    :param dataPrecision: 'double' or 'single', precision for both storage and accumulation
+    :param pairwise: False or True, only compute the correlation between the i-th columns of X and Y, which have the same size
+    :param maxM: maximum number of elements of Y loaded in one block
     X and Y have the same number of rows
-    :return: Corr
+    :return: Corr, [N_X, N_Y], or [N_X] when pairwise is True. 1D inputs drop their dimension in Corr
 
-    Note: this method will use memory as it concatenates X and Y along column direction.
     By Yuncong Ma, 9/5/2023
     """
 
     np_float, np_eps = set_data_precision(dataPrecision)
     if not isinstance(X, np.ndarray):
         X = np.array(X, dtype=np_float)
-    else:
-        X = X.astype(np_float)
-    if Y is not None:
-        if not isinstance(Y, np.ndarray):
-            Y = np.array(Y, dtype=np_float)
-        else:
-            Y = Y.astype(np_float)
+    if Y is not None and not isinstance(Y, np.ndarray):
+        Y = np.array(Y, dtype=np_float)
 
     # Check size of X and Y
     if len(X.shape) > 2 or (Y is not None and len(Y.shape) > 2):
         raise ValueError("X and Y must be 1D or 2D matrices")
     if Y is not None and X.shape[0] != Y.shape[0]:
         raise ValueError("X and Y must have the same number of columns")
-
-    dim_X = X.shape
-    if Y is not None:
-        dim_Y = Y.shape
-        if len(dim_X) == 2 and len(dim_Y) == 2:
-            temp = np.corrcoef(X, Y, rowvar=False)
-            Corr = temp[0:dim_X[1], dim_X[1]:dim_X[1]+dim_Y[1]]
-        elif len(dim_X) == 1 and len(dim_Y) == 2:
-            temp = np.corrcoef(X, Y, rowvar=False)
-            Corr = temp[0, 1:1+dim_Y[1]]
-        elif len(dim_X) == 2 and len(dim_Y) == 1:
-            temp = np.corrcoef(X, Y, rowvar=False)
-            Corr = temp[1:1+dim_X[1], 0]
+    if Y is None and len(X.shape) != 2:
+        raise ValueError("X must be a 2D matrix")
+    if pairwise and (Y is None or X.shape != Y.shape):
+        raise ValueError("X and Y must have the same size in pairwise mode")
+
+    dim_time = X.shape[0]
+    blockSize = max(maxM // max(dim_time, 1), 1)
+    if Y is None:
+        # Symmetric blocks of columns in X, so X can also be a np.memmap in a compact data type
+        N_X = X.shape[1]
+        if N_X <= blockSize:
+            Zx = standardize_column(X, dataPrecision)
+            Corr = Zx.T @ Zx
         else:
-            temp = np.corrcoef(X, Y, rowvar=False)
-            Corr = temp[0, 1]
+            Corr = np.empty((N_X, N_X), dtype=np_float)
+            for i0 in range(0, N_X, blockSize):
+                i1 = min(i0 + blockSize, N_X)
+                Zi = standardize_column(X[:, i0:i1], dataPrecision)
+                Corr[i0:i1, i0:i1] = Zi.T @ Zi
+                for j0 in range(i1, N_X, blockSize):
+                    j1 = min(j0 + blockSize, N_X)
+                    Corr[i0:i1, j0:j1] = Zi.T @ standardize_column(X[:, j0:j1], dataPrecision)
+                    Corr[j0:j1, i0:i1] = Corr[i0:i1, j0:j1].T
+        np.clip(Corr, -1, 1, out=Corr)
+        return Corr
+
+    Zx = standardize_column(X, dataPrecision)
+    flag_1D = len(Y.shape) == 1
+    if flag_1D:
+        Y = Y[:, np.newaxis]
+    N_Y = Y.shape[1]
+    if pairwise:
+        Corr = np.empty(N_Y, dtype=np_float)
     else:
-        if len(X.shape) != 2:
-            raise ValueError("X must be a 2D matrix")
-        Corr = np.corrcoef(X, rowvar=False)
+        Corr = np.empty((Zx.shape[1], N_Y), dtype=np_float)
+    for j0 in range(0, N_Y, blockSize):
+        j1 = min(j0 + blockSize, N_Y)
+        Zy = standardize_column(Y[:, j0:j1], dataPrecision)
+        if pairwise:
+            Corr[j0:j1] = np.einsum('ij,ij->j', Zx[:, j0:j1], Zy)
+        else:
+            Corr[:, j0:j1] = Zx.T @ Zy
+    np.clip(Corr, -1, 1, out=Corr)
+
+    # Drop dimensions of 1D inputs
+    if pairwise:
+        if flag_1D:
+            Corr = Corr[0]
+    elif len(X.shape) == 1 and flag_1D:
+        Corr = Corr[0, 0]
+    elif len(X.shape) == 1:
+        Corr = Corr[0, :]
+    elif flag_1D:
+        Corr = Corr[:, 0]
 
     return Corr
 
@@ -151,7 +216,7 @@ def initialize_u(X, U0, V0, error=1e-4, maxIter=1000, minIter=30, meanFitRatio=0
     """
     initialize_u(X, U0, V0, error=1e-4, maxIter=1000, minIter=30, meanFitRatio=0.1, initConv=1, dataPrecision='double')
 
-    :param X: data, 2D matrix [dim_time, dim_space]
+    :param X: data, 2D matrix [dim_time, dim_space], or blocked data from setup_blocked_data
     :param U0: initial temporal component, 2D matrix [dim_time, k]
     :param V0: initial spatial component, 2D matrix [dim_space, k]
     :param error: data fitting error
@@ -167,10 +232,14 @@ def initialize_u(X, U0, V0, error=1e-4, maxIter=1000, minIter=30, meanFitRatio=0
     """
 
     np_float, np_eps = set_data_precision(dataPrecision)
-    if not isinstance(X, np.ndarray):
-        X = np.array(X, dtype=np_float)
+    if isinstance(X, dict):
+        X_shape = (X['dim_time'], X['dim_space'])
     else:
-        X = X.astype(np_float)
+        if not isinstance(X, np.ndarray):
+            X = np.array(X, dtype=np_float)
+        else:
+            X = X.astype(np_float)
+        X_shape = X.shape
     if not isinstance(U0, np.ndarray):
         U0 = np.array(U0, dtype=np_float)
     else:
@@ -181,30 +250,36 @@ def initialize_u(X, U0, V0, error=1e-4, maxIter=1000, minIter=30, meanFitRatio=0
         V0 = V0.astype(np_float)
 
     # Check the data size of X, U0 and V0
-    if len(X.shape) != 2 or len(U0.shape) != 2 or len(V0.shape) != 2:
+    if len(X_shape) != 2 or len(U0.shape) != 2 or len(V0.shape) != 2:
         raise ValueError("X, U0 and V0 must be 2D matrices")
-    if X.shape[0] != U0.shape[0] or X.shape[1] != V0.shape[0] or U0.shape[1] != V0.shape[1]:
+    if X_shape[0] != U0.shape[0] or X_shape[1] != V0.shape[0] or U0.shape[1] != V0.shape[1]:
         raise ValueError("X, U0 and V0 need to have appropriate sizes")
 
     # Duplicate a copy for iterative update of U and V
     U = U0.copy()
     V = V0.copy()
 
-    newFit = data_fitting_error(X, U, V, 0, 1, dataPrecision)
+    # V is fixed, so XV and VV are computed once
+    # The data fitting error uses the Gram identity to avoid the full-size residual
+    X2 = data_squared_norm(X)
+    XV = data_matmul(X, V, dataPrecision=dataPrecision)
+    VV = V.T @ V
+    UVV = np.empty_like(U)
+
+    newFit = data_fitting_error_gram(X2, U, XV, VV)
     meanFit = newFit / meanFitRatio
 
     maxErr = 1
     for i in range(1, maxIter+1):
-        # update U with fixed V
-        XV = X @ V
-        VV = V.T @ V
-        UVV = U @ VV
-
-        U = U * (XV / np.maximum(UVV, np_eps))
+        # update U with fixed V, in place
+        np.matmul(U, VV, out=UVV)
+        np.maximum(UVV, np_eps, out=UVV)
+        np.divide(XV, UVV, out=UVV)
+        U *= UVV
 
         if i > minIter:
             if initConv:
-                newFit = data_fitting_error(X, U, V, 0, 1, dataPrecision)
+                newFit = data_fitting_error_gram(X2, U, XV, VV)
                 meanFit = meanFitRatio * meanFit + (1 - meanFitRatio) * newFit
                 maxErr = (meanFit - newFit) / meanFit
 
@@ -293,6 +368,245 @@ def data_fitting_error(X, U, V, deltaVU=0, dVordU=1, dataPrecision='double'):
     return Fitting_Error
 
 
+def data_squared_norm(X, maxM=12500000):
+    """
+    data_squared_norm(X, maxM=12500000)
+    Compute the squared Frobenius norm of X in float64, without creating a full-size temporary
+
+    :param X: 2D matrix [dim_time, dim_space], or blocked data from setup_blocked_data
+    :param maxM: maximum number of elements processed in one block of rows
+    :return: X2, a float64 scalar
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if isinstance(X, dict):
+        # computed when setting up blocked data
+        return X['X2']
+
+    dim_time, dim_space = X.shape
+    nRow = int(np.maximum(1, np.floor(maxM / np.maximum(dim_space, 1))))
+    X2 = 0.0
+    for i in range(0, dim_time, nRow):
+        block = X[i:i+nRow, :]
+        X2 += float(np.einsum('ij,ij->', block, block, dtype=np.float64))
+
+    return X2
+
+
+def setup_blocked_data(Data, maxM=12500000, Normalization=True, dataPrecision='double'):
+    """
+    setup_blocked_data(Data, maxM=12500000, Normalization=True, dataPrecision='double')
+    Setup data stored in a memory-mapped array for out-of-core computation, where data are read in blocks of columns (space)
+    Only one block is loaded in memory at a time, with at most maxM elements
+    The vp-vmax normalization of each column is kept as its minimum and range, and applied to each loaded block, same as normalize_data
+
+    :param Data: a memory-mapped 2D matrix [dim_time, dim_space], or directory of a .npy file storing it
+    :param maxM: maximum number of elements in one block of columns
+    :param Normalization: False or True, whether to apply vp-vmax normalization to data
+    :param dataPrecision: 'double' or 'single'
+    :return: blocked, a dict storing the memory-mapped data, normalization, block size, and the squared norm X2 and sum sumX of normalized data
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    if isinstance(Data, str):
+        Data = np.load(Data, mmap_mode='r')
+    if len(Data.shape) != 2:
+        raise ValueError("Data must be a 2D matrix")
+
+    dim_time, dim_space = Data.shape
+    nCol = int(np.maximum(1, np.floor(maxM / np.maximum(dim_time, 1))))
+    blocked = {'Data': Data, 'dim_time': dim_time, 'dim_space': dim_space, 'nCol': nCol, 'dataPrecision': dataPrecision,
+               'minVal': None, 'rangeVal': None}
+
+    # Minimum and range of each column for the vp-vmax normalization
+    if Normalization:
+        minVal = np.empty(dim_space, dtype=np_float)
+        rangeVal = np.empty(dim_space, dtype=np_float)
+        for j in range(0, dim_space, nCol):
+            block = np.asarray(Data[:, j:j+nCol], dtype=np_float)
+            minVal[j:j+nCol] = np.min(block, axis=0)
+            rangeVal[j:j+nCol] = np.maximum(np.max(block, axis=0) - minVal[j:j+nCol], np_eps)
+        blocked['minVal'] = minVal
+        blocked['rangeVal'] = rangeVal
+
+    # Squared norm and sum of the normalized data
+    X2 = 0.0
+    sumX = 0.0
+    for j in range(0, dim_space, nCol):
+        block = get_data_block(blocked, j, j+nCol)
+        X2 += float(np.einsum('ij,ij->', block, block, dtype=np.float64))
+        sumX += float(np.sum(block, dtype=np.float64))
+    blocked['X2'] = X2
+    blocked['sumX'] = sumX
+
+    return blocked
+
+
+def get_data_block(blocked: dict, j0, j1):
+    """
+    get_data_block(blocked: dict, j0, j1)
+    Load columns j0 to j1-1 of blocked data into memory, with normalization applied
+
+    :param blocked: blocked data from setup_blocked_data
+    :param j0: first column
+    :param j1: last column + 1
+    :return: block, 2D matrix [dim_time, j1-j0]
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(blocked['dataPrecision'])
+
+    block = np.array(blocked['Data'][:, j0:j1], dtype=np_float)
+    if blocked['minVal'] is not None:
+        block -= blocked['minVal'][j0:j1]
+        block /= blocked['rangeVal'][j0:j1]
+
+    return block
+
+
+def data_matmul(X, V, out=None, dataPrecision='double'):
+    """
+    data_matmul(X, V, out=None, dataPrecision='double')
+    Compute X @ V for data in memory, a temporal sketch from setup_temporal_sketch, or blocked data from setup_blocked_data
+
+    :param X: data, 2D matrix [dim_time, dim_space] or 3D [nBatch, dim_time, dim_space], or a dict of sketch or blocked data
+    :param V: 2D matrix, [dim_space, K], or 3D [nBatch, dim_space, K]
+    :param out: optional preallocated output, [dim_time, K]
+    :param dataPrecision: 'double' or 'single'
+    :return: out
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if not isinstance(X, dict):
+        return np.matmul(X, V, out=out)
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+    if out is None:
+        out = np.empty((X['dim_time'], V.shape[1]), dtype=np.result_type(np_float, V.dtype))
+
+    if 'Q' in X:
+        # Approximated by Q @ (Xc @ V), which is kept positive as X and V are non-negative
+        np.matmul(X['Q'], X['Xc'] @ V, out=out)
+        np.maximum(out, np_eps, out=out)
+    else:
+        # Accumulate products of blocks along the space dimension
+        out[:] = 0
+        nCol = X['nCol']
+        for j in range(0, X['dim_space'], nCol):
+            out += get_data_block(X, j, j+nCol) @ V[j:j+nCol, :]
+
+    return out
+
+
+def data_matmul_T(X, U, out=None, dataPrecision='double'):
+    """
+    data_matmul_T(X, U, out=None, dataPrecision='double')
+    Compute X' @ U for data in memory, a temporal sketch from setup_temporal_sketch, or blocked data from setup_blocked_data
+
+    :param X: data, 2D matrix [dim_time, dim_space] or 3D [nBatch, dim_time, dim_space], or a dict of sketch or blocked data
+    :param U: 2D matrix, [dim_time, K], or 3D [nBatch, dim_time, K]
+    :param out: optional preallocated output, [dim_space, K]
+    :param dataPrecision: 'double' or 'single'
+    :return: out
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if not isinstance(X, dict):
+        return np.matmul(X.swapaxes(-1, -2), U, out=out)
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+    if out is None:
+        out = np.empty((X['dim_space'], U.shape[1]), dtype=np.result_type(np_float, U.dtype))
+
+    if 'Q' in X:
+        # Approximated by Xc' @ (Q' @ U), which is kept positive as X and U are non-negative
+        np.matmul(X['Xc'].T, X['Q'].T @ U, out=out)
+        np.maximum(out, np_eps, out=out)
+    else:
+        # Each block of columns gives the corresponding rows of X' @ U
+        nCol = X['nCol']
+        for j in range(0, X['dim_space'], nCol):
+            np.matmul(get_data_block(X, j, j+nCol).T, U, out=out[j:j+nCol, :])
+
+    return out
+
+
+def data_fitting_error_gram(X2, U, XV, VV):
+    """
+    data_fitting_error_gram(X2, U, XV, VV)
+    Calculate the data fitting error ||X - UV'||^2 using the identity ||X||^2 - 2tr(U'XV) + tr(U'U V'V)
+    It only needs K-sized reductions, avoiding the [dim_time, dim_space] residual used in data_fitting_error
+
+    :param X2: squared Frobenius norm of X, from data_squared_norm
+    :param U: 2D matrix, [dim_time, K]
+    :param XV: 2D matrix, [dim_time, K], X @ V
+    :param VV: 2D matrix, [K, K], V' @ V
+    :return: Fitting_Error, a float64 scalar
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    UU = U.T @ U
+    Fitting_Error = X2 - 2 * float(np.einsum('ij,ij->', U, XV, dtype=np.float64)) + float(np.einsum('ij,ij->', UU, VV, dtype=np.float64))
+    # Rounding errors may give a tiny negative value for a perfect fit
+    Fitting_Error = np.maximum(Fitting_Error, 0.0)
+
+    return Fitting_Error
+
+
+def compute_objective_SR_NMF(X2, U, V, XV, VV, WV=None, DV=None, alphaS=0, alphaL=0, ard=0, hyperLam=0, dataPrecision='double'):
+    """
+    compute_objective_SR_NMF(X2, U, V, XV, VV, WV=None, DV=None, alphaS=0, alphaL=0, ard=0, hyperLam=0, dataPrecision='double')
+    Calculate the objective function of SR-NMF from products already available in the multiplicative update
+    The data fitting term uses the Gram identity, and the Laplacian term tr(V'LV) uses L = D - W with WV and DV
+
+    :param X2: squared Frobenius norm of X, from data_squared_norm
+    :param U: 2D matrix, [dim_time, K]
+    :param V: 2D matrix, [dim_space, K]
+    :param XV: 2D matrix, [dim_time, K], X @ V
+    :param VV: 2D matrix, [K, K], V' @ V
+    :param WV: 2D matrix, [dim_space, K], W @ V, required when alphaL > 0
+    :param DV: 2D matrix, [dim_space, K], D @ V, required when alphaL > 0
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param hyperLam: coefficient of the ard regularization term
+    :param dataPrecision: 'double' or 'single'
+    :return: LogL, LDf, LSl, L21, ardU
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    dim_time = U.shape[0]
+
+    ardU = 0
+    if ard > 0:
+        su = np.sum(U, axis=0)
+        su[su == 0] = 1
+        ardU = np.sum(np.log(su)) * dim_time * hyperLam
+
+    # V is non-negative, so its l1 norm is the column sum
+    L21 = alphaS * np.sum(np.sum(V, axis=0) / np.maximum(np.sqrt(np.einsum('ij,ij->j', V, V)), np_eps))
+    LDf = data_fitting_error_gram(X2, U, XV, VV)
+    LSl = 0
+    if alphaL > 0:
+        LSl = float(np.einsum('ij,ij->', V, DV, dtype=np.float64)) - float(np.einsum('ij,ij->', V, WV, dtype=np.float64))
+
+    # Objective function
+    LogL = L21 + ardU + LDf + LSl
+
+    return LogL, LDf, LSl, L21, ardU
+
+
 def normalize_u_v(U, V, NormV, Norm, dataPrecision='double'):
     """
     normalize_u_v(U, V, NormV, Norm, dataPrecision='double')
@@ -335,247 +649,894 @@ def normalize_u_v(U, V, NormV, Norm, dataPrecision='double'):
         norms = np.max(V, axis=0)
         norms = np.maximum(norms, np_eps)
 
+    # Broadcasting along the first dimension avoids tiling norms to full size
     if NormV:
-        U = U * np.tile(norms, (dim_time, 1))
-        V = V / np.tile(norms, (dim_space, 1))
+        U = U * norms
+        V = V / norms
     else:
-        U = U / np.tile(norms, (dim_time, 1))
-        V = V * np.tile(norms, (dim_space, 1))
+        U = U / norms
+        V = V * norms
 
     return U, V
 
 
-def construct_Laplacian_gNb(gNb: np.ndarray, dim_space, vxI=0, X=None, alphaL=10, normW=1, dataPrecision='double'):
+def setup_NMF_workspace(dim_time, dim_space, K, dataPrecision='double', nBatch=None):
     """
-    construct_Laplacian_gNb(gNb: np.ndarray, dim_space, vxI=0, X=None, alphaL=10, normW=1, dataPrecision='double')
-    construct Laplacian matrices for Laplacian spatial regularization term
+    setup_NMF_workspace(dim_time, dim_space, K, dataPrecision='double', nBatch=None)
+    Preallocate all buffers used by the multiplicative update of SR-NMF
+    The workspace can be reused for any data with the same size, such as scans of different subjects
 
-    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
-    :param dim_space: dimension of space (number of voxels or vertices)
-    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
-    :param X: fMRI data, a 2D matrix, [dim_time, dim_space]
-    :param alphaL: internal hyper parameter for Laplacian regularization term
-    :param normW: 1 or 2, normalization method for Laplacian matrix W
+    :param dim_time: number of time points
+    :param dim_space: number of nodes (vertex, voxel)
+    :param K: number of FNs
     :param dataPrecision: 'double' or 'single'
-    :return: L, W, D: sparse 2D matrices [dim_space, dim_space]
+    :param nBatch: None or a positive integer. If set, buffers have a leading batch dimension for nBatch subjects
+    :return: workspace, a dict of preallocated arrays
 
-    Yuncong Ma, 9/13/2023
+    Yuncong Ma, 11/9/2023
     """
 
     np_float, np_eps = set_data_precision(dataPrecision)
 
-    # Construct the spatial affinity graph
-    # gNb uses index starting from 1
-    W = scipy.sparse.coo_matrix((np.ones(gNb.shape[0]), (gNb[:, 0] - 1, gNb[:, 1] - 1)), shape=(dim_space, dim_space), dtype=np_float)
-    if vxI > 0:
-        for i in range(gNb.shape[0]):
-            xi = gNb[i, 0] - 1
-            yi = gNb[i, 1] - 1
-            if xi < yi:
-                corrVal = (1.0 + mat_corr(X[:, xi], X[:, yi], dataPrecision)) / 2
-                W[xi, yi] = corrVal
-                W[yi, xi] = corrVal
-
-    # Defining other matrices
-    DCol = np.array(W.sum(axis=1), dtype=np_float).flatten()
-    D = scipy.sparse.spdiags(DCol, 0, dim_space, dim_space)
-    L = D - W
-    if normW > 0:
-        D_mhalf = scipy.sparse.spdiags(np.power(DCol, -0.5), 0, dim_space, dim_space)
-        L = D_mhalf @ L @ D_mhalf * alphaL
-        W = D_mhalf @ W @ D_mhalf * alphaL
-        D = D_mhalf @ D @ D_mhalf * alphaL
+    # Leading batch dimension
+    B = () if nBatch is None else (nBatch,)
+
+    workspace = {'dim_time': dim_time, 'dim_space': dim_space, 'K': K, 'dataPrecision': dataPrecision, 'nBatch': nBatch,
+                 # V update, [dim_space, K]
+                 'XU': np.empty(B + (dim_space, K), dtype=np_float),
+                 'VUU': np.empty(B + (dim_space, K), dtype=np_float),
+                 'tmpV': np.empty(B + (dim_space, K), dtype=np_float),
+                 'maskV': np.empty(B + (dim_space, K), dtype=bool),
+                 'DV': np.empty(B + (dim_space, K), dtype=np_float),
+                 'numV': np.empty(B + (dim_space, K), dtype=np_float),
+                 'prevV': np.empty(B + (dim_space, K), dtype=np_float),
+                 'colV': np.empty(B + (dim_space,), dtype=np_float),
+                 'hessV': np.empty(B + (dim_space,), dtype=np_float),
+                 # U update, [dim_time, K]
+                 'XV': np.empty(B + (dim_time, K), dtype=np_float),
+                 'UVV': np.empty(B + (dim_time, K), dtype=np_float),
+                 'prevU': np.empty(B + (dim_time, K), dtype=np_float),
+                 'colU': np.empty(B + (dim_time,), dtype=np_float),
+                 # [K, K]
+                 'UU': np.empty(B + (K, K), dtype=np_float),
+                 'VV': np.empty(B + (K, K), dtype=np_float),
+                 # [1, K], broadcast along the first dimension of U and V
+                 'normK': np.empty(B + (1, K), dtype=np_float),
+                 'sumK': np.empty(B + (1, K), dtype=np_float),
+                 # Copies of U and V from last iteration
+                 'oldU': np.empty(B + (dim_time, K), dtype=np_float),
+                 'oldV': np.empty(B + (dim_space, K), dtype=np_float),
+                 # Optional support of V, a boolean matrix [dim_space, K], used by the HALS solver
+                 'supportV': None}
+
+    return workspace
+
+
+def setup_temporal_sketch(X, sketchSize, nPower=1, dataPrecision='double'):
+    """
+    setup_temporal_sketch(X, sketchSize, nPower=1, dataPrecision='double')
+    Compress data along the time dimension using a randomized range finder, X ~ Q @ Xc
+    Q has orthonormal columns spanning the dominant temporal subspace of X, so that X' @ U ~ Xc' @ (Q' @ U) and X @ V ~ Q @ (Xc @ V)
+    The cost of these products in SR-NMF is reduced from dim_time * dim_space * K to about sketchSize * (dim_time + dim_space) * K
+
+    :param X: data, 2D matrix [dim_time, dim_space], or blocked data from setup_blocked_data
+    :param sketchSize: positive integer, number of rows of the compressed data, smaller than dim_time
+    :param nPower: number of power iterations to improve the accuracy of Q for slowly decaying spectrum
+    :param dataPrecision: 'double' or 'single'
+    :return: sketch, a dict with Q [dim_time, sketchSize] and Xc [sketchSize, dim_space]
 
-    return L, W, D
+    Yuncong Ma, 11/9/2023
+    """
 
+    np_float, np_eps = set_data_precision(dataPrecision)
 
-def pFN_NMF(Data, gFN, gNb, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-4, normW=1,
-            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, initConv=1, ard=0, eta=0, dataPrecision='double', logFile='Log_pFN_NMF.log'):
+    if isinstance(X, dict):
+        dim_time, dim_space = X['dim_time'], X['dim_space']
+    else:
+        dim_time, dim_space = X.shape
+    sketchSize = int(np.minimum(sketchSize, dim_time))
+
+    # Random projection of rows of X
+    Omega = np.random.standard_normal((dim_space, sketchSize)).astype(np_float)
+    Q, _ = np.linalg.qr(data_matmul(X, Omega, dataPrecision=dataPrecision))
+    del Omega
+    # Power iterations, with orthonormalization in between for numerical stability
+    for _ in range(nPower):
+        Q, _ = np.linalg.qr(data_matmul_T(X, Q, dataPrecision=dataPrecision))
+        Q, _ = np.linalg.qr(data_matmul(X, Q, dataPrecision=dataPrecision))
+
+    Q = Q.astype(np_float)
+    Xc = np.ascontiguousarray(data_matmul_T(X, Q, dataPrecision=dataPrecision).T)
+
+    sketch = {'Q': Q, 'Xc': Xc, 'dim_time': dim_time, 'dim_space': dim_space, 'sketchSize': sketchSize}
+
+    return sketch
+
+
+def normalize_u_v_inplace(U, V, NormV, Norm, workspace, dataPrecision='double'):
     """
-    pFN_NMF(Data, gFN, gNb, maxIter=1000, minIter=30,
-            meanFitRatio=0.1, error=1e-4, normW=1,
-            Alpha=2, Beta=30, alphaS=2, alphaL=10, initConv=1, ard=0, eta=0,
-            dataPrecision='double', logFile='Log_pFN_NMF.log')
-    Compute personalized FNs by spatially-regularized NMF method with group FNs as initialization
+    normalize_u_v_inplace(U, V, NormV, Norm, workspace, dataPrecision='double')
+    Normalize U and V in place, same as normalize_u_v but without allocation
 
-    :param Data: 2D matrix [dim_time, dim_space]. Data will be formatted to Tensor and normalized.
-    :param gFN: group level FNs 2D matrix [dim_space, K], K is the number of functional networks. gFN will be cloned
-    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
-    :param maxIter: maximum iteration number for multiplicative update
-    :param minIter: minimum iteration in case fast convergence
-    :param meanFitRatio: a 0-1 scaler, exponential moving average coefficient, used for the initialization of U when using group initialized V
-    :param error: difference of cost function for convergence
-    :param normW: 1 or 2, normalization method for W used in Laplacian regularization
-    :param Alpha: hyper parameter for spatial sparsity
-    :param Beta: hyper parameter for Laplacian sparsity
-    :param alphaS: internally determined, the coefficient for spatial sparsity based Alpha, data size, K, and gNb
-    :param alphaL: internally determined, the coefficient for Laplacian sparsity based Beta, data size, K, and gNb
-    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
-    :param initConv: flag for convergence of initialization of U
-    :param ard: 0 or 1, flat for combining similar clusters
-    :param eta: a hyper parameter for the ard regularization term
-    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
-    :param logFile: str, directory of a txt log file
-    :return: U and V. U is the temporal components of pFNs, a 2D matrix [dim_time, K], and V is the spatial components of pFNs, a 2D matrix [dim_space, K]
+    :param U: 2D matrix, [Time, k], or 3D [nBatch, Time, k] for a batch, updated in place
+    :param V: 2D matrix, [Space, k], or 3D [nBatch, Space, k] for a batch, updated in place
+    :param NormV: 1 or 0
+    :param Norm: 1 or 2
+    :param workspace: preallocated buffers from setup_NMF_workspace
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-    Yuncong Ma, 9/26/2023
+    Yuncong Ma, 11/9/2023
     """
 
-    # Setup data precision and eps
     np_float, np_eps = set_data_precision(dataPrecision)
-    if not isinstance(gFN, np.ndarray):
-        gFN = np.array(gFN, dype=np_float)
-    else:
-        gFN = gFN.astype(np_float)
-    if not isinstance(Data, np.ndarray):
-        Data = np.array(Data, dype=np_float)
+
+    # Norms of columns, [1, K], or [nBatch, 1, K] for a batch
+    norms = workspace['normK']
+    if Norm == 2:
+        np.einsum('...ij,...ij->...j', V, V, out=norms[..., 0, :])
+        np.sqrt(norms, out=norms)
     else:
-        Data = Data.astype(np_float)
+        np.max(V, axis=-2, out=norms[..., 0, :])
+    np.maximum(norms, np_eps, out=norms)
 
-    # check dimension of Data and gFN
-    if Data.shape[1] != gFN.shape[0]:
-        raise ValueError("The second dimension of Data should match the first dimension of gFn, as they are space dimension")
+    if NormV:
+        U *= norms
+        V /= norms
+    else:
+        U /= norms
+        V *= norms
 
-    K = gFN.shape[1]
 
-    # setup log file
-    logFile = open(logFile, 'a')
-    print(f'\nStart NMF for pFN using NumPy at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+def update_V_SR_NMF(X, U, V, workspace, WV=None, DV=None, alphaS=0, alphaL=0, solver='mu', Laplacian=None, maxInner=10, dataPrecision='double'):
+    """
+    update_V_SR_NMF(X, U, V, workspace, WV=None, DV=None, alphaS=0, alphaL=0, solver='mu', Laplacian=None, maxInner=10, dataPrecision='double')
+    Update V in SR-NMF with fixed U, computed in place with preallocated buffers
+    X' @ U and U' @ U are computed once, and kept in workspace['XU'] and workspace['UU']
+    X, U and V can be stacked along a leading batch dimension, with a workspace for the same nBatch. 'hals' does not support batch
+
+    :param X: data, 2D matrix [dim_time, dim_space], a temporal sketch of data from setup_temporal_sketch, or blocked data from setup_blocked_data
+    :param U: 2D matrix, [dim_time, K]
+    :param V: 2D matrix, [dim_space, K], updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace
+    :param WV: 2D matrix, [dim_space, K], W @ V, required when alphaL > 0
+    :param DV: 2D matrix, [dim_space, K], D @ V, required when alphaL > 0
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param solver: 'mu', 'accelerated_mu' or 'hals'
+        'mu' is the multiplicative update, Eq. 8-11
+        'accelerated_mu' repeats the multiplicative update with the same X' @ U, up to maxInner times
+        'hals' updates columns of V one by one, each to its non-negative minimizer with other columns fixed, with a residual updated after each column
+    :param Laplacian: Laplacian operator from setup_Laplacian_operator, required for 'accelerated_mu' and 'hals' when alphaL > 0
+    :param maxInner: maximum number of inner updates for 'accelerated_mu'
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-    # initialization
-    initV = gFN.copy()
+    Yuncong Ma, 11/9/2023
+    """
 
-    dim_time, dim_space = Data.shape
+    data_matmul_T(X, U, out=workspace['XU'], dataPrecision=dataPrecision)
+    np.matmul(U.swapaxes(-1, -2), U, out=workspace['UU'])
+
+    if solver == 'mu':
+        update_V_SR_NMF_step(V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+
+    elif solver == 'accelerated_mu':
+        # The number of inner updates balances the cost of X' @ U and the cost of one update
+        dim_time = workspace['dim_time']
+        K = workspace['K']
+        nNb = Laplacian['W'].nnz / workspace['dim_space'] if alphaL > 0 else 0
+        nInner = int(np.clip(np.floor(1 + 0.5 * (1 + dim_time / (K + nNb))), 1, maxInner))
+        prevV = workspace['prevV']
+        delta0 = 0
+        for j in range(nInner):
+            if j > 0 and alphaL > 0:
+                WV, DV = apply_Laplacian_operator(Laplacian, V, DV)
+            np.copyto(prevV, V)
+            update_V_SR_NMF_step(V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+            # Stop inner updates when the change of V becomes small compared to the first one
+            prevV -= V
+            delta = np.sqrt(np.einsum('ij,ij->', prevV, prevV))
+            if j == 0:
+                delta0 = delta
+            elif delta <= 0.1 * delta0:
+                break
 
-    # Median number of graph neighbors
-    nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
+    elif solver == 'hals':
+        update_V_SR_NMF_hals(V, workspace, Laplacian=Laplacian, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
 
-    # Use Alpha and Beta to set alphaS and alphaL if they are 0
-    if alphaS == 0 and Alpha > 0:
-        alphaS = np.round(Alpha * dim_time / K)
-    if alphaL == 0 and Beta > 0:
-        alphaL = np.round(Beta * dim_time / K / nM)
+    else:
+        raise ValueError('Unknown solver for SR-NMF: ' + str(solver))
 
-    # Prepare and normalize scan
-    Data = normalize_data(Data, 'vp', 'vmax', dataPrecision)
-    X = Data    # Save memory
 
-    # Construct the spatial affinity graph
-    L, W, D = construct_Laplacian_gNb(gNb, dim_space, vxI, X, alphaL, normW, dataPrecision)
+def update_V_SR_NMF_step(V, workspace, WV=None, DV=None, alphaS=0, alphaL=0, dataPrecision='double'):
+    """
+    update_V_SR_NMF_step(V, workspace, WV=None, DV=None, alphaS=0, alphaL=0, dataPrecision='double')
+    One multiplicative update of V, Eq. 8-11, using workspace['XU'] and workspace['UU']
+
+    :param V: 2D matrix, [dim_space, K], updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace, with XU and UU ready
+    :param WV: 2D matrix, [dim_space, K], W @ V, required when alphaL > 0
+    :param DV: 2D matrix, [dim_space, K], D @ V, required when alphaL > 0
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-    # Initialize V
-    V = np.copy(initV)
-    miv = np.max(V, axis=0)
-    trimInd = V / np.maximum(np.tile(miv, (dim_space, 1)), np_eps) < 5e-2
-    V[trimInd] = 0
+    Yuncong Ma, 11/9/2023
+    """
 
-    # Initialize U
-    U = X @ V / np.tile(np.sum(V, axis=0), (dim_time, 1))
+    np_float, np_eps = set_data_precision(dataPrecision)
 
-    U = initialize_u(X, U, V, error=error, maxIter=100, minIter=minIter, meanFitRatio=meanFitRatio, initConv=initConv)
+    numV = workspace['numV']
+    VUU = workspace['VUU']
+    tmpV = workspace['tmpV']
+
+    np.copyto(numV, workspace['XU'])
+    np.matmul(V, workspace['UU'], out=VUU)
+
+    if alphaS > 0:
+        # V is non-negative, so the l1 norm of each column is its sum
+        colNorm = workspace['normK']
+        colSum = workspace['sumK']
+        np.einsum('...ij,...ij->...j', V, V, out=colNorm[..., 0, :])
+        np.sqrt(colNorm, out=colNorm)
+        np.sum(V, axis=-2, out=colSum[..., 0, :])
+
+        # posTerm = V / max(|V| * ||V||_2, eps)
+        np.multiply(V, colNorm, out=tmpV)
+        np.maximum(tmpV, np_eps, out=tmpV)
+        np.divide(V, tmpV, out=tmpV)
+        tmpV *= 0.5 * alphaS
+        VUU += tmpV
+
+        # negTerm = V * ||V||_1 / max(||V||_2^3, eps)
+        np.power(colNorm, 3, out=colNorm)
+        np.maximum(colNorm, np_eps, out=colNorm)
+        np.divide(colSum, colNorm, out=colSum)
+        colSum *= 0.5 * alphaS
+        np.multiply(V, colSum, out=tmpV)
+        numV += tmpV
+
+    if alphaL > 0:
+        numV += WV
+        VUU += DV
+
+    np.maximum(VUU, np_eps, out=VUU)
+    np.divide(numV, VUU, out=VUU)
+    V *= VUU
+
+
+def update_V_SR_NMF_hals(V, workspace, Laplacian=None, alphaS=0, alphaL=0, dataPrecision='double'):
+    """
+    update_V_SR_NMF_hals(V, workspace, Laplacian=None, alphaS=0, alphaL=0, dataPrecision='double')
+    Hierarchical alternating least squares (HALS) update of V, using workspace['XU'] and workspace['UU']
+    Columns of V are updated one by one for k = 1, ..., K. The residual R = X'U - V U'U is computed once,
+    and updated by a rank-1 term after each column, so that each column sees the latest other columns
+    Without regularization, each column is the exact non-negative minimizer with other columns fixed, max(0, R[:, k] / UU[k, k] + V[:, k])
+    The Laplacian term uses D as the diagonal and W @ V[:, k] from the current column, and the L21 term is linearized at the current column
+    If workspace['supportV'] is set, entries outside this support are kept at zero
+
+    :param V: 2D matrix, [dim_space, K], updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace, with XU and UU ready
+    :param Laplacian: Laplacian operator from setup_Laplacian_operator, required when alphaL > 0
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-    initV = V.copy()
+    Yuncong Ma, 11/9/2023
+    """
 
-    # Alternative update of U and V
-    # Variables
+    np_float, np_eps = set_data_precision(dataPrecision)
 
-    if ard > 0:
-        lambdas = np.sum(U, axis=0) / dim_time
-        hyperLam = eta * np.sum(np.power(X, 2)) / (dim_time * dim_space * 2)
-    else:
-        lambdas = 0
-        hyperLam = 0
+    UU = workspace['UU']
+    newV = workspace['colV']
+    hess = workspace['hessV']
+    tmpV = workspace['tmpV']
 
-    flagQC = 0
-    oldLogL = np.inf
-    oldU = U.copy()
-    oldV = V.copy()
-    #  Multiplicative update of U and V
-    for i in range(1, 1+maxIter):
-        # ===================== update V ========================
-        # Eq. 8-11
-        XU = X.T @ U
-        UU = U.T @ U
-        VUU = V @ UU
+    # Residual R = X'U - V U'U, [dim_space, K]
+    R = workspace['VUU']
+    np.matmul(V, UU, out=R)
+    np.subtract(workspace['XU'], R, out=R)
 
-        tmpl2 = np.power(V, 2)
+    for k in range(workspace['K']):
+        v = V[:, k]
 
+        # Numerator of the column update, X'U[:, k] - sum_{j != k} V[:, j] UU[j, k]
+        np.multiply(v, UU[k, k], out=newV)
+        newV += R[:, k]
+        if alphaL > 0:
+            newV += Laplacian['W'] @ v
         if alphaS > 0:
-            tmpl21 = np.sqrt(tmpl2)
-            tmpl22 = np.tile(np.sqrt(np.sum(tmpl2, axis=0)), (dim_space, 1))
-            tmpl21s = np.tile(np.sum(tmpl21, axis=0), (dim_space, 1))
-            posTerm = V / np.maximum(tmpl21 * tmpl22, np_eps)
-            negTerm = V * tmpl21s / np.maximum(np.power(tmpl22, 3), np_eps)
-
-            VUU = VUU + 0.5 * alphaS * posTerm
-            XU = XU + 0.5 * alphaS * negTerm
+            colNorm = np.maximum(np.sqrt(np.dot(v, v)), np_eps)
+            newV -= 0.5 * alphaS / colNorm
+            newV += (0.5 * alphaS * np.sum(v) / colNorm ** 3) * v
 
+        # Diagonal of the column subproblem
         if alphaL > 0:
-            WV = W @ V.astype(np.float64)
-            DV = D @ V.astype(np.float64)
+            np.add(Laplacian['D'], UU[k, k], out=hess)
+        else:
+            hess.fill(UU[k, k])
+        np.maximum(hess, np_eps, out=hess)
 
-            XU = XU + WV
-            VUU = VUU + DV
+        np.divide(newV, hess, out=newV)
+        np.maximum(newV, 0, out=newV)
+        # Zeros in V cannot change in the multiplicative update, so they are kept for the same sparsity pattern
+        if workspace['supportV'] is not None:
+            np.multiply(newV, workspace['supportV'][:, k], out=newV)
 
-        V = V * (XU / np.maximum(VUU, np_eps))
+        # Rank-1 update of the residual with the change of this column
+        np.subtract(newV, v, out=hess)
+        np.multiply(hess[:, None], UU[k, :], out=tmpV)
+        R -= tmpV
+        np.copyto(v, newV)
 
-        # Prune V if empty components are found in V
-        # This is almost impossible to happen without combining FNs
-        prunInd = np.sum(V != 0, axis=0) == 1
-        if np.any(prunInd):
-            V[:, prunInd] = np.zeros((dim_space, np.sum(prunInd)))
-            U[:, prunInd] = np.zeros((dim_time, np.sum(prunInd)))
 
-        # normalize U and V
-        U, V = normalize_u_v(U, V, 1, 1, dataPrecision)
+def update_U_SR_NMF(X, U, V, workspace, ard=0, lambdas=0, hyperLam=0, solver='mu', maxInner=10, dataPrecision='double'):
+    """
+    update_U_SR_NMF(X, U, V, workspace, ard=0, lambdas=0, hyperLam=0, solver='mu', maxInner=10, dataPrecision='double')
+    Update U in SR-NMF with fixed V, computed in place with preallocated buffers
+    X @ V and V' @ V are kept in workspace['XV'] and workspace['VV'] for the objective function
+    X, U and V can be stacked along a leading batch dimension, with a workspace for the same nBatch. 'hals' does not support batch
+
+    :param X: data, 2D matrix [dim_time, dim_space], a temporal sketch of data from setup_temporal_sketch, or blocked data from setup_blocked_data
+    :param U: 2D matrix, [dim_time, K], updated in place
+    :param V: 2D matrix, [dim_space, K]
+    :param workspace: preallocated buffers from setup_NMF_workspace
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param lambdas: 1D vector [K] or a scalar, used for the ard term
+    :param hyperLam: coefficient of the ard regularization term
+    :param solver: 'mu', 'accelerated_mu' or 'hals', see update_V_SR_NMF
+    :param maxInner: maximum number of inner updates for 'accelerated_mu'
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-        # ===================== update U =========================
-        XV = X @ V
-        VV = V.T @ V
-        UVV = U @ VV
+    Yuncong Ma, 11/9/2023
+    """
 
-        if ard > 0:  # ard term for U
-            posTerm = 1 / np.maximum(np.tile(lambdas, (dim_time, 1)), np_eps)
+    data_matmul(X, V, out=workspace['XV'], dataPrecision=dataPrecision)
+    np.matmul(V.swapaxes(-1, -2), V, out=workspace['VV'])
+
+    if solver == 'mu':
+        update_U_SR_NMF_step(U, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, dataPrecision=dataPrecision)
+
+    elif solver == 'accelerated_mu':
+        # The number of inner updates balances the cost of X @ V and the cost of one update
+        nInner = int(np.clip(np.floor(1 + 0.5 * (1 + workspace['dim_space'] / (workspace['K'] + 1))), 1, maxInner))
+        prevU = workspace['prevU']
+        delta0 = 0
+        for j in range(nInner):
+            np.copyto(prevU, U)
+            update_U_SR_NMF_step(U, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, dataPrecision=dataPrecision)
+            # Stop inner updates when the change of U becomes small compared to the first one
+            prevU -= U
+            delta = np.sqrt(np.einsum('ij,ij->', prevU, prevU))
+            if j == 0:
+                delta0 = delta
+            elif delta <= 0.1 * delta0:
+                break
 
-            UVV = UVV + posTerm * hyperLam
+    elif solver == 'hals':
+        update_U_SR_NMF_hals(U, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, dataPrecision=dataPrecision)
 
-        U = U * (XV / np.maximum(UVV, np_eps))
+    else:
+        raise ValueError('Unknown solver for SR-NMF: ' + str(solver))
 
-        # Prune U if empty components are found in U
-        # This is almost impossible to happen without combining FNs
-        prunInd = np.sum(U, axis=0) == 0
-        if np.any(prunInd):
-            V[:, prunInd] = np.zeros((dim_space, np.sum(prunInd)))
-            U[:, prunInd] = np.zeros((dim_time, np.sum(prunInd)))
 
-        # update lambda
-        if ard > 0:
-            lambdas = np.sum(U, axis=0) / dim_time
+def update_U_SR_NMF_step(U, workspace, ard=0, lambdas=0, hyperLam=0, dataPrecision='double'):
+    """
+    update_U_SR_NMF_step(U, workspace, ard=0, lambdas=0, hyperLam=0, dataPrecision='double')
+    One multiplicative update of U, using workspace['XV'] and workspace['VV']
 
-        # ==== calculate objective function value ====
-        ardU = 0
-        tmp2 = 0
-        tmpl21 = np.power(V, 2)
+    :param U: 2D matrix, [dim_time, K], updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace, with XV and VV ready
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param lambdas: 1D vector [K] or a scalar, used for the ard term
+    :param hyperLam: coefficient of the ard regularization term
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-        if ard > 0:
-            su = np.sum(U, axis=0)
-            su[su == 0] = 1
-            ardU = np.sum(np.log(su)) * dim_time * hyperLam
+    Yuncong Ma, 11/9/2023
+    """
 
-        if alphaL > 0:
-            tmp2 = V.T @ L * V.T
+    np_float, np_eps = set_data_precision(dataPrecision)
 
-        L21 = alphaS * np.sum(np.sum(np.sqrt(tmpl21), axis=0) / np.maximum(np.sqrt(np.sum(tmpl21, axis=0)), np_eps))
-        # LDf = data_fitting_error(X, U, V, 0, 1)
-        LDf = np.sum(np.power(X - U @ V.T, 2))
-        LSl = np.sum(tmp2)
+    UVV = workspace['UVV']
+    np.matmul(U, workspace['VV'], out=UVV)
 
-        # Objective function
-        LogL = L21 + ardU + LDf + LSl
-        print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile)
+    if ard > 0:  # ard term for U
+        UVV += hyperLam / np.maximum(lambdas, np_eps)
 
-        # The iteration needs to meet minimum iteration number and small changes of LogL
-        if i > minIter and abs(oldLogL - LogL) / np.maximum(oldLogL, np_eps) < error:
+    np.maximum(UVV, np_eps, out=UVV)
+    np.divide(workspace['XV'], UVV, out=UVV)
+    U *= UVV
+
+
+def update_U_SR_NMF_hals(U, workspace, ard=0, lambdas=0, hyperLam=0, dataPrecision='double'):
+    """
+    update_U_SR_NMF_hals(U, workspace, ard=0, lambdas=0, hyperLam=0, dataPrecision='double')
+    Hierarchical alternating least squares (HALS) update of U, using workspace['XV'] and workspace['VV']
+    Columns of U are updated one by one for k = 1, ..., K, each to the exact non-negative minimizer with other columns fixed
+    The residual R = XV - U V'V is computed once, and updated by a rank-1 term after each column
+
+    :param U: 2D matrix, [dim_time, K], updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace, with XV and VV ready
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param lambdas: 1D vector [K] or a scalar, used for the ard term
+    :param hyperLam: coefficient of the ard regularization term
+    :param dataPrecision: 'double' or 'single'
+    :return: None
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    VV = workspace['VV']
+    newU = workspace['colU']
+    tmpU = workspace['prevU']
+    if ard > 0:
+        ardTerm = hyperLam / np.maximum(np.broadcast_to(lambdas, (workspace['K'],)), np_eps)
+
+    # Residual R = XV - U V'V, [dim_time, K]
+    R = workspace['UVV']
+    np.matmul(U, VV, out=R)
+    np.subtract(workspace['XV'], R, out=R)
+
+    for k in range(workspace['K']):
+        u = U[:, k]
+
+        # u = max(0, u + (R[:, k] - ardTerm[k]) / VV[k, k])
+        np.copyto(newU, R[:, k])
+        if ard > 0:
+            newU -= ardTerm[k]
+        newU /= np.maximum(VV[k, k], np_eps)
+        newU += u
+        np.maximum(newU, 0, out=newU)
+
+        # Rank-1 update of the residual with the change of this column
+        np.subtract(newU, u, out=u)
+        np.multiply(u[:, None], VV[k, :], out=tmpU)
+        R -= tmpU
+        np.copyto(u, newU)
+
+
+def compute_edge_correlation(X, row, col, maxM=12500000, dataPrecision='double'):
+    """
+    compute_edge_correlation(X, row, col, maxM=12500000, dataPrecision='double')
+    Compute the temporal Pearson correlation between the two nodes of each edge in a graph
+    Nodes are z-scored once, and correlations are dot products of z-scored time series, computed over blocks of edges
+    Each block gathers at most maxM elements of time series for each side of its edges
+
+    :param X: fMRI data, a 2D matrix, [dim_time, dim_space]
+    :param row: 1D vector [N], node index of one side of each edge, starting from 0
+    :param col: 1D vector [N], node index of the other side of each edge, starting from 0
+    :param maxM: maximum number of elements gathered in one block
+    :param dataPrecision: 'double' or 'single'
+    :return: edgeCorr, a 1D vector [N]. Nodes without temporal variation have zero correlation to other nodes
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    # z-scored time series of each node, stored by rows for gathering
+    Z = np.array(np.transpose(X), dtype=np_float, order='C')
+    Z -= np.mean(Z, axis=1, keepdims=True)
+    normZ = np.sqrt(np.sum(Z * Z, axis=1, keepdims=True))
+    Z = np.divide(Z, normZ, out=np.zeros_like(Z), where=normZ > 0)
+
+    nEdge = len(row)
+    edgeCorr = np.empty(nEdge, dtype=np_float)
+    blockSize = max(maxM // Z.shape[1], 1)
+    for j0 in range(0, nEdge, blockSize):
+        j1 = min(j0 + blockSize, nEdge)
+        edgeCorr[j0:j1] = np.einsum('ij,ij->i', Z[row[j0:j1]], Z[col[j0:j1]])
+
+    return edgeCorr
+
+
+def setup_Laplacian_operator(gNb: np.ndarray, dim_space, vxI=0, X=None, alphaL=1, normW=1, dataPrecision='double', edgeCorr=None):
+    """
+    setup_Laplacian_operator(gNb: np.ndarray, dim_space, vxI=0, X=None, alphaL=1, normW=1, dataPrecision='double', edgeCorr=None)
+    Construct the Laplacian operator L = D - W for the Laplacian spatial regularization term
+    W is stored as a CSR matrix and D as a vector, both in the working precision
+    Without vxI, the operator only depends on gNb, so it can be built once and shared by all bootstrap runs and subjects,
+    using scale_Laplacian_operator to set alphaL for each data
+    With vxI, edges are weighted by (1 + r) / 2, with r the temporal correlation between the two nodes, see compute_edge_correlation
+
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param dim_space: dimension of space (number of voxels or vertices)
+    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
+    :param X: fMRI data, a 2D matrix, [dim_time, dim_space], required when vxI > 0 and edgeCorr is None
+    :param alphaL: internal hyper parameter for Laplacian regularization term
+    :param normW: 1 or 2, normalization method for Laplacian matrix W
+    :param dataPrecision: 'double' or 'single'
+    :param edgeCorr: None or precomputed temporal correlations of edges in gNb, a 1D vector [N], used when vxI > 0
+    :return: Laplacian, a dict with W (CSR matrix [dim_space, dim_space]), D (1D vector [dim_space]), alphaL, normW, vxI and dataPrecision
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    # gNb uses index starting from 1
+    row = np.asarray(gNb[:, 0], dtype=np.int64) - 1
+    col = np.asarray(gNb[:, 1], dtype=np.int64) - 1
+
+    # Edge weights of the spatial affinity graph
+    if vxI > 0:
+        if edgeCorr is None:
+            if X is None:
+                raise ValueError('X is required to construct the Laplacian operator when vxI > 0')
+            edgeCorr = compute_edge_correlation(X, row, col, dataPrecision=dataPrecision)
+        weight = ((1.0 + np.asarray(edgeCorr)) / 2).astype(np_float)
+    else:
+        weight = np.ones(gNb.shape[0], dtype=np_float)
+
+    # Duplicated edges are summed as in a COO matrix
+    W = scipy.sparse.csr_matrix((weight, (row, col)), shape=(dim_space, dim_space), dtype=np_float)
+    W.sum_duplicates()
+    D = np.asarray(W.sum(axis=1), dtype=np_float).flatten()
+
+    if normW > 0:
+        # Symmetric normalization D^-1/2 (D - W) D^-1/2, scaled by alphaL
+        # Isolated nodes have no edges, and are kept at zero
+        D_mhalf = np.zeros(dim_space, dtype=np_float)
+        D_mhalf[D > 0] = np.power(D[D > 0], -0.5)
+        W_row = np.repeat(np.arange(dim_space), np.diff(W.indptr))
+        W.data *= D_mhalf[W_row] * D_mhalf[W.indices] * alphaL
+        D = (D * D_mhalf * D_mhalf * alphaL).astype(np_float)
+
+    Laplacian = {'W': W, 'D': D, 'alphaL': alphaL, 'normW': normW, 'vxI': vxI, 'dataPrecision': dataPrecision}
+
+    return Laplacian
+
+
+def scale_Laplacian_operator(Laplacian: dict, alphaL, dataPrecision='double'):
+    """
+    scale_Laplacian_operator(Laplacian: dict, alphaL, dataPrecision='double')
+    Get a Laplacian operator with a different alphaL, sharing the sparse structure of the input one
+    alphaL only scales the operator when normW > 0, consistent to construct_Laplacian_gNb
+
+    :param Laplacian: a Laplacian operator from setup_Laplacian_operator
+    :param alphaL: internal hyper parameter for Laplacian regularization term
+    :param dataPrecision: 'double' or 'single'
+    :return: Laplacian, a new dict
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    W = Laplacian['W']
+    if Laplacian['normW'] > 0:
+        ratio = alphaL / Laplacian['alphaL']
+    else:
+        ratio = 1
+    if ratio == 1 and W.dtype == np_float:
+        return dict(Laplacian, alphaL=alphaL)
+
+    W = scipy.sparse.csr_matrix(((W.data * ratio).astype(np_float), W.indices, W.indptr), shape=W.shape)
+    D = (Laplacian['D'] * ratio).astype(np_float)
+
+    return dict(Laplacian, W=W, D=D, alphaL=alphaL, dataPrecision=dataPrecision)
+
+
+def apply_Laplacian_operator(Laplacian: dict, V, DV=None):
+    """
+    apply_Laplacian_operator(Laplacian: dict, V, DV=None)
+    Compute W @ V and D @ V with a Laplacian operator, so that L @ V = DV - WV
+
+    :param Laplacian: a Laplacian operator from setup_Laplacian_operator
+    :param V: 2D matrix, [dim_space, K], or 3D [nBatch, dim_space, K] for a batch
+    :param DV: optional 2D matrix, [dim_space, K], or 3D [nBatch, dim_space, K], preallocated output for D @ V
+    :return: WV, DV
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if V.ndim == 3:
+        # A batch of V, [nBatch, dim_space, K], is multiplied as one [dim_space, nBatch*K] matrix
+        nBatch, dim_space, K = V.shape
+        WV = (Laplacian['W'] @ V.transpose(1, 0, 2).reshape(dim_space, nBatch * K)).reshape(dim_space, nBatch, K).transpose(1, 0, 2)
+    else:
+        WV = Laplacian['W'] @ V
+    if DV is None:
+        DV = np.empty_like(V)
+    np.multiply(Laplacian['D'][:, np.newaxis], V, out=DV)
+
+    return WV, DV
+
+
+def construct_Laplacian_gNb(gNb: np.ndarray, dim_space, vxI=0, X=None, alphaL=10, normW=1, dataPrecision='double'):
+    """
+    construct_Laplacian_gNb(gNb: np.ndarray, dim_space, vxI=0, X=None, alphaL=10, normW=1, dataPrecision='double')
+    construct Laplacian matrices for Laplacian spatial regularization term
+
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param dim_space: dimension of space (number of voxels or vertices)
+    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
+    :param X: fMRI data, a 2D matrix, [dim_time, dim_space]
+    :param alphaL: internal hyper parameter for Laplacian regularization term
+    :param normW: 1 or 2, normalization method for Laplacian matrix W
+    :param dataPrecision: 'double' or 'single'
+    :return: L, W, D: sparse 2D matrices [dim_space, dim_space]
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    Laplacian = setup_Laplacian_operator(gNb, dim_space, vxI=vxI, X=X, alphaL=alphaL, normW=normW, dataPrecision=dataPrecision)
+    W = Laplacian['W']
+    D = scipy.sparse.diags(Laplacian['D'], 0, shape=(dim_space, dim_space), format='csr')
+    L = D - W
+
+    return L, W, D
+
+
+def save_NMF_checkpoint(file_checkpoint: str, U, V, Iter, LogL, fingerprint=''):
+    """
+    save_NMF_checkpoint(file_checkpoint: str, U, V, Iter, LogL, fingerprint='')
+    Save U and V of an NMF iteration into a .npz file
+
+    :param file_checkpoint: directory of the .npz file
+    :param U: 2D matrix [dim_time, K], numpy.ndarray
+    :param V: 2D matrix [dim_space, K], numpy.ndarray
+    :param Iter: the iteration number of U and V
+    :param LogL: the objective function value of U and V
+    :param fingerprint: a str identifying inputs and settings
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Write to a temporary file first, so that a preempted job never leaves an incomplete checkpoint
+    file_temp = file_checkpoint + '.tmp'
+    with open(file_temp, 'wb') as file:
+        np.savez(file, U=U, V=V, Iter=Iter, LogL=LogL, Fingerprint=fingerprint)
+    os.replace(file_temp, file_checkpoint)
+
+
+def load_NMF_checkpoint(file_checkpoint: str, fingerprint=''):
+    """
+    load_NMF_checkpoint(file_checkpoint: str, fingerprint='')
+    Load U and V saved by save_NMF_checkpoint
+
+    :param file_checkpoint: directory of the .npz file
+    :param fingerprint: a str identifying inputs and settings
+    :return: checkpoint, a dict with keys 'U', 'V', 'Iter' and 'LogL', or None if the file does not exist or has a different fingerprint
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if not os.path.isfile(file_checkpoint):
+        return None
+    with np.load(file_checkpoint) as file:
+        if str(file['Fingerprint']) != fingerprint:
+            return None
+        checkpoint = {'U': file['U'], 'V': file['V'], 'Iter': int(file['Iter']), 'LogL': float(file['LogL'])}
+
+    return checkpoint
+
+
+def pFN_NMF(Data, gFN, gNb, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-4, normW=1,
+            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, initConv=1, ard=0, eta=0, solver='mu', Laplacian=None, maxM=12500000,
+            initUV=None, file_checkpoint=None, checkpointInterval=600, fingerprint='', dataPrecision='double', logFile='Log_pFN_NMF.log'):
+    """
+    pFN_NMF(Data, gFN, gNb, maxIter=1000, minIter=30,
+            meanFitRatio=0.1, error=1e-4, normW=1,
+            Alpha=2, Beta=30, alphaS=2, alphaL=10, initConv=1, ard=0, eta=0, solver='mu', Laplacian=None, maxM=12500000,
+            initUV=None, file_checkpoint=None, checkpointInterval=600, fingerprint='',
+            dataPrecision='double', logFile='Log_pFN_NMF.log')
+    Compute personalized FNs by spatially-regularized NMF method with group FNs as initialization
+    Data can be a memory-mapped array for out-of-core computation, which is read in blocks of at most maxM elements, see setup_blocked_data
+    With file_checkpoint, U and V are saved periodically, and a later call with the same fingerprint resumes from the last checkpoint
+    With initUV, it starts from a previous pFN of the same subject computed with the same gFN, see load_warm_start
+
+    :param Data: 2D matrix [dim_time, dim_space]. Data will be formatted to Tensor and normalized. It can also be a memory-mapped array or directory of a .npy file
+    :param gFN: group level FNs 2D matrix [dim_space, K], K is the number of functional networks. gFN will be cloned
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param maxIter: maximum iteration number for multiplicative update
+    :param minIter: minimum iteration in case fast convergence
+    :param meanFitRatio: a 0-1 scaler, exponential moving average coefficient, used for the initialization of U when using group initialized V
+    :param error: difference of cost function for convergence
+    :param normW: 1 or 2, normalization method for W used in Laplacian regularization
+    :param Alpha: hyper parameter for spatial sparsity
+    :param Beta: hyper parameter for Laplacian sparsity
+    :param alphaS: internally determined, the coefficient for spatial sparsity based Alpha, data size, K, and gNb
+    :param alphaL: internally determined, the coefficient for Laplacian sparsity based Beta, data size, K, and gNb
+    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
+    :param initConv: flag for convergence of initialization of U
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param eta: a hyper parameter for the ard regularization term
+    :param solver: 'mu', 'accelerated_mu' or 'hals', the solver for updating U and V, see update_V_SR_NMF
+    :param Laplacian: optional Laplacian operator from setup_Laplacian_operator, shared across runs with the same gNb. Its normW and vxI are used, and it is rescaled to alphaL
+    :param maxM: maximum number of elements in one block of data for out-of-core computation
+    :param initUV: None or a tuple (U, V) of a previous pFN. V replaces the trimmed gFN as initialization. U is used if it has the same number of time points, and then minIter is not applied
+    :param file_checkpoint: None or directory of a .npz file for checkpoints of U and V
+    :param checkpointInterval: minimum number of seconds between two checkpoints
+    :param fingerprint: a str identifying inputs and settings, see compute_unit_fingerprint. A checkpoint with a different fingerprint is ignored
+    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
+    :param logFile: str, directory of a txt log file
+    :return: U and V. U is the temporal components of pFNs, a 2D matrix [dim_time, K], and V is the spatial components of pFNs, a 2D matrix [dim_space, K]
+
+    Yuncong Ma, 9/26/2023
+    """
+
+    # Setup data precision and eps
+    np_float, np_eps = set_data_precision(dataPrecision)
+    if not isinstance(gFN, np.ndarray):
+        gFN = np.array(gFN, dype=np_float)
+    else:
+        gFN = gFN.astype(np_float)
+    flag_OutOfCore = isinstance(Data, (str, np.memmap))
+    if flag_OutOfCore:
+        # Data stay on disk, and normalization is applied to each loaded block
+        X = setup_blocked_data(Data, maxM, dataPrecision=dataPrecision)
+        dim_time, dim_space = X['dim_time'], X['dim_space']
+    else:
+        if not isinstance(Data, np.ndarray):
+            Data = np.array(Data, dype=np_float)
+        else:
+            Data = Data.astype(np_float)
+        dim_time, dim_space = Data.shape
+
+    # check dimension of Data and gFN
+    if dim_space != gFN.shape[0]:
+        raise ValueError("The second dimension of Data should match the first dimension of gFn, as they are space dimension")
+
+    K = gFN.shape[1]
+
+    # setup log file
+    logFile = open(logFile, 'a')
+    print(f'\nStart NMF for pFN using NumPy at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
+    # initialization
+    initV = gFN.copy()
+
+    # Median number of graph neighbors
+    nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
+
+    # Use Alpha and Beta to set alphaS and alphaL if they are 0
+    if alphaS == 0 and Alpha > 0:
+        alphaS = np.round(Alpha * dim_time / K)
+    if alphaL == 0 and Beta > 0:
+        alphaL = np.round(Beta * dim_time / K / nM)
+
+    # Prepare and normalize scan
+    if not flag_OutOfCore:
+        Data = normalize_data(Data, 'vp', 'vmax', dataPrecision)
+        X = Data    # Save memory
+
+    # Construct the spatial affinity graph
+    if flag_OutOfCore and vxI > 0:
+        raise ValueError("vxI is not supported for out-of-core data")
+    if Laplacian is None:
+        Laplacian = setup_Laplacian_operator(gNb, dim_space, vxI, X, alphaL, normW, dataPrecision)
+    else:
+        Laplacian = scale_Laplacian_operator(Laplacian, alphaL, dataPrecision)
+
+    # Initialize V
+    V = np.copy(initV)
+    miv = np.max(V, axis=0)
+    trimInd = V / np.maximum(miv, np_eps) < 5e-2
+    V[trimInd] = 0
+
+    # Resume from a checkpoint of U and V
+    checkpoint = None
+    if file_checkpoint is not None:
+        checkpoint = load_NMF_checkpoint(file_checkpoint, fingerprint)
+        if checkpoint is not None and (checkpoint['U'].shape != (dim_time, K) or checkpoint['V'].shape != (dim_space, K)):
+            checkpoint = None
+
+    # Warm start from a previous pFN
+    flag_WarmStart = False
+    if checkpoint is None and initUV is not None and initUV[1].shape == (dim_space, K):
+        V = np.array(initUV[1], dtype=np_float)
+        V[trimInd] = 0
+        flag_WarmStart = initUV[0].shape == (dim_time, K)
+        print('Warm start from a previous pFN', file=logFile, flush=True)
+
+    # Initialize U
+    if checkpoint is not None:
+        # The initialization of U is skipped
+        U = checkpoint['U']
+        V = checkpoint['V']
+        print(f'Resume from the checkpoint at iteration {checkpoint["Iter"]}', file=logFile, flush=True)
+    elif flag_WarmStart:
+        # U and V start near convergence
+        U = np.array(initUV[0], dtype=np_float)
+        minIter = 1
+    else:
+        U = data_matmul(X, V, dataPrecision=dataPrecision) / np.sum(V, axis=0)
+
+        U = initialize_u(X, U, V, error=error, maxIter=100, minIter=minIter, meanFitRatio=meanFitRatio, initConv=initConv)
+
+    initV = V.copy()
+
+    # Alternative update of U and V
+    # Variables
+
+    # Squared norm of X for the data fitting term, computed once
+    X2 = data_squared_norm(X)
+
+    if ard > 0:
+        lambdas = np.sum(U, axis=0) / dim_time
+        hyperLam = eta * X2 / (dim_time * dim_space * 2)
+    else:
+        lambdas = 0
+        hyperLam = 0
+
+    # Preallocated buffers for the in-place multiplicative update
+    workspace = setup_NMF_workspace(dim_time, dim_space, K, dataPrecision)
+    XV = workspace['XV']
+    VV = workspace['VV']
+    oldU = workspace['oldU']
+    oldV = workspace['oldV']
+    U = np.ascontiguousarray(U, dtype=np_float)
+    V = np.ascontiguousarray(V, dtype=np_float)
+    # Keep the trimmed entries of gFN at zero, as in the multiplicative update
+    workspace['supportV'] = ~trimInd
+
+    # WV and DV are shared by the V update and the objective function
+    WV = None
+    DV = None
+    if alphaL > 0:
+        WV, DV = apply_Laplacian_operator(Laplacian, V, workspace['DV'])
+
+    flagQC = 0
+    oldLogL = np.inf
+    iStart = 1
+    if checkpoint is not None:
+        oldLogL = np_float(checkpoint['LogL'])
+        iStart = checkpoint['Iter'] + 1
+    timeCheckpoint = time.time()
+    np.copyto(oldU, U)
+    np.copyto(oldV, V)
+    #  Multiplicative update of U and V
+    for i in range(iStart, 1+maxIter):
+        # ===================== update V ========================
+        # Eq. 8-11
+        # WV and DV were computed with the current V at the end of last iteration
+        update_V_SR_NMF(X, U, V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, solver=solver, Laplacian=Laplacian, dataPrecision=dataPrecision)
+
+        # Prune V if empty components are found in V
+        # This is almost impossible to happen without combining FNs
+        np.not_equal(V, 0, out=workspace['maskV'])
+        prunInd = np.sum(workspace['maskV'], axis=0) == 1
+        if np.any(prunInd):
+            V[:, prunInd] = 0
+            U[:, prunInd] = 0
+
+        # normalize U and V
+        normalize_u_v_inplace(U, V, 1, 1, workspace, dataPrecision)
+
+        # ===================== update U =========================
+        update_U_SR_NMF(X, U, V, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, solver=solver, dataPrecision=dataPrecision)
+
+        # Prune U if empty components are found in U
+        # This is almost impossible to happen without combining FNs
+        prunInd = np.sum(U, axis=0) == 0
+        if np.any(prunInd):
+            V[:, prunInd] = 0
+            U[:, prunInd] = 0
+
+        # update lambda
+        if ard > 0:
+            lambdas = np.sum(U, axis=0) / dim_time
+
+        # ==== calculate objective function value ====
+        # WV and DV of the updated V are reused in the next V update
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator(Laplacian, V, DV)
+
+        # XV and VV are from the U update, and V has not changed since then
+        LogL, LDf, LSl, L21, ardU = compute_objective_SR_NMF(X2, U, V, XV, VV, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL,
+                                                             ard=ard, hyperLam=hyperLam, dataPrecision=dataPrecision)
+        print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile)
+
+        # The iteration needs to meet minimum iteration number and small changes of LogL
+        if i > minIter and abs(oldLogL - LogL) / np.maximum(oldLogL, np_eps) < error:
             break
         oldLogL = LogL.copy()
 
@@ -588,29 +1549,483 @@ def pFN_NMF(Data, gFN, gNb, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e
 
         if QC_Delta_Sim <= 0:
             flagQC = 1
-            U = oldU.copy()
-            V = oldV.copy()
+            np.copyto(U, oldU)
+            np.copyto(V, oldV)
             print(f'\n  QC: Meet QC constraint: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
             print(f'    Use results from last iteration', file=logFile, flush=True)
             break
         else:
-            oldU = U.copy()
-            oldV = V.copy()
+            np.copyto(oldU, U)
+            np.copyto(oldV, V)
             print(f'        QC: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
 
+            # Save U and V of an accepted iteration
+            if file_checkpoint is not None and time.time() - timeCheckpoint >= checkpointInterval:
+                save_NMF_checkpoint(file_checkpoint, U, V, i, oldLogL, fingerprint)
+                timeCheckpoint = time.time()
+
     print(f'\n Finished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
 
     return U, V
 
 
+def pFN_NMF_batch(Data_list, gFN, gNb, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-4, normW=1,
+                  Alpha=2, Beta=30, alphaS=0, alphaL=0, initConv=1, ard=0, eta=0, Laplacian=None, dataPrecision='double', logFile_list=None):
+    """
+    pFN_NMF_batch(Data_list, gFN, gNb, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-4, normW=1,
+                  Alpha=2, Beta=30, alphaS=0, alphaL=0, initConv=1, ard=0, eta=0, Laplacian=None, dataPrecision='double', logFile_list=None)
+    Compute personalized FNs for a batch of subjects together, using the same multiplicative update as pFN_NMF
+    Data of all subjects are stacked into a 3D matrix [nBatch, dim_time, dim_space], so that updates use batched matrix multiplications
+    Each subject has its own convergence and QC check, and leaves the batch once finished
+    vxI is not supported, as the Laplacian operator is shared by all subjects
+
+    :param Data_list: a list of 2D matrices [dim_time, dim_space], with the same dim_time
+    :param gFN: group level FNs 2D matrix [dim_space, K], K is the number of functional networks
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param maxIter: maximum iteration number for multiplicative update
+    :param minIter: minimum iteration in case fast convergence
+    :param meanFitRatio: a 0-1 scaler, exponential moving average coefficient, used for the initialization of U when using group initialized V
+    :param error: difference of cost function for convergence
+    :param normW: 1 or 2, normalization method for W used in Laplacian regularization
+    :param Alpha: hyper parameter for spatial sparsity
+    :param Beta: hyper parameter for Laplacian sparsity
+    :param alphaS: internally determined, the coefficient for spatial sparsity based Alpha, data size, K, and gNb
+    :param alphaL: internally determined, the coefficient for Laplacian sparsity based Beta, data size, K, and gNb
+    :param initConv: flag for convergence of initialization of U
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param eta: a hyper parameter for the ard regularization term
+    :param Laplacian: optional Laplacian operator from setup_Laplacian_operator. It is rescaled to alphaL
+    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
+    :param logFile_list: None or a list of str, directories of txt log files for each subject
+    :return: U_list and V_list, lists of U [dim_time, K] and V [dim_space, K] for each subject
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Setup data precision and eps
+    np_float, np_eps = set_data_precision(dataPrecision)
+    gFN = np.asarray(gFN).astype(np_float)
+
+    nBatch = len(Data_list)
+    dim_time, dim_space = Data_list[0].shape
+    K = gFN.shape[1]
+
+    # check dimension of Data and gFN
+    for Data in Data_list:
+        if Data.shape[0] != dim_time:
+            raise ValueError("All data in a batch should have the same time dimension")
+        if Data.shape[1] != gFN.shape[0]:
+            raise ValueError("The second dimension of Data should match the first dimension of gFn, as they are space dimension")
+
+    # setup log files
+    if logFile_list is None:
+        logFile_list = ['Log_pFN_NMF.log'] * nBatch
+    logFile_list = [open(logFile, 'a') if isinstance(logFile, str) else logFile for logFile in logFile_list]
+    for logFile in logFile_list:
+        print(f'\nStart NMF for pFN using NumPy in a batch of {nBatch} at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
+    # Median number of graph neighbors
+    nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
+
+    # Use Alpha and Beta to set alphaS and alphaL if they are 0
+    if alphaS == 0 and Alpha > 0:
+        alphaS = np.round(Alpha * dim_time / K)
+    if alphaL == 0 and Beta > 0:
+        alphaL = np.round(Beta * dim_time / K / nM)
+
+    # Prepare and normalize scans into a 3D matrix
+    X = np.empty((nBatch, dim_time, dim_space), dtype=np_float)
+    for b in range(nBatch):
+        X[b] = normalize_data(Data_list[b], 'vp', 'vmax', dataPrecision)
+
+    # Construct the spatial affinity graph, shared by all subjects
+    if Laplacian is None:
+        Laplacian = setup_Laplacian_operator(gNb, dim_space, 0, None, alphaL, normW, dataPrecision)
+    else:
+        Laplacian = scale_Laplacian_operator(Laplacian, alphaL, dataPrecision)
+
+    # Initialize V, same for all subjects
+    V0 = gFN.copy()
+    miv = np.max(V0, axis=0)
+    trimInd = V0 / np.maximum(miv, np_eps) < 5e-2
+    V0[trimInd] = 0
+    V = np.array(np.broadcast_to(V0, (nBatch, dim_space, K)), dtype=np_float, order='C')
+
+    # Initialize U for each subject
+    U = np.empty((nBatch, dim_time, K), dtype=np_float)
+    for b in range(nBatch):
+        U[b] = initialize_u(X[b], X[b] @ V0 / np.sum(V0, axis=0), V0, error=error, maxIter=100, minIter=minIter,
+                            meanFitRatio=meanFitRatio, initConv=initConv, dataPrecision=dataPrecision)
+
+    # Squared norm of each X for the data fitting term
+    X2 = np.array([data_squared_norm(X[b]) for b in range(nBatch)])
+
+    if ard > 0:
+        lambdas = np.sum(U, axis=1, keepdims=True) / dim_time
+        hyperLam = (eta * X2 / (dim_time * dim_space * 2)).reshape((nBatch, 1, 1))
+    else:
+        lambdas = 0
+        hyperLam = np.zeros((nBatch, 1, 1))
+
+    # Preallocated buffers for the in-place multiplicative update of the whole batch
+    workspace = setup_NMF_workspace(dim_time, dim_space, K, dataPrecision, nBatch=nBatch)
+    oldU = workspace['oldU']
+    oldV = workspace['oldV']
+
+    # WV and DV are shared by the V update and the objective function
+    WV = None
+    DV = None
+    if alphaL > 0:
+        WV, DV = apply_Laplacian_operator(Laplacian, V, workspace['DV'])
+
+    # Subjects remaining in the batch, and their results
+    subject = np.arange(nBatch)
+    U_list = [None] * nBatch
+    V_list = [None] * nBatch
+    oldLogL = np.full(nBatch, np.inf)
+    np.copyto(oldU, U)
+    np.copyto(oldV, V)
+
+    #  Multiplicative update of U and V
+    for i in range(1, 1+maxIter):
+        # ===================== update V ========================
+        update_V_SR_NMF(X, U, V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+
+        # Prune V if empty components are found in V
+        np.not_equal(V, 0, out=workspace['maskV'])
+        prunInd = np.sum(workspace['maskV'], axis=1) == 1
+        for b, k in np.argwhere(prunInd):
+            V[b, :, k] = 0
+            U[b, :, k] = 0
+
+        # normalize U and V
+        normalize_u_v_inplace(U, V, 1, 1, workspace, dataPrecision)
+
+        # ===================== update U =========================
+        update_U_SR_NMF(X, U, V, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, dataPrecision=dataPrecision)
+
+        # Prune U if empty components are found in U
+        prunInd = np.sum(U, axis=1) == 0
+        for b, k in np.argwhere(prunInd):
+            V[b, :, k] = 0
+            U[b, :, k] = 0
+
+        # update lambda
+        if ard > 0:
+            lambdas = np.sum(U, axis=1, keepdims=True) / dim_time
+
+        # ==== calculate objective function value ====
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator(Laplacian, V, DV)
+
+        flagFinished = np.zeros(len(subject), dtype=bool)
+        for b in range(len(subject)):
+            logFile = logFile_list[subject[b]]
+            LogL, LDf, LSl, L21, ardU = compute_objective_SR_NMF(X2[b], U[b], V[b], workspace['XV'][b], workspace['VV'][b],
+                                                                 WV=WV[b] if alphaL > 0 else None, DV=DV[b] if alphaL > 0 else None,
+                                                                 alphaS=alphaS, alphaL=alphaL, ard=ard, hyperLam=hyperLam[b, 0, 0], dataPrecision=dataPrecision)
+            print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile)
+
+            # The iteration needs to meet minimum iteration number and small changes of LogL
+            if i > minIter and abs(oldLogL[b] - LogL) / np.maximum(oldLogL[b], np_eps) < error:
+                flagFinished[b] = True
+                continue
+            oldLogL[b] = LogL
+
+            # QC Control
+            temp = mat_corr(gFN, V[b], dataPrecision)
+            QC_Spatial_Correspondence = np.copy(np.diag(temp))
+            temp -= np.diag(2 * np.ones(K))  # set diagonal values to lower than -1
+            QC_Spatial_Correspondence_Control = np.max(temp, axis=1)
+            QC_Delta_Sim = np.min(QC_Spatial_Correspondence - QC_Spatial_Correspondence_Control)
+
+            if QC_Delta_Sim <= 0:
+                U[b] = oldU[b]
+                V[b] = oldV[b]
+                flagFinished[b] = True
+                print(f'\n  QC: Meet QC constraint: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
+                print(f'    Use results from last iteration', file=logFile, flush=True)
+            else:
+                oldU[b] = U[b]
+                oldV[b] = V[b]
+                print(f'        QC: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
+
+        if not np.any(flagFinished):
+            continue
+
+        # Finished subjects leave the batch
+        for b in np.flatnonzero(flagFinished):
+            U_list[subject[b]] = U[b].copy()
+            V_list[subject[b]] = V[b].copy()
+        keep = np.flatnonzero(~flagFinished)
+        if keep.shape[0] == 0:
+            break
+        # Move remaining subjects to the front, without copying the whole batch
+        for b_new, b in enumerate(keep):
+            if b_new != b:
+                X[b_new] = X[b]
+                U[b_new] = U[b]
+                V[b_new] = V[b]
+                oldU[b_new] = oldU[b]
+                oldV[b_new] = oldV[b]
+        nActive = keep.shape[0]
+        X = X[:nActive]
+        U = U[:nActive]
+        V = V[:nActive]
+        subject = subject[keep]
+        X2 = X2[keep]
+        oldLogL = oldLogL[keep]
+        hyperLam = hyperLam[keep]
+        if ard > 0:
+            lambdas = lambdas[keep]
+        workspace = {key: value[:nActive] if isinstance(value, np.ndarray) else value for key, value in workspace.items()}
+        workspace['nBatch'] = nActive
+        oldU = workspace['oldU']
+        oldV = workspace['oldV']
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator(Laplacian, V, workspace['DV'])
+
+    # Subjects reaching the maximum iteration
+    for b in range(len(subject)):
+        if U_list[subject[b]] is None:
+            U_list[subject[b]] = U[b].copy()
+            V_list[subject[b]] = V[b].copy()
+
+    for logFile in logFile_list:
+        print(f'\n Finished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
+    return U_list, V_list
+
+
+def setup_restart_tracker(warmUp=30, abandonRatio=0.05):
+    """
+    setup_restart_tracker(warmUp=30, abandonRatio=0.05)
+    Setup a tracker shared by concurrent repetitions of gFN_NMF, storing LogL of each iteration of each repetition
+
+    :param warmUp: number of iterations before a repetition can be abandoned
+    :param abandonRatio: a repetition is abandoned if its LogL is larger than the best LogL of other repetitions at the same iteration by this ratio
+    :return: tracker, a dict
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    tracker = {'lock': threading.Lock(), 'LogL': {}, 'finished': set(),
+               'warmUp': warmUp, 'abandonRatio': abandonRatio}
+
+    return tracker
+
+
+def update_restart_tracker(tracker: dict, repeat, phase, LogL):
+    """
+    update_restart_tracker(tracker: dict, repeat, phase, LogL)
+    Record LogL of the next iteration of a repetition, and check whether this repetition falls behind the others
+    Iterations on compressed data and the refinement on the original data are tracked as different phases, as their LogL are not comparable
+
+    :param tracker: a tracker from setup_restart_tracker
+    :param repeat: index of the repetition
+    :param phase: 0 for iterations on compressed data or on the original data, 1 for the refinement
+    :param LogL: LogL of the current iteration, None to mark this phase as finished
+    :return: True if this repetition should be abandoned
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    with tracker['lock']:
+        if LogL is None:
+            tracker['finished'].add((repeat, phase))
+            return False
+        trajectory = tracker['LogL'].setdefault((repeat, phase), [])
+        trajectory.append(float(LogL))
+        i = len(trajectory)
+        if i < tracker['warmUp']:
+            return False
+        # Best LogL of other repetitions at the same iteration, or at the end of their finished iterations
+        bestLogL = np.inf
+        for (r, p), t in tracker['LogL'].items():
+            if r == repeat or p != phase:
+                continue
+            if len(t) >= i:
+                bestLogL = min(bestLogL, t[i-1])
+            elif (r, p) in tracker['finished']:
+                bestLogL = min(bestLogL, t[-1])
+        return trajectory[-1] > bestLogL * (1 + tracker['abandonRatio'])
+
+
+def gFN_NMF_restart(X, sketch, U, V, X2, Laplacian, workspace=None, maxIter=1000, minIter=30, error=1e-8,
+                    alphaS=0, alphaL=0, ard=0, eta=0, solver='mu', repeat=1, tracker=None, dataPrecision='double', logFile=None):
+    """
+    gFN_NMF_restart(X, sketch, U, V, X2, Laplacian, workspace=None, maxIter=1000, minIter=30, error=1e-8,
+                    alphaS=0, alphaL=0, ard=0, eta=0, solver='mu', repeat=1, tracker=None, dataPrecision='double', logFile=None)
+    Run one repetition of gFN_NMF from an initialization of U and V, which are updated in place
+    With a tracker from setup_restart_tracker, LogL is shared with concurrent repetitions, and this repetition is abandoned once it falls behind
+
+    :param X: data, 2D matrix [dim_time, dim_space], or blocked data from setup_blocked_data
+    :param sketch: None or a temporal sketch of X from setup_temporal_sketch, used before a refinement on X
+    :param U: initial temporal components, 2D matrix [dim_time, K]
+    :param V: initial spatial components, 2D matrix [dim_space, K]
+    :param X2: squared norm of X from data_squared_norm
+    :param Laplacian: a Laplacian operator from setup_Laplacian_operator
+    :param workspace: None or preallocated buffers from setup_NMF_workspace
+    :param maxIter: maximum iteration number for multiplicative update
+    :param minIter: minimum iteration in case fast convergence
+    :param error: difference of cost function for convergence
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param eta: a hyper parameter for the ard regularization term
+    :param solver: 'mu', 'accelerated_mu' or 'hals', the solver for updating U and V, see update_V_SR_NMF
+    :param repeat: index of the repetition
+    :param tracker: None or a tracker from setup_restart_tracker
+    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
+    :param logFile: None or an opened log file
+    :return: LogL, flag_Repeat. flag_Repeat is 0 for convergence, 1 if stopped before the minimum iteration number, and 2 if abandoned
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    np_float, np_eps = set_data_precision(dataPrecision)
+    dim_time, K = U.shape
+    dim_space = V.shape[0]
+    if workspace is None:
+        workspace = setup_NMF_workspace(dim_time, dim_space, K, dataPrecision)
+    XV = workspace['XV']
+    VV = workspace['VV']
+    # Concurrent repetitions are distinguished in the log file
+    logPrefix = '' if tracker is None else f'Repeat = {repeat}, '
+
+    # Normalize data
+    normalize_u_v_inplace(U, V, 1, 1, workspace, dataPrecision)
+
+    if ard > 0:
+        ard = 1
+        eta = 0.1
+        lambdas = np.sum(U, axis=0) / dim_time
+        hyperLam = eta * X2 / (dim_time * dim_space * 2)
+    else:
+        lambdas = 0
+        hyperLam = 0
+
+    # WV and DV are shared by the V update and the objective function
+    WV = None
+    DV = None
+    if alphaL > 0:
+        WV, DV = apply_Laplacian_operator(Laplacian, V, workspace['DV'])
+
+    oldLogL = np.inf
+    LogL = np.inf
+    flag_Repeat = 0
+
+    # Use the compressed data first, then refine results using the original data
+    Xi = X if sketch is None else sketch
+    iRefine = 0
+
+    # Multiplicative update of U and V
+    for i in range(1, 1+maxIter+(minIter if sketch is not None else 0)):
+        # ===================== update V ========================
+        # Eq. 8-11
+        # WV and DV were computed with the current V at the end of last iteration
+        update_V_SR_NMF(Xi, U, V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, solver=solver, Laplacian=Laplacian, dataPrecision=dataPrecision)
+
+        # Prune V if empty components are found in V
+        # This is almost impossible to happen without combining FNs
+        np.not_equal(V, 0, out=workspace['maskV'])
+        prunInd = np.sum(workspace['maskV'], axis=0) == 1
+        if np.any(prunInd):
+            V[:, prunInd] = 0
+            U[:, prunInd] = 0
+
+        # normalize U and V
+        normalize_u_v_inplace(U, V, 1, 1, workspace, dataPrecision)
+
+        # ===================== update U =========================
+        update_U_SR_NMF(Xi, U, V, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, solver=solver, dataPrecision=dataPrecision)
+
+        # Prune U if empty components are found in U
+        # This is almost impossible to happen without combining FNs
+        prunInd = np.sum(U, axis=0) == 0
+        if np.any(prunInd):
+            V[:, prunInd] = 0
+            U[:, prunInd] = 0
+
+        # update lambda
+        if ard > 0:
+            lambdas = np.sum(U) / dim_time
+
+        # ==== calculate objective function value ====
+        # WV and DV of the updated V are reused in the next V update
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator(Laplacian, V, DV)
+
+        # XV and VV are from the U update, and V has not changed since then
+        LogL, LDf, LSl, L21, ardU = compute_objective_SR_NMF(X2, U, V, XV, VV, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL,
+                                                             ard=ard, hyperLam=hyperLam, dataPrecision=dataPrecision)
+        print(f"    {logPrefix}Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile, flush=True)
+
+        # Stop this repetition if it falls behind concurrent repetitions
+        if tracker is not None and update_restart_tracker(tracker, repeat, int(iRefine > 0), LogL):
+            flag_Repeat = 2
+            print(f'\n Repetition {repeat} is abandoned as its LogL falls behind other repetitions\n', file=logFile, flush=True)
+            break
+
+        # The iteration needs to meet minimum iteration number and small changes of LogL
+        if iRefine > 0:
+            # Refinement on the original data stops at convergence or after minIter iterations
+            if (i > iRefine + 1 and abs(oldLogL - LogL) / np.maximum(oldLogL, np_eps) < error) or i - iRefine >= minIter:
+                break
+        elif 1 < i < minIter and abs(oldLogL - LogL) / np.maximum(oldLogL, np_eps) < error:
+            flag_Repeat = 1
+            print('\n Iteration stopped before the minimum iteration number. The results might be poor.\n', file=logFile, flush=True)
+            break
+        elif (i > minIter and abs(oldLogL - LogL) / np.maximum(oldLogL, np_eps) < error) or i >= maxIter:
+            if sketch is None:
+                break
+            # LogL of compressed data is not comparable to LogL of the original data
+            if tracker is not None:
+                update_restart_tracker(tracker, repeat, 0, None)
+            Xi = X
+            iRefine = i
+            oldLogL = np.inf
+            print('\n Start refinement using the original data\n', file=logFile, flush=True)
+            continue
+        oldLogL = LogL.copy()
+
+    if tracker is not None and flag_Repeat != 2:
+        update_restart_tracker(tracker, repeat, int(iRefine > 0), None)
+
+    return LogL, flag_Repeat
+
+
+def setup_warm_start_V(V, initV):
+    """
+    setup_warm_start_V(V, initV)
+    Replace the first columns of a random initial V by FNs of a previous solution, such as gFNs of a smaller K
+    Each FN in initV is scaled to the mean of the random V, so that all columns start at the same level
+
+    :param V: random initial FNs, 2D matrix [dim_space, K]
+    :param initV: FNs of a previous solution, 2D matrix [dim_space, K0] with K0 <= K
+    :return: V, 2D matrix [dim_space, K]
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    initV = np.asarray(initV, dtype=V.dtype)
+    meanV = np.mean(initV, axis=0, keepdims=True)
+    V[:, :initV.shape[1]] = initV / np.maximum(meanV, np.finfo(V.dtype).eps) * np.mean(V)
+    return V
+
+
 def gFN_NMF(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
-            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, dataPrecision='double', logFile='Log_pFN_NMF.log'):
+            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, solver='mu', Laplacian=None, sketchSize=0, maxM=12500000, nParallel=1, abandonRatio=0.05, initV=None, dataPrecision='double', logFile='Log_pFN_NMF.log'):
     """
     gFN_NMF(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
-            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, dataPrecision='double', logFile='Log_pFN_NMF.log')
+            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, solver='mu', Laplacian=None, sketchSize=0, maxM=12500000, nParallel=1, abandonRatio=0.05, initV=None, dataPrecision='double', logFile='Log_pFN_NMF.log')
     Compute group-level FNs using NMF method
+    With a positive sketchSize, NMF runs on a temporal sketch of data, followed by a refinement of at most minIter iterations on the original data
+    Data can be a memory-mapped array for out-of-core computation, which is read in blocks of at most maxM elements, see setup_blocked_data
+    With nParallel > 1, all nRepeat repetitions run concurrently and the best one is kept. A repetition is abandoned after minIter iterations once its LogL falls behind the others by abandonRatio
+    With initV, such as gFNs of a smaller K, the first columns of V in all repetitions start from initV, see setup_warm_start_V
 
-    :param Data: 2D matrix [dim_time, dim_space], recommend to normalize each fMRI scan before concatenate them along the time dimension
+    :param Data: 2D matrix [dim_time, dim_space], recommend to normalize each fMRI scan before concatenate them along the time dimension. It can also be a memory-mapped array or directory of a .npy file
     :param K: number of FNs
     :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
     :param maxIter: maximum iteration number for multiplicative update
@@ -625,6 +2040,13 @@ def gFN_NMF(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
     :param ard: 0 or 1, flat for combining similar clusters
     :param eta: a hyper parameter for the ard regularization term
     :param nRepeat: Any positive integer, the number of repetition to avoid poor initialization
+    :param solver: 'mu', 'accelerated_mu' or 'hals', the solver for updating U and V, see update_V_SR_NMF
+    :param Laplacian: optional Laplacian operator from setup_Laplacian_operator, shared across runs with the same gNb. Its normW and vxI are used, and it is rescaled to alphaL
+    :param sketchSize: 0, 'Automatic' or a positive integer, number of rows of the temporal sketch from setup_temporal_sketch. 0 disables compression, and 'Automatic' uses max(20*K, 200)
+    :param maxM: maximum number of elements in one block of data for out-of-core computation
+    :param nParallel: 1, 'Automatic' or a positive integer, number of repetitions running concurrently in threads. 1 runs repetitions one by one until one reaches minIter, and 'Automatic' uses the number of CPUs. Threads of numpy and PyTorch are split among concurrent repetitions
+    :param abandonRatio: a concurrent repetition is abandoned if its LogL is larger than the best LogL of other repetitions at the same iteration by this ratio
+    :param initV: None or initial FNs, 2D matrix [dim_space, K0] with K0 <= K
     :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
     :param logFile: str, directory of a txt log file
     :return: gFN, 2D matrix [dim_space, K]
@@ -639,13 +2061,19 @@ def gFN_NMF(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
 
     # Setup data precision and eps
     np_float, np_eps = set_data_precision(dataPrecision)
-    if not isinstance(Data, np.ndarray):
-        Data = np.array(Data, dype=np_float)
+    flag_OutOfCore = isinstance(Data, (str, np.memmap))
+    if flag_OutOfCore:
+        # Data stay on disk, and normalization is applied to each loaded block
+        X = setup_blocked_data(Data, maxM, dataPrecision=dataPrecision)
+        dim_time, dim_space = X['dim_time'], X['dim_space']
     else:
-        Data = Data.astype(np_float)
+        if not isinstance(Data, np.ndarray):
+            Data = np.array(Data, dype=np_float)
+        else:
+            Data = Data.astype(np_float)
 
-    # Input data size
-    dim_time, dim_space = Data.shape
+        # Input data size
+        dim_time, dim_space = Data.shape
 
     # Median number of graph neighbors
     nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
@@ -656,147 +2084,359 @@ def gFN_NMF(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
     if alphaL == 0 and Beta > 0:
         alphaL = np.round(Beta * dim_time / K / nM)
 
+    if initV is not None and (initV.shape[0] != dim_space or initV.shape[1] > K):
+        raise ValueError('initV must have dim_space rows and at most K columns')
+
     # Prepare and normalize scan
-    Data = normalize_data(Data, 'vp', 'vmax', dataPrecision)
-    X = Data  # Save memory
+    if not flag_OutOfCore:
+        Data = normalize_data(Data, 'vp', 'vmax', dataPrecision)
+        X = Data  # Save memory
 
     # Construct the spatial affinity graph
-    L, W, D = construct_Laplacian_gNb(gNb, dim_space, vxI, X, alphaL, normW, dataPrecision)
+    if flag_OutOfCore and vxI > 0:
+        raise ValueError("vxI is not supported for out-of-core data")
+    if Laplacian is None:
+        Laplacian = setup_Laplacian_operator(gNb, dim_space, vxI, X, alphaL, normW, dataPrecision)
+    else:
+        Laplacian = scale_Laplacian_operator(Laplacian, alphaL, dataPrecision)
+
+    # Squared norm and mean of X, computed once for all repetitions
+    X2 = data_squared_norm(X)
+    mean_X = (X['sumX'] if flag_OutOfCore else np.sum(X)) / (dim_time*dim_space)
+
+    # Temporal compression of data, shared by all repetitions
+    sketch = None
+    if sketchSize == 'Automatic':
+        sketchSize = int(np.maximum(20 * K, 200))
+    if 0 < sketchSize < dim_time:
+        sketch = setup_temporal_sketch(X, sketchSize, dataPrecision=dataPrecision)
+        print(f'\n Data are compressed from {dim_time} to {sketch["sketchSize"]} time points\n', file=logFile, flush=True)
+
+    if nParallel == 'Automatic':
+        nParallel = os.cpu_count()
+    nParallel = int(np.maximum(np.minimum(nParallel, nRepeat), 1))
+
+    if nParallel == 1:
+        # Preallocated buffers for the in-place multiplicative update, shared by all repetitions
+        workspace = setup_NMF_workspace(dim_time, dim_space, K, dataPrecision)
 
-    flag_Repeat = 0
-    for repeat in range(1, 1 + nRepeat):
         flag_Repeat = 0
-        print(f'\n Starting {repeat}-th repetition\n', file=logFile, flush=True)
+        for repeat in range(1, 1 + nRepeat):
+            print(f'\n Starting {repeat}-th repetition\n', file=logFile, flush=True)
+
+            # Initialize U and V
+            U = (np.random.rand(dim_time, K) + 1) * (np.sqrt(mean_X/K))
+            V = (np.random.rand(dim_space, K) + 1) * (np.sqrt(mean_X/K))
+            if initV is not None:
+                V = setup_warm_start_V(V, initV)
+
+            U = U.astype(np_float)
+            V = V.astype(np_float)
+
+            LogL, flag_Repeat = gFN_NMF_restart(X, sketch, U, V, X2, Laplacian, workspace, maxIter=maxIter, minIter=minIter, error=error,
+                                                alphaS=alphaS, alphaL=alphaL, ard=ard, eta=eta, solver=solver, repeat=repeat,
+                                                dataPrecision=dataPrecision, logFile=logFile)
+            if flag_Repeat == 0:
+                break
 
-        # Initialize U and V
-        mean_X = np.sum(X) / (dim_time*dim_space)
-        U = (np.random.rand(dim_time, K) + 1) * (np.sqrt(mean_X/K))
-        V = (np.random.rand(dim_space, K) + 1) * (np.sqrt(mean_X/K))
+    else:
+        # Initialize U and V of all repetitions in order, so that results do not depend on the concurrent execution
+        list_U = []
+        list_V = []
+        for repeat in range(1, 1 + nRepeat):
+            U = (np.random.rand(dim_time, K) + 1) * (np.sqrt(mean_X/K))
+            V = (np.random.rand(dim_space, K) + 1) * (np.sqrt(mean_X/K))
+            if initV is not None:
+                V = setup_warm_start_V(V, initV)
+            list_U.append(U.astype(np_float))
+            list_V.append(V.astype(np_float))
+
+        # Repetitions share X and Laplacian, and each one allocates its own workspace
+        print(f'\n Starting {nRepeat} repetitions with {nParallel} in parallel\n', file=logFile, flush=True)
+        tracker = setup_restart_tracker(warmUp=minIter, abandonRatio=abandonRatio)
+        # Threads of numpy and PyTorch are split among concurrent repetitions to avoid oversubscribing CPU cores
+        with split_computation_thread(nParallel), concurrent.futures.ThreadPoolExecutor(max_workers=nParallel) as executor:
+            list_future = [executor.submit(gFN_NMF_restart, X, sketch, list_U[repeat-1], list_V[repeat-1], X2, Laplacian, None,
+                                           maxIter=maxIter, minIter=minIter, error=error, alphaS=alphaS, alphaL=alphaL, ard=ard, eta=eta,
+                                           solver=solver, repeat=repeat, tracker=tracker, dataPrecision=dataPrecision, logFile=logFile)
+                           for repeat in range(1, 1 + nRepeat)]
+            list_result = [future.result() for future in list_future]
+
+        # Keep the converged repetition with the lowest LogL
+        best = min(range(nRepeat), key=lambda r: (list_result[r][1], float(list_result[r][0])))
+        LogL, flag_Repeat = list_result[best]
+        V = list_V[best]
+        print(f'\n Selected {best+1}-th repetition with LogL: {LogL}\n', file=logFile, flush=True)
 
-        # Normalize data
-        U, V = normalize_u_v(U, V, 1, 1, dataPrecision)
+    if flag_Repeat == 1:
+        print('\n All repetition stopped before the minimum iteration number. The final results might be poor\n', file=logFile, flush=True)
 
-        if ard > 0:
-            ard = 1
-            eta = 0.1
-            lambdas = np.sum(U, axis=0) / dim_time
-            hyperLam = eta * np.sum(np.power(X, 2)) / (dim_time * dim_space * 2)
-        else:
-            lambdas = 0
-            hyperLam = 0
+    gFN = V
+    print(f'\nFinished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
 
-        oldLogL = np.inf
+    return gFN
 
-        # Multiplicative update of U and V
-        for i in range(1, 1+maxIter):
-            # ===================== update V ========================
-            # Eq. 8-11
-            XU = X.T @ U
-            UU = U.T @ U
-            VUU = V @ UU
 
-            tmpl2 = np.power(V, 2)
+def gFN_NMF_online(file_scan_list, K, gNb, dataType='Surface', dataFormat='HCP Surface (*.cifti, *.mat)', Brain_Mask=None, maxIter=1000, minIter=30, error=1e-8, normW=1,
+                   Alpha=2, Beta=30, alphaS=0, alphaL=0, ard=0, eta=0, nScanBatch=1, Laplacian=None, Cache=None, dataPrecision='double', logFile='Log_pFN_NMF.log'):
+    """
+    gFN_NMF_online(file_scan_list, K, gNb, dataType='Surface', dataFormat='HCP Surface (*.cifti, *.mat)', Brain_Mask=None, maxIter=1000, minIter=30, error=1e-8, normW=1,
+                   Alpha=2, Beta=30, alphaS=0, alphaL=0, ard=0, eta=0, nScanBatch=1, Laplacian=None, Cache=None, dataPrecision='double', logFile='Log_pFN_NMF.log')
+    Compute group-level FNs using NMF method, streaming scans from disk instead of concatenating them
+    Only one scan is in memory at a time. Each scan keeps its own temporal components U_s, and the V update uses the sufficient statistics
+    X' @ U = sum(X_s' @ U_s) and U' @ U = sum(U_s' @ U_s), which are updated incrementally after updating U_s
+    Each scan is normalized by vp-vmax, equivalent to normalizing the concatenated data
+    Each iteration is a pass over all scans, and V is updated before every nScanBatch scans. The objective function is accumulated along the pass
+    Without Cache, every pass reads and decodes all scans from disk again, for up to maxIter passes
+    With ard, lambdas are updated after each pass in the same way as gFN_NMF_restart after each U update
+
+    :param file_scan_list: directory of a txt file storing directories of fMRI scans, such as Scan_List.txt of a bootstrap run
+    :param K: number of FNs
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: data format supported by load_fmri_scan
+    :param Brain_Mask: None or a brain mask, required for reshaping volume data
+    :param maxIter: maximum number of passes over all scans
+    :param minIter: minimum number of passes in case fast convergence
+    :param error: difference of cost function for convergence
+    :param normW: 1 or 2, normalization method for W used in Laplacian regularization
+    :param Alpha: hyper parameter for spatial sparsity
+    :param Beta: hyper parameter for Laplacian sparsity
+    :param alphaS: internally determined, the coefficient for spatial sparsity based Alpha, data size, K, and gNb
+    :param alphaL: internally determined, the coefficient for Laplacian sparsity based Beta, data size, K, and gNb
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param eta: a hyper parameter for the ard regularization term
+    :param nScanBatch: positive integer, number of scans between two updates of V
+    :param Laplacian: optional Laplacian operator from setup_Laplacian_operator, shared across runs with the same gNb. Its normW is used, and it is rescaled to alphaL
+    :param Cache: None or a dict of the scan cache used by load_fmri_scan. Scans are loaded once per pass over all scans, so later passes read them from the cache
+    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
+    :param logFile: str, directory of a txt log file
+    :return: gFN, 2D matrix [dim_space, K]
 
-            if alphaS > 0:
-                tmpl21 = np.sqrt(tmpl2)
-                tmpl22 = np.tile(np.sqrt(np.sum(tmpl2, axis=0)), (dim_space, 1))
-                tmpl21s = np.tile(np.sum(tmpl21, axis=0), (dim_space, 1))
-                posTerm = V / np.maximum(tmpl21 * tmpl22, np_eps)
-                negTerm = V * tmpl21s / np.maximum(np.power(tmpl22, 3), np_eps)
+    Yuncong Ma, 11/9/2023
+    """
 
-                VUU = VUU + 0.5 * alphaS * posTerm
-                XU = XU + 0.5 * alphaS * negTerm
+    # setup log file
+    if isinstance(logFile, str):
+        logFile = open(logFile, 'a')
+    print(f'\nStart online NMF for gFN using NumPy at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
+    # Setup data precision and eps
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    if os.path.isfile(file_scan_list) and file_scan_list.endswith('.txt'):
+        scan_list = [line.replace('\n', '') for line in open(file_scan_list, 'r')]
+        scan_list = [scan for scan in scan_list if len(scan) > 0]
+    else:
+        scan_list = [file_scan_list]
+    nScan = len(scan_list)
+
+    # First pass: random initialization of U and V, and sufficient statistics
+    # This matches gFN_NMF, which updates V first using a random U
+    U_list = [None] * nScan
+    X2_list = np.zeros(nScan)
+    dim_time = 0
+    V = None
+    for s in range(nScan):
+        X = load_fmri_scan(scan_list[s], dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
+                           Normalization='vp-vmax', Cache=Cache).astype(np_float)
+        if V is None:
+            dim_space = X.shape[1]
+            V = (np.random.rand(dim_space, K) + 1).astype(np_float)
+            norms = np.maximum(np.max(V, axis=0), np_eps)
+            V /= norms
+            XU = np.zeros((dim_space, K), dtype=np.float64)
+            UU = np.zeros((K, K), dtype=np.float64)
+            sumU = np.zeros(K, dtype=np.float64)
+        elif X.shape[1] != dim_space:
+            raise ValueError('Scans have different spatial dimensions when loading scan: ' + scan_list[s])
+        mean_X = np.sum(X) / X.size
+        U = ((np.random.rand(X.shape[0], K) + 1) * (np.sqrt(mean_X / K)) * norms).astype(np_float)
+        XU += X.T @ U
+        UU += U.T @ U
+        sumU += np.sum(U, axis=0)
+        U_list[s] = U
+        dim_time += X.shape[0]
+        X2_list[s] = data_squared_norm(X)
+        del X
+    X2 = np.sum(X2_list)
+    print(f' {nScan} scans with {dim_time} time points in total\n', file=logFile, flush=True)
 
-            if alphaL > 0:
-                WV = W @ V.astype(np.float64)
-                DV = D @ V.astype(np.float64)
+    # Median number of graph neighbors
+    nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
+
+    # Use Alpha and Beta to set alphaS and alphaL if they are 0
+    if alphaS == 0 and Alpha > 0:
+        alphaS = np.round(Alpha * dim_time / K)
+    if alphaL == 0 and Beta > 0:
+        alphaL = np.round(Beta * dim_time / K / nM)
 
-                XU = XU + WV
-                VUU = VUU + DV
+    # Construct the spatial affinity graph
+    if Laplacian is None:
+        Laplacian = setup_Laplacian_operator(gNb, dim_space, 0, None, alphaL, normW, dataPrecision)
+    else:
+        Laplacian = scale_Laplacian_operator(Laplacian, alphaL, dataPrecision)
 
-            V = V * (XU / np.maximum(VUU, np_eps))
+    if ard > 0:
+        ard = 1
+        eta = 0.1
+        lambdas = sumU / dim_time
+        hyperLam = eta * X2 / (dim_time * dim_space * 2)
+    else:
+        lambdas = 0
+        hyperLam = 0
 
-            # Prune V if empty components are found in V
-            # This is almost impossible to happen without combining FNs
-            prunInd = np.sum(V != 0, axis=0) == 1
-            if np.any(prunInd):
-                V[:, prunInd] = np.zeros((dim_space, np.sum(prunInd)))
-                U[:, prunInd] = np.zeros((dim_time, np.sum(prunInd)))
+    # Preallocated buffers for V only, as U of each scan has its own size
+    workspace = setup_NMF_workspace(0, dim_space, K, dataPrecision)
+    WV = None
+    DV = None
 
-            # normalize U and V
-            U, V = normalize_u_v(U, V, 1, 1)
+    oldLogL = np.inf
+    for i in range(1, 1+maxIter):
+        LDf = 0
+        for s in range(nScan):
+            if s % nScanBatch == 0:
+                # ===================== update V ========================
+                # Eq. 8-11, using the sufficient statistics from all scans
+                np.maximum(XU, np_eps, out=workspace['XU'])
+                np.copyto(workspace['UU'], UU)
+                if alphaL > 0:
+                    WV, DV = apply_Laplacian_operator(Laplacian, V, workspace['DV'])
+                update_V_SR_NMF_step(V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+
+                # normalize U and V, and scale the sufficient statistics accordingly
+                norms = np.maximum(np.max(V, axis=0), np_eps)
+                V /= norms
+                for U in U_list:
+                    U *= norms
+                XU *= norms
+                UU *= np.outer(norms, norms)
+                sumU *= norms
 
             # ===================== update U =========================
+            X = load_fmri_scan(scan_list[s], dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
+                               Normalization='vp-vmax', Cache=Cache).astype(np_float)
+            U = U_list[s]
             XV = X @ V
             VV = V.T @ V
-            UVV = U @ VV
-
-            if ard > 0:  # ard term for U
-                posTerm = 1 / np.maximum(np.tile(lambdas, (dim_time, 1)), np_eps)
-
-                UVV = UVV + posTerm * hyperLam
+            oldU = U.copy()
 
-            U = U * (XV / np.maximum(UVV, np_eps))
+            # Multiplicative update of U_s
+            UVV = U @ VV
+            if ard > 0:
+                UVV += hyperLam / np.maximum(lambdas, np_eps)
+            U *= XV / np.maximum(UVV, np_eps)
 
-            # Prune U if empty components are found in U
-            # This is almost impossible to happen without combining FNs
-            prunInd = np.sum(U, axis=0) == 0
-            if np.any(prunInd):
-                V[:, prunInd] = np.zeros((dim_space, np.sum(prunInd)))
-                U[:, prunInd] = np.zeros((dim_time, np.sum(prunInd)))
+            # Update sufficient statistics with the change of U_s
+            XU += X.T @ (U - oldU)
+            UU += U.T @ U - oldU.T @ oldU
+            sumU += np.sum(U, axis=0) - np.sum(oldU, axis=0)
+            LDf += data_fitting_error_gram(X2_list[s], U, XV, VV)
+            del X
 
-            # update lambda
-            if ard > 0:
-                lambdas = np.sum(U) / dim_time
+        # update lambda
+        if ard > 0:
+            lambdas = np.sum(sumU) / dim_time
 
-            # ==== calculate objective function value ====
-            ardU = 0
-            tmp2 = 0
-            tmpl21 = np.power(V, 2)
+        # ==== calculate objective function value ====
+        # The data fitting term of each scan uses V at the time of updating its U_s
+        L21 = alphaS * np.sum(np.sum(V, axis=0) / np.maximum(np.sqrt(np.sum(V * V, axis=0)), np_eps))
+        LSl = 0
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator(Laplacian, V)
+            LSl = np.sum(V * DV, dtype=np.float64) - np.sum(V * WV, dtype=np.float64)
+        ardU = 0
+        if ard > 0:
+            su = sumU.copy()
+            su[su == 0] = 1
+            ardU = np.sum(np.log(su)) * dim_time * hyperLam
+        LogL = L21 + ardU + LDf + LSl
+        print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile, flush=True)
 
-            if ard > 0:
-                su = np.sum(U, axis=0)
-                su[su == 0] = 1
-                ardU = np.sum(np.log(su)) * dim_time * hyperLam
+        # The iteration needs to meet minimum iteration number and small changes of LogL
+        if i > minIter and abs(oldLogL - LogL) / np.maximum(oldLogL, np_eps) < error:
+            break
+        oldLogL = LogL
 
-            if alphaL > 0:
-                tmp2 = V.T @ L * V.T
+    gFN = V
+    print(f'\nFinished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
 
-            L21 = alphaS * np.sum(np.sum(np.sqrt(tmpl21), axis=0) / np.maximum(np.sqrt(np.sum(tmpl21, axis=0)), np_eps))
-            # LDf = data_fitting_error(X, U, V, 0, 1)
-            LDf = np.sum(np.power(X - U @ V.T, 2))
-            LSl = np.sum(tmp2)
+    return gFN
 
-            # Objective function
-            LogL = L21 + LDf + LSl + ardU
-            print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile, flush=True)
 
-            # The iteration needs to meet minimum iteration number and small changes of LogL
-            if 1 < i < minIter and abs(oldLogL - LogL) / np.maximum(oldLogL, np_eps) < error:
-                flag_Repeat = 1
-                print('\n Iteration stopped before the minimum iteration number. The results might be poor.\n', file=logFile, flush=True)
-                break
-            elif i > minIter and abs(oldLogL - LogL) / np.maximum(oldLogL, np_eps) < error:
-                break
-            oldLogL = LogL.copy()
-        if flag_Repeat == 0:
-            break
+def NCut_discretisation(EigenVectors, ps, maxIter=20, maxM=12500000, dataPrecision='double'):
+    """
+    NCut_discretisation(EigenVectors, ps, maxIter=20, maxM=12500000, dataPrecision='double')
+    Discretize NCut eigenvectors into cluster labels for a batch of trials
+    Each trial starts from a different row in ps, and selects other initial centers as rows with the minimum similarity to previous ones
+    Trials are run together with stacked matrix products and SVDs, in chunks of at most maxM elements of EigenVectors @ R
+
+    :param EigenVectors: 2D matrix [n, k], eigenvectors with each row normalized to norm 1
+    :param ps: 1D vector [T], index of the initial row of each trial
+    :param maxIter: maximum number of discretisation iterations, after the first one
+    :param maxM: maximum number of elements in one chunk of trials
+    :param dataPrecision: 'double' or 'single', used for the stop criterion
+    :return: C, NcutValue. C is a 2D matrix [T, n] with cluster labels starting from 0. NcutValue is a 1D vector [T]
+
+    Yuncong Ma, 11/9/2023
+    """
 
-    if flag_Repeat == 1:
-        print('\n All repetition stopped before the minimum iteration number. The final results might be poor\n', file=logFile, flush=True)
+    np_float, np_eps = set_data_precision(dataPrecision)
+    n, k = EigenVectors.shape
+    ps = np.asarray(ps, dtype=np.int64)
+    nTrial = len(ps)
+    C = np.zeros((nTrial, n), dtype=np.int64)
+    NcutValue = np.zeros(nTrial)
+
+    chunkSize = max(maxM // (n * k), 1)
+    for t0 in range(0, nTrial, chunkSize):
+        t1 = min(t0 + chunkSize, nTrial)
+        nT = t1 - t0
+        trial = np.arange(nT)
+
+        # Initial centers, similar to initialization in k++
+        R = np.zeros((nT, k, k))
+        R[:, :, 0] = EigenVectors[ps[t0:t1], :]
+        c = np.zeros((nT, n))  # Total distance to selected centers
+        c[trial, ps[t0:t1]] = np.inf
+        for j in range(1, k):
+            c += np.abs(R[:, :, j-1] @ EigenVectors.T)
+            p = np.argmin(c, axis=1)
+            c[trial, p] = np.inf
+            R[:, :, j] = EigenVectors[p, :]
+
+        lastObjectiveValue = np.zeros(nT)
+        active = trial
+        for nbIterationsDiscretisation in range(1, maxIter + 2):
+            J = np.argmax(np.matmul(EigenVectors, R[active]), axis=2)  # Assign each sample to K centers of R based on highest similarity
+            # Sum of eigenvectors within each cluster, the same as EigenvectorsDiscrete.T @ EigenVectors
+            M = np.zeros((len(active), k, k))
+            np.add.at(M, (np.arange(len(active))[:, np.newaxis], J), EigenVectors)
+            U, S, Vh = np.linalg.svd(M)
+            value = 2 * (n - np.sum(S, axis=1))
 
-    gFN = V
-    print(f'\nFinished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+            # escape the loop when converged or meet max iteration
+            flag_Stop = (np.abs(value - lastObjectiveValue[active]) < np_eps) | (nbIterationsDiscretisation > maxIter)
+            C[t0 + active[flag_Stop]] = J[flag_Stop]
+            NcutValue[t0 + active[flag_Stop]] = value[flag_Stop]
+            lastObjectiveValue[active] = value
+            R[active[~flag_Stop]] = np.matmul(np.swapaxes(Vh[~flag_Stop], 1, 2), np.swapaxes(U[~flag_Stop], 1, 2))  # Update R which stores the new centers
+            active = active[~flag_Stop]
+            if len(active) == 0:
+                break
 
-    return gFN
+    return C, NcutValue
 
 
 def gFN_fusion_NCut(gFN_BS, K, NCut_MaxTrial=100, dataPrecision='double', logFile='Log_gFN_fusion_NCut'):
     """
     gFN_fusion_NCut(gFN_BS, K, NCut_MaxTrial=100, dataPrecision='double')
     Fuses FN results to generate representative group-level FNs
+    The normalized similarity matrix is scaled by the degree vector, and its first K eigenvectors are obtained by a symmetric eigensolver
+    All NCut trials are run in batches by NCut_discretisation
 
-    :param gFN_BS: FNs obtained from bootstrapping method, FNs are concatenated along the K dimension
+    :param gFN_BS: FNs obtained from bootstrapping method, FNs are concatenated along the K dimension.
+        It can be a transposed np.memmap of an FN stack from load_FN_stack, which is read in blocks
     :param K: Number of FNs, not the total number of FNs obtained from bootstrapping
     :param NCut_MaxTrial: Max number trials for NCut method
     :param dataPrecision: 'double' or 'single'
@@ -813,123 +2453,87 @@ def gFN_fusion_NCut(gFN_BS, K, NCut_MaxTrial=100, dataPrecision='double', logFil
 
     # Setup data precision and eps
     np_float, np_eps = set_data_precision(dataPrecision)
+    # A np.ndarray, including a np.memmap of an FN stack, is used without a copy in the working precision
     if not isinstance(gFN_BS, np.ndarray):
-        gFN_BS = np.array(gFN_BS, dype=np_float)
-    else:
-        gFN_BS = gFN_BS.astype(np_float)
+        gFN_BS = np.array(gFN_BS, dtype=np_float)
 
     # clustering by NCut
 
-    # Get similarity between samples
-    corrVal = mat_corr(gFN_BS, dataPrecision=dataPrecision)  # similarity between FNs, [K * n_BS, K * n_BS]
-    corrVal[np.isnan(corrVal)] = -1
-    nDis = 1 - corrVal  # Transform Pearson correlation to non-negative values similar to distance
-    triuInd = np.triu(np.ones(nDis.shape), 1)  # Index of upper triangle
-    nDisVec = nDis[triuInd == 1]  # Take the values in upper triangle
+    # Get similarity between samples, updated in place to save memory
+    nDis = mat_corr(gFN_BS, dataPrecision=dataPrecision)  # similarity between FNs, [K * n_BS, K * n_BS]
+    nDis[np.isnan(nDis)] = -1
+    np.subtract(1, nDis, out=nDis)  # Transform Pearson correlation to non-negative values similar to distance
+    n = nDis.shape[0]
+    nDisVec = np.concatenate([nDis[i, i+1:] for i in range(n)])  # Take the values in upper triangle
     # Make all distance non-negative and normalize their distribution
-    nW = np.exp(-np.power(nDis, 2) / (np.power(np.median(nDisVec), 2)))  # Transform distance values using exp(-X/std^2) with std as the median value
+    # Transform distance values using exp(-X/std^2) with std as the median value
+    nW = np.square(nDis, out=nDis)
+    nW *= -1 / np.power(np.median(nDisVec), 2)
+    np.exp(nW, out=nW)
     nW[np.isnan(nW)] = 0
     sumW = np.sum(nW, axis=1)  # total distance for each FN
     sumW[sumW == 0] = 1  # In case two FNs are the same
-    # Construct Laplacian matrix
-    D = np.diag(sumW)
-    L = np.sqrt(np.linalg.inv(D)) @ nW @ np.linalg.inv(np.sqrt(D))  # A way to normalize nW based on the total distance of each FN
-    L = (L + L.T) / 2  # Ensure L is symmetric. Computation error may result in asymmetry
-
-    eVal, Ev = scipy.sparse.linalg.eigs(L.astype(np.float64), K, which='LR')  # Get first K eigenvectors, sign of vectors may be different to MATLAB results
-    Ev = np.real(Ev)
+    # Construct Laplacian matrix, D^(-1/2) @ nW @ D^(-1/2) with D = diag(sumW), to normalize nW based on the total distance of each FN
+    dW = 1 / np.sqrt(sumW)
+    L = nW
+    L *= dW[:, np.newaxis]
+    L *= dW[np.newaxis, :]
+    np.add(L, L.T, out=L)  # Ensure L is symmetric. Computation error may result in asymmetry
+    L /= 2
+    L = L.astype(np.float64, copy=False)
+
+    # Get first K eigenvectors, sign of vectors may be different to MATLAB results
+    if K < n - 1:
+        # The leading eigenvector is proportional to sqrt(sumW), used as the starting vector
+        eVal, Ev = scipy.sparse.linalg.eigsh(L, K, which='LA', v0=np.sqrt(sumW).astype(np.float64))
+    else:
+        eVal, Ev = np.linalg.eigh(L)
+        Ev = Ev[:, n-K:]
+    del L, nW, nDis
     # Correct the sign of eigenvectors to make them same as derived from MATLAB
     temp = np.sign(np.sum(Ev, axis=0))  # Use the total value of each eigenvector to reset its sign
     temp[temp == 0.0] = 1.0
-    Ev = Ev * np.tile(temp, (Ev.shape[0], 1))  # Reset the sign of each eigenvector
-    normvect = np.sqrt(np.diag(Ev @ Ev.T))  # Get the norm of each eigenvector
+    Ev = Ev * temp[np.newaxis, :]  # Reset the sign of each eigenvector
+    normvect = np.sqrt(np.sum(Ev ** 2, axis=1, keepdims=True))  # Get the norm of each row
     normvect[normvect == 0.0] = 1  # Incase all 0 eigenvector
-    Ev = np.linalg.solve(np.diag(normvect), Ev)  # Use linear solution to normalize Ev satisfying normvect * Ev_new = Ev_old
+    EigenVectors = Ev / normvect  # normalize eigenvectors to ensure each FN vector's norm = 1
 
     # Multiple trials to get reproducible results
+    ps = np.random.randint(0, n, NCut_MaxTrial)  # Choose a random row in eigenvectors for each trial as an initial center
+    C_Trial, NcutValue = NCut_discretisation(EigenVectors, ps, dataPrecision=dataPrecision)
     Best_C = []
     Best_NCutValue = np.inf
     for i in range(NCut_MaxTrial):
         print(f'    Iter = ' + str(i), file=logFile)
-        EigenVectors = Ev
-        n, k = EigenVectors.shape  # n is K * n_BS, k is K
-
-        vm = np.sqrt(np.sum(EigenVectors**2, axis=1, keepdims=True))  # norm of each row
-        EigenVectors = EigenVectors / np.tile(vm, (1, k))  # normalize eigenvectors to ensure each FN vector's norm = 1
-
-        R = np.zeros((k, k))
-        ps = np.random.randint(0, n, 1)  # Choose a random row in eigenvectors
-        R[:, 0] = EigenVectors[ps, :]  # This randomly selected row in eigenvectors is used as an initial center
-
-        c_index = np.zeros(n)
-        c = np.zeros(n)  # Total distance to different rows in R [K * n_BS, 1]
-        c_index[0] = ps  # Store the index of selected samples
-        c[ps] = np.inf
-
-        for j in range(2, k+1):  # Find another K-1 rows in eigenvectors which have the minimum similarity to previous selected rows, similar to initialization in k++
-            c += np.abs(EigenVectors @ R[:, j-2])
-            ps = np.argmin(c)
-            c_index[j-1] = ps
-            c[ps] = np.inf
-            R[:, j-1] = EigenVectors[ps, :].T
-
-        lastObjectiveValue = 0
-        exitLoop = 0
-        nbIterationsDiscretisation = 0
-        nbIterationsDiscretisationMax = 20
-
-        while exitLoop == 0:
-            nbIterationsDiscretisation += 1
-
-            EigenVectorsR = EigenVectors @ R
-            n, k = EigenVectorsR.shape
-            J = np.argmax(EigenVectorsR, axis=1)  # Assign each sample to K centers of R based on highest similarity
-            EigenvectorsDiscrete = scipy.sparse.csr_matrix((np.ones(n), (np.arange(n), J)), shape=(n, k))  # Generate a 0-1 matrix with each row containing only one 1
-
-            U, S, Vh = scipy.linalg.svd(EigenvectorsDiscrete.T @ EigenVectors, full_matrices=False)  # Economy-size decomposition
-
-            S = np.diag(S)  # To match MATLAB svd results
-            V = Vh.T  # To match MATLAB svd results
-            NcutValue = 2 * (n - np.trace(S))
-
-            # escape the loop when converged or meet max iteration
-            if abs(NcutValue - lastObjectiveValue) < np_eps or nbIterationsDiscretisation > nbIterationsDiscretisationMax:
-                exitLoop = 1
-                print(f'    Reach stop criterion of NCut, NcutValue = '+str(NcutValue)+'\n', file=logFile, flush=True)
-            else:
-                print(f'    NcutValue = '+str(NcutValue), file=logFile)
-                lastObjectiveValue = NcutValue
-                R = V @ U.T  # Update R which stores the new centers
-
-        C = np.argmax(EigenvectorsDiscrete.toarray(), axis=1)  # Assign each sample to K centers in R
+        print(f'    Reach stop criterion of NCut, NcutValue = '+str(NcutValue[i])+'\n', file=logFile, flush=True)
+        C = C_Trial[i]
 
         if len(np.unique(C)) < K:  # Check whether there are empty results
             print(f'    Found empty results in iteration '+str(i+1)+'\n', file=logFile, flush=True)
         else:  # Update the best result
-            if NcutValue < Best_NCutValue:
-                Best_NCutValue = NcutValue
+            if NcutValue[i] < Best_NCutValue:
+                Best_NCutValue = NcutValue[i]
                 Best_C = C
 
     if len(set(Best_C)) < K:  # In case even the last trial has empty results
         raise ValueError('  Cannot generate non-empty gFNs\n')
-        Flag = 1
-        Message = "Cannot generate non-empty FN"
 
     print(f'Best NCut value = '+str(Best_NCutValue)+'\n', file=logFile, flush=True)
 
     # Get centroid
+    # Each FN is standardized once, within its cluster, and the similarity within each cluster is a block of their products
     C = Best_C
     gFN = np.zeros((gFN_BS.shape[0], K))
     for ki in range(K):
-        if np.sum(C == ki) > 1:
-            candSet = gFN_BS[:, C == ki]  # Get the candidate set of FNs assigned to cluster ki
-            corrW = np.abs(mat_corr(candSet, dataPrecision=dataPrecision))  # Get the similarity between candidate FNs
+        candInd = np.where(C == ki)[0]  # Get the candidate set of FNs assigned to cluster ki
+        if len(candInd) > 1:
+            Z = standardize_column(gFN_BS[:, candInd], dataPrecision)
+            corrW = np.abs(np.clip(Z.T @ Z, -1, 1))  # Get the similarity between candidate FNs
             corrW[np.isnan(corrW)] = 0
             mInd = np.argmax(np.sum(corrW, axis=0), axis=0)  # Find the FN with the highest total similarity to all other FNs
-            gFN[:, ki] = candSet[:, mInd]
-        elif np.sum(C == ki) == 1:
-            mInd = C.tolist().index(ki)
-            gFN[:, ki] = gFN_BS[:, mInd]
+            gFN[:, ki] = gFN_BS[:, candInd[mInd]]
+        elif len(candInd) == 1:
+            gFN[:, ki] = gFN_BS[:, candInd[0]]
 
     gFN = gFN / np.maximum(np.tile(np.max(gFN, axis=0), (gFN.shape[0], 1)), np_eps)  # Normalize each FN by its max value
     print(f'\nFinished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
@@ -1175,14 +2779,14 @@ def bootstrap_scan(dir_output: str, file_scan: str, file_subject_ID: str, file_s
 
 
 def setup_NMF_setting(dir_pnet_result: str, K=17, Combine_Scan=False, file_gFN=None, samplingMethod='Subject', sampleSize='Automatic', nBS=50, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-8,
-                      normW=1, Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, Parallel=False, Computation_Mode='CPU', N_Thread=1, dataPrecision='double', outputFormat='Both'):
+                      normW=1, Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, solver='mu', batchSize=1, Compression=False, sketchSize='Automatic', Online=False, nScanBatch=1, Parallel_Repeat=False, nParallelRepeat='Automatic', abandonRatio=0.05, Sweep_Warm_Start=False, Parallel=False, Computation_Mode='CPU', N_Thread=1, N_Process='Automatic', Prefetch=False, nPrefetch=2, prefetchMemory=None, Cache=False, dir_cache=None, cacheSize=100, Resume=False, Checkpoint=False, checkpointInterval=600, Warm_Start=False, dir_warmStart=None, dataPrecision='double', outputFormat='Both'):
     """
     setup_NMF_setting(dir_pnet_result: str, K=17, Combine_Scan=False, Compute_gFN=True, samplingMethod='Subject', sampleSize='Automatic', nBS=50, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-8,
-                      normW=1, Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, Parallel=False, Computation_Mode='CPU', N_Thread=1, dataPrecision='double')
+                      normW=1, Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, solver='mu', batchSize=1, Compression=False, sketchSize='Automatic', Online=False, nScanBatch=1, Parallel_Repeat=False, nParallelRepeat='Automatic', abandonRatio=0.05, Sweep_Warm_Start=False, Parallel=False, Computation_Mode='CPU', N_Thread=1, N_Process='Automatic', Prefetch=False, nPrefetch=2, prefetchMemory=None, Cache=False, dir_cache=None, cacheSize=100, Resume=False, Checkpoint=False, checkpointInterval=600, Warm_Start=False, dir_warmStart=None, dataPrecision='double')
     Setup the setting for NMF-based method to compute gFNs and pFNs
 
     :param dir_pnet_result: directory of the pNet result folder
-    :param K: number of FNs
+    :param K: number of FNs, or a list of numbers of FNs for a sweep of K. A sweep shares data loading and bootstrap samples among K values, and saves results of each K into a result folder K_<K>
     :param Combine_Scan: False or True, whether to combine multiple scans for the same subject
     :param file_gFN: directory of a precomputed gFN in .mat format
     :param samplingMethod: 'Subject' or 'Group_Subject'. Uniform sampling based subject ID, or group and then subject ID
@@ -1201,9 +2805,31 @@ def setup_NMF_setting(dir_pnet_result: str, K=17, Combine_Scan=False, file_gFN=N
     :param ard: 0 or 1, flat for combining similar clusters
     :param eta: a hyper parameter for the ard regularization term
     :param nRepeat: Any positive integer, the number of repetition to avoid poor initialization
-    :param Parallel: False or True, whether to enable parallel computation
+    :param solver: 'mu', 'accelerated_mu' or 'hals'. Multiplicative update, multiplicative update with inner loops, or hierarchical alternating least squares
+    :param batchSize: positive integer, number of subjects with the same number of time points computed together for pFNs. It requires solver='mu' and vxI=0. Batches are grouped by file headers, and data of at most batchSize subjects are loaded at a time
+    :param Compression: False or True, whether to compress bootstrapped data along the time dimension for gFNs, using a randomized sketch followed by a refinement on the original data. When vxI is 0, bootstrapped data are kept in a .npy file in each bootstrap folder instead of memory, and read in blocks
+    :param sketchSize: 'Automatic' or a positive integer, number of time points after compression. 'Automatic' uses max(20*K, 200)
+    :param Online: False or True, whether to compute gFNs of each bootstrap run by streaming scans from disk, without concatenating them in memory. It requires vxI=0
+    :param nScanBatch: positive integer, number of scans between two updates of gFNs in the online mode
+    :param Parallel_Repeat: False or True, whether to run the nRepeat repetitions of gFNs concurrently in threads and keep the best one
+    :param nParallelRepeat: 'Automatic' or a positive integer, number of concurrent repetitions. 'Automatic' uses the number of CPUs
+    :param abandonRatio: a concurrent repetition is abandoned if its objective function is larger than the best of other repetitions at the same iteration by this ratio
+    :param Sweep_Warm_Start: False or True, whether to start gFNs of each bootstrap run in a sweep of K from its gFNs of the previous K. It does not apply to the online mode
+    :param Parallel: False or True, whether to enable parallel computation. Bootstrap runs of gFNs and subject folders of pFNs are dispatched to worker processes. Workers import the main script again, so a script running pNet must use the if __name__ == '__main__': guard, see setup_process_pool
     :param Computation_Mode: 'CPU'
-    :param N_Thread: positive integers, used for parallel computation
+    :param N_Thread: positive integers, used for parallel computation. It is the total number of threads, split among worker processes
+    :param N_Process: 'Automatic' or a positive integer, number of worker processes for bootstrap runs and subjects, each using N_Thread // N_Process threads. 'Automatic' uses one thread per process
+    :param Prefetch: False or True, whether to load data of next bootstrap runs and subject folders in background threads while computing the current one. It applies when Parallel is False
+    :param nPrefetch: positive integer, maximum number of bootstrap runs or subject folders loaded ahead
+    :param prefetchMemory: None or a positive number in GB, maximum memory of data loaded ahead
+    :param Cache: False or True, whether to keep masked and normalized scans in a scan cache, so that scans loaded again by bootstrap runs, pFNs and quality control are memory-mapped from the cache
+    :param dir_cache: None or directory of the scan cache, which can be shared by pNet result folders. None uses Scan_Cache in FN_Computation
+    :param cacheSize: None or a positive number in GB, maximum size of the scan cache. Least recently used scans are removed when it is exceeded
+    :param Resume: False or True, whether to skip bootstrap runs, gFNs and subject folders finished by a previous run with the same inputs and settings
+    :param Checkpoint: False or True, whether to save U and V periodically when computing pFNs of each subject folder, so that a stopped run resumes from the last checkpoint. It does not apply to batchSize > 1
+    :param checkpointInterval: minimum number of seconds between two checkpoints
+    :param Warm_Start: False or True, whether to start pFNs of each subject folder from its previous pFNs computed with the same gFNs and K, which are kept in a warm-start cache. It does not apply to batchSize > 1
+    :param dir_warmStart: None or directory of the warm-start cache, which can be shared by pNet result folders. None uses Warm_Start in FN_Computation
     :param dataPrecision: 'double' or 'single'
     :param outputFormat: 'MAT', 'Both', 'MAT' is to save results in FN.mat and TC.mat for functional networks and time courses respectively. 'Both' is for both matlab format and fMRI input file format
 
@@ -1214,6 +2840,9 @@ def setup_NMF_setting(dir_pnet_result: str, K=17, Combine_Scan=False, file_gFN=N
 
     dir_pnet_dataInput, dir_pnet_FNC, _, _, _, _ = setup_result_folder(dir_pnet_result)
 
+    if solver not in ('mu', 'accelerated_mu', 'hals'):
+        raise ValueError('Unknown solver for SR-NMF: ' + str(solver))
+
     # Set sampleSize if it is 'Automatic'
     if sampleSize == 'Automatic':
         file_subject_ID = os.path.join(dir_pnet_dataInput, 'Subject_ID.txt')
@@ -1228,13 +2857,23 @@ def setup_NMF_setting(dir_pnet_result: str, K=17, Combine_Scan=False, file_gFN=N
                 'BootStrap': BootStrap,
                 'maxIter': maxIter, 'minIter': minIter, 'error': error,
                 'normW': normW, 'Alpha': Alpha, 'Beta': Beta, 'alphaS': alphaS, 'alphaL': alphaL, 'vxI': vxI,
-                'ard': ard, 'eta': eta, 'nRepeat': nRepeat}
+                'ard': ard, 'eta': eta, 'nRepeat': nRepeat, 'solver': solver,
+                'Compression': {'Enable': Compression, 'sketchSize': sketchSize},
+                'Online': {'Enable': Online, 'nScanBatch': nScanBatch},
+                'Parallel_Repeat': {'Enable': Parallel_Repeat, 'nParallel': nParallelRepeat, 'abandonRatio': abandonRatio},
+                'Sweep_Warm_Start': Sweep_Warm_Start}
     Personalized_FN = {'maxIter': maxIter, 'minIter': minIter, 'meanFitRatio': meanFitRatio, 'error': error,
                        'normW': normW, 'Alpha': Alpha, 'Beta': Beta, 'alphaS': alphaS, 'alphaL': alphaL,
-                       'vxI': vxI, 'ard': ard, 'eta': eta}
+                       'vxI': vxI, 'ard': ard, 'eta': eta, 'solver': solver, 'batchSize': batchSize,
+                       'Warm_Start': {'Enable': Warm_Start, 'dir_warmStart': dir_warmStart if dir_warmStart is not None else os.path.join(dir_pnet_FNC, 'Warm_Start')}}
     Computation = {'Parallel': Parallel,
                    'Model': Computation_Mode,
                    'N_Thread': N_Thread,
+                   'N_Process': N_Process,
+                   'Prefetch': {'Enable': Prefetch, 'nPrefetch': nPrefetch, 'maxMemory': prefetchMemory},
+                   'Cache': {'Enable': Cache, 'dir_cache': dir_cache if dir_cache is not None else os.path.join(dir_pnet_FNC, 'Scan_Cache'), 'maxSize': cacheSize},
+                   'Resume': Resume,
+                   'Checkpoint': {'Enable': Checkpoint, 'Interval': checkpointInterval},
                    'dataPrecision': dataPrecision}
 
     setting = {'Method': 'SR-NMF',
@@ -1249,12 +2888,13 @@ def setup_NMF_setting(dir_pnet_result: str, K=17, Combine_Scan=False, file_gFN=N
     return setting
 
 
-def setup_pFN_folder(dir_pnet_result: str):
+def setup_pFN_folder(dir_pnet_result: str, createFolder=True):
     """
-    setup_pFN_folder(dir_pnet_result: str)
+    setup_pFN_folder(dir_pnet_result: str, createFolder=True)
     Setup sub-folders in Personalized_FN to
 
     :param dir_pnet_result: directory of the pNet result folder
+    :param createFolder: False to only get the subject folder list, when sub-folders are created by another job
     :return: list_subject_folder_unique: unique subject folder array for getting sub-folders in Personalized_FN
 
     Yuncong Ma, 9/25/2023
@@ -1284,6 +2924,9 @@ def setup_pFN_folder(dir_pnet_result: str):
     if combineScan and len(list_subject_folder_unique) == len(list_subject_folder):
         raise ValueError('When combineScan is enabled, the txt file Subject_Folder.txt is supposed to show repeated sub-folder names')
 
+    if not createFolder:
+        return list_subject_folder_unique
+
     N_Scan = list_subject_folder_unique.shape[0]
     for i in range(N_Scan):
         template = list_subject_folder_unique[i]
@@ -1301,22 +2944,770 @@ def setup_pFN_folder(dir_pnet_result: str):
     return list_subject_folder_unique
 
 
-def run_FN_Computation(dir_pnet_result: str):
+def setup_shard_owner(shard=None, unitRange=None):
+    """
+    setup_shard_owner(shard=None, unitRange=None)
+    Name a job of run_FN_Computation by its shard spec, used as the owner of units in the manifest
+
+    :param shard: None or [shardIndex, shardCount], with shardIndex starting from 1
+    :param unitRange: None or [first, last], indexes of units starting from 1
+    :return: owner, a str, or None without sharding
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    owner = []
+    if shard is not None:
+        owner.append(f'Shard_{int(shard[0])}_of_{int(shard[1])}')
+    if unitRange is not None:
+        owner.append(f'Range_{int(unitRange[0])}_to_{int(unitRange[1])}')
+    if len(owner) == 0:
+        return None
+
+    return '_'.join(owner)
+
+
+def select_shard_unit(nUnit, shard=None, unitRange=None):
+    """
+    select_shard_unit(nUnit, shard=None, unitRange=None)
+    Select units, such as bootstrap runs or subject folders, computed by one shard
+    Units are interleaved across shards, so that shards get similar workloads
+
+    :param nUnit: total number of units
+    :param shard: None or [shardIndex, shardCount], with shardIndex starting from 1
+    :param unitRange: None or [first, last], indexes of units starting from 1
+    :return: list_unit, a list of indexes starting from 1
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    list_unit = list(range(1, nUnit+1))
+    if shard is not None:
+        shardIndex, shardCount = int(shard[0]), int(shard[1])
+        if shardIndex < 1 or shardIndex > shardCount:
+            raise ValueError('shardIndex should be between 1 and shardCount')
+        list_unit = list_unit[shardIndex-1::shardCount]
+    if unitRange is not None:
+        list_unit = [i for i in list_unit if unitRange[0] <= i <= unitRange[1]]
+
+    return list_unit
+
+
+def claim_manifest_unit(dir_manifest: str, unit: str, owner: str, fingerprint=None):
+    """
+    claim_manifest_unit(dir_manifest: str, unit: str, owner: str, fingerprint=None)
+    Claim a unit of computation in a manifest folder shared by all shards
+    The claim file is created exclusively, so that only one shard gets the unit. A unit can be claimed again by the same owner, such as a restarted job
+    With fingerprint, a finished unit is skipped only if it was finished with the same fingerprint, see check_manifest_unit. Otherwise its finished mark is removed, and the unit is claimed again
+
+    :param dir_manifest: directory of the manifest folder
+    :param unit: name of the unit
+    :param owner: name of the shard from setup_shard_owner
+    :param fingerprint: None or a str from compute_unit_fingerprint
+    :return: True if the unit is claimed by this owner and not finished yet
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    file_finished = os.path.join(dir_manifest, unit + '.finished')
+    file_claim = os.path.join(dir_manifest, unit + '.claim')
+    if os.path.isfile(file_finished):
+        if fingerprint is None or check_manifest_unit(dir_manifest, unit, fingerprint):
+            return False
+        # The unit was finished with different inputs or settings. Only the shard renaming its finished mark takes it over
+        file_stale = f'{file_finished}.stale.{socket.gethostname()}.{os.getpid()}'
+        try:
+            os.rename(file_finished, file_stale)
+        except FileNotFoundError:
+            pass
+        else:
+            os.remove(file_stale)
+            with open(file_claim, 'w') as file:
+                print(owner, file=file)
+                print(f'{socket.gethostname()} {os.getpid()} ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=file)
+            return True
+    try:
+        fd = os.open(file_claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        with open(file_claim, 'r') as file:
+            return file.readline().replace('\n', '') == owner
+    with os.fdopen(fd, 'w') as file:
+        print(owner, file=file)
+        print(f'{socket.gethostname()} {os.getpid()} ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=file)
+
+    return True
+
+
+def finish_manifest_unit(dir_manifest: str, unit: str, owner: str, fingerprint=None):
+    """
+    finish_manifest_unit(dir_manifest: str, unit: str, owner: str, fingerprint=None)
+    Mark a claimed unit as finished in the manifest folder
+
+    :param dir_manifest: directory of the manifest folder
+    :param unit: name of the unit
+    :param owner: name of the shard from setup_shard_owner
+    :param fingerprint: None or a str from compute_unit_fingerprint, used to resume computation
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Write to a temporary file first, so that other shards never see an incomplete file
+    file_temp = os.path.join(dir_manifest, f'{unit}.finished.{socket.gethostname()}.{os.getpid()}')
+    with open(file_temp, 'w') as file:
+        print(owner, file=file)
+        print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=file)
+        if fingerprint is not None:
+            print(fingerprint, file=file)
+    os.replace(file_temp, os.path.join(dir_manifest, unit + '.finished'))
+
+
+def wait_manifest_unit(dir_manifest: str, unit: str, interval=10, logFile=None):
+    """
+    wait_manifest_unit(dir_manifest: str, unit: str, interval=10, logFile=None)
+    Wait until a unit claimed by another shard is finished
+
+    :param dir_manifest: directory of the manifest folder
+    :param unit: name of the unit
+    :param interval: seconds between two checks
+    :param logFile: None or an opened log file
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if not os.path.isfile(os.path.join(dir_manifest, unit + '.finished')):
+        print(f'Wait for {unit} claimed by another shard', file=logFile, flush=True)
+    while not os.path.isfile(os.path.join(dir_manifest, unit + '.finished')):
+        time.sleep(interval)
+
+
+def check_manifest(dir_manifest: str, list_unit: list, list_fingerprint=None):
+    """
+    check_manifest(dir_manifest: str, list_unit: list, list_fingerprint=None)
+    Find units not finished yet in the manifest folder
+
+    :param dir_manifest: directory of the manifest folder
+    :param list_unit: names of units
+    :param list_fingerprint: None or a list of fingerprints of units from compute_unit_fingerprint. Units finished with a different fingerprint, or with a fingerprint of None, are not finished
+    :return: list_missing, names of units without a finished mark
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if list_fingerprint is None:
+        list_missing = [unit for unit in list_unit if not os.path.isfile(os.path.join(dir_manifest, unit + '.finished'))]
+    else:
+        list_missing = [unit for unit, fingerprint in zip(list_unit, list_fingerprint)
+                        if fingerprint is None or not check_manifest_unit(dir_manifest, unit, fingerprint)]
+
+    return list_missing
+
+
+def check_manifest_unit(dir_manifest: str, unit: str, fingerprint: str):
+    """
+    check_manifest_unit(dir_manifest: str, unit: str, fingerprint: str)
+    Check whether a unit was finished with the same inputs and settings, used to resume computation
+
+    :param dir_manifest: directory of the manifest folder
+    :param unit: name of the unit
+    :param fingerprint: a str from compute_unit_fingerprint
+    :return: True if the unit is finished with the same fingerprint
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    file_finished = os.path.join(dir_manifest, unit + '.finished')
+    if not os.path.isfile(file_finished):
+        return False
+    with open(file_finished, 'r') as file:
+        list_line = [line.replace('\n', '') for line in file]
+
+    return len(list_line) > 2 and list_line[2] == fingerprint
+
+
+def setup_fingerprint_setting(setting: dict, stage='Group_FN'):
+    """
+    setup_fingerprint_setting(setting: dict, stage='Group_FN')
+    Select settings that affect results of gFNs or pFNs, used to fingerprint units
+    Settings of parallel computation are excluded, so that a job can be resumed with a different number of threads or processes
+    Execution-only settings of the stage, Parallel_Repeat of Group_FN, batchSize and the warm-start directory of Personalized_FN, are excluded as well
+
+    :param setting: a dict with settings of Data_Input and FN_Computation
+    :param stage: 'Group_FN' or 'Personalized_FN'
+    :return: setting_stage, a dict
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    setting_FN = dict(setting['FN_Computation'][stage])
+    if stage == 'Group_FN':
+        setting_FN.pop('Parallel_Repeat', None)
+    else:
+        setting_FN.pop('batchSize', None)
+        if isinstance(setting_FN.get('Warm_Start'), dict):
+            setting_FN['Warm_Start'] = {key: value for key, value in setting_FN['Warm_Start'].items() if key != 'dir_warmStart'}
+
+    setting_stage = {'Data_Input': setting['Data_Input'],
+                     'Method': setting['FN_Computation']['Method'],
+                     'K': setting['FN_Computation']['K'],
+                     'Combine_Scan': setting['FN_Computation']['Combine_Scan'],
+                     stage: setting_FN,
+                     'dataPrecision': setting['FN_Computation']['Computation']['dataPrecision']}
+
+    return setting_stage
+
+
+def compute_unit_fingerprint(setting: dict, list_file=None, file_scan_list=None, list_array=None, maxSize=16777216):
+    """
+    compute_unit_fingerprint(setting: dict, list_file=None, file_scan_list=None, list_array=None, maxSize=16777216)
+    Compute a fingerprint of a unit of computation from its settings and input files
+    Files up to maxSize bytes are hashed by contents. Larger files, such as fMRI scans, are hashed by path, size and modification time, as reading them takes as long as the computation
+
+    :param setting: a dict of settings, see setup_fingerprint_setting
+    :param list_file: None or a list of input files
+    :param file_scan_list: None or a txt file of fMRI scans, which are added to input files together with the txt file
+    :param list_array: None or a list of numpy.ndarray, hashed by contents. It is preferred for .mat files, as their headers contain the time of saving
+    :param maxSize: maximum number of bytes of a file hashed by contents
+    :return: fingerprint, a str of hexadecimal digits
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    list_file = [] if list_file is None else list(list_file)
+    if file_scan_list is not None:
+        list_file.append(file_scan_list)
+        list_file += [line.replace('\n', '') for line in open(file_scan_list, 'r') if len(line.replace('\n', '')) > 0]
+
+    hashValue = hashlib.sha1(json.dumps(setting, sort_keys=True, default=str).encode())
+    for file in list_file:
+        fileStat = os.stat(file)
+        if fileStat.st_size <= maxSize:
+            with open(file, 'rb') as fileContent:
+                hashValue.update(fileContent.read())
+        else:
+            hashValue.update(f'{os.path.abspath(file)} {fileStat.st_size} {fileStat.st_mtime_ns}'.encode())
+    if list_array is not None:
+        for array in list_array:
+            hashValue.update(str(array.shape).encode())
+            hashValue.update(np.ascontiguousarray(array).tobytes())
+
+    return hashValue.hexdigest()
+
+
+def setup_warm_start_file(dir_warmStart: str, subjectFolder: str, gFN: np.ndarray):
+    """
+    setup_warm_start_file(dir_warmStart: str, subjectFolder: str, gFN: np.ndarray)
+    Get the file of a warm-start cache, keyed by the subject folder, the gFN and K
+
+    :param dir_warmStart: directory of the warm-start cache
+    :param subjectFolder: name of the subject folder in Personalized_FN
+    :param gFN: group level FNs, 2D matrix [dim_space, K]
+    :return: file_warmStart, directory of a .npz file
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    fingerprint_gFN = compute_unit_fingerprint({}, list_array=[gFN])
+    file_warmStart = os.path.join(dir_warmStart, subjectFolder, f'K{gFN.shape[1]}_{fingerprint_gFN[:16]}.npz')
+
+    return file_warmStart
+
+
+def save_warm_start(file_warmStart: str, U, V, setting_pFN: dict):
+    """
+    save_warm_start(file_warmStart: str, U, V, setting_pFN: dict)
+    Save a converged pFN into the warm-start cache
+
+    :param file_warmStart: directory of a .npz file from setup_warm_start_file
+    :param U: temporal components of pFNs, 2D matrix [dim_time, K], numpy.ndarray
+    :param V: spatial components of pFNs, 2D matrix [dim_space, K], numpy.ndarray
+    :param setting_pFN: a dict of settings in Personalized_FN
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    os.makedirs(os.path.dirname(file_warmStart), exist_ok=True)
+    # Write to a temporary file first, so that concurrent jobs never load an incomplete file
+    file_temp = f'{file_warmStart}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(file_temp, 'wb') as file:
+        np.savez(file, U=U, V=V, normW=setting_pFN['normW'], vxI=setting_pFN['vxI'], ard=setting_pFN['ard'])
+    os.replace(file_temp, file_warmStart)
+
+
+def load_warm_start(file_warmStart: str, setting_pFN: dict):
+    """
+    load_warm_start(file_warmStart: str, setting_pFN: dict)
+    Load a previous pFN from the warm-start cache, if it is compatible with the current settings
+    Regularization needs the same form, given by normW, vxI and ard, while Alpha and Beta may change
+
+    :param file_warmStart: directory of a .npz file from setup_warm_start_file
+    :param setting_pFN: a dict of settings in Personalized_FN
+    :return: initUV, a tuple (U, V), or None
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if not os.path.isfile(file_warmStart):
+        return None
+    with np.load(file_warmStart) as file:
+        for key in ('normW', 'vxI', 'ard'):
+            if file[key] != setting_pFN[key]:
+                return None
+        initUV = (file['U'], file['V'])
+
+    return initUV
+
+
+def save_FN_block(file_block: str, FN: np.ndarray):
+    """
+    save_FN_block(file_block: str, FN: np.ndarray)
+    Save gFNs of one bootstrap run into a compact float32 .npy file [K, dim_space], its row block of the FN stack built by load_FN_stack
+    It is written into a temporary file and then renamed, so that a partial file is never seen by other processes
+
+    :param file_block: directory of the .npy file, FN.npy in the sub-folder of the bootstrap run
+    :param FN: gFNs of this bootstrap run, 2D matrix [dim_space, K] in the compact 2D form before reshape_FN
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    file_temp = f'{file_block}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(file_temp, 'wb') as file:
+        np.save(file, np.ascontiguousarray(np.transpose(FN), dtype=np.float32))
+    os.replace(file_temp, file_block)
+
+
+def load_FN_stack(dir_pnet_BS: str, nBS: int, K: int, dataType='Surface', Brain_Mask=None, mmapMode='r'):
+    """
+    load_FN_stack(dir_pnet_BS: str, nBS: int, K: int, dataType='Surface', Brain_Mask=None, mmapMode='r')
+    Build the FN stack FN_BS.npy in the BootStrapping folder from gFNs of all bootstrap runs, and load it as a np.memmap
+    The FN stack is a float32 .npy file [nBS * K, dim_space], with one row block of K FNs per bootstrap run. It is written by this process only, one row block at a time
+    A row block is copied from FN.npy of a bootstrap run if it is not older than its FN.mat and has the expected shape. Otherwise, it is read from FN.mat
+
+    :param dir_pnet_BS: directory of the BootStrapping folder
+    :param nBS: number of bootstrap runs
+    :param K: number of FNs
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param Brain_Mask: None or a brain mask for volume data
+    :param mmapMode: 'r' for read-only, or 'c' for copy-on-write, which gives a writable array without changing the file
+    :return: gFN_BS, a transposed np.memmap [dim_space, nBS * K] in float32, with FNs concatenated along the K dimension
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    file_stack = os.path.join(dir_pnet_BS, 'FN_BS.npy')
+    file_temp = f'{file_stack}.{socket.gethostname()}.{os.getpid()}.tmp'
+    stack = None
+    for rep in range(1, nBS+1):
+        file_FN = os.path.join(dir_pnet_BS, str(rep), 'FN.mat')
+        file_block = os.path.join(dir_pnet_BS, str(rep), 'FN.npy')
+        block = None
+        if os.path.isfile(file_block) and os.path.getmtime(file_block) >= os.path.getmtime(file_FN):
+            block = np.load(file_block, mmap_mode='r')
+            if block.shape[0] != K or (stack is not None and block.shape[1] != stack.shape[1]):
+                block = None
+        if block is None:
+            # Bootstrap runs without a valid FN.npy, such as those finished by an earlier version
+            block = np.transpose(reshape_FN(load_matlab_single_array(file_FN), dataType=dataType, Brain_Mask=Brain_Mask))
+            if block.shape[0] != K:
+                raise ValueError(f'FN.mat of the {rep}-th bootstrap run has {block.shape[0]} FNs rather than {K}')
+        if stack is None:
+            stack = np.lib.format.open_memmap(file_temp, mode='w+', dtype=np.float32, shape=(nBS * K, block.shape[1]))
+        elif block.shape[1] != stack.shape[1]:
+            raise ValueError(f'FN.mat of the {rep}-th bootstrap run has a spatial dimension of {block.shape[1]} rather than {stack.shape[1]}')
+        stack[(rep-1)*K:rep*K, :] = block
+        del block
+    stack.flush()
+    del stack
+    os.replace(file_temp, file_stack)
+
+    gFN_BS = np.transpose(np.load(file_stack, mmap_mode=mmapMode))
+    return gFN_BS
+
+
+def setup_parallel_worker(nJob, N_Thread=1, N_Process='Automatic'):
+    """
+    setup_parallel_worker(nJob, N_Thread=1, N_Process='Automatic')
+    Split N_Thread threads among worker processes running nJob independent jobs, so that workers x threads does not exceed N_Thread
+
+    :param nJob: number of jobs
+    :param N_Thread: positive integer, total number of threads, which is limited to the number of CPU cores
+    :param N_Process: 'Automatic' or a positive integer, number of worker processes. 'Automatic' uses one process per thread
+    :return: nWorker, nThread_Worker. nWorker is the number of worker processes, and nThread_Worker is the number of threads in each worker
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    N_Thread = int(np.maximum(np.minimum(N_Thread, os.cpu_count()), 1))
+    if N_Process == 'Automatic':
+        N_Process = N_Thread
+    nWorker = int(np.maximum(np.minimum(np.minimum(N_Process, N_Thread), nJob), 1))
+    nThread_Worker = int(np.maximum(N_Thread // nWorker, 1))
+
+    return nWorker, nThread_Worker
+
+
+def setup_process_pool(nWorker: int, nThread_Worker: int):
+    """
+    setup_process_pool(nWorker: int, nThread_Worker: int)
+    Start a pool of worker processes for bootstrap runs or subject folders, each limited to nThread_Worker threads
+    Workers are started by spawn, as fork is not safe with threads of BLAS and PyTorch in the main process
+    Spawn imports the main script again in each worker, so a script running pNet in parallel must call it under if __name__ == '__main__':, see check_main_process
+
+    :param nWorker: number of worker processes, see setup_parallel_worker
+    :param nThread_Worker: number of threads in each worker
+    :return: executor, a concurrent.futures.ProcessPoolExecutor
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=nWorker, mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=set_computation_thread, initargs=(nThread_Worker,))
+
+    return executor
+
+
+def setup_pFN_batch(list_file_scan_list: list, batchSize: int, dataType: str, dataFormat: str, Brain_Mask=None):
+    """
+    setup_pFN_batch(list_file_scan_list: list, batchSize: int, dataType: str, dataFormat: str, Brain_Mask=None)
+    Group subject folders into batches of pFN_NMF_batch, each with up to batchSize subjects of the same number of time points
+    Numbers of time points are read from file headers, so that data of a batch can be loaded when it runs, and at most batchSize subjects are kept in memory
+
+    :param list_file_scan_list: a list of Scan_List.txt files of subject folders
+    :param batchSize: positive integer, maximum number of subjects in a batch
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: 'HCP Surface (*.cifti, *.mat)', 'MGH Surface (*.mgh)', 'MGZ Surface (*.mgz)', 'Volume (*.nii, *.nii.gz, *.mat)', 'HCP Surface-Volume (*.cifti)', 'HCP Volume (*.cifti)'
+    :param Brain_Mask: None or a brain mask [X Y Z], required for volume data
+    :return: list_batch, a list of batches, each a list of positions in list_file_scan_list. Batches are ordered by their first subject
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    list_batch = []
+    # The batch being filled for each number of time points
+    list_open = {}
+    for n, file_scan_list in enumerate(list_file_scan_list):
+        scan_list = [line.replace('\n', '') for line in open(file_scan_list, 'r')]
+        if '' in scan_list:
+            scan_list = scan_list[:scan_list.index('')]
+        dim_time = sum([load_fmri_scan_shape(scan, dataType, dataFormat, Reshape=True, Brain_Mask=Brain_Mask)[0] for scan in scan_list])
+        if dim_time not in list_open or len(list_open[dim_time]) == batchSize:
+            list_open[dim_time] = []
+            list_batch.append(list_open[dim_time])
+        list_open[dim_time].append(n)
+
+    return list_batch
+
+
+def setup_K_sweep_folder(dir_pnet_result: str, K: int, setting: dict):
+    """
+    setup_K_sweep_folder(dir_pnet_result: str, K: int, setting: dict)
+    Setup the result folder of one K in a sweep of K, which is a complete pNet result folder K_<K> inside dir_pnet_result
+    Data_Input, gNb.mat and scan lists of bootstrap runs are copied from dir_pnet_result, so that all K values share the same bootstrap samples
+    Its settings are those of dir_pnet_result with a single K and Resume enabled, so that run_FN_Computation continues from bootstrap runs computed by the sweep
+
+    :param dir_pnet_result: directory of the pNet result folder with a list of K
+    :param K: number of FNs of this result folder
+    :param setting: a dict with settings of Data_Input and FN_Computation in dir_pnet_result
+    :return: dir_pnet_result_K, directory of the result folder of K
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    dir_pnet_dataInput, dir_pnet_FNC, _, _, _, _ = setup_result_folder(dir_pnet_result)
+    dir_pnet_result_K = os.path.join(dir_pnet_result, f'K_{K}')
+    dir_pnet_dataInput_K, dir_pnet_FNC_K, _, _, _, _ = setup_result_folder(dir_pnet_result_K)
+
+    shutil.copytree(dir_pnet_dataInput, dir_pnet_dataInput_K, dirs_exist_ok=True)
+    settingFNC = dict(setting['FN_Computation'], K=K, Computation=dict(setting['FN_Computation']['Computation'], Resume=True))
+    write_json_setting(settingFNC, os.path.join(dir_pnet_FNC_K, 'Setting.json'))
+
+    # Bootstrap samples
+    shutil.copyfile(os.path.join(dir_pnet_FNC, 'gNb.mat'), os.path.join(dir_pnet_FNC_K, 'gNb.mat'))
+    nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+    for rep in range(1, 1+nBS):
+        os.makedirs(os.path.join(dir_pnet_FNC_K, 'BootStrapping', str(rep)), exist_ok=True)
+        shutil.copyfile(os.path.join(dir_pnet_FNC, 'BootStrapping', str(rep), 'Scan_List.txt'),
+                        os.path.join(dir_pnet_FNC_K, 'BootStrapping', str(rep), 'Scan_List.txt'))
+
+    return dir_pnet_result_K
+
+
+def finish_K_sweep_folder(dir_pnet_result_K: str):
+    """
+    finish_K_sweep_folder(dir_pnet_result_K: str)
+    Record bootstrap files and bootstrap runs computed by a sweep of K as finished in the manifest of the result folder of one K
+    Fingerprints are computed in the same way as run_FN_Computation, so that it resumes with these units
+
+    :param dir_pnet_result_K: directory of the result folder of one K, see setup_K_sweep_folder
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    dir_pnet_dataInput, dir_pnet_FNC, _, _, _, _ = setup_result_folder(dir_pnet_result_K)
+    dir_pnet_BS = os.path.join(dir_pnet_FNC, 'BootStrapping')
+    dir_manifest = os.path.join(dir_pnet_FNC, 'Manifest')
+    os.makedirs(dir_manifest, exist_ok=True)
+    setting = {'Data_Input': load_json_setting(os.path.join(dir_pnet_dataInput, 'Setting.json')),
+               'FN_Computation': load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))}
+    setting_gFN = setup_fingerprint_setting(setting, 'Group_FN')
+
+    list_file = [os.path.join(dir_pnet_dataInput, file) for file in ('Scan_List.txt', 'Subject_ID.txt', 'Subject_Folder.txt', 'Group_ID.txt')]
+    if not os.path.exists(list_file[3]):
+        list_file = list_file[:3]
+    finish_manifest_unit(dir_manifest, 'Setup_BootStrap', 'Sweep', compute_unit_fingerprint(setting_gFN, list_file))
+    for rep in range(1, 1+setting['FN_Computation']['Group_FN']['BootStrap']['nBS']):
+        if os.path.isfile(os.path.join(dir_pnet_BS, str(rep), 'FN.mat')):
+            finish_manifest_unit(dir_manifest, f'BootStrap_{rep}', 'Sweep',
+                                 compute_unit_fingerprint(setting_gFN, file_scan_list=os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')))
+
+
+def run_gFN_bootstrap(dir_pnet_BS: str, rep: int, gNb: np.ndarray, setting: dict, Brain_Mask=None, Laplacian=None, N_Thread=None, sweepK=None, Data=None):
+    """
+    run_gFN_bootstrap(dir_pnet_BS: str, rep: int, gNb: np.ndarray, setting: dict, Brain_Mask=None, Laplacian=None, N_Thread=None, sweepK=None, Data=None)
+    Compute gFNs of one bootstrap run, and save them into FN.mat and FN.npy in its sub-folder. FN.npy is its row block of the FN stack built by load_FN_stack
+    It is used by run_FN_Computation, either in the main process or in a worker process
+    With sweepK, data are loaded and the Laplacian operator is built once, and gFNs of all K values are computed in ascending order of K
+    With compression and vxI = 0, data are loaded into a memory-mapped Data.npy in the bootstrap folder, which is removed after gFNs are computed
+
+    :param dir_pnet_BS: directory of the BootStrapping folder, which contains a sub-folder for each bootstrap run
+    :param rep: index of the bootstrap run, starting from 1
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param setting: a dict with settings of Data_Input and FN_Computation
+    :param Brain_Mask: None or a brain mask for volume data
+    :param Laplacian: None or a Laplacian operator from setup_Laplacian_operator shared by bootstrap runs. It is built here if None and vxI is 0
+    :param N_Thread: None or number of threads available to this bootstrap run, shared by concurrent repetitions of gFN_NMF
+    :param sweepK: None or a dict {K: directory of the result folder of K} from setup_K_sweep_folder, where results of each K are saved
+    :param Data: None or data of this bootstrap run loaded by load_fmri_scan with Normalization='vp-vmax', such as from prefetch_fmri_scan. It is loaded here if None
+    :return: Laplacian, the Laplacian operator used, which can be shared with later bootstrap runs when vxI is 0
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Parameters
+    dataType = setting['Data_Input']['Data_Type']
+    dataFormat = setting['Data_Input']['Data_Format']
+    K = setting['FN_Computation']['K']
+    maxIter = setting['FN_Computation']['Group_FN']['maxIter']
+    minIter = setting['FN_Computation']['Group_FN']['minIter']
+    error = setting['FN_Computation']['Group_FN']['error']
+    normW = setting['FN_Computation']['Group_FN']['normW']
+    Alpha = setting['FN_Computation']['Group_FN']['Alpha']
+    Beta = setting['FN_Computation']['Group_FN']['Beta']
+    alphaS = setting['FN_Computation']['Group_FN']['alphaS']
+    alphaL = setting['FN_Computation']['Group_FN']['alphaL']
+    vxI = setting['FN_Computation']['Group_FN']['vxI']
+    ard = setting['FN_Computation']['Group_FN']['ard']
+    eta = setting['FN_Computation']['Group_FN']['eta']
+    nRepeat = setting['FN_Computation']['Group_FN']['nRepeat']
+    solver = setting['FN_Computation']['Group_FN'].get('solver', 'mu')
+    Compression = setting['FN_Computation']['Group_FN'].get('Compression', {'Enable': False})
+    sketchSize = Compression['sketchSize'] if Compression['Enable'] else 0
+    Online = setting['FN_Computation']['Group_FN'].get('Online', {'Enable': False})
+    Parallel_Repeat = setting['FN_Computation']['Group_FN'].get('Parallel_Repeat', {'Enable': False})
+    nParallel = Parallel_Repeat['nParallel'] if Parallel_Repeat['Enable'] else 1
+    abandonRatio = Parallel_Repeat.get('abandonRatio', 0.05)
+    Sweep_Warm_Start = setting['FN_Computation']['Group_FN'].get('Sweep_Warm_Start', False)
+    dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+    Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+    nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+
+    # Threads of a worker are split among concurrent repetitions in gFN_NMF
+    if N_Thread is not None and nParallel != 1:
+        if nParallel == 'Automatic':
+            nParallel = N_Thread
+        set_computation_thread(N_Thread)
+
+    # K values and BootStrapping folders to save their results
+    if sweepK is None:
+        list_K = [(K, dir_pnet_BS)]
+    else:
+        list_K = [(K, os.path.join(sweepK[K], 'FN_Computation', 'BootStrapping')) for K in sorted(sweepK)]
+
+    # log file
+    logFile = os.path.join(dir_pnet_BS, str(rep), 'Log.log')
+    # load data
+    file_scan_list = os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')
+    Laplacian_BS = Laplacian
+    file_Data = None
+    if not (Online['Enable'] and vxI == 0):
+        if Data is None:
+            if sketchSize != 0 and vxI == 0:
+                # With compression, data stay on disk, and both the temporal sketch and the refinement read them in blocks
+                file_Data = os.path.join(dir_pnet_BS, str(rep), 'Data.npy')
+            Data = load_fmri_scan(file_scan_list, dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
+                                  Normalization='vp-vmax', Cache=Cache, file_memmap=file_Data, logFile=logFile)
+        if Laplacian is None and vxI == 0:
+            Laplacian = setup_Laplacian_operator(gNb, Data.shape[1], normW=normW, dataPrecision=dataPrecision)
+        Laplacian_BS = Laplacian
+        if sweepK is not None and vxI > 0:
+            # The Laplacian operator with vxI depends on data only, and it is rescaled to alphaL of each K by gFN_NMF
+            Laplacian_BS = setup_Laplacian_operator(gNb, Data.shape[1], vxI=vxI, X=Data, normW=normW, dataPrecision=dataPrecision)
+
+    FN_BS = None
+    for K, dir_pnet_BS_K in list_K:
+        logFile_K = logFile if sweepK is None else os.path.join(dir_pnet_BS_K, str(rep), 'Log.log')
+        # gFNs of the previous K start the first FNs of this K
+        initV = FN_BS if Sweep_Warm_Start else None
+        if Online['Enable'] and vxI == 0:
+            # stream scans from disk without concatenation
+            FN_BS = gFN_NMF_online(file_scan_list, K, gNb, dataType=dataType, dataFormat=dataFormat, Brain_Mask=Brain_Mask,
+                                   maxIter=maxIter, minIter=minIter, error=error, normW=normW,
+                                   Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, ard=ard, eta=eta,
+                                   nScanBatch=Online['nScanBatch'], Laplacian=Laplacian, Cache=Cache, dataPrecision=dataPrecision, logFile=logFile_K)
+        else:
+            # perform NMF
+            FN_BS = gFN_NMF(Data, K, gNb, maxIter=maxIter, minIter=minIter, error=error, normW=normW,
+                            Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, vxI=vxI, ard=ard, eta=eta,
+                            nRepeat=nRepeat, solver=solver, Laplacian=Laplacian_BS, sketchSize=sketchSize, nParallel=nParallel, abandonRatio=abandonRatio,
+                            initV=initV, dataPrecision=dataPrecision, logFile=logFile_K)
+        # save results, and FN.npy after FN.mat so that it is not older than FN.mat
+        sio.savemat(os.path.join(dir_pnet_BS_K, str(rep), 'FN.mat'), {"FN": reshape_FN(FN_BS, dataType=dataType, Brain_Mask=Brain_Mask)})
+        save_FN_block(os.path.join(dir_pnet_BS_K, str(rep), 'FN.npy'), FN_BS)
+
+    if file_Data is not None:
+        del Data
+        os.remove(file_Data)
+
+    return Laplacian
+
+
+def run_pFN_subject(dir_pnet_pFN_indv: str, gFN: np.ndarray, gNb: np.ndarray, setting: dict, Brain_Mask=None, Laplacian=None, fingerprint=None, Data=None):
+    """
+    run_pFN_subject(dir_pnet_pFN_indv: str, gFN: np.ndarray, gNb: np.ndarray, setting: dict, Brain_Mask=None, Laplacian=None, fingerprint=None, Data=None)
+    Compute pFNs of one subject folder in Personalized_FN, and save them into FN.mat and TC.mat
+    It is used by run_FN_Computation, either in the main process or in a worker process
+
+    :param dir_pnet_pFN_indv: directory of the subject folder, containing Scan_List.txt
+    :param gFN: group level FNs, 2D matrix [dim_space, K]
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param setting: a dict with settings of Data_Input and FN_Computation
+    :param Brain_Mask: None or a brain mask for volume data
+    :param Laplacian: None or a Laplacian operator from setup_Laplacian_operator shared by subjects
+    :param fingerprint: None or a str from compute_unit_fingerprint. With checkpoints enabled in setting, it identifies the checkpoint to resume from
+    :param Data: None or data of this subject folder loaded by load_fmri_scan, such as from prefetch_fmri_scan. It is loaded here if None
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Parameters
+    dataType = setting['Data_Input']['Data_Type']
+    dataFormat = setting['Data_Input']['Data_Format']
+    maxIter = setting['FN_Computation']['Personalized_FN']['maxIter']
+    minIter = setting['FN_Computation']['Personalized_FN']['minIter']
+    meanFitRatio = setting['FN_Computation']['Personalized_FN']['meanFitRatio']
+    error = setting['FN_Computation']['Personalized_FN']['error']
+    normW = setting['FN_Computation']['Personalized_FN']['normW']
+    Alpha = setting['FN_Computation']['Personalized_FN']['Alpha']
+    Beta = setting['FN_Computation']['Personalized_FN']['Beta']
+    alphaS = setting['FN_Computation']['Personalized_FN']['alphaS']
+    alphaL = setting['FN_Computation']['Personalized_FN']['alphaL']
+    vxI = setting['FN_Computation']['Personalized_FN']['vxI']
+    ard = setting['FN_Computation']['Personalized_FN']['ard']
+    eta = setting['FN_Computation']['Personalized_FN']['eta']
+    solver = setting['FN_Computation']['Personalized_FN'].get('solver', 'mu')
+    dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+    Checkpoint = setting['FN_Computation']['Computation'].get('Checkpoint', {'Enable': False})
+    Warm_Start = setting['FN_Computation']['Personalized_FN'].get('Warm_Start', {'Enable': False})
+    Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+
+    # log file
+    logFile = os.path.join(dir_pnet_pFN_indv, 'Log.log')
+    # Checkpoints of U and V during a long run
+    file_checkpoint = os.path.join(dir_pnet_pFN_indv, 'Checkpoint.npz') if Checkpoint['Enable'] else None
+    checkpointInterval = Checkpoint.get('Interval', 600)
+    # Warm start from previous pFNs of this subject folder
+    initUV = None
+    if Warm_Start['Enable']:
+        file_warmStart = setup_warm_start_file(Warm_Start['dir_warmStart'], os.path.basename(os.path.normpath(dir_pnet_pFN_indv)), gFN)
+        initUV = load_warm_start(file_warmStart, setting['FN_Computation']['Personalized_FN'])
+    # load data
+    if Data is None:
+        Data = load_fmri_scan(os.path.join(dir_pnet_pFN_indv, 'Scan_List.txt'),
+                              dataType=dataType, dataFormat=dataFormat,
+                              Reshape=True, Brain_Mask=Brain_Mask, Cache=Cache, logFile=logFile)
+    # perform NMF
+    TC, pFN = pFN_NMF(Data, gFN, gNb, maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio, error=error, normW=normW,
+                      Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, vxI=vxI, ard=ard, eta=eta,
+                      solver=solver, Laplacian=Laplacian, initUV=initUV,
+                      file_checkpoint=file_checkpoint, checkpointInterval=checkpointInterval, fingerprint='' if fingerprint is None else fingerprint,
+                      dataPrecision=dataPrecision, logFile=logFile)
+    if Warm_Start['Enable']:
+        save_warm_start(file_warmStart, TC, pFN, setting['FN_Computation']['Personalized_FN'])
+    # output
+    pFN = reshape_FN(pFN, dataType=dataType, Brain_Mask=Brain_Mask)
+    sio.savemat(os.path.join(dir_pnet_pFN_indv, 'FN.mat'), {"FN": pFN})
+    sio.savemat(os.path.join(dir_pnet_pFN_indv, 'TC.mat'), {"TC": TC})
+    # The checkpoint is no longer needed
+    if file_checkpoint is not None and os.path.isfile(file_checkpoint):
+        os.remove(file_checkpoint)
+
+
+def run_gFN_fusion(dir_pnet_result: str, setting: dict, Brain_Mask=None):
+    """
+    run_gFN_fusion(dir_pnet_result: str, setting: dict, Brain_Mask=None)
+    Fuse gFNs of all bootstrap runs using NCut, and save them into FN.mat in Group_FN
+
+    :param dir_pnet_result: directory of pNet result folder
+    :param setting: a dict with settings of Data_Input and FN_Computation
+    :param Brain_Mask: None or a brain mask for volume data
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    _, dir_pnet_FNC, dir_pnet_gFN, _, _, _ = setup_result_folder(dir_pnet_result)
+    dir_pnet_BS = os.path.join(dir_pnet_FNC, 'BootStrapping')
+    dataType = setting['Data_Input']['Data_Type']
+    K = setting['FN_Computation']['K']
+    nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+
+    # load bootstrapped results, memory-mapped from the FN stack
+    gFN_BS = load_FN_stack(dir_pnet_BS, nBS, K, dataType=dataType, Brain_Mask=Brain_Mask)
+    # log
+    logFile = os.path.join(dir_pnet_gFN, 'Log.log')
+    # Fuse bootstrapped results
+    gFN = gFN_fusion_NCut(gFN_BS, K, logFile=logFile)
+    del gFN_BS
+    # output
+    gFN = reshape_FN(gFN, dataType=dataType, Brain_Mask=Brain_Mask)
+    sio.savemat(os.path.join(dir_pnet_gFN, 'FN.mat'), {"FN": gFN})
+
+
+def run_FN_Computation(dir_pnet_result: str, shard=None, unitRange=None):
     """
-    run_FN_Computation(dir_pnet_result: str)
+    run_FN_Computation(dir_pnet_result: str, shard=None, unitRange=None)
     run the FN Computation module with settings ready in Data_Input and FN_Computation
+    With shard or unitRange, it runs one job of a job array, computing a slice of bootstrap runs, or a slice of subject folders once gFNs are ready
+    Jobs coordinate through a manifest of claimed and finished units in FN_Computation, and gather_FN_Computation fuses bootstrap results and checks completeness
+    Finished units are recorded in the manifest with fingerprints of their inputs and settings. With Resume enabled in setting, or in shards, units finished with the same fingerprints are skipped
 
     :param dir_pnet_result: directory of pNet result folder
+    :param shard: None or [shardIndex, shardCount], to compute the shardIndex-th of shardCount interleaved slices, with shardIndex starting from 1
+    :param unitRange: None or [first, last], to compute bootstrap runs or subject folders from first to last, starting from 1
 
     Yuncong Ma, 11/7/2023
     """
 
+    # Worker processes of parallel computation import the main script again, and must not rerun FN computation
+    check_main_process()
+
     # get directories of sub-folders
     dir_pnet_dataInput, dir_pnet_FNC, dir_pnet_gFN, dir_pnet_pFN, _, _ = setup_result_folder(dir_pnet_result)
 
+    # shard spec
+    owner = setup_shard_owner(shard, unitRange)
+    flag_Shard = owner is not None
+    if not flag_Shard:
+        # A single job computes all units
+        owner = 'All'
+    dir_manifest = os.path.join(dir_pnet_FNC, 'Manifest')
+    os.makedirs(dir_manifest, exist_ok=True)
+
     # log file
-    logFile_FNC = os.path.join(dir_pnet_FNC, 'log.log')
-    logFile_FNC = open(logFile_FNC, 'w')
+    if flag_Shard:
+        # Each shard has its own log file
+        logFile_FNC = os.path.join(dir_pnet_FNC, f'log_{owner}.log')
+    else:
+        logFile_FNC = os.path.join(dir_pnet_FNC, 'log.log')
+    logFile_FNC = open(logFile_FNC, 'a' if flag_Shard else 'w')
     print('\nStart FN computation using Numpy at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())) + '\n',
           file=logFile_FNC, flush=True)
 
@@ -1329,6 +3720,12 @@ def run_FN_Computation(dir_pnet_result: str):
     settingFNC = load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))
     setting = {'Data_Input': settingDataInput, 'FN_Computation': settingFNC}
     print('Settings are loaded from folder Data_Input and FN_Computation', file=logFile_FNC, flush=True)
+    # Skip units finished with the same inputs and settings. Shards skip units finished with the same fingerprints when claiming them, see claim_manifest_unit
+    Resume = setting['FN_Computation']['Computation'].get('Resume', False) and not flag_Shard
+    # A list of K runs a sweep of K, with a result folder for each K, see setup_K_sweep_folder
+    flag_Sweep = isinstance(setting['FN_Computation']['K'], list)
+    if flag_Sweep and (flag_Shard or setting['FN_Computation']['Group_FN']['file_gFN'] is not None):
+        raise ValueError('A sweep of K does not support shard, unitRange or file_gFN')
 
     # load basic settings
     dataType = setting['Data_Input']['Data_Type']
@@ -1348,7 +3745,11 @@ def run_FN_Computation(dir_pnet_result: str):
     if setting['FN_Computation']['Method'] == 'SR-NMF':
         print('FN computation uses spatial-regularized non-negative matrix factorization method', file=logFile_FNC, flush=True)
 
-        if setting['FN_Computation']['Group_FN']['file_gFN'] is None:
+        if flag_Shard and setting['FN_Computation']['Group_FN']['file_gFN'] is None and check_gathered_gFN(dir_pnet_FNC, dir_pnet_gFN, setting):
+            # gFNs have been gathered from bootstrap runs of all shards, with the same settings
+            print('Use gFNs gathered from bootstrap runs of all shards', file=logFile_FNC, flush=True)
+
+        elif setting['FN_Computation']['Group_FN']['file_gFN'] is None:
             # 2 steps
             # step 1 ============== bootstrap
             # sub-folder in FNC for storing bootstrapped results
@@ -1359,81 +3760,137 @@ def run_FN_Computation(dir_pnet_result: str):
             # Log
             logFile = os.path.join(dir_pnet_BS, 'Log.log')
 
-            # Generate additional parameters
-            gNb = compute_gNb(Brain_Template)
-            scipy.io.savemat(os.path.join(dir_pnet_FNC, 'gNb.mat'), {'gNb': gNb})
             # Input files
             file_scan = os.path.join(dir_pnet_dataInput, 'Scan_List.txt')
             file_subject_ID = os.path.join(dir_pnet_dataInput, 'Subject_ID.txt')
             file_subject_folder = os.path.join(dir_pnet_dataInput, 'Subject_Folder.txt')
             file_group_ID = os.path.join(dir_pnet_dataInput, 'Group_ID.txt')
             if not os.path.exists(file_group_ID):
-                file_group = None
+                file_group_ID = None
             # Parameters
             combineScan = setting['FN_Computation']['Combine_Scan']
             samplingMethod = setting['FN_Computation']['Group_FN']['BootStrap']['samplingMethod']
             sampleSize = setting['FN_Computation']['Group_FN']['BootStrap']['sampleSize']
             nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+            # Settings for fingerprints of units
+            setting_gFN = setup_fingerprint_setting(setting, 'Group_FN')
+            fingerprint_setup = compute_unit_fingerprint(setting_gFN, [file_scan, file_subject_ID, file_subject_folder] + ([] if file_group_ID is None else [file_group_ID]))
+
+            # Bootstrap files are prepared once for all shards, and reused when resuming
+            if Resume and check_manifest_unit(dir_manifest, 'Setup_BootStrap', fingerprint_setup) and os.path.isfile(os.path.join(dir_pnet_FNC, 'gNb.mat')):
+                print('Resume with bootstrap files of a previous run', file=logFile_FNC, flush=True)
+                gNb = load_matlab_single_array(os.path.join(dir_pnet_FNC, 'gNb.mat'))
+            elif not flag_Shard or claim_manifest_unit(dir_manifest, 'Setup_BootStrap', owner, fingerprint_setup):
+                # Generate additional parameters
+                gNb = compute_gNb(Brain_Template)
+                scipy.io.savemat(os.path.join(dir_pnet_FNC, 'gNb.mat'), {'gNb': gNb})
+
+                # create scan lists for bootstrap
+                bootstrap_scan(dir_pnet_BS, file_scan, file_subject_ID, file_subject_folder,
+                               file_group_ID=file_group_ID, combineScan=combineScan,
+                               samplingMethod=samplingMethod, sampleSize=sampleSize, nBS=nBS, logFile=logFile)
+                finish_manifest_unit(dir_manifest, 'Setup_BootStrap', owner, fingerprint_setup)
+            else:
+                wait_manifest_unit(dir_manifest, 'Setup_BootStrap', logFile=logFile_FNC)
+                gNb = load_matlab_single_array(os.path.join(dir_pnet_FNC, 'gNb.mat'))
 
-            # create scan lists for bootstrap
-            bootstrap_scan(dir_pnet_BS, file_scan, file_subject_ID, file_subject_folder,
-                           file_group_ID=file_group_ID, combineScan=combineScan,
-                           samplingMethod=samplingMethod, sampleSize=sampleSize, nBS=nBS, logFile=logFile)
+            # Result folders of K values in a sweep of K, sharing bootstrap samples
+            sweepK = None
+            list_dir_BS = [dir_pnet_BS]
+            if flag_Sweep:
+                sweepK = {K: setup_K_sweep_folder(dir_pnet_result, K, setting) for K in sorted(setting['FN_Computation']['K'])}
+                list_dir_BS = [os.path.join(sweepK[K], 'FN_Computation', 'BootStrapping') for K in sweepK]
+                print('Run a sweep of K = ' + ', '.join([str(K) for K in sweepK]) + ', sharing data loading of bootstrap runs', file=logFile_FNC, flush=True)
 
             # Parameters
             K = setting['FN_Computation']['K']
-            maxIter = setting['FN_Computation']['Group_FN']['maxIter']
-            minIter = setting['FN_Computation']['Group_FN']['minIter']
-            error = setting['FN_Computation']['Group_FN']['error']
-            normW = setting['FN_Computation']['Group_FN']['normW']
-            Alpha = setting['FN_Computation']['Group_FN']['Alpha']
-            Beta = setting['FN_Computation']['Group_FN']['Beta']
-            alphaS = setting['FN_Computation']['Group_FN']['alphaS']
-            alphaL = setting['FN_Computation']['Group_FN']['alphaL']
-            vxI = setting['FN_Computation']['Group_FN']['vxI']
-            ard = setting['FN_Computation']['Group_FN']['ard']
-            eta = setting['FN_Computation']['Group_FN']['eta']
-            nRepeat = setting['FN_Computation']['Group_FN']['nRepeat']
-            dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+            Parallel = setting['FN_Computation']['Computation'].get('Parallel', False)
+            N_Thread = setting['FN_Computation']['Computation'].get('N_Thread', 1)
+            N_Process = setting['FN_Computation']['Computation'].get('N_Process', 'Automatic')
+            Prefetch = setting['FN_Computation']['Computation'].get('Prefetch', {'Enable': False})
+            Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+            Online = setting['FN_Computation']['Group_FN'].get('Online', {'Enable': False})
+            Compression = setting['FN_Computation']['Group_FN'].get('Compression', {'Enable': False})
+            # Bootstrap runs of this job
+            list_rep = list(range(1, 1+nBS)) if not flag_Shard else select_shard_unit(nBS, shard, unitRange)
+            list_fingerprint = {rep: compute_unit_fingerprint(setting_gFN, file_scan_list=os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')) for rep in list_rep}
+            if flag_Shard:
+                # Bootstrap runs finished with different inputs or settings are computed again
+                list_rep = [rep for rep in list_rep if claim_manifest_unit(dir_manifest, f'BootStrap_{rep}', owner, list_fingerprint[rep])]
+            if Resume:
+                list_rep = [rep for rep in list_rep if not (check_manifest_unit(dir_manifest, f'BootStrap_{rep}', list_fingerprint[rep])
+                                                            and all([os.path.isfile(os.path.join(dir_BS, str(rep), 'FN.mat')) for dir_BS in list_dir_BS]))]
+                print(f'Resume with {nBS - len(list_rep)} finished bootstrap runs', file=logFile_FNC, flush=True)
 
             # NMF on bootstrapped subsets
             print('Start to NMF for each bootstrap at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
-            for rep in range(1, 1+nBS):
-                # log file
-                logFile = os.path.join(dir_pnet_BS, str(rep), 'Log.log')
-                # load data
-                file_scan_list = os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')
-                Data = load_fmri_scan(file_scan_list, dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
-                                      Normalization='vp-vmax', logFile=logFile)
-                # perform NMF
-                FN_BS = gFN_NMF(Data, K, gNb, maxIter=maxIter, minIter=minIter, error=error, normW=normW,
-                                Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, vxI=vxI, ard=ard, eta=eta,
-                                nRepeat=nRepeat, dataPrecision=dataPrecision, logFile=logFile)
-                # save results
-                FN_BS = reshape_FN(FN_BS, dataType=dataType, Brain_Mask=Brain_Mask)
-                sio.savemat(os.path.join(dir_pnet_BS, str(rep), 'FN.mat'), {"FN": FN_BS})
+            if Parallel and len(list_rep) > 1:
+                # Bootstrap runs are dispatched to worker processes, and N_Thread threads are split among workers
+                nWorker, nThread_Worker = setup_parallel_worker(len(list_rep), N_Thread, N_Process)
+                print(f'Run {len(list_rep)} bootstraps using {nWorker} workers with {nThread_Worker} threads each', file=logFile_FNC, flush=True)
+                # Each bootstrap run builds its own Laplacian operator, as its size is known after loading data
+                with setup_process_pool(nWorker, nThread_Worker) as executor:
+                    list_future = {executor.submit(run_gFN_bootstrap, dir_pnet_BS, rep, gNb, setting, Brain_Mask, None, nThread_Worker, sweepK): rep
+                                   for rep in list_rep}
+                    # FN.mat of each bootstrap run is saved once it finishes
+                    for future in concurrent.futures.as_completed(list_future):
+                        future.result()
+                        finish_manifest_unit(dir_manifest, f'BootStrap_{list_future[future]}', owner, list_fingerprint[list_future[future]])
+                        print(f'Finished {list_future[future]}-th bootstrap at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+            else:
+                # Laplacian operator shared by all bootstrap runs when it does not depend on data
+                Laplacian = None
+                # Data of next bootstrap runs are loaded in background threads, except in the online mode and the compression mode
+                Data_Source = None
+                if Prefetch['Enable'] and not ((Online['Enable'] or Compression['Enable']) and setting['FN_Computation']['Group_FN']['vxI'] == 0):
+                    Data_Source = prefetch_fmri_scan([os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt') for rep in list_rep],
+                                                     dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask, Normalization='vp-vmax',
+                                                     nPrefetch=Prefetch.get('nPrefetch', 2), maxMemory=Prefetch.get('maxMemory', None), Cache=Cache,
+                                                     list_logFile=[os.path.join(dir_pnet_BS, str(rep), 'Log.log') for rep in list_rep])
+                for rep in list_rep:
+                    Laplacian = run_gFN_bootstrap(dir_pnet_BS, rep, gNb, setting, Brain_Mask=Brain_Mask, Laplacian=Laplacian, sweepK=sweepK,
+                                                  Data=None if Data_Source is None else next(Data_Source))
+                    finish_manifest_unit(dir_manifest, f'BootStrap_{rep}', owner, list_fingerprint[rep])
+
+            if flag_Shard:
+                # gFNs are fused by gather_FN_Computation after all shards finish
+                print('Finished bootstrap runs of this shard at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())) +
+                      '. Run gather_FN_Computation after all shards finish', file=logFile_FNC, flush=True)
+                return
+
+            if flag_Sweep:
+                # Each K resumes from bootstrap runs of the sweep in its own result folder
+                for K in sweepK:
+                    finish_K_sweep_folder(sweepK[K])
+                    print(f'Start FN computation of K = {K} in folder ' + sweepK[K] + ' at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+                    run_FN_Computation(sweepK[K])
+                print('Finished FN computation at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+                return
 
             # step 2 ============== fuse results
             # Generate gFNs
-            print('Start to fuse bootstrapped results using NCut at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
-            FN_BS = np.empty(nBS, dtype=np.ndarray)
-            # load bootstrapped results
-            for rep in range(1, nBS+1):
-                FN_BS[rep-1] = np.array(reshape_FN(load_matlab_single_array(os.path.join(dir_pnet_BS, str(rep), 'FN.mat')), dataType=dataType, Brain_Mask=Brain_Mask))
-            gFN_BS = np.concatenate(FN_BS, axis=1)
-            # log
-            logFile = os.path.join(dir_pnet_gFN, 'Log.log')
-            # Fuse bootstrapped results
-            gFN = gFN_fusion_NCut(gFN_BS, K, logFile=logFile)
-            # output
-            gFN = reshape_FN(gFN, dataType=dataType, Brain_Mask=Brain_Mask)
-            sio.savemat(os.path.join(dir_pnet_gFN, 'FN.mat'), {"FN": gFN})
+            fingerprint_gFN = compute_unit_fingerprint(setting_gFN, [os.path.join(dir_pnet_BS, str(rep), 'FN.mat') for rep in range(1, 1+nBS)])
+            if Resume and check_manifest_unit(dir_manifest, 'Group_FN', fingerprint_gFN) and os.path.isfile(os.path.join(dir_pnet_gFN, 'FN.mat')):
+                print('Resume with gFNs of a previous run', file=logFile_FNC, flush=True)
+            else:
+                print('Start to fuse bootstrapped results using NCut at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+                run_gFN_fusion(dir_pnet_result, setting, Brain_Mask=Brain_Mask)
+                finish_manifest_unit(dir_manifest, 'Group_FN', owner, fingerprint_gFN)
 
         else:  # use precomputed gFNs
-            file_gFN = setting['FN_Computation']['Group_FN']['file_gFN']
-            gFN = load_matlab_single_array(file_gFN)
-            check_gFN(gFN, method=setting['FN_Computation']['Method'])
-            sio.savemat(os.path.join(dir_pnet_gFN, 'FN.mat'), {"FN": gFN})
+            # Precomputed gFNs are copied once for all shards
+            if not flag_Shard or claim_manifest_unit(dir_manifest, 'Setup_gFN', owner):
+                file_gFN = setting['FN_Computation']['Group_FN']['file_gFN']
+                gFN = load_matlab_single_array(file_gFN)
+                check_gFN(gFN, method=setting['FN_Computation']['Method'])
+                sio.savemat(os.path.join(dir_pnet_gFN, 'FN.mat'), {"FN": gFN})
+                # gNb is required for pFNs
+                gNb = compute_gNb(Brain_Template)
+                scipy.io.savemat(os.path.join(dir_pnet_FNC, 'gNb.mat'), {'gNb': gNb})
+                if flag_Shard:
+                    finish_manifest_unit(dir_manifest, 'Setup_gFN', owner)
+            else:
+                wait_manifest_unit(dir_manifest, 'Setup_gFN', logFile=logFile_FNC)
             print('load precomputed gFNs', file=logFile_FNC, flush=True)
         # ============================================= #
 
@@ -1445,45 +3902,234 @@ def run_FN_Computation(dir_pnet_result: str):
         gNb = load_matlab_single_array(os.path.join(dir_pnet_FNC, 'gNb.mat'))
         # reshape to 2D if required
         gFN = reshape_FN(gFN, dataType=dataType, Brain_Mask=Brain_Mask)
-        # setup folders in Personalized_FN
-        list_subject_folder = setup_pFN_folder(dir_pnet_result)
+        # setup folders in Personalized_FN, once for all shards
+        if not flag_Shard or claim_manifest_unit(dir_manifest, 'Setup_Personalized_FN', owner):
+            list_subject_folder = setup_pFN_folder(dir_pnet_result)
+            if flag_Shard:
+                finish_manifest_unit(dir_manifest, 'Setup_Personalized_FN', owner)
+        else:
+            wait_manifest_unit(dir_manifest, 'Setup_Personalized_FN', logFile=logFile_FNC)
+            list_subject_folder = setup_pFN_folder(dir_pnet_result, createFolder=False)
         N_Scan = len(list_subject_folder)
-        for i in range(1, N_Scan+1):
-            print(f'Start to compute pFNs for {i}-th folder: {list_subject_folder[i-1]}', file=logFile_FNC, flush=True)
-            dir_pnet_pFN_indv = os.path.join(dir_pnet_pFN, list_subject_folder[i-1])
-            # parameter
-            maxIter = setting['FN_Computation']['Personalized_FN']['maxIter']
-            minIter = setting['FN_Computation']['Personalized_FN']['minIter']
-            meanFitRatio = setting['FN_Computation']['Personalized_FN']['meanFitRatio']
-            error = setting['FN_Computation']['Personalized_FN']['error']
-            normW = setting['FN_Computation']['Personalized_FN']['normW']
-            Alpha = setting['FN_Computation']['Personalized_FN']['Alpha']
-            Beta = setting['FN_Computation']['Personalized_FN']['Beta']
-            alphaS = setting['FN_Computation']['Personalized_FN']['alphaS']
-            alphaL = setting['FN_Computation']['Personalized_FN']['alphaL']
-            vxI = setting['FN_Computation']['Personalized_FN']['vxI']
-            ard = setting['FN_Computation']['Personalized_FN']['ard']
-            eta = setting['FN_Computation']['Personalized_FN']['eta']
-            dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
-            # log file
-            logFile = os.path.join(dir_pnet_pFN_indv, 'Log.log')
-            # load data
-            Data = load_fmri_scan(os.path.join(dir_pnet_pFN_indv, 'Scan_List.txt'),
-                                  dataType=dataType, dataFormat=dataFormat,
-                                  Reshape=True, Brain_Mask=Brain_Mask, logFile=logFile)
-            # perform NMF
-            TC, pFN = pFN_NMF(Data, gFN, gNb, maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio, error=error, normW=normW,
-                              Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, vxI=vxI, ard=ard, eta=eta,
-                              dataPrecision=dataPrecision, logFile=logFile)
-            # output
-            pFN = reshape_FN(pFN.numpy(), dataType=dataType, Brain_Mask=Brain_Mask)
-            sio.savemat(os.path.join(dir_pnet_pFN_indv, 'FN.mat'), {"FN": pFN})
-            sio.savemat(os.path.join(dir_pnet_pFN_indv, 'TC.mat'), {"TC": TC})
+        # Subject folders of this job
+        list_index = list(range(1, N_Scan+1)) if not flag_Shard else select_shard_unit(N_Scan, shard, unitRange)
+        # Fingerprints of subject folders also depend on gFNs
+        setting_pFN = setup_fingerprint_setting(setting, 'Personalized_FN')
+        setting_pFN['gFN'] = compute_unit_fingerprint({}, list_array=[gFN])
+        list_fingerprint = {i: compute_unit_fingerprint(setting_pFN, file_scan_list=os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Scan_List.txt')) for i in list_index}
+        if flag_Shard:
+            # Subject folders finished with different inputs or settings are computed again
+            list_index = [i for i in list_index if claim_manifest_unit(dir_manifest, f'Personalized_FN_{i}', owner, list_fingerprint[i])]
+        if Resume:
+            list_index = [i for i in list_index if not (check_manifest_unit(dir_manifest, f'Personalized_FN_{i}', list_fingerprint[i])
+                                                        and os.path.isfile(os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'FN.mat'))
+                                                        and os.path.isfile(os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'TC.mat')))]
+            print(f'Resume with {N_Scan - len(list_index)} finished subject folders', file=logFile_FNC, flush=True)
+        # parameter
+        maxIter = setting['FN_Computation']['Personalized_FN']['maxIter']
+        minIter = setting['FN_Computation']['Personalized_FN']['minIter']
+        meanFitRatio = setting['FN_Computation']['Personalized_FN']['meanFitRatio']
+        error = setting['FN_Computation']['Personalized_FN']['error']
+        normW = setting['FN_Computation']['Personalized_FN']['normW']
+        Alpha = setting['FN_Computation']['Personalized_FN']['Alpha']
+        Beta = setting['FN_Computation']['Personalized_FN']['Beta']
+        alphaS = setting['FN_Computation']['Personalized_FN']['alphaS']
+        alphaL = setting['FN_Computation']['Personalized_FN']['alphaL']
+        vxI = setting['FN_Computation']['Personalized_FN']['vxI']
+        ard = setting['FN_Computation']['Personalized_FN']['ard']
+        eta = setting['FN_Computation']['Personalized_FN']['eta']
+        solver = setting['FN_Computation']['Personalized_FN'].get('solver', 'mu')
+        batchSize = setting['FN_Computation']['Personalized_FN'].get('batchSize', 1)
+        dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+        Parallel = setting['FN_Computation']['Computation'].get('Parallel', False)
+        N_Thread = setting['FN_Computation']['Computation'].get('N_Thread', 1)
+        N_Process = setting['FN_Computation']['Computation'].get('N_Process', 'Automatic')
+        Prefetch = setting['FN_Computation']['Computation'].get('Prefetch', {'Enable': False})
+        Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+        # Laplacian operator shared by all subjects when it does not depend on data
+        Laplacian = None
+        if vxI == 0:
+            Laplacian = setup_Laplacian_operator(gNb, gFN.shape[0], normW=normW, dataPrecision=dataPrecision)
+
+        if Parallel and len(list_index) > 1:
+            # Subjects are dispatched to worker processes, and N_Thread threads are split among workers
+            nWorker, nThread_Worker = setup_parallel_worker(len(list_index), N_Thread, N_Process)
+            print(f'Run {len(list_index)} folders using {nWorker} workers with {nThread_Worker} threads each', file=logFile_FNC, flush=True)
+            with setup_process_pool(nWorker, nThread_Worker) as executor:
+                list_future = {executor.submit(run_pFN_subject, os.path.join(dir_pnet_pFN, list_subject_folder[i-1]), gFN, gNb, setting, Brain_Mask, Laplacian, list_fingerprint[i]): i
+                               for i in list_index}
+                # FN.mat and TC.mat of each subject are saved once it finishes
+                for nFinished, future in enumerate(concurrent.futures.as_completed(list_future), 1):
+                    future.result()
+                    finish_manifest_unit(dir_manifest, f'Personalized_FN_{list_future[future]}', owner, list_fingerprint[list_future[future]])
+                    print(f'Finished pFNs ({nFinished}/{len(list_index)}) for {list_future[future]}-th folder: {list_subject_folder[list_future[future]-1]} at '
+                          + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+        else:
+            # Subjects with the same number of time points are computed in batches
+            # Batches are set up from file headers, so that data of a batch are loaded only when it runs
+            flag_Batch = batchSize > 1 and solver == 'mu' and vxI == 0
+            if flag_Batch:
+                list_batch = setup_pFN_batch([os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Scan_List.txt') for i in list_index], batchSize,
+                                             dataType=dataType, dataFormat=dataFormat, Brain_Mask=Brain_Mask)
+                list_batch = [[list_index[n] for n in batch] for batch in list_batch]
+            else:
+                list_batch = [[i] for i in list_index]
+            list_index = [i for batch in list_batch for i in batch]
+            # Data of next subject folders are loaded in background threads
+            Data_Source = None
+            if Prefetch['Enable']:
+                Data_Source = prefetch_fmri_scan([os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Scan_List.txt') for i in list_index],
+                                                 dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
+                                                 nPrefetch=Prefetch.get('nPrefetch', 2), maxMemory=Prefetch.get('maxMemory', None), Cache=Cache,
+                                                 list_logFile=[os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Log.log') for i in list_index])
+            for list_index_batch in list_batch:
+                list_dir = []
+                list_Data = []
+                for i in list_index_batch:
+                    print(f'Start to compute pFNs for {i}-th folder: {list_subject_folder[i-1]}', file=logFile_FNC, flush=True)
+                    dir_pnet_pFN_indv = os.path.join(dir_pnet_pFN, list_subject_folder[i-1])
+                    Data = None if Data_Source is None else next(Data_Source)
+
+                    if not flag_Batch:
+                        run_pFN_subject(dir_pnet_pFN_indv, gFN, gNb, setting, Brain_Mask=Brain_Mask, Laplacian=Laplacian, fingerprint=list_fingerprint[i], Data=Data)
+                        finish_manifest_unit(dir_manifest, f'Personalized_FN_{i}', owner, list_fingerprint[i])
+                        continue
+
+                    # load data
+                    if Data is None:
+                        Data = load_fmri_scan(os.path.join(dir_pnet_pFN_indv, 'Scan_List.txt'),
+                                              dataType=dataType, dataFormat=dataFormat,
+                                              Reshape=True, Brain_Mask=Brain_Mask, Cache=Cache, logFile=os.path.join(dir_pnet_pFN_indv, 'Log.log'))
+                    list_dir.append(dir_pnet_pFN_indv)
+                    list_Data.append(Data)
+                    del Data
+                if not flag_Batch:
+                    continue
+
+                TC_list, pFN_list = pFN_NMF_batch(list_Data, gFN, gNb,
+                                                  maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio, error=error, normW=normW,
+                                                  Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, ard=ard, eta=eta,
+                                                  Laplacian=Laplacian, dataPrecision=dataPrecision,
+                                                  logFile_list=[os.path.join(dir_indv, 'Log.log') for dir_indv in list_dir])
+                del list_Data
+                # output
+                for dir_indv, TC, pFN in zip(list_dir, TC_list, pFN_list):
+                    pFN = reshape_FN(pFN, dataType=dataType, Brain_Mask=Brain_Mask)
+                    sio.savemat(os.path.join(dir_indv, 'FN.mat'), {"FN": pFN})
+                    sio.savemat(os.path.join(dir_indv, 'TC.mat'), {"TC": TC})
+                for i_batch in list_index_batch:
+                    finish_manifest_unit(dir_manifest, f'Personalized_FN_{i_batch}', owner, list_fingerprint[i_batch])
         # ============================================= #
 
     print('Finished FN computation at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
 
 
+def check_gathered_gFN(dir_pnet_FNC: str, dir_pnet_gFN: str, setting: dict):
+    """
+    check_gathered_gFN(dir_pnet_FNC: str, dir_pnet_gFN: str, setting: dict)
+    Check whether gFNs gathered from bootstrap runs of all shards are fused from the current bootstrap results with the current settings
+    It is used by shards to reuse gathered gFNs, and by gather_FN_Computation to fuse gFNs again after bootstrap runs are computed again
+
+    :param dir_pnet_FNC: directory of the FN_Computation folder
+    :param dir_pnet_gFN: directory of the Group_FN folder
+    :param setting: a dict with settings of Data_Input and FN_Computation
+    :return: True if gFNs are gathered with the same fingerprint
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    dir_pnet_BS = os.path.join(dir_pnet_FNC, 'BootStrapping')
+    nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+    list_file_BS = [os.path.join(dir_pnet_BS, str(rep), 'FN.mat') for rep in range(1, 1+nBS)]
+    if not os.path.isfile(os.path.join(dir_pnet_gFN, 'FN.mat')) or not all([os.path.isfile(file) for file in list_file_BS]):
+        return False
+
+    return check_manifest_unit(os.path.join(dir_pnet_FNC, 'Manifest'), 'Group_FN', compute_unit_fingerprint(setup_fingerprint_setting(setting, 'Group_FN'), list_file_BS))
+
+
+def gather_FN_Computation(dir_pnet_result: str):
+    """
+    gather_FN_Computation(dir_pnet_result: str)
+    Gather results of all shards of run_FN_Computation, using the manifest in FN_Computation
+    Once all bootstrap runs are finished, gFNs are fused using NCut, and shards can be submitted again to compute pFNs
+    Once gFNs are ready, it checks whether pFNs of all subject folders are finished
+    Units finished with different inputs or settings, according to their fingerprints in the manifest, are not finished, and gFNs are fused again after their bootstrap runs are computed again
+
+    :param dir_pnet_result: directory of pNet result folder
+    :return: True if all units of the current stage are finished
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # get directories of sub-folders
+    dir_pnet_dataInput, dir_pnet_FNC, dir_pnet_gFN, dir_pnet_pFN, _, _ = setup_result_folder(dir_pnet_result)
+    dir_manifest = os.path.join(dir_pnet_FNC, 'Manifest')
+
+    # log file
+    logFile_FNC = os.path.join(dir_pnet_FNC, 'log.log')
+    logFile_FNC = open(logFile_FNC, 'a')
+    print('\nStart gathering shards of FN computation at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())) + '\n',
+          file=logFile_FNC, flush=True)
+
+    # load settings for data input and FN computation
+    if not os.path.isfile(os.path.join(dir_pnet_dataInput, 'Setting.json')):
+        raise ValueError('Cannot find the setting json file in folder Data_Input')
+    if not os.path.isfile(os.path.join(dir_pnet_FNC, 'Setting.json')):
+        raise ValueError('Cannot find the setting json file in folder FN_Computation')
+    settingDataInput = load_json_setting(os.path.join(dir_pnet_dataInput, 'Setting.json'))
+    settingFNC = load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))
+    setting = {'Data_Input': settingDataInput, 'FN_Computation': settingFNC}
+
+    # gFNs from bootstrap runs
+    if setting['FN_Computation']['Group_FN']['file_gFN'] is None and not check_gathered_gFN(dir_pnet_FNC, dir_pnet_gFN, setting):
+        nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+        dir_pnet_BS = os.path.join(dir_pnet_FNC, 'BootStrapping')
+        # Bootstrap runs finished with different inputs or settings are not finished
+        setting_gFN = setup_fingerprint_setting(setting, 'Group_FN')
+        list_fingerprint = [compute_unit_fingerprint(setting_gFN, file_scan_list=os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt'))
+                            if os.path.isfile(os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')) else None for rep in range(1, nBS+1)]
+        list_missing = check_manifest(dir_manifest, [f'BootStrap_{rep}' for rep in range(1, nBS+1)], list_fingerprint)
+        if len(list_missing) > 0:
+            print(f'{len(list_missing)} of {nBS} bootstrap runs are not finished: ' + ', '.join(list_missing), file=logFile_FNC, flush=True)
+            return False
+
+        # load Brain Template
+        Brain_Template = load_brain_template(os.path.join(dir_pnet_dataInput, 'Brain_Template.json.zip'))
+        if setting['Data_Input']['Data_Type'] == 'Volume':
+            Brain_Mask = Brain_Template['Brain_Mask']
+        else:
+            Brain_Mask = None
+
+        print('Start to fuse bootstrapped results using NCut at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+        run_gFN_fusion(dir_pnet_result, setting, Brain_Mask=Brain_Mask)
+        fingerprint_gFN = compute_unit_fingerprint(setting_gFN, [os.path.join(dir_pnet_BS, str(rep), 'FN.mat') for rep in range(1, 1+nBS)])
+        finish_manifest_unit(dir_manifest, 'Group_FN', 'Gather', fingerprint_gFN)
+        print('gFNs are ready, and shards can be submitted again to compute pFNs', file=logFile_FNC, flush=True)
+        return True
+
+    # pFNs
+    if not os.path.isfile(os.path.join(dir_manifest, 'Setup_Personalized_FN.finished')):
+        print('pFNs have not been started by any shard', file=logFile_FNC, flush=True)
+        return False
+    list_subject_folder = setup_pFN_folder(dir_pnet_result, createFolder=False)
+    N_Scan = len(list_subject_folder)
+    # Subject folders finished with different inputs, settings or gFNs are not finished
+    Brain_Mask = None
+    if setting['Data_Input']['Data_Type'] == 'Volume':
+        Brain_Mask = load_brain_template(os.path.join(dir_pnet_dataInput, 'Brain_Template.json.zip'))['Brain_Mask']
+    gFN = reshape_FN(load_matlab_single_array(os.path.join(dir_pnet_gFN, 'FN.mat')), dataType=setting['Data_Input']['Data_Type'], Brain_Mask=Brain_Mask)
+    setting_pFN = setup_fingerprint_setting(setting, 'Personalized_FN')
+    setting_pFN['gFN'] = compute_unit_fingerprint({}, list_array=[gFN])
+    list_fingerprint = [compute_unit_fingerprint(setting_pFN, file_scan_list=os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Scan_List.txt')) for i in range(1, N_Scan+1)]
+    list_missing = check_manifest(dir_manifest, [f'Personalized_FN_{i}' for i in range(1, N_Scan+1)], list_fingerprint)
+    if len(list_missing) > 0:
+        print(f'{len(list_missing)} of {N_Scan} subject folders are not finished: ' + ', '.join(list_missing), file=logFile_FNC, flush=True)
+        return False
+
+    print('Finished FN computation of all shards at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+    return True
+
+
 def check_gFN(gFN: np.ndarray, method='SR-NMF', logFile=None):
     """
     Check the values in gFNs to ensure compatibility to the desired FN model\
@@ -8,64 +8,127 @@ import scipy.io as sio
 import os
 import re
 import time
+import concurrent.futures
 import torch
 
 
 # other functions of pNet
 from Data_Input import *
-from FN_Computation import construct_Laplacian_gNb, check_gFN, compute_gNb, bootstrap_scan, setup_pFN_folder
+from Computation_Environment import set_computation_thread, split_computation_thread, check_main_process
+from FN_Computation import construct_Laplacian_gNb, setup_Laplacian_operator, setup_blocked_data, setup_restart_tracker, update_restart_tracker, setup_parallel_worker, check_gFN, compute_gNb, bootstrap_scan, setup_pFN_folder, \
+    setup_shard_owner, select_shard_unit, claim_manifest_unit, finish_manifest_unit, wait_manifest_unit, check_manifest, \
+    save_NMF_checkpoint, load_NMF_checkpoint, compute_unit_fingerprint, setup_fingerprint_setting, check_manifest_unit, \
+    setup_warm_start_file, save_warm_start, load_warm_start, save_FN_block, load_FN_stack, setup_K_sweep_folder, finish_K_sweep_folder, setup_process_pool, setup_pFN_batch, check_gathered_gFN
 
 
-def mat_corr_torch(X, Y=None, dataPrecision='double'):
+def standardize_column_torch(X, dataPrecision='double'):
+    """
+    Center each column and scale it to unit norm, so that Pearson correlations between columns become dot products
+    Columns without variation are filled with NaN, consistent to np.corrcoef
+
+    :param X: 1D or 2D matrix, [dim_time, N], numpy.ndarray or torch.Tensor
+    :param dataPrecision: 'double' or 'single'
+    :return: Z, a 2D tensor [dim_time, N] in the working precision
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+    if isinstance(X, torch.Tensor):
+        Z = X.type(torch_float).clone()
+    else:
+        Z = torch.tensor(np.asarray(X), dtype=torch_float)
+    if len(Z.shape) == 1:
+        Z = Z[:, None]
+    Z -= torch.mean(Z, dim=0, keepdim=True)
+    normZ = torch.sqrt(torch.sum(Z * Z, dim=0, keepdim=True))
+    normZ[normZ == 0] = torch.nan
+    Z /= normZ
+    return Z
+
+
+def mat_corr_torch(X, Y=None, dataPrecision='double', pairwise=False, maxM=12500000):
     """
     Perform corr as in MATLAB, pair-wise Pearson correlation between columns in X and Y
+    Columns of X are standardized once, and only the requested cross block is computed by matrix multiplication over blocks of Y columns
+    Each block of Y holds at most maxM elements, so Y can be a np.memmap (e.g. from np.load(file, mmap_mode='r')) read block by block
+    Without Y, the symmetric correlation matrix of X is computed over blocks of X columns in the same way
 
     :param X: 1D or 2D matrix, numpy.ndarray or torch.Tensor
-    :param Y: 1D or 2D matrix, or None, numpy.ndarray or torch.Tensor
-    :param dataPrecision: 'double' or 'single'
+    :param Y: 1D or 2D matrix, or None, numpy.ndarray, np.memmap or torch.Tensor
+    :param dataPrecision: 'double' or 'single', precision for both storage and accumulation
+    :param pairwise: False or True, only compute the correlation between the i-th columns of X and Y, which have the same size
+    :param maxM: maximum number of elements of Y loaded in one block
     X and Y have the same number of rows
-    :return: Corr
+    :return: Corr, [N_X, N_Y], or [N_X] when pairwise is True. 1D inputs drop their dimension in Corr
 
-    Note: this method will use memory as it concatenates X and Y along column direction.
     By Yuncong Ma, 9/5/2023
     """
 
     torch_float, torch_eps = set_data_precision_torch(dataPrecision)
     if not isinstance(X, torch.Tensor):
-        X = torch.tensor(X, dtype=torch_float)
-    else:
-        X = X.type(torch_float)
-    if Y is not None:
-        if not isinstance(Y, torch.Tensor):
-            Y = torch.tensor(Y, dtype=torch_float)
-        else:
-            Y = Y.type(torch_float)
+        X = torch.tensor(np.asarray(X), dtype=torch_float)
+    if Y is not None and not isinstance(Y, (torch.Tensor, np.ndarray)):
+        Y = np.array(Y)
 
     # Check size of X and Y
     if len(X.shape) > 2 or (Y is not None and len(Y.shape) > 2):
         raise ValueError("X and Y must be 1D or 2D matrices")
     if Y is not None and X.shape[0] != Y.shape[0]:
         raise ValueError("X and Y must have the same number of columns")
-
-    if Y is not None:
-        # Subtract the mean to calculate the covariance
-        X_centered = X - torch.mean(X, dim=0, keepdim=True)
-        Y_centered = Y - torch.mean(Y, dim=0, keepdim=True)
-        # Compute the standard deviation of the columns
-        std_X = torch.std(X_centered, dim=0, keepdim=True, unbiased=True)
-        std_Y = torch.std(Y_centered, dim=0, keepdim=True, unbiased=True)
-        # Compute the correlation matrix
-        numerator = (X_centered.T @ Y_centered)
-        denominator = (std_X.T @ std_Y) * torch.tensor(X.shape[0] - 1)
-        Corr = numerator / denominator
+    if Y is None and len(X.shape) != 2:
+        raise ValueError("X must be a 2D matrix")
+    if pairwise and (Y is None or tuple(X.shape) != tuple(Y.shape)):
+        raise ValueError("X and Y must have the same size in pairwise mode")
+
+    dim_time = X.shape[0]
+    blockSize = max(maxM // max(dim_time, 1), 1)
+    if Y is None:
+        # Symmetric blocks of columns in X, so X can also be in a compact data type
+        N_X = X.shape[1]
+        if N_X <= blockSize:
+            Zx = standardize_column_torch(X, dataPrecision)
+            Corr = Zx.T @ Zx
+        else:
+            Corr = torch.empty((N_X, N_X), dtype=torch_float, device=X.device)
+            for i0 in range(0, N_X, blockSize):
+                i1 = min(i0 + blockSize, N_X)
+                Zi = standardize_column_torch(X[:, i0:i1], dataPrecision)
+                Corr[i0:i1, i0:i1] = Zi.T @ Zi
+                for j0 in range(i1, N_X, blockSize):
+                    j1 = min(j0 + blockSize, N_X)
+                    Corr[i0:i1, j0:j1] = Zi.T @ standardize_column_torch(X[:, j0:j1], dataPrecision)
+                    Corr[j0:j1, i0:i1] = Corr[i0:i1, j0:j1].T
+        return torch.clamp(Corr, -1, 1)
+
+    Zx = standardize_column_torch(X, dataPrecision)
+    flag_1D = len(Y.shape) == 1
+    if flag_1D:
+        Y = Y[:, None]
+    N_Y = Y.shape[1]
+    if pairwise:
+        Corr = torch.empty(N_Y, dtype=torch_float, device=Zx.device)
     else:
-        if len(X.shape) != 2:
-            raise ValueError("X must be a 2D matrix")
-        X_centered = X - torch.mean(X, dim=0, keepdim=True)
-        std_X = torch.std(X_centered, dim=0, keepdim=True, unbiased=True)
-        numerator = (X_centered.T @ X_centered)
-        denominator = (std_X.T @ std_X) * torch.tensor(X.shape[0] - 1)
-        Corr = numerator / denominator
+        Corr = torch.empty((Zx.shape[1], N_Y), dtype=torch_float, device=Zx.device)
+    for j0 in range(0, N_Y, blockSize):
+        j1 = min(j0 + blockSize, N_Y)
+        Zy = standardize_column_torch(Y[:, j0:j1], dataPrecision).to(Zx.device)
+        if pairwise:
+            Corr[j0:j1] = torch.sum(Zx[:, j0:j1] * Zy, dim=0)
+        else:
+            Corr[:, j0:j1] = Zx.T @ Zy
+    Corr = torch.clamp(Corr, -1, 1)
+
+    # Drop dimensions of 1D inputs
+    if pairwise:
+        if flag_1D:
+            Corr = Corr[0]
+    elif len(X.shape) == 1 and flag_1D:
+        Corr = Corr[0, 0]
+    elif len(X.shape) == 1:
+        Corr = Corr[0, :]
+    elif flag_1D:
+        Corr = Corr[:, 0]
 
     return Corr
 
@@ -151,7 +214,7 @@ def initialize_u_torch(X, U0, V0, error=1e-4, maxIter=1000, minIter=30, meanFitR
     """
     Initialize U with fixed V, used for pFN_NMF
 
-    :param X: data, 2D matrix [dim_time, dim_space], numpy.ndarray or torch.Tensor
+    :param X: data, 2D matrix [dim_time, dim_space], numpy.ndarray or torch.Tensor, or blocked data from setup_blocked_data
     :param U0: initial temporal component, 2D matrix [dim_time, k], numpy.ndarray or torch.Tensor
     :param V0: initial spatial component, 2D matrix [dim_space, k], numpy.ndarray or torch.Tensor
     :param error: data fitting error
@@ -167,10 +230,14 @@ def initialize_u_torch(X, U0, V0, error=1e-4, maxIter=1000, minIter=30, meanFitR
     """
 
     torch_float, torch_eps = set_data_precision_torch(dataPrecision)
-    if not isinstance(X, torch.Tensor):
-        X = torch.tensor(X, dtype=torch_float)
+    if isinstance(X, dict):
+        X_shape = (X['dim_time'], X['dim_space'])
     else:
-        X = X.type(torch_float)
+        if not isinstance(X, torch.Tensor):
+            X = torch.tensor(X, dtype=torch_float)
+        else:
+            X = X.type(torch_float)
+        X_shape = X.shape
     if not isinstance(U0, torch.Tensor):
         U0 = torch.tensor(U0, dtype=torch_float)
     else:
@@ -181,29 +248,36 @@ def initialize_u_torch(X, U0, V0, error=1e-4, maxIter=1000, minIter=30, meanFitR
         V0 = V0.type(torch_float)
 
     # Check the data size of X, U0 and V0
-    if len(X.shape) != 2 or len(U0.shape) != 2 or len(V0.shape) != 2:
+    if len(X_shape) != 2 or len(U0.shape) != 2 or len(V0.shape) != 2:
         raise ValueError("X, U0 and V0 must be 2D matrices")
-    if X.shape[0] != U0.shape[0] or X.shape[1] != V0.shape[0] or U0.shape[1] != V0.shape[1]:
+    if X_shape[0] != U0.shape[0] or X_shape[1] != V0.shape[0] or U0.shape[1] != V0.shape[1]:
         raise ValueError("X, U0 and V0 need to have appropriate sizes")
 
     U = U0.clone()
     V = V0.clone()
 
-    newFit = data_fitting_error_torch(X, U, V, 0, 1, dataPrecision)
+    # V is fixed, so XV and VV are computed once
+    # The data fitting error uses the Gram identity to avoid the full-size residual
+    X2 = data_squared_norm_torch(X)
+    XV = data_matmul_torch(X, V, dataPrecision=dataPrecision)
+    VV = V.T @ V
+
+    UVV = torch.empty_like(U)
+
+    newFit = data_fitting_error_gram_torch(X2, U, XV, VV)
     meanFit = newFit / meanFitRatio
 
     maxErr = 1
     for i in range(1, maxIter+1):
-        # update U with fixed V
-        XV = X @ V
-        VV = V.T @ V
-        UVV = U @ VV
-
-        U = U * (XV / torch.maximum(UVV, torch_eps))
+        # update U with fixed V, in place
+        torch.matmul(U, VV, out=UVV)
+        UVV.clamp_(min=torch_eps)
+        torch.div(XV, UVV, out=UVV)
+        U.mul_(UVV)
 
         if i > minIter:
             if initConv:
-                newFit = data_fitting_error_torch(X, U, V, 0, 1, dataPrecision)
+                newFit = data_fitting_error_gram_torch(X2, U, XV, VV)
                 meanFit = meanFitRatio * meanFit + (1 - meanFitRatio) * newFit
                 maxErr = (meanFit - newFit) / meanFit
 
@@ -290,6 +364,186 @@ def data_fitting_error_torch(X, U, V, deltaVU=0, dVordU=1, dataPrecision='double
     return Fitting_Error
 
 
+def data_squared_norm_torch(X, maxM=12500000):
+    """
+    Compute the squared Frobenius norm of X in float64, without creating a full-size temporary
+
+    :param X: 2D matrix [dim_time, dim_space], torch.Tensor, or blocked data from setup_blocked_data
+    :param maxM: maximum number of elements processed in one block of rows
+    :return: X2, a float64 tensor scalar
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if isinstance(X, dict):
+        # computed when setting up blocked data
+        return torch.tensor(X['X2'], dtype=torch.float64)
+
+    dim_time, dim_space = X.shape
+    nRow = int(np.maximum(1, np.floor(maxM / np.maximum(dim_space, 1))))
+    X2 = torch.tensor(0.0, dtype=torch.float64)
+    for i in range(0, dim_time, nRow):
+        X2 += torch.pow(torch.linalg.vector_norm(X[i:i+nRow, :], dtype=torch.float64), 2)
+
+    return X2
+
+
+def get_data_block_torch(blocked: dict, j0, j1):
+    """
+    Load columns j0 to j1-1 of blocked data into memory, with normalization applied
+
+    :param blocked: blocked data from setup_blocked_data
+    :param j0: first column
+    :param j1: last column + 1
+    :return: block, 2D matrix [dim_time, j1-j0], torch.Tensor
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(blocked['dataPrecision'])
+
+    block = torch.tensor(np.asarray(blocked['Data'][:, j0:j1]), dtype=torch_float)
+    if blocked['minVal'] is not None:
+        block -= torch.from_numpy(blocked['minVal'][j0:j1]).type(torch_float)
+        block /= torch.from_numpy(blocked['rangeVal'][j0:j1]).type(torch_float)
+
+    return block
+
+
+def data_matmul_torch(X, V, out=None, dataPrecision='double'):
+    """
+    Compute X @ V for data in memory, a temporal sketch from setup_temporal_sketch_torch, or blocked data from setup_blocked_data
+
+    :param X: data, 2D matrix [dim_time, dim_space] or 3D [nBatch, dim_time, dim_space], torch.Tensor, or a dict of sketch or blocked data
+    :param V: 2D matrix, [dim_space, K], or 3D [nBatch, dim_space, K], torch.Tensor
+    :param out: optional preallocated output, [dim_time, K]
+    :param dataPrecision: 'double' or 'single'
+    :return: out
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if not isinstance(X, dict):
+        return torch.matmul(X, V, out=out)
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+    if out is None:
+        out = torch.empty((X['dim_time'], V.shape[1]), dtype=V.dtype)
+
+    if 'Q' in X:
+        # Approximated by Q @ (Xc @ V), which is kept positive as X and V are non-negative
+        torch.matmul(X['Q'], X['Xc'] @ V, out=out)
+        out.clamp_(min=torch_eps)
+    else:
+        # Accumulate products of blocks along the space dimension
+        out.zero_()
+        nCol = X['nCol']
+        for j in range(0, X['dim_space'], nCol):
+            out += get_data_block_torch(X, j, j+nCol).type(V.dtype) @ V[j:j+nCol, :]
+
+    return out
+
+
+def data_matmul_T_torch(X, U, out=None, dataPrecision='double'):
+    """
+    Compute X' @ U for data in memory, a temporal sketch from setup_temporal_sketch_torch, or blocked data from setup_blocked_data
+
+    :param X: data, 2D matrix [dim_time, dim_space] or 3D [nBatch, dim_time, dim_space], torch.Tensor, or a dict of sketch or blocked data
+    :param U: 2D matrix, [dim_time, K], or 3D [nBatch, dim_time, K], torch.Tensor
+    :param out: optional preallocated output, [dim_space, K]
+    :param dataPrecision: 'double' or 'single'
+    :return: out
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if not isinstance(X, dict):
+        return torch.matmul(X.transpose(-1, -2), U, out=out)
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+    if out is None:
+        out = torch.empty((X['dim_space'], U.shape[1]), dtype=U.dtype)
+
+    if 'Q' in X:
+        # Approximated by Xc' @ (Q' @ U), which is kept positive as X and U are non-negative
+        torch.matmul(X['Xc'].T, X['Q'].T @ U, out=out)
+        out.clamp_(min=torch_eps)
+    else:
+        # Each block of columns gives the corresponding rows of X' @ U
+        nCol = X['nCol']
+        for j in range(0, X['dim_space'], nCol):
+            torch.matmul(get_data_block_torch(X, j, j+nCol).type(U.dtype).T, U, out=out[j:j+nCol, :])
+
+    return out
+
+
+def data_fitting_error_gram_torch(X2, U, XV, VV):
+    """
+    Calculate the data fitting error ||X - UV'||^2 using the identity ||X||^2 - 2tr(U'XV) + tr(U'U V'V)
+    It only needs K-sized reductions, avoiding the [dim_time, dim_space] residual used in data_fitting_error_torch
+
+    :param X2: squared Frobenius norm of X, from data_squared_norm_torch
+    :param U: 2D matrix, [dim_time, K], torch.Tensor
+    :param XV: 2D matrix, [dim_time, K], X @ V, torch.Tensor
+    :param VV: 2D matrix, [K, K], V' @ V, torch.Tensor
+    :return: Fitting_Error, a float64 tensor scalar
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    UU = U.T @ U
+    Fitting_Error = X2 - 2 * torch.sum(U * XV, dtype=torch.float64) + torch.sum(UU * VV, dtype=torch.float64)
+    # Rounding errors may give a tiny negative value for a perfect fit
+    Fitting_Error = torch.clamp(Fitting_Error, min=0.0)
+
+    return Fitting_Error
+
+
+def compute_objective_SR_NMF_torch(X2, U, V, XV, VV, WV=None, DV=None, alphaS=0, alphaL=0, ard=0, hyperLam=0, dataPrecision='double'):
+    """
+    Calculate the objective function of SR-NMF from products already available in the multiplicative update
+    The data fitting term uses the Gram identity, and the Laplacian term tr(V'LV) uses L = D - W with WV and DV
+
+    :param X2: squared Frobenius norm of X, from data_squared_norm_torch
+    :param U: 2D matrix, [dim_time, K], torch.Tensor
+    :param V: 2D matrix, [dim_space, K], torch.Tensor
+    :param XV: 2D matrix, [dim_time, K], X @ V, torch.Tensor
+    :param VV: 2D matrix, [K, K], V' @ V, torch.Tensor
+    :param WV: 2D matrix, [dim_space, K], W @ V, required when alphaL > 0
+    :param DV: 2D matrix, [dim_space, K], D @ V, required when alphaL > 0
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param hyperLam: coefficient of the ard regularization term
+    :param dataPrecision: 'double' or 'single'
+    :return: LogL, LDf, LSl, L21, ardU
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    dim_time = U.shape[0]
+
+    ardU = 0
+    if ard > 0:
+        su = torch.sum(U, dim=0)
+        su[su == 0] = 1
+        ardU = torch.sum(torch.log(su)) * dim_time * hyperLam
+
+    # V is non-negative, so its l1 norm is the column sum
+    L21 = torch.mul(alphaS, torch.sum(torch.div(torch.sum(V, dim=0), torch.maximum(torch.linalg.vector_norm(V, dim=0), torch_eps))))
+    LDf = data_fitting_error_gram_torch(X2, U, XV, VV)
+    LSl = 0
+    if alphaL > 0:
+        LSl = torch.sum(V * DV, dtype=torch.float64) - torch.sum(V * WV, dtype=torch.float64)
+
+    # Objective function
+    LogL = L21 + ardU + LDf + LSl
+
+    return LogL, LDf, LSl, L21, ardU
+
+
 def normalize_u_v_torch(U, V, NormV, Norm, dataPrecision='double'):
     """
     Normalize U and V with terms
@@ -331,300 +585,1281 @@ def normalize_u_v_torch(U, V, NormV, Norm, dataPrecision='double'):
         norms = torch.max(V, dim=0)[0]  # torch.max return Value and Index
         norms = torch.maximum(norms, torch_eps)
 
+    # Broadcasting along the first dimension avoids tiling norms to full size
     if NormV:
-        U = U * torch.tile(norms, (dim_time, 1))
-        V = V / torch.tile(norms, (dim_space, 1))
+        U = U * norms
+        V = V / norms
     else:
-        U = U / torch.tile(norms, (dim_time, 1))
-        V = V * torch.tile(norms, (dim_space, 1))
+        U = U / norms
+        V = V * norms
 
     return U, V
 
 
-def construct_Laplacian_gNb_torch(gNb, dim_space, vxI=0, X=None, alphaL=10, normW=1, dataPrecision='double'):
+def setup_NMF_workspace_torch(dim_time, dim_space, K, dataPrecision='double', nBatch=None):
     """
-    Construct Laplacian matrices for Laplacian spatial regularization term
+    Preallocate all buffers used by the multiplicative update of SR-NMF
+    The workspace can be reused for any data with the same size, such as scans of different subjects
 
-    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
-    :param dim_space: dimension of space (number of voxels or vertices)
-    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
-    :param X: fMRI data, a 2D matrix, [dim_time, dim_space]
-    :param alphaL: internal hyper parameter for Laplacian regularization term
-    :param normW: 1 or 2, normalization method for Laplacian matrix W
+    :param dim_time: number of time points
+    :param dim_space: number of nodes (vertex, voxel)
+    :param K: number of FNs
     :param dataPrecision: 'double' or 'single'
-    :return: L, W, D: sparse 2D matrices [dim_space, dim_space]
+    :param nBatch: None or a positive integer. If set, buffers have a leading batch dimension for nBatch subjects
+    :return: workspace, a dict of preallocated tensors
 
-    Yuncong Ma, 9/7/2023
+    Yuncong Ma, 11/9/2023
     """
 
     torch_float, torch_eps = set_data_precision_torch(dataPrecision)
-    np_float, np_eps = set_data_precision(dataPrecision)
 
-    # Use numpy version to do
-    # Current torch version does NOT support sparse matrix multiplication without CUDA
-    if not isinstance(X, np.ndarray):
-        X2 = np.array(X, dtype=np_float)
+    # Leading batch dimension
+    B = () if nBatch is None else (nBatch,)
+
+    workspace = {'dim_time': dim_time, 'dim_space': dim_space, 'K': K, 'dataPrecision': dataPrecision, 'nBatch': nBatch,
+                 # V update, [dim_space, K]
+                 'XU': torch.empty(B + (dim_space, K), dtype=torch_float),
+                 'VUU': torch.empty(B + (dim_space, K), dtype=torch_float),
+                 'tmpV': torch.empty(B + (dim_space, K), dtype=torch_float),
+                 'maskV': torch.empty(B + (dim_space, K), dtype=torch.bool),
+                 'DV': torch.empty(B + (dim_space, K), dtype=torch_float),
+                 'numV': torch.empty(B + (dim_space, K), dtype=torch_float),
+                 'prevV': torch.empty(B + (dim_space, K), dtype=torch_float),
+                 'colV': torch.empty(B + (dim_space,), dtype=torch_float),
+                 'hessV': torch.empty(B + (dim_space,), dtype=torch_float),
+                 # U update, [dim_time, K]
+                 'XV': torch.empty(B + (dim_time, K), dtype=torch_float),
+                 'UVV': torch.empty(B + (dim_time, K), dtype=torch_float),
+                 'prevU': torch.empty(B + (dim_time, K), dtype=torch_float),
+                 'colU': torch.empty(B + (dim_time,), dtype=torch_float),
+                 # [K, K]
+                 'UU': torch.empty(B + (K, K), dtype=torch_float),
+                 'VV': torch.empty(B + (K, K), dtype=torch_float),
+                 # [1, K], broadcast along the first dimension of U and V
+                 'normK': torch.empty(B + (1, K), dtype=torch_float),
+                 'sumK': torch.empty(B + (1, K), dtype=torch_float),
+                 # Copies of U and V from last iteration
+                 'oldU': torch.empty(B + (dim_time, K), dtype=torch_float),
+                 'oldV': torch.empty(B + (dim_space, K), dtype=torch_float),
+                 # Optional support of V, a boolean matrix [dim_space, K], used by the HALS solver
+                 'supportV': None}
+
+    return workspace
+
+
+def setup_temporal_sketch_torch(X, sketchSize, nPower=1, dataPrecision='double'):
+    """
+    Compress data along the time dimension using a randomized range finder, X ~ Q @ Xc
+    Q has orthonormal columns spanning the dominant temporal subspace of X, so that X' @ U ~ Xc' @ (Q' @ U) and X @ V ~ Q @ (Xc @ V)
+    The cost of these products in SR-NMF is reduced from dim_time * dim_space * K to about sketchSize * (dim_time + dim_space) * K
+
+    :param X: data, 2D matrix [dim_time, dim_space], torch.Tensor, or blocked data from setup_blocked_data
+    :param sketchSize: positive integer, number of rows of the compressed data, smaller than dim_time
+    :param nPower: number of power iterations to improve the accuracy of Q for slowly decaying spectrum
+    :param dataPrecision: 'double' or 'single'
+    :return: sketch, a dict with Q [dim_time, sketchSize] and Xc [sketchSize, dim_space]
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    if isinstance(X, dict):
+        dim_time, dim_space = X['dim_time'], X['dim_space']
     else:
-        X2 = X.astype(np_float)
-    L, W, D = construct_Laplacian_gNb(gNb, dim_space, vxI, X2, alphaL, normW, dataPrecision)
+        dim_time, dim_space = X.shape
+    sketchSize = int(np.minimum(sketchSize, dim_time))
 
-    L = L.tocoo()
-    # Create PyTorch sparse tensor using the COO format data
-    indices = torch.tensor(np.array([L.row, L.col]), dtype=torch.long)
-    values = torch.tensor(L.data, dtype=torch_float)
-    L = torch.sparse_coo_tensor(indices, values, L.shape)
+    # Random projection of rows of X
+    Omega = torch.randn((dim_space, sketchSize), dtype=torch_float)
+    Q, _ = torch.linalg.qr(data_matmul_torch(X, Omega, dataPrecision=dataPrecision))
+    del Omega
+    # Power iterations, with orthonormalization in between for numerical stability
+    for _ in range(nPower):
+        Q, _ = torch.linalg.qr(data_matmul_T_torch(X, Q, dataPrecision=dataPrecision))
+        Q, _ = torch.linalg.qr(data_matmul_torch(X, Q, dataPrecision=dataPrecision))
 
-    D = D.tocoo()
-    # Create PyTorch sparse tensor using the COO format data
-    indices = torch.tensor(np.array([D.row, D.col]), dtype=torch.long)
-    values = torch.tensor(D.data, dtype=torch_float)
-    D = torch.sparse_coo_tensor(indices, values, D.shape)
+    Q = Q.type(torch_float).contiguous()
+    Xc = data_matmul_T_torch(X, Q, dataPrecision=dataPrecision).T.contiguous()
 
-    W = W.tocoo()
-    # Create PyTorch sparse tensor using the COO format data
-    indices = torch.tensor(np.array([W.row, W.col]), dtype=torch.long)
-    values = torch.tensor(W.data, dtype=torch_float)
-    W = torch.sparse_coo_tensor(indices, values, W.shape)
+    sketch = {'Q': Q, 'Xc': Xc, 'dim_time': dim_time, 'dim_space': dim_space, 'sketchSize': sketchSize}
 
-    return L, W, D
+    return sketch
 
 
-def pFN_NMF_torch(Data, gFN, gNb, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-4, normW=1,
-            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, initConv=1, ard=0, eta=0, dataPrecision='double', logFile='Log_pFN_NMF.log'):
+def normalize_u_v_inplace_torch(U, V, NormV, Norm, workspace, dataPrecision='double'):
     """
-    Compute personalized FNs by spatially-regularized NMF method with group FNs as initialization
+    Normalize U and V in place, same as normalize_u_v_torch but without allocation
 
-    :param Data: 2D matrix [dim_time, dim_space], numpy.ndarray or torch.Tensor. Data will be formatted to Tensor and normalized.
-    :param gFN: group level FNs 2D matrix [dim_space, K], K is the number of functional networks, numpy.ndarray or torch.Tensor. gFN will be cloned
-    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
-    :param maxIter: maximum iteration number for multiplicative update
-    :param minIter: minimum iteration in case fast convergence
-    :param meanFitRatio: a 0-1 scaler, exponential moving average coefficient, used for the initialization of U when using group initialized V
-    :param error: difference of cost function for convergence
-    :param normW: 1 or 2, normalization method for W used in Laplacian regularization
-    :param Alpha: hyper parameter for spatial sparsity
-    :param Beta: hyper parameter for Laplacian sparsity
-    :param alphaS: internally determined, the coefficient for spatial sparsity based Alpha, data size, K, and gNb
-    :param alphaL: internally determined, the coefficient for Laplacian sparsity based Beta, data size, K, and gNb
-    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
-    :param initConv: flag for convergence of initialization of U
-    :param ard: 0 or 1, flat for combining similar clusters
-    :param eta: a hyper parameter for the ard regularization term
-    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
-    :param logFile: str, directory of a txt log file
-    :return: U and V. U is the temporal components of pFNs, a 2D matrix [dim_time, K], and V is the spatial components of pFNs, a 2D matrix [dim_space, K]
+    :param U: 2D matrix, [Time, k], or 3D [nBatch, Time, k] for a batch, updated in place
+    :param V: 2D matrix, [Space, k], or 3D [nBatch, Space, k] for a batch, updated in place
+    :param NormV: 1 or 0
+    :param Norm: 1 or 2
+    :param workspace: preallocated buffers from setup_NMF_workspace_torch
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-    Yuncong Ma, 10/2/2023
+    Yuncong Ma, 11/9/2023
     """
 
-    # Setup data precision and eps
     torch_float, torch_eps = set_data_precision_torch(dataPrecision)
 
-    # Transform data format if necessary
-    if not isinstance(Data, torch.Tensor):
-        Data = torch.tensor(Data, dtype=torch_float)
-    else:
-        Data = Data.type(torch_float)
-    if not isinstance(gFN, torch.Tensor):
-        gFN = torch.tensor(gFN, dtype=torch_float)
-    else:
-        gFN = gFN.type(torch_float)
-    if not isinstance(error, torch.Tensor):
-        error = torch.tensor(error, dtype=torch_float)
+    # Norms of columns, [1, K], or [nBatch, 1, K] for a batch
+    norms = workspace['normK']
+    if Norm == 2:
+        torch.linalg.vector_norm(V, dim=-2, keepdim=True, out=norms)
     else:
-        error = error.type(torch_float)
-    if not isinstance(eta, torch.Tensor):
-        eta = torch.tensor(eta, dtype=torch_float)
+        torch.amax(V, dim=-2, keepdim=True, out=norms)
+    norms.clamp_(min=torch_eps)
+
+    if NormV:
+        U.mul_(norms)
+        V.div_(norms)
     else:
-        eta = eta.type(torch_float)
-    if not isinstance(alphaS, torch.Tensor):
-        alphaS = torch.tensor(alphaS, dtype=torch_float)
+        U.div_(norms)
+        V.mul_(norms)
+
+
+def update_V_SR_NMF_torch(X, U, V, workspace, WV=None, DV=None, alphaS=0, alphaL=0, solver='mu', Laplacian=None, maxInner=10, dataPrecision='double'):
+    """
+    Update V in SR-NMF with fixed U, computed in place with preallocated buffers
+    X' @ U and U' @ U are computed once, and kept in workspace['XU'] and workspace['UU']
+    X, U and V can be stacked along a leading batch dimension, with a workspace for the same nBatch. 'hals' does not support batch
+
+    :param X: data, 2D matrix [dim_time, dim_space], torch.Tensor, a temporal sketch of data from setup_temporal_sketch_torch, or blocked data from setup_blocked_data
+    :param U: 2D matrix, [dim_time, K], torch.Tensor
+    :param V: 2D matrix, [dim_space, K], torch.Tensor, updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace_torch
+    :param WV: 2D matrix, [dim_space, K], W @ V, required when alphaL > 0
+    :param DV: 2D matrix, [dim_space, K], D @ V, required when alphaL > 0
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param solver: 'mu', 'accelerated_mu' or 'hals'
+        'mu' is the multiplicative update, Eq. 8-11
+        'accelerated_mu' repeats the multiplicative update with the same X' @ U, up to maxInner times
+        'hals' updates columns of V one by one, each to its non-negative minimizer with other columns fixed, with a residual updated after each column
+    :param Laplacian: Laplacian operator from setup_Laplacian_operator_torch, required for 'accelerated_mu' and 'hals' when alphaL > 0
+    :param maxInner: maximum number of inner updates for 'accelerated_mu'
+    :param dataPrecision: 'double' or 'single'
+    :return: None
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    data_matmul_T_torch(X, U, out=workspace['XU'], dataPrecision=dataPrecision)
+    torch.matmul(U.transpose(-1, -2), U, out=workspace['UU'])
+
+    if solver == 'mu':
+        update_V_SR_NMF_step_torch(V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+
+    elif solver == 'accelerated_mu':
+        # The number of inner updates balances the cost of X' @ U and the cost of one update
+        dim_time = workspace['dim_time']
+        K = workspace['K']
+        nNb = Laplacian['W'].values().shape[0] / workspace['dim_space'] if alphaL > 0 else 0
+        nInner = int(np.clip(np.floor(1 + 0.5 * (1 + dim_time / (K + nNb))), 1, maxInner))
+        prevV = workspace['prevV']
+        delta0 = 0
+        for j in range(nInner):
+            if j > 0 and alphaL > 0:
+                WV, DV = apply_Laplacian_operator_torch(Laplacian, V, DV)
+            prevV.copy_(V)
+            update_V_SR_NMF_step_torch(V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+            # Stop inner updates when the change of V becomes small compared to the first one
+            prevV.sub_(V)
+            delta = torch.linalg.vector_norm(prevV)
+            if j == 0:
+                delta0 = delta
+            elif delta <= 0.1 * delta0:
+                break
+
+    elif solver == 'hals':
+        update_V_SR_NMF_hals_torch(V, workspace, Laplacian=Laplacian, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+
     else:
-        alphaS = alphaS.type(torch_float)
+        raise ValueError('Unknown solver for SR-NMF: ' + str(solver))
 
-    # check dimension of Data and gFN
-    if Data.shape[1] != gFN.shape[0]:
-        raise ValueError("The second dimension of Data should match the first dimension of gFn, as they are space dimension")
 
-    K = gFN.shape[1]
+def update_V_SR_NMF_step_torch(V, workspace, WV=None, DV=None, alphaS=0, alphaL=0, dataPrecision='double'):
+    """
+    One multiplicative update of V, Eq. 8-11, using workspace['XU'] and workspace['UU']
+
+    :param V: 2D matrix, [dim_space, K], torch.Tensor, updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace_torch, with XU and UU ready
+    :param WV: 2D matrix, [dim_space, K], W @ V, required when alphaL > 0
+    :param DV: 2D matrix, [dim_space, K], D @ V, required when alphaL > 0
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-    # setup log file
-    if isinstance(logFile, str):
-        logFile = open(logFile, 'a')
-    print(f'\nStart NMF for pFN using PyTorch at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+    Yuncong Ma, 11/9/2023
+    """
 
-    # initialization
-    initV = gFN.clone()
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
 
-    dim_time, dim_space = Data.shape
+    numV = workspace['numV']
+    VUU = workspace['VUU']
+    tmpV = workspace['tmpV']
 
-    # Median number of graph neighbors
-    nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
+    numV.copy_(workspace['XU'])
+    torch.matmul(V, workspace['UU'], out=VUU)
 
-    # Use Alpha and Beta to set alphaS and alphaL if they are 0
-    if alphaS == 0 and Alpha > 0:
-        alphaS = torch.tensor(np.round(Alpha * dim_time / K))
-    if alphaL == 0 and Beta > 0:
-        alphaL = np.round(Beta * dim_time / K / nM)
+    if alphaS > 0:
+        # V is non-negative, so the l1 norm of each column is its sum
+        colNorm = workspace['normK']
+        colSum = workspace['sumK']
+        torch.linalg.vector_norm(V, dim=-2, keepdim=True, out=colNorm)
+        torch.sum(V, dim=-2, keepdim=True, out=colSum)
 
-    # Prepare and normalize scan
-    Data = normalize_data_torch(Data, 'vp', 'vmax')
-    X = Data    # Save memory
+        # posTerm = V / max(|V| * ||V||_2, eps)
+        torch.mul(V, colNorm, out=tmpV)
+        tmpV.clamp_(min=torch_eps)
+        torch.div(V, tmpV, out=tmpV)
+        VUU.add_(tmpV, alpha=0.5 * float(alphaS))
 
-    # Construct the spatial affinity graph
-    L, W, D = construct_Laplacian_gNb_torch(gNb, dim_space, vxI, X, alphaL, normW, dataPrecision)
+        # negTerm = V * ||V||_1 / max(||V||_2^3, eps)
+        colNorm.pow_(3).clamp_(min=torch_eps)
+        colSum.div_(colNorm)
+        torch.mul(V, colSum, out=tmpV)
+        numV.add_(tmpV, alpha=0.5 * float(alphaS))
 
-    # Initialize V
-    V = initV.clone()
-    miv = torch.max(V, dim=0)[0]
-    trimInd = V / torch.maximum(torch.tile(miv, (dim_space, 1)), torch_eps) < torch.tensor(5e-2)
-    V[trimInd] = 0
+    if alphaL > 0:
+        numV.add_(WV)
+        VUU.add_(DV)
 
-    # Initialize U
-    U = X @ V / torch.tile(torch.sum(V, dim=0), (dim_time, 1))
+    VUU.clamp_(min=torch_eps)
+    torch.div(numV, VUU, out=VUU)
+    V.mul_(VUU)
 
-    U = initialize_u_torch(X, U, V, error=error, maxIter=100, minIter=minIter, meanFitRatio=meanFitRatio, initConv=initConv)
 
-    initV = V.clone()
+def update_V_SR_NMF_hals_torch(V, workspace, Laplacian=None, alphaS=0, alphaL=0, dataPrecision='double'):
+    """
+    Hierarchical alternating least squares (HALS) update of V, using workspace['XU'] and workspace['UU']
+    Columns of V are updated one by one for k = 1, ..., K. The residual R = X'U - V U'U is computed once,
+    and updated by a rank-1 term after each column, so that each column sees the latest other columns
+    Without regularization, each column is the exact non-negative minimizer with other columns fixed, max(0, R[:, k] / UU[k, k] + V[:, k])
+    The Laplacian term uses D as the diagonal and W @ V[:, k] from the current column, and the L21 term is linearized at the current column
+    If workspace['supportV'] is set, entries outside this support are kept at zero
+
+    :param V: 2D matrix, [dim_space, K], torch.Tensor, updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace_torch, with XU and UU ready
+    :param Laplacian: Laplacian operator from setup_Laplacian_operator_torch, required when alphaL > 0
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-    # Alternative update of U and V
-    # Variables
+    Yuncong Ma, 11/9/2023
+    """
 
-    if ard > 0:
-        lambdas = torch.sum(U, dim=0) / dim_time
-        hyperLam = eta * torch.sum(torch.pow(X, 2)) / (dim_time * dim_space * 2)
-    else:
-        lambdas = 0
-        hyperLam = 0
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
 
-    flagQC = 0
-    oldLogL = torch.inf
-    oldU = U.clone()
-    oldV = V.clone()
+    UU = workspace['UU']
+    newV = workspace['colV']
+    hess = workspace['hessV']
 
-    for i in range(1, 1+maxIter):
-        # ===================== update V ========================
-        # Eq. 8-11
-        XU = X.T @ U
-        UU = U.T @ U
-        VUU = V @ UU
+    # Residual R = X'U - V U'U, [dim_space, K]
+    R = workspace['VUU']
+    torch.matmul(V, UU, out=R)
+    torch.sub(workspace['XU'], R, out=R)
 
-        tmpl2 = torch.pow(V, 2)
+    for k in range(workspace['K']):
+        v = V[:, k]
 
+        # Numerator of the column update, X'U[:, k] - sum_{j != k} V[:, j] UU[j, k]
+        torch.mul(v, UU[k, k], out=newV)
+        newV.add_(R[:, k])
+        if alphaL > 0:
+            newV.add_(torch.mv(Laplacian['W'], v.contiguous()))
         if alphaS > 0:
-            tmpl21 = torch.sqrt(tmpl2)
-            tmpl22 = torch.tile(torch.sqrt(torch.sum(tmpl2, dim=0)), (dim_space, 1))
-            tmpl21s = torch.tile(torch.sum(tmpl21, dim=0), (dim_space, 1))
-            posTerm = V / torch.maximum(tmpl21 * tmpl22, torch_eps)
-            negTerm = V * tmpl21s / torch.maximum(torch.pow(tmpl22, 3), torch_eps)
-
-            VUU = VUU + 0.5 * alphaS * posTerm
-            XU = XU + 0.5 * alphaS * negTerm
+            colNorm = torch.maximum(torch.linalg.vector_norm(v), torch_eps)
+            newV.sub_(0.5 * alphaS / colNorm)
+            newV.add_((0.5 * alphaS * torch.sum(v) / colNorm ** 3) * v)
 
+        # Diagonal of the column subproblem
         if alphaL > 0:
-            WV = W @ V
-            DV = D @ V
+            torch.add(Laplacian['D'], UU[k, k], out=hess)
+        else:
+            hess.fill_(UU[k, k])
+        hess.clamp_(min=torch_eps)
 
-            XU = XU + WV
-            VUU = VUU + DV
+        newV.div_(hess)
+        newV.clamp_(min=0)
+        # Zeros in V cannot change in the multiplicative update, so they are kept for the same sparsity pattern
+        if workspace['supportV'] is not None:
+            newV.mul_(workspace['supportV'][:, k])
 
-        V = V * (XU / torch.maximum(VUU, torch_eps))
+        # Rank-1 update of the residual with the change of this column
+        torch.sub(newV, v, out=hess)
+        R.addr_(hess, UU[k, :], alpha=-1)
+        v.copy_(newV)
 
-        # Prune V if empty components are found in V
-        # This is almost impossible to happen without combining FNs
-        prunInd = torch.sum(V != 0, dim=0) == 1
-        if torch.any(prunInd):
-            V[:, prunInd] = torch.zeros((dim_space, torch.sum(prunInd)))
-            U[:, prunInd] = torch.zeros((dim_time, torch.sum(prunInd)))
 
-        # normalize U and V
-        U, V = normalize_u_v_torch(U, V, 1, 1)
+def update_U_SR_NMF_torch(X, U, V, workspace, ard=0, lambdas=0, hyperLam=0, solver='mu', maxInner=10, dataPrecision='double'):
+    """
+    Update U in SR-NMF with fixed V, computed in place with preallocated buffers
+    X @ V and V' @ V are kept in workspace['XV'] and workspace['VV'] for the objective function
+    X, U and V can be stacked along a leading batch dimension, with a workspace for the same nBatch. 'hals' does not support batch
+
+    :param X: data, 2D matrix [dim_time, dim_space], torch.Tensor, a temporal sketch of data from setup_temporal_sketch_torch, or blocked data from setup_blocked_data
+    :param U: 2D matrix, [dim_time, K], torch.Tensor, updated in place
+    :param V: 2D matrix, [dim_space, K], torch.Tensor
+    :param workspace: preallocated buffers from setup_NMF_workspace_torch
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param lambdas: 1D vector [K] or a scalar, used for the ard term
+    :param hyperLam: coefficient of the ard regularization term
+    :param solver: 'mu', 'accelerated_mu' or 'hals', see update_V_SR_NMF_torch
+    :param maxInner: maximum number of inner updates for 'accelerated_mu'
+    :param dataPrecision: 'double' or 'single'
+    :return: None
 
-        # ===================== update U =========================
-        XV = X @ V
-        VV = V.T @ V
-        UVV = U @ VV
+    Yuncong Ma, 11/9/2023
+    """
 
-        if ard > 0:  # ard term for U
-            posTerm = torch.tensor(1) / torch.maximum(torch.tile(lambdas, (dim_time, 1)), torch_eps)
+    data_matmul_torch(X, V, out=workspace['XV'], dataPrecision=dataPrecision)
+    torch.matmul(V.transpose(-1, -2), V, out=workspace['VV'])
+
+    if solver == 'mu':
+        update_U_SR_NMF_step_torch(U, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, dataPrecision=dataPrecision)
+
+    elif solver == 'accelerated_mu':
+        # The number of inner updates balances the cost of X @ V and the cost of one update
+        nInner = int(np.clip(np.floor(1 + 0.5 * (1 + workspace['dim_space'] / (workspace['K'] + 1))), 1, maxInner))
+        prevU = workspace['prevU']
+        delta0 = 0
+        for j in range(nInner):
+            prevU.copy_(U)
+            update_U_SR_NMF_step_torch(U, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, dataPrecision=dataPrecision)
+            # Stop inner updates when the change of U becomes small compared to the first one
+            prevU.sub_(U)
+            delta = torch.linalg.vector_norm(prevU)
+            if j == 0:
+                delta0 = delta
+            elif delta <= 0.1 * delta0:
+                break
 
-            UVV = UVV + posTerm * hyperLam
+    elif solver == 'hals':
+        update_U_SR_NMF_hals_torch(U, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, dataPrecision=dataPrecision)
 
-        U = U * (XV / torch.maximum(UVV, torch_eps))
+    else:
+        raise ValueError('Unknown solver for SR-NMF: ' + str(solver))
 
-        # Prune U if empty components are found in U
-        # This is almost impossible to happen without combining FNs
-        prunInd = torch.sum(U, dim=0) == 0
-        if torch.any(prunInd):
-            V[:, prunInd] = torch.zeros((dim_space, torch.sum(prunInd)))
-            U[:, prunInd] = torch.zeros((dim_time, torch.sum(prunInd)))
 
-        # update lambda
-        if ard > 0:
-            lambdas = torch.sum(U, dim=0) / dim_time
+def update_U_SR_NMF_step_torch(U, workspace, ard=0, lambdas=0, hyperLam=0, dataPrecision='double'):
+    """
+    One multiplicative update of U, using workspace['XV'] and workspace['VV']
+
+    :param U: 2D matrix, [dim_time, K], torch.Tensor, updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace_torch, with XV and VV ready
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param lambdas: 1D vector [K] or a scalar, used for the ard term
+    :param hyperLam: coefficient of the ard regularization term
+    :param dataPrecision: 'double' or 'single'
+    :return: None
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    UVV = workspace['UVV']
+    torch.matmul(U, workspace['VV'], out=UVV)
+
+    if ard > 0:  # ard term for U
+        UVV.add_(hyperLam / torch.maximum(torch.as_tensor(lambdas), torch_eps))
+
+    UVV.clamp_(min=torch_eps)
+    torch.div(workspace['XV'], UVV, out=UVV)
+    U.mul_(UVV)
+
+
+def update_U_SR_NMF_hals_torch(U, workspace, ard=0, lambdas=0, hyperLam=0, dataPrecision='double'):
+    """
+    Hierarchical alternating least squares (HALS) update of U, using workspace['XV'] and workspace['VV']
+    Columns of U are updated one by one for k = 1, ..., K, each to the exact non-negative minimizer with other columns fixed
+    The residual R = XV - U V'V is computed once, and updated by a rank-1 term after each column
+
+    :param U: 2D matrix, [dim_time, K], torch.Tensor, updated in place
+    :param workspace: preallocated buffers from setup_NMF_workspace_torch, with XV and VV ready
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param lambdas: 1D vector [K] or a scalar, used for the ard term
+    :param hyperLam: coefficient of the ard regularization term
+    :param dataPrecision: 'double' or 'single'
+    :return: None
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    VV = workspace['VV']
+    newU = workspace['colU']
+    if ard > 0:
+        ardTerm = hyperLam / torch.maximum(torch.as_tensor(lambdas).expand(workspace['K']), torch_eps)
+
+    # Residual R = XV - U V'V, [dim_time, K]
+    R = workspace['UVV']
+    torch.matmul(U, VV, out=R)
+    torch.sub(workspace['XV'], R, out=R)
+
+    for k in range(workspace['K']):
+        u = U[:, k]
+
+        # u = max(0, u + (R[:, k] - ardTerm[k]) / VV[k, k])
+        newU.copy_(R[:, k])
+        if ard > 0:
+            newU.sub_(ardTerm[k])
+        newU.div_(torch.maximum(VV[k, k], torch_eps))
+        newU.add_(u)
+        newU.clamp_(min=0)
+
+        # Rank-1 update of the residual with the change of this column
+        torch.sub(newU, u, out=u)
+        R.addr_(u, VV[k, :], alpha=-1)
+        u.copy_(newU)
+
+
+def construct_Laplacian_gNb_torch(gNb, dim_space, vxI=0, X=None, alphaL=10, normW=1, dataPrecision='double'):
+    """
+    Construct Laplacian matrices for Laplacian spatial regularization term
+
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param dim_space: dimension of space (number of voxels or vertices)
+    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
+    :param X: fMRI data, a 2D matrix, [dim_time, dim_space]
+    :param alphaL: internal hyper parameter for Laplacian regularization term
+    :param normW: 1 or 2, normalization method for Laplacian matrix W
+    :param dataPrecision: 'double' or 'single'
+    :return: L, W, D: sparse 2D matrices [dim_space, dim_space]
+
+    Yuncong Ma, 9/7/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    # Use numpy version to do
+    # Current torch version does NOT support sparse matrix multiplication without CUDA
+    if not isinstance(X, np.ndarray):
+        X2 = np.array(X, dtype=np_float)
+    else:
+        X2 = X.astype(np_float)
+    L, W, D = construct_Laplacian_gNb(gNb, dim_space, vxI, X2, alphaL, normW, dataPrecision)
+
+    L = L.tocoo()
+    # Create PyTorch sparse tensor using the COO format data
+    indices = torch.tensor(np.array([L.row, L.col]), dtype=torch.long)
+    values = torch.tensor(L.data, dtype=torch_float)
+    L = torch.sparse_coo_tensor(indices, values, L.shape)
+
+    D = D.tocoo()
+    # Create PyTorch sparse tensor using the COO format data
+    indices = torch.tensor(np.array([D.row, D.col]), dtype=torch.long)
+    values = torch.tensor(D.data, dtype=torch_float)
+    D = torch.sparse_coo_tensor(indices, values, D.shape)
+
+    W = W.tocoo()
+    # Create PyTorch sparse tensor using the COO format data
+    indices = torch.tensor(np.array([W.row, W.col]), dtype=torch.long)
+    values = torch.tensor(W.data, dtype=torch_float)
+    W = torch.sparse_coo_tensor(indices, values, W.shape)
+
+    return L, W, D
+
+
+def compute_edge_correlation_torch(X, row, col, maxM=12500000, dataPrecision='double'):
+    """
+    Compute the temporal Pearson correlation between the two nodes of each edge in a graph
+    Nodes are z-scored once, and correlations are dot products of z-scored time series, computed over blocks of edges
+    Each block gathers at most maxM elements of time series for each side of its edges
+
+    :param X: fMRI data, a 2D matrix, [dim_time, dim_space], numpy.ndarray or torch.Tensor
+    :param row: 1D vector [N], node index of one side of each edge, starting from 0
+    :param col: 1D vector [N], node index of the other side of each edge, starting from 0
+    :param maxM: maximum number of elements gathered in one block
+    :param dataPrecision: 'double' or 'single'
+    :return: edgeCorr, a 1D tensor [N]. Nodes without temporal variation have zero correlation to other nodes
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+    row = torch.as_tensor(np.asarray(row), dtype=torch.int64)
+    col = torch.as_tensor(np.asarray(col), dtype=torch.int64)
+
+    # z-scored time series of each node, stored by rows for gathering
+    Z = torch.as_tensor(X).type(torch_float).T.contiguous().clone()
+    Z -= torch.mean(Z, dim=1, keepdim=True)
+    normZ = torch.sqrt(torch.sum(Z * Z, dim=1, keepdim=True))
+    normZ[normZ == 0] = 1
+    Z /= normZ
+
+    nEdge = row.shape[0]
+    edgeCorr = torch.empty(nEdge, dtype=torch_float)
+    blockSize = max(maxM // Z.shape[1], 1)
+    for j0 in range(0, nEdge, blockSize):
+        j1 = min(j0 + blockSize, nEdge)
+        edgeCorr[j0:j1] = torch.sum(Z[row[j0:j1]] * Z[col[j0:j1]], dim=1)
+
+    return edgeCorr
+
+
+def setup_Laplacian_operator_torch(gNb, dim_space, vxI=0, X=None, alphaL=1, normW=1, dataPrecision='double'):
+    """
+    Construct the Laplacian operator L = D - W for the Laplacian spatial regularization term
+    W is stored as a sparse CSR tensor and D as a vector, both in the working precision
+    Without vxI, the operator only depends on gNb, so it can be built once and shared by all bootstrap runs and subjects
+    With vxI, edge correlations are computed by compute_edge_correlation_torch
+
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param dim_space: dimension of space (number of voxels or vertices)
+    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
+    :param X: fMRI data, a 2D matrix, [dim_time, dim_space], required when vxI > 0
+    :param alphaL: internal hyper parameter for Laplacian regularization term
+    :param normW: 1 or 2, normalization method for Laplacian matrix W
+    :param dataPrecision: 'double' or 'single'
+    :return: Laplacian, a dict with W (sparse CSR tensor [dim_space, dim_space]), D (1D tensor [dim_space]), alphaL, normW, vxI and dataPrecision
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    # Edge correlations are computed in torch
+    edgeCorr = None
+    if vxI > 0 and X is not None:
+        gNb_index = np.asarray(gNb, dtype=np.int64) - 1
+        edgeCorr = compute_edge_correlation_torch(X, gNb_index[:, 0], gNb_index[:, 1], dataPrecision=dataPrecision).cpu().numpy()
+
+    # Use numpy version to build the sparse structure
+    Laplacian = setup_Laplacian_operator(gNb, dim_space, vxI=vxI, alphaL=alphaL, normW=normW, edgeCorr=edgeCorr, dataPrecision=dataPrecision)
+
+    W = Laplacian['W']
+    Laplacian['W'] = torch.sparse_csr_tensor(torch.from_numpy(W.indptr.astype(np.int64)), torch.from_numpy(W.indices.astype(np.int64)),
+                                             torch.from_numpy(W.data), size=W.shape, dtype=torch_float)
+    Laplacian['D'] = torch.from_numpy(Laplacian['D']).type(torch_float)
+
+    return Laplacian
+
+
+def scale_Laplacian_operator_torch(Laplacian: dict, alphaL, dataPrecision='double'):
+    """
+    Get a Laplacian operator with a different alphaL, sharing the sparse structure of the input one
+    alphaL only scales the operator when normW > 0, consistent to construct_Laplacian_gNb
+
+    :param Laplacian: a Laplacian operator from setup_Laplacian_operator_torch
+    :param alphaL: internal hyper parameter for Laplacian regularization term
+    :param dataPrecision: 'double' or 'single'
+    :return: Laplacian, a new dict
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    W = Laplacian['W']
+    if Laplacian['normW'] > 0:
+        ratio = float(alphaL / Laplacian['alphaL'])
+    else:
+        ratio = 1
+    if ratio == 1 and W.dtype == torch_float:
+        return dict(Laplacian, alphaL=alphaL)
+
+    W = torch.sparse_csr_tensor(W.crow_indices(), W.col_indices(), (W.values() * ratio).type(torch_float), size=W.shape)
+    D = (Laplacian['D'] * ratio).type(torch_float)
+
+    return dict(Laplacian, W=W, D=D, alphaL=alphaL, dataPrecision=dataPrecision)
+
+
+def apply_Laplacian_operator_torch(Laplacian: dict, V, DV=None):
+    """
+    Compute W @ V and D @ V with a Laplacian operator, so that L @ V = DV - WV
+
+    :param Laplacian: a Laplacian operator from setup_Laplacian_operator_torch
+    :param V: 2D matrix, [dim_space, K], or 3D [nBatch, dim_space, K] for a batch, torch.Tensor
+    :param DV: optional 2D matrix, [dim_space, K], or 3D [nBatch, dim_space, K], preallocated output for D @ V
+    :return: WV, DV
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    if V.dim() == 3:
+        # A batch of V, [nBatch, dim_space, K], is multiplied as one [dim_space, nBatch*K] matrix
+        nBatch, dim_space, K = V.shape
+        WV = (Laplacian['W'] @ V.permute(1, 0, 2).reshape(dim_space, nBatch * K)).reshape(dim_space, nBatch, K).permute(1, 0, 2)
+    else:
+        WV = Laplacian['W'] @ V
+    if DV is None:
+        DV = torch.empty_like(V)
+    torch.mul(Laplacian['D'][:, None], V, out=DV)
+
+    return WV, DV
+
+
+def pFN_NMF_torch(Data, gFN, gNb, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-4, normW=1,
+            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, initConv=1, ard=0, eta=0, solver='mu', Laplacian=None, maxM=12500000,
+            initUV=None, file_checkpoint=None, checkpointInterval=600, fingerprint='', dataPrecision='double', logFile='Log_pFN_NMF.log'):
+    """
+    Compute personalized FNs by spatially-regularized NMF method with group FNs as initialization
+    Data can be a memory-mapped array for out-of-core computation, which is read in blocks of at most maxM elements, see setup_blocked_data
+    With file_checkpoint, U and V are saved periodically, and a later call with the same fingerprint resumes from the last checkpoint
+    With initUV, it starts from a previous pFN of the same subject computed with the same gFN, see load_warm_start
+
+    :param Data: 2D matrix [dim_time, dim_space], numpy.ndarray or torch.Tensor. Data will be formatted to Tensor and normalized. It can also be a memory-mapped array or directory of a .npy file
+    :param gFN: group level FNs 2D matrix [dim_space, K], K is the number of functional networks, numpy.ndarray or torch.Tensor. gFN will be cloned
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param maxIter: maximum iteration number for multiplicative update
+    :param minIter: minimum iteration in case fast convergence
+    :param meanFitRatio: a 0-1 scaler, exponential moving average coefficient, used for the initialization of U when using group initialized V
+    :param error: difference of cost function for convergence
+    :param normW: 1 or 2, normalization method for W used in Laplacian regularization
+    :param Alpha: hyper parameter for spatial sparsity
+    :param Beta: hyper parameter for Laplacian sparsity
+    :param alphaS: internally determined, the coefficient for spatial sparsity based Alpha, data size, K, and gNb
+    :param alphaL: internally determined, the coefficient for Laplacian sparsity based Beta, data size, K, and gNb
+    :param vxI: 0 or 1, flag for using the temporal correlation between nodes (vertex, voxel)
+    :param initConv: flag for convergence of initialization of U
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param eta: a hyper parameter for the ard regularization term
+    :param solver: 'mu', 'accelerated_mu' or 'hals', the solver for updating U and V, see update_V_SR_NMF_torch
+    :param Laplacian: optional Laplacian operator from setup_Laplacian_operator_torch, shared across runs with the same gNb. Its normW and vxI are used, and it is rescaled to alphaL
+    :param maxM: maximum number of elements in one block of data for out-of-core computation
+    :param initUV: None or a tuple (U, V) of a previous pFN, numpy.ndarray or torch.Tensor. V replaces the trimmed gFN as initialization. U is used if it has the same number of time points, and then minIter is not applied
+    :param file_checkpoint: None or directory of a .npz file for checkpoints of U and V
+    :param checkpointInterval: minimum number of seconds between two checkpoints
+    :param fingerprint: a str identifying inputs and settings, see compute_unit_fingerprint. A checkpoint with a different fingerprint is ignored
+    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
+    :param logFile: str, directory of a txt log file
+    :return: U and V. U is the temporal components of pFNs, a 2D matrix [dim_time, K], and V is the spatial components of pFNs, a 2D matrix [dim_space, K]
+
+    Yuncong Ma, 10/2/2023
+    """
+
+    # Setup data precision and eps
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    # Transform data format if necessary
+    flag_OutOfCore = isinstance(Data, (str, np.memmap))
+    if flag_OutOfCore:
+        # Data stay on disk, and normalization is applied to each loaded block
+        X = setup_blocked_data(Data, maxM, dataPrecision=dataPrecision)
+        dim_time, dim_space = X['dim_time'], X['dim_space']
+    else:
+        if not isinstance(Data, torch.Tensor):
+            Data = torch.tensor(Data, dtype=torch_float)
+        else:
+            Data = Data.type(torch_float)
+        dim_time, dim_space = Data.shape
+    if not isinstance(gFN, torch.Tensor):
+        gFN = torch.tensor(gFN, dtype=torch_float)
+    else:
+        gFN = gFN.type(torch_float)
+    if not isinstance(error, torch.Tensor):
+        error = torch.tensor(error, dtype=torch_float)
+    else:
+        error = error.type(torch_float)
+    if not isinstance(eta, torch.Tensor):
+        eta = torch.tensor(eta, dtype=torch_float)
+    else:
+        eta = eta.type(torch_float)
+    if not isinstance(alphaS, torch.Tensor):
+        alphaS = torch.tensor(alphaS, dtype=torch_float)
+    else:
+        alphaS = alphaS.type(torch_float)
+
+    # check dimension of Data and gFN
+    if dim_space != gFN.shape[0]:
+        raise ValueError("The second dimension of Data should match the first dimension of gFn, as they are space dimension")
+
+    K = gFN.shape[1]
+
+    # setup log file
+    if isinstance(logFile, str):
+        logFile = open(logFile, 'a')
+    print(f'\nStart NMF for pFN using PyTorch at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
+    # initialization
+    initV = gFN.clone()
+
+    # Median number of graph neighbors
+    nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
+
+    # Use Alpha and Beta to set alphaS and alphaL if they are 0
+    if alphaS == 0 and Alpha > 0:
+        alphaS = torch.tensor(np.round(Alpha * dim_time / K))
+    if alphaL == 0 and Beta > 0:
+        alphaL = np.round(Beta * dim_time / K / nM)
+
+    # Prepare and normalize scan
+    if not flag_OutOfCore:
+        Data = normalize_data_torch(Data, 'vp', 'vmax', dataPrecision)
+        X = Data    # Save memory
+
+    # Construct the spatial affinity graph
+    if flag_OutOfCore and vxI > 0:
+        raise ValueError("vxI is not supported for out-of-core data")
+    if Laplacian is None:
+        Laplacian = setup_Laplacian_operator_torch(gNb, dim_space, vxI, X, alphaL, normW, dataPrecision)
+    else:
+        Laplacian = scale_Laplacian_operator_torch(Laplacian, alphaL, dataPrecision)
+
+    # Initialize V
+    V = initV.clone()
+    miv = torch.max(V, dim=0)[0]
+    trimInd = V / torch.maximum(miv, torch_eps) < torch.tensor(5e-2)
+    V[trimInd] = 0
+
+    # Resume from a checkpoint of U and V
+    checkpoint = None
+    if file_checkpoint is not None:
+        checkpoint = load_NMF_checkpoint(file_checkpoint, fingerprint)
+        if checkpoint is not None and (checkpoint['U'].shape != (dim_time, K) or checkpoint['V'].shape != (dim_space, K)):
+            checkpoint = None
+
+    # Warm start from a previous pFN
+    flag_WarmStart = False
+    if checkpoint is None and initUV is not None and tuple(initUV[1].shape) == (dim_space, K):
+        V = torch.as_tensor(initUV[1]).type(torch_float).clone()
+        V[trimInd] = 0
+        flag_WarmStart = tuple(initUV[0].shape) == (dim_time, K)
+        print('Warm start from a previous pFN', file=logFile, flush=True)
+
+    # Initialize U
+    if checkpoint is not None:
+        # The initialization of U is skipped
+        U = torch.tensor(checkpoint['U'], dtype=torch_float)
+        V = torch.tensor(checkpoint['V'], dtype=torch_float)
+        print(f'Resume from the checkpoint at iteration {checkpoint["Iter"]}', file=logFile, flush=True)
+    elif flag_WarmStart:
+        # U and V start near convergence
+        U = torch.as_tensor(initUV[0]).type(torch_float).clone()
+        minIter = 1
+    else:
+        U = data_matmul_torch(X, V, dataPrecision=dataPrecision) / torch.sum(V, dim=0)
+
+        U = initialize_u_torch(X, U, V, error=error, maxIter=100, minIter=minIter, meanFitRatio=meanFitRatio, initConv=initConv)
+
+    initV = V.clone()
+
+    # Alternative update of U and V
+    # Variables
+
+    # Squared norm of X for the data fitting term, computed once
+    X2 = data_squared_norm_torch(X)
+
+    if ard > 0:
+        lambdas = torch.sum(U, dim=0) / dim_time
+        hyperLam = eta * X2 / (dim_time * dim_space * 2)
+    else:
+        lambdas = 0
+        hyperLam = 0
+
+    # Preallocated buffers for the in-place multiplicative update
+    workspace = setup_NMF_workspace_torch(dim_time, dim_space, K, dataPrecision)
+    XV = workspace['XV']
+    VV = workspace['VV']
+    oldU = workspace['oldU']
+    oldV = workspace['oldV']
+    U = U.type(torch_float).contiguous()
+    V = V.type(torch_float).contiguous()
+    # Keep the trimmed entries of gFN at zero, as in the multiplicative update
+    workspace['supportV'] = ~trimInd
+
+    # WV and DV are shared by the V update and the objective function
+    WV = None
+    DV = None
+    if alphaL > 0:
+        WV, DV = apply_Laplacian_operator_torch(Laplacian, V, workspace['DV'])
+
+    flagQC = 0
+    oldLogL = torch.inf
+    iStart = 1
+    if checkpoint is not None:
+        oldLogL = torch.tensor(checkpoint['LogL'], dtype=torch_float)
+        iStart = checkpoint['Iter'] + 1
+    timeCheckpoint = time.time()
+    oldU.copy_(U)
+    oldV.copy_(V)
+
+    for i in range(iStart, 1+maxIter):
+        # ===================== update V ========================
+        # Eq. 8-11
+        # WV and DV were computed with the current V at the end of last iteration
+        update_V_SR_NMF_torch(X, U, V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, solver=solver, Laplacian=Laplacian, dataPrecision=dataPrecision)
+
+        # Prune V if empty components are found in V
+        # This is almost impossible to happen without combining FNs
+        torch.ne(V, 0, out=workspace['maskV'])
+        prunInd = torch.sum(workspace['maskV'], dim=0) == 1
+        if torch.any(prunInd):
+            V[:, prunInd] = 0
+            U[:, prunInd] = 0
+
+        # normalize U and V
+        normalize_u_v_inplace_torch(U, V, 1, 1, workspace, dataPrecision)
+
+        # ===================== update U =========================
+        update_U_SR_NMF_torch(X, U, V, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, solver=solver, dataPrecision=dataPrecision)
+
+        # Prune U if empty components are found in U
+        # This is almost impossible to happen without combining FNs
+        prunInd = torch.sum(U, dim=0) == 0
+        if torch.any(prunInd):
+            V[:, prunInd] = 0
+            U[:, prunInd] = 0
+
+        # update lambda
+        if ard > 0:
+            lambdas = torch.sum(U, dim=0) / dim_time
 
         # ==== calculate objective function value ====
-        ardU = 0
-        tmp1 = 0
-        tmp2 = 0
-        tmp3 = 0
-        tmpl21 = torch.pow(V, 2)
+        # WV and DV of the updated V are reused in the next V update
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator_torch(Laplacian, V, DV)
+
+        # XV and VV are from the U update, and V has not changed since then
+        LogL, LDf, LSl, L21, ardU = compute_objective_SR_NMF_torch(X2, U, V, XV, VV, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL,
+                                                                   ard=ard, hyperLam=hyperLam, dataPrecision=dataPrecision)
+        print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile)
+
+        # The iteration needs to meet minimum iteration number and small changes of LogL
+        if i > minIter and abs(oldLogL - LogL) / torch.maximum(oldLogL, torch_eps) < error:
+            break
+        oldLogL = LogL.clone()
+
+        # QC Control
+        temp = mat_corr_torch(gFN, V, dataPrecision=dataPrecision)
+        QC_Spatial_Correspondence = torch.clone(torch.diag(temp))
+        temp -= torch.diag(2 * torch.ones(K))  # set diagonal values to lower than -1
+        QC_Spatial_Correspondence_Control = torch.max(temp, dim=0)[0]
+        QC_Delta_Sim = torch.min(QC_Spatial_Correspondence - QC_Spatial_Correspondence_Control)
+        QC_Delta_Sim = QC_Delta_Sim.cpu().numpy()
+
+        if QC_Delta_Sim <= 0:
+            flagQC = 1
+            U.copy_(oldU)
+            V.copy_(oldV)
+            print(f'\n  QC: Meet QC constraint: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
+            print(f'    Use results from last iteration', file=logFile, flush=True)
+            break
+        else:
+            oldU.copy_(U)
+            oldV.copy_(V)
+            print(f'        QC: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
+
+            # Save U and V of an accepted iteration
+            if file_checkpoint is not None and time.time() - timeCheckpoint >= checkpointInterval:
+                save_NMF_checkpoint(file_checkpoint, U.numpy(), V.numpy(), i, float(oldLogL), fingerprint)
+                timeCheckpoint = time.time()
+
+    print(f'\n Finished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
+    return U, V
+
+
+def pFN_NMF_batch_torch(Data_list, gFN, gNb, maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-4, normW=1,
+                        Alpha=2, Beta=30, alphaS=0, alphaL=0, initConv=1, ard=0, eta=0, Laplacian=None, dataPrecision='double', logFile_list=None):
+    """
+    Compute personalized FNs for a batch of subjects together, using the same multiplicative update as pFN_NMF_torch
+    Data of all subjects are stacked into a 3D tensor [nBatch, dim_time, dim_space], so that updates use batched matrix multiplications
+    Each subject has its own convergence and QC check, and leaves the batch once finished
+    vxI is not supported, as the Laplacian operator is shared by all subjects
+
+    :param Data_list: a list of 2D matrices [dim_time, dim_space], numpy.ndarray or torch.Tensor, with the same dim_time
+    :param gFN: group level FNs 2D matrix [dim_space, K], K is the number of functional networks, numpy.ndarray or torch.Tensor. gFN will be cloned
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param maxIter: maximum iteration number for multiplicative update
+    :param minIter: minimum iteration in case fast convergence
+    :param meanFitRatio: a 0-1 scaler, exponential moving average coefficient, used for the initialization of U when using group initialized V
+    :param error: difference of cost function for convergence
+    :param normW: 1 or 2, normalization method for W used in Laplacian regularization
+    :param Alpha: hyper parameter for spatial sparsity
+    :param Beta: hyper parameter for Laplacian sparsity
+    :param alphaS: internally determined, the coefficient for spatial sparsity based Alpha, data size, K, and gNb
+    :param alphaL: internally determined, the coefficient for Laplacian sparsity based Beta, data size, K, and gNb
+    :param initConv: flag for convergence of initialization of U
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param eta: a hyper parameter for the ard regularization term
+    :param Laplacian: optional Laplacian operator from setup_Laplacian_operator_torch. It is rescaled to alphaL
+    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
+    :param logFile_list: None or a list of str, directories of txt log files for each subject
+    :return: U_list and V_list, lists of U [dim_time, K] and V [dim_space, K] for each subject
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Setup data precision and eps
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    if not isinstance(gFN, torch.Tensor):
+        gFN = torch.tensor(gFN, dtype=torch_float)
+    else:
+        gFN = gFN.type(torch_float)
+
+    nBatch = len(Data_list)
+    dim_time, dim_space = Data_list[0].shape
+    K = gFN.shape[1]
+
+    # check dimension of Data and gFN
+    for Data in Data_list:
+        if Data.shape[0] != dim_time:
+            raise ValueError("All data in a batch should have the same time dimension")
+        if Data.shape[1] != gFN.shape[0]:
+            raise ValueError("The second dimension of Data should match the first dimension of gFn, as they are space dimension")
+
+    # setup log files
+    if logFile_list is None:
+        logFile_list = ['Log_pFN_NMF.log'] * nBatch
+    logFile_list = [open(logFile, 'a') if isinstance(logFile, str) else logFile for logFile in logFile_list]
+    for logFile in logFile_list:
+        print(f'\nStart NMF for pFN using PyTorch in a batch of {nBatch} at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
+    # Median number of graph neighbors
+    nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
+
+    # Use Alpha and Beta to set alphaS and alphaL if they are 0
+    if alphaS == 0 and Alpha > 0:
+        alphaS = np.round(Alpha * dim_time / K)
+    if alphaL == 0 and Beta > 0:
+        alphaL = np.round(Beta * dim_time / K / nM)
+
+    # Prepare and normalize scans into a 3D tensor
+    X = torch.empty((nBatch, dim_time, dim_space), dtype=torch_float)
+    for b in range(nBatch):
+        X[b] = normalize_data_torch(Data_list[b], 'vp', 'vmax', dataPrecision)
+
+    # Construct the spatial affinity graph, shared by all subjects
+    if Laplacian is None:
+        Laplacian = setup_Laplacian_operator_torch(gNb, dim_space, 0, None, alphaL, normW, dataPrecision)
+    else:
+        Laplacian = scale_Laplacian_operator_torch(Laplacian, alphaL, dataPrecision)
+
+    # Initialize V, same for all subjects
+    V0 = gFN.clone()
+    miv = torch.max(V0, dim=0)[0]
+    trimInd = V0 / torch.maximum(miv, torch_eps) < torch.tensor(5e-2)
+    V0[trimInd] = 0
+    V = V0.repeat(nBatch, 1, 1)
+
+    # Initialize U for each subject
+    U = torch.empty((nBatch, dim_time, K), dtype=torch_float)
+    for b in range(nBatch):
+        U[b] = initialize_u_torch(X[b], X[b] @ V0 / torch.sum(V0, dim=0), V0, error=error, maxIter=100, minIter=minIter,
+                                  meanFitRatio=meanFitRatio, initConv=initConv, dataPrecision=dataPrecision)
+
+    # Squared norm of each X for the data fitting term
+    X2 = torch.stack([data_squared_norm_torch(X[b]) for b in range(nBatch)])
+
+    if ard > 0:
+        lambdas = torch.sum(U, dim=1, keepdim=True) / dim_time
+        hyperLam = (eta * X2 / (dim_time * dim_space * 2)).type(torch_float).reshape((nBatch, 1, 1))
+    else:
+        lambdas = 0
+        hyperLam = torch.zeros((nBatch, 1, 1), dtype=torch_float)
+
+    # Preallocated buffers for the in-place multiplicative update of the whole batch
+    workspace = setup_NMF_workspace_torch(dim_time, dim_space, K, dataPrecision, nBatch=nBatch)
+    oldU = workspace['oldU']
+    oldV = workspace['oldV']
+
+    # WV and DV are shared by the V update and the objective function
+    WV = None
+    DV = None
+    if alphaL > 0:
+        WV, DV = apply_Laplacian_operator_torch(Laplacian, V, workspace['DV'])
+
+    # Subjects remaining in the batch, and their results
+    subject = np.arange(nBatch)
+    U_list = [None] * nBatch
+    V_list = [None] * nBatch
+    oldLogL = [torch.tensor(torch.inf)] * nBatch
+    oldU.copy_(U)
+    oldV.copy_(V)
+
+    #  Multiplicative update of U and V
+    for i in range(1, 1+maxIter):
+        # ===================== update V ========================
+        update_V_SR_NMF_torch(X, U, V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+
+        # Prune V if empty components are found in V
+        torch.ne(V, 0, out=workspace['maskV'])
+        prunInd = torch.sum(workspace['maskV'], dim=1) == 1
+        if torch.any(prunInd):
+            for b, k in torch.argwhere(prunInd):
+                V[b, :, k] = 0
+                U[b, :, k] = 0
+
+        # normalize U and V
+        normalize_u_v_inplace_torch(U, V, 1, 1, workspace, dataPrecision)
+
+        # ===================== update U =========================
+        update_U_SR_NMF_torch(X, U, V, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, dataPrecision=dataPrecision)
+
+        # Prune U if empty components are found in U
+        prunInd = torch.sum(U, dim=1) == 0
+        if torch.any(prunInd):
+            for b, k in torch.argwhere(prunInd):
+                V[b, :, k] = 0
+                U[b, :, k] = 0
+
+        # update lambda
+        if ard > 0:
+            lambdas = torch.sum(U, dim=1, keepdim=True) / dim_time
 
+        # ==== calculate objective function value ====
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator_torch(Laplacian, V, DV)
+
+        flagFinished = np.zeros(len(subject), dtype=bool)
+        for b in range(len(subject)):
+            logFile = logFile_list[subject[b]]
+            LogL, LDf, LSl, L21, ardU = compute_objective_SR_NMF_torch(X2[b], U[b], V[b], workspace['XV'][b], workspace['VV'][b],
+                                                                       WV=WV[b] if alphaL > 0 else None, DV=DV[b] if alphaL > 0 else None,
+                                                                       alphaS=alphaS, alphaL=alphaL, ard=ard, hyperLam=hyperLam[b, 0, 0], dataPrecision=dataPrecision)
+            print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile)
+
+            # The iteration needs to meet minimum iteration number and small changes of LogL
+            if i > minIter and abs(oldLogL[b] - LogL) / torch.maximum(oldLogL[b], torch_eps) < error:
+                flagFinished[b] = True
+                continue
+            oldLogL[b] = LogL.clone()
+
+            # QC Control
+            temp = mat_corr_torch(gFN, V[b], dataPrecision=dataPrecision)
+            QC_Spatial_Correspondence = torch.clone(torch.diag(temp))
+            temp -= torch.diag(2 * torch.ones(K))  # set diagonal values to lower than -1
+            QC_Spatial_Correspondence_Control = torch.max(temp, dim=0)[0]
+            QC_Delta_Sim = torch.min(QC_Spatial_Correspondence - QC_Spatial_Correspondence_Control)
+            QC_Delta_Sim = QC_Delta_Sim.cpu().numpy()
+
+            if QC_Delta_Sim <= 0:
+                U[b].copy_(oldU[b])
+                V[b].copy_(oldV[b])
+                flagFinished[b] = True
+                print(f'\n  QC: Meet QC constraint: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
+                print(f'    Use results from last iteration', file=logFile, flush=True)
+            else:
+                oldU[b].copy_(U[b])
+                oldV[b].copy_(V[b])
+                print(f'        QC: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
+
+        if not np.any(flagFinished):
+            continue
+
+        # Finished subjects leave the batch
+        for b in np.flatnonzero(flagFinished):
+            U_list[subject[b]] = U[b].clone()
+            V_list[subject[b]] = V[b].clone()
+        keep = np.flatnonzero(~flagFinished)
+        if keep.shape[0] == 0:
+            break
+        # Move remaining subjects to the front, without copying the whole batch
+        for b_new, b in enumerate(keep):
+            if b_new != b:
+                X[b_new] = X[b]
+                U[b_new] = U[b]
+                V[b_new] = V[b]
+                oldU[b_new] = oldU[b]
+                oldV[b_new] = oldV[b]
+        nActive = keep.shape[0]
+        X = X[:nActive]
+        U = U[:nActive]
+        V = V[:nActive]
+        subject = subject[keep]
+        X2 = X2[keep]
+        oldLogL = [oldLogL[b] for b in keep]
+        hyperLam = hyperLam[keep]
         if ard > 0:
-            su = torch.sum(U, dim=0)
-            su[su == 0] = 1
-            ardU = torch.sum(torch.log(su)) * dim_time * hyperLam
+            lambdas = lambdas[keep]
+        workspace = {key: value[:nActive] if isinstance(value, torch.Tensor) else value for key, value in workspace.items()}
+        workspace['nBatch'] = nActive
+        oldU = workspace['oldU']
+        oldV = workspace['oldV']
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator_torch(Laplacian, V, workspace['DV'])
+
+    # Subjects reaching the maximum iteration
+    for b in range(len(subject)):
+        if U_list[subject[b]] is None:
+            U_list[subject[b]] = U[b].clone()
+            V_list[subject[b]] = V[b].clone()
+
+    for logFile in logFile_list:
+        print(f'\n Finished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
+    return U_list, V_list
+
+
+def gFN_NMF_restart_torch(X, sketch, U, V, X2, Laplacian, workspace=None, maxIter=1000, minIter=30, error=1e-8,
+                          alphaS=0, alphaL=0, ard=0, eta=0, solver='mu', repeat=1, tracker=None, dataPrecision='double', logFile=None):
+    """
+    Run one repetition of gFN_NMF_torch from an initialization of U and V, which are updated in place
+    With a tracker from setup_restart_tracker, LogL is shared with concurrent repetitions, and this repetition is abandoned once it falls behind
+
+    :param X: data, 2D matrix [dim_time, dim_space], torch.Tensor, or blocked data from setup_blocked_data
+    :param sketch: None or a temporal sketch of X from setup_temporal_sketch_torch, used before a refinement on X
+    :param U: initial temporal components, 2D matrix [dim_time, K], torch.Tensor
+    :param V: initial spatial components, 2D matrix [dim_space, K], torch.Tensor
+    :param X2: squared norm of X from data_squared_norm_torch
+    :param Laplacian: a Laplacian operator from setup_Laplacian_operator_torch
+    :param workspace: None or preallocated buffers from setup_NMF_workspace_torch
+    :param maxIter: maximum iteration number for multiplicative update
+    :param minIter: minimum iteration in case fast convergence
+    :param error: difference of cost function for convergence
+    :param alphaS: the coefficient for spatial sparsity
+    :param alphaL: the coefficient for Laplacian sparsity
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param eta: a hyper parameter for the ard regularization term
+    :param solver: 'mu', 'accelerated_mu' or 'hals', the solver for updating U and V, see update_V_SR_NMF_torch
+    :param repeat: index of the repetition
+    :param tracker: None or a tracker from setup_restart_tracker
+    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
+    :param logFile: None or an opened log file
+    :return: LogL, flag_Repeat. flag_Repeat is 0 for convergence, 1 if stopped before the minimum iteration number, and 2 if abandoned
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+    dim_time, K = U.shape
+    dim_space = V.shape[0]
+    if workspace is None:
+        workspace = setup_NMF_workspace_torch(dim_time, dim_space, K, dataPrecision)
+    XV = workspace['XV']
+    VV = workspace['VV']
+    # Concurrent repetitions are distinguished in the log file
+    logPrefix = '' if tracker is None else f'Repeat = {repeat}, '
+
+    # Normalize data
+    normalize_u_v_inplace_torch(U, V, 1, 1, workspace, dataPrecision)
+
+    if ard > 0:
+        ard = 1
+        eta = 0.1
+        lambdas = torch.sum(U, dim=0) / dim_time
+        hyperLam = eta * X2 / (dim_time * dim_space * 2)
+    else:
+        lambdas = 0
+        hyperLam = 0
 
-        tmpDf = torch.pow(X - U @ V.T, 2)
-        tmp1 = torch.sum(tmpDf)
+    # WV and DV are shared by the V update and the objective function
+    WV = None
+    DV = None
+    if alphaL > 0:
+        WV, DV = apply_Laplacian_operator_torch(Laplacian, V, workspace['DV'])
 
+    oldLogL = torch.inf
+    LogL = torch.inf
+    flag_Repeat = 0
+
+    # Use the compressed data first, then refine results using the original data
+    Xi = X if sketch is None else sketch
+    iRefine = 0
+
+    # Multiplicative update of U and V
+    for i in range(1, 1+maxIter+(minIter if sketch is not None else 0)):
+        # ===================== update V ========================
+        # Eq. 8-11
+        # WV and DV were computed with the current V at the end of last iteration
+        update_V_SR_NMF_torch(Xi, U, V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, solver=solver, Laplacian=Laplacian, dataPrecision=dataPrecision)
+
+        # Prune V if empty components are found in V
+        # This is almost impossible to happen without combining FNs
+        torch.ne(V, 0, out=workspace['maskV'])
+        prunInd = torch.sum(workspace['maskV'], dim=0) == 1
+        if torch.any(prunInd):
+            V[:, prunInd] = 0
+            U[:, prunInd] = 0
+
+        # normalize U and V
+        normalize_u_v_inplace_torch(U, V, 1, 1, workspace, dataPrecision)
+
+        # ===================== update U =========================
+        update_U_SR_NMF_torch(Xi, U, V, workspace, ard=ard, lambdas=lambdas, hyperLam=hyperLam, solver=solver, dataPrecision=dataPrecision)
+
+        # Prune U if empty components are found in U
+        # This is almost impossible to happen without combining FNs
+        prunInd = torch.sum(U, dim=0) == 0
+        if torch.any(prunInd):
+            V[:, prunInd] = 0
+            U[:, prunInd] = 0
+
+        # update lambda
+        if ard > 0:
+            lambdas = torch.sum(U) / dim_time
+
+        # ==== calculate objective function value ====
+        # WV and DV of the updated V are reused in the next V update
         if alphaL > 0:
-            tmp2 = V.T @ L * V.T
+            WV, DV = apply_Laplacian_operator_torch(Laplacian, V, DV)
 
-        L21 = alphaS * torch.sum(torch.sum(torch.sqrt(tmpl21), dim=0) / torch.maximum(torch.sqrt(torch.sum(tmpl21, dim=0)), torch_eps))
-        LDf = tmp1
-        LSl = torch.sum(tmp2)
+        # XV and VV are from the U update, and V has not changed since then
+        LogL, LDf, LSl, L21, ardU = compute_objective_SR_NMF_torch(X2, U, V, XV, VV, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL,
+                                                                   ard=ard, hyperLam=hyperLam, dataPrecision=dataPrecision)
+        print(f"    {logPrefix}Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile, flush=True)
 
-        # Objective function
-        LogL = L21 + ardU + LDf + LSl
-        print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile)
+        # Stop this repetition if it falls behind concurrent repetitions
+        if tracker is not None and update_restart_tracker(tracker, repeat, int(iRefine > 0), LogL):
+            flag_Repeat = 2
+            print(f'\n Repetition {repeat} is abandoned as its LogL falls behind other repetitions\n', file=logFile, flush=True)
+            break
 
-        # The iteration needs to meet minimum iteration number and small changes of LogL
-        if i > minIter and abs(oldLogL - LogL) / torch.maximum(oldLogL, torch_eps) < error:
+        if iRefine > 0:
+            # Refinement on the original data stops at convergence or after minIter iterations
+            if (i > iRefine + 1 and abs(oldLogL - LogL) / torch.maximum(oldLogL, torch_eps) < error) or i - iRefine >= minIter:
+                break
+        elif 1 < i < minIter and abs(oldLogL - LogL) / torch.maximum(oldLogL, torch_eps) < error:
+            flag_Repeat = 1
+            print('\n Iteration stopped before the minimum iteration number. The results might be poor.\n', file=logFile, flush=True)
             break
+        elif (i > minIter and abs(oldLogL - LogL) / torch.maximum(oldLogL, torch_eps) < error) or i >= maxIter:
+            if sketch is None:
+                break
+            # LogL of compressed data is not comparable to LogL of the original data
+            if tracker is not None:
+                update_restart_tracker(tracker, repeat, 0, None)
+            Xi = X
+            iRefine = i
+            oldLogL = torch.inf
+            print('\n Start refinement using the original data\n', file=logFile, flush=True)
+            continue
         oldLogL = LogL.clone()
 
-        # QC Control
-        temp = mat_corr_torch(gFN, V, dataPrecision=dataPrecision)
-        QC_Spatial_Correspondence = torch.clone(torch.diag(temp))
-        temp -= torch.diag(2 * torch.ones(K))  # set diagonal values to lower than -1
-        QC_Spatial_Correspondence_Control = torch.max(temp, dim=0)[0]
-        QC_Delta_Sim = torch.min(QC_Spatial_Correspondence - QC_Spatial_Correspondence_Control)
-        QC_Delta_Sim = QC_Delta_Sim.cpu().numpy()
+    if tracker is not None and flag_Repeat != 2:
+        update_restart_tracker(tracker, repeat, int(iRefine > 0), None)
 
-        if QC_Delta_Sim <= 0:
-            flagQC = 1
-            U = oldU.clone()
-            V = oldV.clone()
-            print(f'\n  QC: Meet QC constraint: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
-            print(f'    Use results from last iteration', file=logFile, flush=True)
-            break
-        else:
-            oldU = U.clone()
-            oldV = V.clone()
-            print(f'        QC: Delta sim = {QC_Delta_Sim}', file=logFile, flush=True)
+    return LogL, flag_Repeat
 
-    print(f'\n Finished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
 
-    return U, V
+def setup_warm_start_V_torch(V, initV):
+    """
+    Replace the first columns of a random initial V by FNs of a previous solution, such as gFNs of a smaller K
+    Each FN in initV is scaled to the mean of the random V, so that all columns start at the same level
+
+    :param V: random initial FNs, 2D tensor [dim_space, K]
+    :param initV: FNs of a previous solution, 2D matrix [dim_space, K0] with K0 <= K, numpy.ndarray or torch.Tensor
+    :return: V, 2D tensor [dim_space, K]
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    initV = torch.as_tensor(initV).type(V.dtype).to(V.device)
+    meanV = torch.mean(initV, dim=0, keepdim=True)
+    V[:, :initV.shape[1]] = initV / torch.clamp(meanV, min=torch.finfo(V.dtype).eps) * torch.mean(V)
+    return V
 
 
 def gFN_NMF_torch(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
-            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, dataPrecision='double', logFile='Log_pFN_NMF.log'):
+            Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, solver='mu', Laplacian=None, sketchSize=0, maxM=12500000, nParallel=1, abandonRatio=0.05, initV=None, dataPrecision='double', logFile='Log_pFN_NMF.log'):
     """
     Compute group-level FNs using NMF method
+    With a positive sketchSize, NMF runs on a temporal sketch of data, followed by a refinement of at most minIter iterations on the original data
+    Data can be a memory-mapped array for out-of-core computation, which is read in blocks of at most maxM elements, see setup_blocked_data
+    With nParallel > 1, all nRepeat repetitions run concurrently and the best one is kept. A repetition is abandoned after minIter iterations once its LogL falls behind the others by abandonRatio
+    With initV, such as gFNs of a smaller K, the first columns of V in all repetitions start from initV, see setup_warm_start_V_torch
 
-    :param Data: 2D matrix [dim_time, dim_space], numpy.ndarray or torch.Tensor, recommend to normalize each fMRI scan before concatenate them along the time dimension
+    :param Data: 2D matrix [dim_time, dim_space], numpy.ndarray or torch.Tensor, recommend to normalize each fMRI scan before concatenate them along the time dimension. It can also be a memory-mapped array or directory of a .npy file
     :param K: number of FNs
     :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
     :param maxIter: maximum iteration number for multiplicative update
@@ -639,6 +1874,13 @@ def gFN_NMF_torch(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
     :param ard: 0 or 1, flat for combining similar clusters
     :param eta: a hyper parameter for the ard regularization term
     :param nRepeat: Any positive integer, the number of repetition to avoid poor initialization
+    :param solver: 'mu', 'accelerated_mu' or 'hals', the solver for updating U and V, see update_V_SR_NMF_torch
+    :param Laplacian: optional Laplacian operator from setup_Laplacian_operator_torch, shared across runs with the same gNb. Its normW and vxI are used, and it is rescaled to alphaL
+    :param sketchSize: 0, 'Automatic' or a positive integer, number of rows of the temporal sketch from setup_temporal_sketch_torch. 0 disables compression, and 'Automatic' uses max(20*K, 200)
+    :param maxM: maximum number of elements in one block of data for out-of-core computation
+    :param nParallel: 1, 'Automatic' or a positive integer, number of repetitions running concurrently in threads. 1 runs repetitions one by one until one reaches minIter, and 'Automatic' uses the number of CPUs. Threads of numpy and PyTorch are split among concurrent repetitions
+    :param abandonRatio: a concurrent repetition is abandoned if its LogL is larger than the best LogL of other repetitions at the same iteration by this ratio
+    :param initV: None or initial FNs, 2D matrix [dim_space, K0] with K0 <= K, numpy.ndarray or torch.Tensor
     :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
     :param logFile: str, directory of a txt log file
     :return: gFN, 2D matrix [dim_space, K]
@@ -655,10 +1897,17 @@ def gFN_NMF_torch(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
     torch_float, torch_eps = set_data_precision_torch(dataPrecision)
 
     # Transform data format if necessary
-    if not isinstance(Data, torch.Tensor):
-        Data = torch.tensor(Data, dtype=torch_float)
+    flag_OutOfCore = isinstance(Data, (str, np.memmap))
+    if flag_OutOfCore:
+        # Data stay on disk, and normalization is applied to each loaded block
+        X = setup_blocked_data(Data, maxM, dataPrecision=dataPrecision)
+        dim_time, dim_space = X['dim_time'], X['dim_space']
     else:
-        Data = Data.type(torch_float)
+        if not isinstance(Data, torch.Tensor):
+            Data = torch.tensor(Data, dtype=torch_float)
+        else:
+            Data = Data.type(torch_float)
+        dim_time, dim_space = Data.shape
     if not isinstance(error, torch.Tensor):
         error = torch.tensor(error, dtype=torch_float)
     else:
@@ -672,9 +1921,6 @@ def gFN_NMF_torch(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
     else:
         alphaS = alphaS.type(torch_float)
 
-    # Input data size
-    dim_time, dim_space = Data.shape
-
     # Median number of graph neighbors
     nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
 
@@ -684,144 +1930,351 @@ def gFN_NMF_torch(Data, K, gNb, maxIter=1000, minIter=30, error=1e-8, normW=1,
     if alphaL == 0 and Beta > 0:
         alphaL = np.round(Beta * dim_time / K / nM)
 
+    if initV is not None and (initV.shape[0] != dim_space or initV.shape[1] > K):
+        raise ValueError('initV must have dim_space rows and at most K columns')
+
     # Prepare and normalize scan
-    Data = normalize_data_torch(Data, 'vp', 'vmax')
-    X = Data  # Save memory
+    if not flag_OutOfCore:
+        Data = normalize_data_torch(Data, 'vp', 'vmax', dataPrecision)
+        X = Data  # Save memory
 
     # Construct the spatial affinity graph
-    L, W, D = construct_Laplacian_gNb_torch(gNb, dim_space, vxI, X, alphaL, normW, dataPrecision)
+    if flag_OutOfCore and vxI > 0:
+        raise ValueError("vxI is not supported for out-of-core data")
+    if Laplacian is None:
+        Laplacian = setup_Laplacian_operator_torch(gNb, dim_space, vxI, X, alphaL, normW, dataPrecision)
+    else:
+        Laplacian = scale_Laplacian_operator_torch(Laplacian, alphaL, dataPrecision)
 
-    flag_Repeat = 0
-    for repeat in range(1, 1 + nRepeat):
-        flag_Repeat = 0
-        print(f'\n Starting {repeat}-th repetition\n', file=logFile, flush=True)
+    # Squared norm and mean of X, computed once for all repetitions
+    X2 = data_squared_norm_torch(X)
+    mean_X = (torch.tensor(X['sumX'], dtype=torch_float) if flag_OutOfCore else torch.sum(X)) / (dim_time*dim_space)
 
-        # Initialize U and V
-        mean_X = torch.divide(torch.sum(X), torch.tensor(dim_time*dim_space))
-        U = (torch.rand((dim_time, K), dtype=torch_float) + 1) * (torch.sqrt(torch.div(mean_X, K)))
-        V = (torch.rand((dim_space, K), dtype=torch_float) + 1) * (torch.sqrt(torch.div(mean_X, K)))
+    # Temporal compression of data, shared by all repetitions
+    sketch = None
+    if sketchSize == 'Automatic':
+        sketchSize = int(np.maximum(20 * K, 200))
+    if 0 < sketchSize < dim_time:
+        sketch = setup_temporal_sketch_torch(X, sketchSize, dataPrecision=dataPrecision)
+        print(f'\n Data are compressed from {dim_time} to {sketch["sketchSize"]} time points\n', file=logFile, flush=True)
 
-        # Normalize data
-        U, V = normalize_u_v_torch(U, V, 1, 1, dataPrecision)
+    if nParallel == 'Automatic':
+        nParallel = os.cpu_count()
+    nParallel = int(np.maximum(np.minimum(nParallel, nRepeat), 1))
 
-        if ard > 0:
-            ard = 1
-            eta = 0.1
-            lambdas = torch.sum(U, dim=0) / dim_time
-            hyperLam = eta * torch.sum(torch.pow(X, 2)) / (dim_time * dim_space * 2)
-        else:
-            lambdas = 0
-            hyperLam = 0
+    if nParallel == 1:
+        # Preallocated buffers for the in-place multiplicative update, shared by all repetitions
+        workspace = setup_NMF_workspace_torch(dim_time, dim_space, K, dataPrecision)
 
-        oldLogL = torch.inf
+        flag_Repeat = 0
+        for repeat in range(1, 1 + nRepeat):
+            print(f'\n Starting {repeat}-th repetition\n', file=logFile, flush=True)
+
+            # Initialize U and V
+            U = (torch.rand((dim_time, K), dtype=torch_float) + 1) * (torch.sqrt(torch.div(mean_X, K)))
+            V = (torch.rand((dim_space, K), dtype=torch_float) + 1) * (torch.sqrt(torch.div(mean_X, K)))
+            if initV is not None:
+                V = setup_warm_start_V_torch(V, initV)
+
+            LogL, flag_Repeat = gFN_NMF_restart_torch(X, sketch, U, V, X2, Laplacian, workspace, maxIter=maxIter, minIter=minIter, error=error,
+                                                      alphaS=alphaS, alphaL=alphaL, ard=ard, eta=eta, solver=solver, repeat=repeat,
+                                                      dataPrecision=dataPrecision, logFile=logFile)
+            if flag_Repeat == 0:
+                break
 
-        # Multiplicative update of U and V
-        for i in range(1, 1+maxIter):
-            # ===================== update V ========================
-            # Eq. 8-11
-            XU = torch.matmul(X.T, U)
-            UU = torch.matmul(U.T, U)
-            VUU = torch.matmul(V, UU)
+    else:
+        # Initialize U and V of all repetitions in order, so that results do not depend on the concurrent execution
+        list_U = []
+        list_V = []
+        for repeat in range(1, 1 + nRepeat):
+            list_U.append((torch.rand((dim_time, K), dtype=torch_float) + 1) * (torch.sqrt(torch.div(mean_X, K))))
+            list_V.append((torch.rand((dim_space, K), dtype=torch_float) + 1) * (torch.sqrt(torch.div(mean_X, K))))
+            if initV is not None:
+                list_V[-1] = setup_warm_start_V_torch(list_V[-1], initV)
+
+        # Repetitions share X and Laplacian, and each one allocates its own workspace
+        print(f'\n Starting {nRepeat} repetitions with {nParallel} in parallel\n', file=logFile, flush=True)
+        tracker = setup_restart_tracker(warmUp=minIter, abandonRatio=abandonRatio)
+        # Threads of numpy and PyTorch are split among concurrent repetitions to avoid oversubscribing CPU cores
+        with split_computation_thread(nParallel), concurrent.futures.ThreadPoolExecutor(max_workers=nParallel) as executor:
+            list_future = [executor.submit(gFN_NMF_restart_torch, X, sketch, list_U[repeat-1], list_V[repeat-1], X2, Laplacian, None,
+                                           maxIter=maxIter, minIter=minIter, error=error, alphaS=alphaS, alphaL=alphaL, ard=ard, eta=eta,
+                                           solver=solver, repeat=repeat, tracker=tracker, dataPrecision=dataPrecision, logFile=logFile)
+                           for repeat in range(1, 1 + nRepeat)]
+            list_result = [future.result() for future in list_future]
+
+        # Keep the converged repetition with the lowest LogL
+        best = min(range(nRepeat), key=lambda r: (list_result[r][1], float(list_result[r][0])))
+        LogL, flag_Repeat = list_result[best]
+        V = list_V[best]
+        print(f'\n Selected {best+1}-th repetition with LogL: {LogL}\n', file=logFile, flush=True)
 
-            tmpl2 = torch.pow(V, 2)
+    if flag_Repeat == 1:
+        print('\n All repetition stopped before the minimum iteration number. The final results might be poor\n', file=logFile, flush=True)
 
-            if alphaS > 0:
-                tmpl21 = torch.sqrt(tmpl2)
-                tmpl22 = torch.sqrt(torch.sum(tmpl2, dim=0, keepdim=True))  # tmpl22 = torch.tile(torch.sqrt(torch.sum(tmpl2, dim=0)), (dim_space, 1))
-                tmpl21s = torch.sum(tmpl21, dim=0, keepdim=True)  # tmpl21s = torch.tile(torch.sum(tmpl21, dim=0), (dim_space, 1))
-                posTerm = torch.div(V, torch.maximum(torch.mul(tmpl21, tmpl22), torch_eps))
-                negTerm = torch.div(torch.mul(V, tmpl21s), torch.maximum(torch.pow(tmpl22, 3), torch_eps))
+    gFN = V
+    print(f'\nFinished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+    return gFN
 
-                VUU = VUU + 0.5 * alphaS * posTerm
-                XU = XU + 0.5 * alphaS * negTerm
 
-            if alphaL > 0:
-                WV = torch.matmul(W, V.type(torch.float64))
-                DV = torch.matmul(D, V.type(torch.float64))
+def gFN_NMF_online_torch(file_scan_list, K, gNb, dataType='Surface', dataFormat='HCP Surface (*.cifti, *.mat)', Brain_Mask=None, maxIter=1000, minIter=30, error=1e-8, normW=1,
+                         Alpha=2, Beta=30, alphaS=0, alphaL=0, ard=0, eta=0, nScanBatch=1, Laplacian=None, Cache=None, dataPrecision='double', logFile='Log_pFN_NMF.log'):
+    """
+    Compute group-level FNs using NMF method, streaming scans from disk instead of concatenating them
+    Only one scan is in memory at a time. Each scan keeps its own temporal components U_s, and the V update uses the sufficient statistics
+    X' @ U = sum(X_s' @ U_s) and U' @ U = sum(U_s' @ U_s), which are updated incrementally after updating U_s
+    Each scan is normalized by vp-vmax, equivalent to normalizing the concatenated data
+    Each iteration is a pass over all scans, and V is updated before every nScanBatch scans. The objective function is accumulated along the pass
+    Without Cache, every pass reads and decodes all scans from disk again, for up to maxIter passes
+    With ard, lambdas are updated after each pass in the same way as gFN_NMF_restart_torch after each U update
+
+    :param file_scan_list: directory of a txt file storing directories of fMRI scans, such as Scan_List.txt of a bootstrap run
+    :param K: number of FNs
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param dataType: 'Surface', 'Volume', 'Surface-Volume'
+    :param dataFormat: data format supported by load_fmri_scan
+    :param Brain_Mask: None or a brain mask, required for reshaping volume data
+    :param maxIter: maximum number of passes over all scans
+    :param minIter: minimum number of passes in case fast convergence
+    :param error: difference of cost function for convergence
+    :param normW: 1 or 2, normalization method for W used in Laplacian regularization
+    :param Alpha: hyper parameter for spatial sparsity
+    :param Beta: hyper parameter for Laplacian sparsity
+    :param alphaS: internally determined, the coefficient for spatial sparsity based Alpha, data size, K, and gNb
+    :param alphaL: internally determined, the coefficient for Laplacian sparsity based Beta, data size, K, and gNb
+    :param ard: 0 or 1, flat for combining similar clusters
+    :param eta: a hyper parameter for the ard regularization term
+    :param nScanBatch: positive integer, number of scans between two updates of V
+    :param Laplacian: optional Laplacian operator from setup_Laplacian_operator_torch, shared across runs with the same gNb. Its normW is used, and it is rescaled to alphaL
+    :param Cache: None or a dict of the scan cache used by load_fmri_scan. Scans are loaded once per pass over all scans, so later passes read them from the cache
+    :param dataPrecision: 'single' or 'float32', 'double' or 'float64'
+    :param logFile: str, directory of a txt log file
+    :return: gFN, 2D matrix [dim_space, K], torch.Tensor
 
-                XU = torch.add(XU, WV)
-                VUU = torch.add(VUU, DV)
+    Yuncong Ma, 11/9/2023
+    """
 
-            V = torch.mul(V, (torch.div(XU, torch.maximum(VUU, torch_eps))))
+    # setup log file
+    if isinstance(logFile, str):
+        logFile = open(logFile, 'a')
+    print(f'\nStart online NMF for gFN using PyTorch at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
 
-            # Prune V if empty components are found in V
-            # This is almost impossible to happen without combining FNs
-            prunInd = torch.sum(V != 0, dim=0) == 1
-            if torch.any(prunInd):
-                V[:, prunInd] = torch.zeros((dim_space, torch.sum(prunInd)))
-                U[:, prunInd] = torch.zeros((dim_time, torch.sum(prunInd)))
+    # Setup data precision and eps
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
 
-            # normalize U and V
-            U, V = normalize_u_v_torch(U, V, 1, 1, dataPrecision)
+    if os.path.isfile(file_scan_list) and file_scan_list.endswith('.txt'):
+        scan_list = [line.replace('\n', '') for line in open(file_scan_list, 'r')]
+        scan_list = [scan for scan in scan_list if len(scan) > 0]
+    else:
+        scan_list = [file_scan_list]
+    nScan = len(scan_list)
+
+    # First pass: random initialization of U and V, and sufficient statistics
+    # This matches gFN_NMF, which updates V first using a random U
+    U_list = [None] * nScan
+    X2_list = torch.zeros(nScan, dtype=torch.float64)
+    dim_time = 0
+    V = None
+    for s in range(nScan):
+        X = torch.tensor(load_fmri_scan(scan_list[s], dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
+                                        Normalization='vp-vmax', Cache=Cache), dtype=torch_float)
+        if V is None:
+            dim_space = X.shape[1]
+            V = torch.rand((dim_space, K), dtype=torch_float) + 1
+            norms = torch.clamp(torch.amax(V, dim=0), min=torch_eps)
+            V /= norms
+            XU = torch.zeros((dim_space, K), dtype=torch.float64)
+            UU = torch.zeros((K, K), dtype=torch.float64)
+            sumU = torch.zeros(K, dtype=torch.float64)
+        elif X.shape[1] != dim_space:
+            raise ValueError('Scans have different spatial dimensions when loading scan: ' + scan_list[s])
+        mean_X = torch.sum(X) / X.numel()
+        U = (torch.rand((X.shape[0], K), dtype=torch_float) + 1) * torch.sqrt(mean_X / K) * norms
+        XU += X.T @ U
+        UU += U.T @ U
+        sumU += torch.sum(U, dim=0)
+        U_list[s] = U
+        dim_time += X.shape[0]
+        X2_list[s] = data_squared_norm_torch(X)
+        del X
+    X2 = torch.sum(X2_list)
+    print(f' {nScan} scans with {dim_time} time points in total\n', file=logFile, flush=True)
 
-            # ===================== update U =========================
-            XV = torch.matmul(X, V)
-            VV = torch.matmul(V.T, V)
-            UVV = torch.matmul(U, VV)
+    # Median number of graph neighbors
+    nM = np.median(np.unique(gNb[:, 0], return_counts=True)[1])
 
-            if ard > 0:  # ard term for U
-                posTerm = torch.div(torch.tensor(1.0), torch.maximum(torch.tile(lambdas, (dim_time, 1)), torch_eps))
+    # Use Alpha and Beta to set alphaS and alphaL if they are 0
+    if alphaS == 0 and Alpha > 0:
+        alphaS = np.round(Alpha * dim_time / K)
+    if alphaL == 0 and Beta > 0:
+        alphaL = np.round(Beta * dim_time / K / nM)
 
-                UVV = torch.add(UVV, posTerm * hyperLam)
+    # Construct the spatial affinity graph
+    if Laplacian is None:
+        Laplacian = setup_Laplacian_operator_torch(gNb, dim_space, 0, None, alphaL, normW, dataPrecision)
+    else:
+        Laplacian = scale_Laplacian_operator_torch(Laplacian, alphaL, dataPrecision)
 
-            U = torch.mul(U, torch.div(XV, torch.maximum(UVV, torch_eps)))
+    if ard > 0:
+        ard = 1
+        eta = 0.1
+        lambdas = sumU / dim_time
+        hyperLam = eta * X2 / (dim_time * dim_space * 2)
+    else:
+        lambdas = 0
+        hyperLam = 0
 
-            # Prune U if empty components are found in U
-            # This is almost impossible to happen without combining FNs
-            prunInd = torch.sum(U, dim=0) == 0
-            if torch.any(prunInd):
-                V[:, prunInd] = torch.zeros((dim_space, torch.sum(prunInd)))
-                U[:, prunInd] = torch.zeros((dim_time, torch.sum(prunInd)))
+    # Preallocated buffers for V only, as U of each scan has its own size
+    workspace = setup_NMF_workspace_torch(0, dim_space, K, dataPrecision)
+    WV = None
+    DV = None
 
-            # update lambda
-            if ard > 0:
-                lambdas = torch.sum(U) / dim_time
+    oldLogL = torch.inf
+    for i in range(1, 1+maxIter):
+        LDf = 0
+        for s in range(nScan):
+            if s % nScanBatch == 0:
+                # ===================== update V ========================
+                # Eq. 8-11, using the sufficient statistics from all scans
+                workspace['XU'].copy_(XU.clamp(min=torch_eps))
+                workspace['UU'].copy_(UU)
+                if alphaL > 0:
+                    WV, DV = apply_Laplacian_operator_torch(Laplacian, V, workspace['DV'])
+                update_V_SR_NMF_step_torch(V, workspace, WV=WV, DV=DV, alphaS=alphaS, alphaL=alphaL, dataPrecision=dataPrecision)
+
+                # normalize U and V, and scale the sufficient statistics accordingly
+                norms = torch.clamp(torch.amax(V, dim=0), min=torch_eps)
+                V /= norms
+                for U in U_list:
+                    U *= norms
+                XU *= norms
+                UU *= torch.outer(norms, norms)
+                sumU *= norms
 
-            # ==== calculate objective function value ====
-            ardU = 0
-            tmp2 = 0
-            tmpl21 = torch.pow(V, 2)
+            # ===================== update U =========================
+            X = torch.tensor(load_fmri_scan(scan_list[s], dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
+                                            Normalization='vp-vmax', Cache=Cache), dtype=torch_float)
+            U = U_list[s]
+            XV = X @ V
+            VV = V.T @ V
+            oldU = U.clone()
 
+            # Multiplicative update of U_s
+            UVV = U @ VV
             if ard > 0:
-                su = torch.sum(U, dim=0)
-                su[su == 0] = 1
-                ardU = torch.sum(torch.log(su)) * dim_time * hyperLam
+                UVV += (hyperLam / torch.clamp(lambdas, min=torch_eps)).type(torch_float)
+            U *= XV / torch.clamp(UVV, min=torch_eps)
 
-            if alphaL > 0:
-                tmp2 = torch.mul(torch.matmul(V.T, L), V.T)
+            # Update sufficient statistics with the change of U_s
+            XU += X.T @ (U - oldU)
+            UU += U.T @ U - oldU.T @ oldU
+            sumU += torch.sum(U, dim=0) - torch.sum(oldU, dim=0)
+            LDf += data_fitting_error_gram_torch(X2_list[s], U, XV, VV)
+            del X
 
-            L21 = torch.mul(alphaS, torch.sum(torch.div(torch.sum(torch.sqrt(tmpl21), dim=0), torch.maximum(torch.sqrt(torch.sum(tmpl21, dim=0)), torch_eps))))
-            # LDf = data_fitting_error(X, U, V, 0, 1)
-            LDf = torch.sum(torch.pow(torch.subtract(X, torch.matmul(U, V.T)), 2))
-            LSl = torch.sum(tmp2)
+        # update lambda
+        if ard > 0:
+            lambdas = torch.sum(sumU) / dim_time
 
-            # Objective function
-            LogL = L21 + LDf + LSl + ardU
-            print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile, flush=True)
+        # ==== calculate objective function value ====
+        # The data fitting term of each scan uses V at the time of updating its U_s
+        L21 = alphaS * torch.sum(torch.sum(V, dim=0) / torch.clamp(torch.linalg.vector_norm(V, dim=0), min=torch_eps))
+        LSl = 0
+        if alphaL > 0:
+            WV, DV = apply_Laplacian_operator_torch(Laplacian, V)
+            LSl = torch.sum(V * DV, dtype=torch.float64) - torch.sum(V * WV, dtype=torch.float64)
+        ardU = 0
+        if ard > 0:
+            su = sumU.clone()
+            su[su == 0] = 1
+            ardU = torch.sum(torch.log(su)) * dim_time * hyperLam
+        LogL = L21 + ardU + LDf + LSl
+        print(f"    Iter = {i}: LogL: {LogL}, dataFit: {LDf}, spaLap: {LSl}, L21: {L21}, ardU: {ardU}", file=logFile, flush=True)
 
-            if 1 < i < minIter and abs(oldLogL - LogL) / torch.maximum(oldLogL, torch_eps) < error:
-                flag_Repeat = 1
-                print('\n Iteration stopped before the minimum iteration number. The results might be poor.\n', file=logFile, flush=True)
-                break
-            elif i > minIter and abs(oldLogL - LogL) / torch.maximum(oldLogL, torch_eps) < error:
-                break
-            oldLogL = LogL.clone()
-        if flag_Repeat == 0:
+        # The iteration needs to meet minimum iteration number and small changes of LogL
+        if i > minIter and abs(oldLogL - LogL) / torch.maximum(oldLogL, torch_eps) < error:
             break
-
-    if flag_Repeat == 1:
-        print('\n All repetition stopped before the minimum iteration number. The final results might be poor\n', file=logFile, flush=True)
+        oldLogL = LogL
 
     gFN = V
     print(f'\nFinished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
+
     return gFN
 
 
+def NCut_discretisation_torch(EigenVectors, ps, maxIter=20, maxM=12500000, dataPrecision='double'):
+    """
+    Discretize NCut eigenvectors into cluster labels for a batch of trials
+    Each trial starts from a different row in ps, and selects other initial centers as rows with the minimum similarity to previous ones
+    Trials are run together with stacked matrix products and SVDs, in chunks of at most maxM elements of EigenVectors @ R
+
+    :param EigenVectors: 2D tensor [n, k], eigenvectors with each row normalized to norm 1
+    :param ps: 1D tensor [T], index of the initial row of each trial
+    :param maxIter: maximum number of discretisation iterations, after the first one
+    :param maxM: maximum number of elements in one chunk of trials
+    :param dataPrecision: 'double' or 'single'
+    :return: C, NcutValue. C is a 2D tensor [T, n] with cluster labels starting from 0. NcutValue is a 1D tensor [T]
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+    n, k = EigenVectors.shape
+    device = EigenVectors.device
+    ps = torch.as_tensor(ps, dtype=torch.int64, device=device)
+    nTrial = ps.shape[0]
+    C = torch.zeros((nTrial, n), dtype=torch.int64, device=device)
+    NcutValue = torch.zeros(nTrial, dtype=torch_float, device=device)
+
+    chunkSize = max(maxM // (n * k), 1)
+    for t0 in range(0, nTrial, chunkSize):
+        t1 = min(t0 + chunkSize, nTrial)
+        nT = t1 - t0
+        trial = torch.arange(nT, device=device)
+
+        # Initial centers, similar to initialization in k++
+        R = torch.zeros((nT, k, k), dtype=torch_float, device=device)
+        R[:, :, 0] = EigenVectors[ps[t0:t1], :]
+        c = torch.zeros((nT, n), dtype=torch_float, device=device)  # Total distance to selected centers
+        c[trial, ps[t0:t1]] = torch.inf
+        for j in range(1, k):
+            c += torch.abs(R[:, :, j-1] @ EigenVectors.T)
+            p = torch.argmin(c, dim=1)
+            c[trial, p] = torch.inf
+            R[:, :, j] = EigenVectors[p, :]
+
+        lastObjectiveValue = torch.zeros(nT, dtype=torch_float, device=device)
+        active = trial
+        for nbIterationsDiscretisation in range(1, maxIter + 2):
+            nA = active.shape[0]
+            J = torch.argmax(torch.matmul(EigenVectors, R[active]), dim=2)  # Assign each sample to K centers of R based on highest similarity
+            # Sum of eigenvectors within each cluster, the same as EigenvectorsDiscrete.T @ EigenVectors
+            M = torch.zeros((nA, k, k), dtype=torch_float, device=device)
+            M.index_put_((torch.arange(nA, device=device)[:, None].expand(nA, n), J), EigenVectors.expand(nA, n, k), accumulate=True)
+            U, S, Vh = torch.linalg.svd(M)
+            value = 2 * (n - torch.sum(S, dim=1))
+
+            # escape the loop when converged or meet max iteration
+            flag_Stop = (torch.abs(value - lastObjectiveValue[active]) < torch_eps) | (nbIterationsDiscretisation > maxIter)
+            C[t0 + active[flag_Stop]] = J[flag_Stop]
+            NcutValue[t0 + active[flag_Stop]] = value[flag_Stop]
+            lastObjectiveValue[active] = value
+            R[active[~flag_Stop]] = torch.matmul(Vh[~flag_Stop].transpose(1, 2), U[~flag_Stop].transpose(1, 2))  # Update R which stores the new centers
+            active = active[~flag_Stop]
+            if active.shape[0] == 0:
+                break
+
+    return C, NcutValue
+
+
 def gFN_fusion_NCut_torch(gFN_BS, K, NCut_MaxTrial=100, dataPrecision='double', logFile='Log_gFN_fusion_NCut'):
     """
     Fuses FN results to generate representative group-level FNs
+    The normalized similarity matrix is scaled by the degree vector, and its first K eigenvectors are obtained by LOBPCG
+    All NCut trials are run in batches by NCut_discretisation_torch
 
-    :param gFN_BS: FNs obtained from bootstrapping method, FNs are concatenated along the K dimension
+    :param gFN_BS: FNs obtained from bootstrapping method, FNs are concatenated along the K dimension.
+        It can be a tensor sharing memory with a transposed np.memmap of an FN stack from load_FN_stack, which is read in blocks
     :param K: Number of FNs, not the total number of FNs obtained from bootstrapping
     :param NCut_MaxTrial: Max number trials for NCut method
     :param dataPrecision: 'double' or 'single'
@@ -839,129 +2292,87 @@ def gFN_fusion_NCut_torch(gFN_BS, K, NCut_MaxTrial=100, dataPrecision='double',
     # Setup data precision and eps
     torch_float, torch_eps = set_data_precision_torch(dataPrecision)
 
+    # A torch.Tensor, including one sharing memory with a np.memmap of an FN stack, is used without a copy in the working precision
     if not isinstance(gFN_BS, torch.Tensor):
         gFN_BS = torch.tensor(gFN_BS, dtype=torch_float)
-    else:
-        gFN_BS = gFN_BS.type(torch_float)
 
     # clustering by NCut
 
-    # Get similarity between samples
-    corrVal = mat_corr_torch(gFN_BS, dataPrecision=dataPrecision)  # similarity between FNs, [K * n_BS, K * n_BS]
-    corrVal[torch.isnan(corrVal)] = -1
-    nDis = 1 - corrVal  # Transform Pearson correlation to non-negative values similar to distance
-    triuInd = torch.triu(torch.ones(nDis.shape), 1)  # Index of upper triangle
-    nDisVec = nDis[triuInd == 1]  # Take the values in upper triangle
+    # Get similarity between samples, updated in place to save memory
+    nDis = mat_corr_torch(gFN_BS, dataPrecision=dataPrecision)  # similarity between FNs, [K * n_BS, K * n_BS]
+    nDis[torch.isnan(nDis)] = -1
+    torch.sub(1, nDis, out=nDis)  # Transform Pearson correlation to non-negative values similar to distance
+    n = nDis.shape[0]
+    nDisVec = torch.cat([nDis[i, i+1:] for i in range(n)])  # Take the values in upper triangle
     # Make all distance non-negative and normalize their distribution
-    nW = torch.exp(-torch.pow(nDis, 2) / (torch.pow(torch.median(nDisVec), 2)))  # Transform distance values using exp(-X/std^2) with std as the median value
+    # Transform distance values using exp(-X/std^2) with std as the median value
+    nW = nDis.square_()
+    nW *= -1 / torch.pow(torch.median(nDisVec), 2)
+    nW.exp_()
     nW[torch.isnan(nW)] = 0
     sumW = torch.sum(nW, dim=1)  # total distance for each FN
     sumW[sumW == 0] = 1  # In case two FNs are the same
-    # Construct Laplacian matrix
-    D = torch.diag(sumW)
-    L = torch.sqrt(torch.linalg.inv(D)) @ nW @ torch.linalg.inv(torch.sqrt(D))  # A way to normalize nW based on the total distance of each FN
+    # Construct Laplacian matrix, D^(-1/2) @ nW @ D^(-1/2) with D = diag(sumW), to normalize nW based on the total distance of each FN
+    dW = 1 / torch.sqrt(sumW)
+    L = nW
+    L *= dW[:, None]
+    L *= dW[None, :]
     L = (L + L.T) / 2  # Ensure L is symmetric. Computation error may result in asymmetry
 
     # Get first K eigenvectors, sign of vectors may be different to MATLAB results
-    eigenvalues, eigenvectors = torch.linalg.eigh(L.type(torch_float))
-    # Sort by eigenvalues and select the K largest
-    sorted_indices = torch.argsort(eigenvalues, descending=True)[:K]
-    eVal = eigenvalues[sorted_indices]
-    Ev = eigenvectors[:, sorted_indices]
-    Ev = torch.real(Ev)
+    if n >= 3 * K:
+        # The leading eigenvector is proportional to sqrt(sumW), used in the starting block with other columns from a fixed random generator
+        X0 = torch.randn((n, K), generator=torch.Generator().manual_seed(0), dtype=torch_float).to(L.device)
+        X0[:, 0] = torch.sqrt(sumW)
+        eVal, Ev = torch.lobpcg(L, k=K, X=X0, largest=True, tol=torch_eps ** 0.5)
+    else:
+        eVal, Ev = torch.linalg.eigh(L)
+        Ev = Ev[:, n-K:]
+    del L, nW, nDis
     # Correct the sign of eigenvectors to make them same as derived from MATLAB
     temp = torch.sign(torch.sum(Ev, dim=0))  # Use the total value of each eigenvector to reset its sign
     temp[temp == 0.0] = 1.0
-    Ev = Ev * torch.tile(temp, (Ev.shape[0], 1))  # Reset the sign of each eigenvector
-    normvect = torch.sqrt(torch.diag(Ev @ Ev.T))  # Get the norm of each eigenvector
+    Ev = Ev * temp[None, :]  # Reset the sign of each eigenvector
+    normvect = torch.sqrt(torch.sum(Ev ** 2, dim=1, keepdim=True))  # Get the norm of each row
     normvect[normvect == 0.0] = 1  # Incase all 0 eigenvector
-    Ev = torch.linalg.solve(torch.diag(normvect), Ev)  # Use linear solution to normalize Ev satisfying normvect * Ev_new = Ev_old
+    EigenVectors = Ev / normvect  # normalize eigenvectors to ensure each FN vector's norm = 1
 
     # Multiple trials to get reproducible results
+    ps = torch.randint(0, n, (NCut_MaxTrial,))  # Choose a random row in eigenvectors for each trial as an initial center
+    C_Trial, NcutValue = NCut_discretisation_torch(EigenVectors, ps, dataPrecision=dataPrecision)
     Best_C = []
     Best_NCutValue = torch.inf
-    for i in range(1,NCut_MaxTrial+1):
+    for i in range(1, NCut_MaxTrial+1):
         print(f'    Iter = ' + str(i), file=logFile)
-        EigenVectors = Ev
-        n, k = EigenVectors.shape  # n is K * n_BS, k is K
-
-        vm = torch.sqrt(torch.sum(EigenVectors**2, dim=1, keepdims=True))  # norm of each row
-        EigenVectors = EigenVectors / torch.tile(vm, (1, k))  # normalize eigenvectors to ensure each FN vector's norm = 1
-
-        R = torch.zeros((k, k), dtype=torch_float)
-        ps = torch.randint(0, n, (1,))  # Choose a random row in eigenvectors
-        R[:, 0] = EigenVectors[ps, :]  # This randomly selected row in eigenvectors is used as an initial center
-
-        c_index = torch.zeros(n)
-        c = torch.zeros(n, dtype=torch_float)  # Total distance to different rows in R [K * n_BS, 1]
-        c_index[0] = ps  # Store the index of selected samples
-        c[ps] = torch.inf
-
-        for j in range(2, k+1):  # Find another K-1 rows in eigenvectors which have the minimum similarity to previous selected rows, similar to initialization in k++
-            c += torch.abs(EigenVectors @ R[:, j-2])
-            ps = torch.argmin(c)
-            c_index[j-1] = ps
-            c[ps] = torch.inf
-            R[:, j-1] = EigenVectors[ps, :]
-
-        lastObjectiveValue = 0
-        exitLoop = 0
-        nbIterationsDiscretisation = 0
-        nbIterationsDiscretisationMax = 20
-
-        while exitLoop == 0:
-            nbIterationsDiscretisation += 1
-
-            EigenVectorsR = EigenVectors @ R
-            n, k = EigenVectorsR.shape
-            J = torch.argmax(EigenVectorsR, dim=1)  # Assign each sample to K centers of R based on highest similarity
-            Indice = torch.stack((torch.arange(n).type(torch.int32), J.type(torch.int32)))
-            EigenvectorsDiscrete = torch.sparse_coo_tensor(Indice, torch.ones(n, dtype=torch_float), (n, k))  # Generate a 0-1 matrix with each row containing only one 1
-
-            U, S, Vh = torch.linalg.svd(EigenvectorsDiscrete.T @ EigenVectors, full_matrices=False)  # Economy-size decomposition
-
-            S = torch.diag(S)  # To match MATLAB svd results
-            V = Vh.T  # To match MATLAB svd results
-            NcutValue = 2 * (n - torch.trace(S))
-
-            # escape the loop when converged or meet max iteration
-            if abs(NcutValue - lastObjectiveValue) < torch_eps or nbIterationsDiscretisation > nbIterationsDiscretisationMax:
-                exitLoop = 1
-                print(f'    Reach stop criterion of NCut, NcutValue = '+str(NcutValue.numpy())+'\n', file=logFile, flush=True)
-            else:
-                print(f'    NcutValue = '+str(NcutValue.numpy()), file=logFile)
-                lastObjectiveValue = NcutValue
-                R = V @ U.T  # Update R which stores the new centers
-
-        C = torch.argmax(EigenvectorsDiscrete.to_dense(), dim=1)  # Assign each sample to K centers in R
+        print(f'    Reach stop criterion of NCut, NcutValue = '+str(NcutValue[i-1].cpu().numpy())+'\n', file=logFile, flush=True)
+        C = C_Trial[i-1]
 
         if len(torch.unique(C)) < K:  # Check whether there are empty results
             print(f'    Found empty results in iteration '+str(i)+'\n', file=logFile, flush=True)
         else:  # Update the best result
-            if NcutValue < Best_NCutValue:
-                Best_NCutValue = NcutValue
+            if NcutValue[i-1] < Best_NCutValue:
+                Best_NCutValue = NcutValue[i-1]
                 Best_C = C
 
-    if len(set(Best_C)) < K:  # In case even the last trial has empty results
+    if len(set(Best_C.tolist() if isinstance(Best_C, torch.Tensor) else Best_C)) < K:  # In case even the last trial has empty results
         raise ValueError('  Cannot generate non-empty gFNs\n')
-        Flag = 1
-        Message = "Cannot generate non-empty FN"
 
-    print(f'Best NCut value = '+str(Best_NCutValue.numpy())+'\n', file=logFile, flush=True)
+    print(f'Best NCut value = '+str(Best_NCutValue.cpu().numpy())+'\n', file=logFile, flush=True)
 
     # Get centroid
-    C = Best_C
-    gFN = torch.zeros((gFN_BS.shape[0], K))
+    # Each FN is standardized once, within its cluster, and the similarity within each cluster is a block of their products
+    C = Best_C.to(gFN_BS.device)
+    gFN = torch.zeros((gFN_BS.shape[0], K), dtype=torch_float, device=gFN_BS.device)
     for ki in range(K):
-        if torch.sum(C == ki) > 1:
-            candSet = gFN_BS[:, C == ki]  # Get the candidate set of FNs assigned to cluster ki
-            corrW = torch.abs(mat_corr_torch(candSet, dataPrecision=dataPrecision))  # Get the similarity between candidate FNs
+        candInd = torch.nonzero(C == ki, as_tuple=True)[0]  # Get the candidate set of FNs assigned to cluster ki
+        if candInd.shape[0] > 1:
+            Z = standardize_column_torch(gFN_BS[:, candInd], dataPrecision)
+            corrW = torch.abs(torch.clamp(Z.T @ Z, -1, 1))  # Get the similarity between candidate FNs
             corrW[torch.isnan(corrW)] = 0
             mInd = torch.argmax(torch.sum(corrW, dim=0), dim=0)  # Find the FN with the highest total similarity to all other FNs
-            gFN[:, ki] = candSet[:, mInd]
-        elif torch.sum(C == ki) == 1:
-            mInd = int((C == ki).nonzero(as_tuple=True)[0])
-            gFN[:, ki] = gFN_BS[:, mInd]
+            gFN[:, ki] = gFN_BS[:, candInd[mInd]]
+        elif candInd.shape[0] == 1:
+            gFN[:, ki] = gFN_BS[:, candInd[0]]
 
     gFN = gFN / torch.maximum(torch.tile(torch.max(gFN, dim=0)[0], (gFN.shape[0], 1)), torch_eps)  # Normalize each FN by its max value
     print(f'\nFinished at '+time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))+'\n', file=logFile, flush=True)
@@ -969,21 +2380,253 @@ def gFN_fusion_NCut_torch(gFN_BS, K, NCut_MaxTrial=100, dataPrecision='double',
     return gFN
 
 
-def run_FN_Computation_torch(dir_pnet_result: str):
+def run_gFN_bootstrap_torch(dir_pnet_BS: str, rep: int, gNb: np.ndarray, setting: dict, Brain_Mask=None, Laplacian=None, N_Thread=None, sweepK=None, Data=None):
+    """
+    Compute gFNs of one bootstrap run, and save them into FN.mat and FN.npy in its sub-folder. FN.npy is its row block of the FN stack built by load_FN_stack
+    It is used by run_FN_Computation_torch, either in the main process or in a worker process
+    With sweepK, data are loaded and the Laplacian operator is built once, and gFNs of all K values are computed in ascending order of K
+    With compression and vxI = 0, data are loaded into a memory-mapped Data.npy in the bootstrap folder, which is removed after gFNs are computed
+
+    :param dir_pnet_BS: directory of the BootStrapping folder, which contains a sub-folder for each bootstrap run
+    :param rep: index of the bootstrap run, starting from 1
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param setting: a dict with settings of Data_Input and FN_Computation
+    :param Brain_Mask: None or a brain mask for volume data
+    :param Laplacian: None or a Laplacian operator from setup_Laplacian_operator_torch shared by bootstrap runs. It is built here if None and vxI is 0
+    :param N_Thread: None or number of threads available to this bootstrap run, shared by concurrent repetitions of gFN_NMF_torch
+    :param sweepK: None or a dict {K: directory of the result folder of K} from setup_K_sweep_folder, where results of each K are saved
+    :param Data: None or data of this bootstrap run loaded by load_fmri_scan with Normalization='vp-vmax', such as from prefetch_fmri_scan. It is loaded here if None
+    :return: Laplacian, the Laplacian operator used, which can be shared with later bootstrap runs when vxI is 0
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Parameters
+    dataType = setting['Data_Input']['Data_Type']
+    dataFormat = setting['Data_Input']['Data_Format']
+    K = setting['FN_Computation']['K']
+    maxIter = setting['FN_Computation']['Group_FN']['maxIter']
+    minIter = setting['FN_Computation']['Group_FN']['minIter']
+    error = setting['FN_Computation']['Group_FN']['error']
+    normW = setting['FN_Computation']['Group_FN']['normW']
+    Alpha = setting['FN_Computation']['Group_FN']['Alpha']
+    Beta = setting['FN_Computation']['Group_FN']['Beta']
+    alphaS = setting['FN_Computation']['Group_FN']['alphaS']
+    alphaL = setting['FN_Computation']['Group_FN']['alphaL']
+    vxI = setting['FN_Computation']['Group_FN']['vxI']
+    ard = setting['FN_Computation']['Group_FN']['ard']
+    eta = setting['FN_Computation']['Group_FN']['eta']
+    nRepeat = setting['FN_Computation']['Group_FN']['nRepeat']
+    solver = setting['FN_Computation']['Group_FN'].get('solver', 'mu')
+    Compression = setting['FN_Computation']['Group_FN'].get('Compression', {'Enable': False})
+    sketchSize = Compression['sketchSize'] if Compression['Enable'] else 0
+    Online = setting['FN_Computation']['Group_FN'].get('Online', {'Enable': False})
+    Parallel_Repeat = setting['FN_Computation']['Group_FN'].get('Parallel_Repeat', {'Enable': False})
+    nParallel = Parallel_Repeat['nParallel'] if Parallel_Repeat['Enable'] else 1
+    abandonRatio = Parallel_Repeat.get('abandonRatio', 0.05)
+    Sweep_Warm_Start = setting['FN_Computation']['Group_FN'].get('Sweep_Warm_Start', False)
+    dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+    Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+    nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+
+    # Threads of a worker are split among concurrent repetitions in gFN_NMF
+    if N_Thread is not None and nParallel != 1:
+        if nParallel == 'Automatic':
+            nParallel = N_Thread
+        set_computation_thread(N_Thread)
+
+    # K values and BootStrapping folders to save their results
+    if sweepK is None:
+        list_K = [(K, dir_pnet_BS)]
+    else:
+        list_K = [(K, os.path.join(sweepK[K], 'FN_Computation', 'BootStrapping')) for K in sorted(sweepK)]
+
+    # log file
+    logFile = os.path.join(dir_pnet_BS, str(rep), 'Log.log')
+    # load data
+    file_scan_list = os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')
+    Laplacian_BS = Laplacian
+    file_Data = None
+    if not (Online['Enable'] and vxI == 0):
+        if Data is None:
+            if sketchSize != 0 and vxI == 0:
+                # With compression, data stay on disk, and both the temporal sketch and the refinement read them in blocks
+                file_Data = os.path.join(dir_pnet_BS, str(rep), 'Data.npy')
+            Data = load_fmri_scan(file_scan_list, dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
+                                  Normalization='vp-vmax', Cache=Cache, file_memmap=file_Data, logFile=logFile)
+        if Laplacian is None and vxI == 0:
+            Laplacian = setup_Laplacian_operator_torch(gNb, Data.shape[1], normW=normW, dataPrecision=dataPrecision)
+        Laplacian_BS = Laplacian
+        if sweepK is not None and vxI > 0:
+            # The Laplacian operator with vxI depends on data only, and it is rescaled to alphaL of each K by gFN_NMF_torch
+            Laplacian_BS = setup_Laplacian_operator_torch(gNb, Data.shape[1], vxI=vxI, X=Data, normW=normW, dataPrecision=dataPrecision)
+
+    FN_BS = None
+    for K, dir_pnet_BS_K in list_K:
+        logFile_K = logFile if sweepK is None else os.path.join(dir_pnet_BS_K, str(rep), 'Log.log')
+        # gFNs of the previous K start the first FNs of this K
+        initV = FN_BS if Sweep_Warm_Start else None
+        if Online['Enable'] and vxI == 0:
+            # stream scans from disk without concatenation
+            FN_BS = gFN_NMF_online_torch(file_scan_list, K, gNb, dataType=dataType, dataFormat=dataFormat, Brain_Mask=Brain_Mask,
+                                         maxIter=maxIter, minIter=minIter, error=error, normW=normW,
+                                         Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, ard=ard, eta=eta,
+                                         nScanBatch=Online['nScanBatch'], Laplacian=Laplacian, Cache=Cache, dataPrecision=dataPrecision, logFile=logFile_K)
+        else:
+            # perform NMF
+            FN_BS = gFN_NMF_torch(Data, K, gNb, maxIter=maxIter, minIter=minIter, error=error, normW=normW,
+                                  Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, vxI=vxI, ard=ard, eta=eta,
+                                  nRepeat=nRepeat, solver=solver, Laplacian=Laplacian_BS, sketchSize=sketchSize, nParallel=nParallel, abandonRatio=abandonRatio,
+                                  initV=initV, dataPrecision=dataPrecision, logFile=logFile_K)
+        # save results, and FN.npy after FN.mat so that it is not older than FN.mat
+        sio.savemat(os.path.join(dir_pnet_BS_K, str(rep), 'FN.mat'), {"FN": reshape_FN(FN_BS.numpy(), dataType=dataType, Brain_Mask=Brain_Mask)})
+        save_FN_block(os.path.join(dir_pnet_BS_K, str(rep), 'FN.npy'), FN_BS.numpy())
+
+    if file_Data is not None:
+        del Data
+        os.remove(file_Data)
+
+    return Laplacian
+
+
+def run_pFN_subject_torch(dir_pnet_pFN_indv: str, gFN: np.ndarray, gNb: np.ndarray, setting: dict, Brain_Mask=None, Laplacian=None, fingerprint=None, Data=None):
+    """
+    Compute pFNs of one subject folder in Personalized_FN, and save them into FN.mat and TC.mat
+    It is used by run_FN_Computation_torch, either in the main process or in a worker process
+
+    :param dir_pnet_pFN_indv: directory of the subject folder, containing Scan_List.txt
+    :param gFN: group level FNs, 2D matrix [dim_space, K]
+    :param gNb: graph neighborhood, a 2D matrix [N, 2] storing rows and columns of non-zero elements
+    :param setting: a dict with settings of Data_Input and FN_Computation
+    :param Brain_Mask: None or a brain mask for volume data
+    :param Laplacian: None or a Laplacian operator from setup_Laplacian_operator_torch shared by subjects
+    :param fingerprint: None or a str from compute_unit_fingerprint. With checkpoints enabled in setting, it identifies the checkpoint to resume from
+    :param Data: None or data of this subject folder loaded by load_fmri_scan, such as from prefetch_fmri_scan. It is loaded here if None
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Parameters
+    dataType = setting['Data_Input']['Data_Type']
+    dataFormat = setting['Data_Input']['Data_Format']
+    maxIter = setting['FN_Computation']['Personalized_FN']['maxIter']
+    minIter = setting['FN_Computation']['Personalized_FN']['minIter']
+    meanFitRatio = setting['FN_Computation']['Personalized_FN']['meanFitRatio']
+    error = setting['FN_Computation']['Personalized_FN']['error']
+    normW = setting['FN_Computation']['Personalized_FN']['normW']
+    Alpha = setting['FN_Computation']['Personalized_FN']['Alpha']
+    Beta = setting['FN_Computation']['Personalized_FN']['Beta']
+    alphaS = setting['FN_Computation']['Personalized_FN']['alphaS']
+    alphaL = setting['FN_Computation']['Personalized_FN']['alphaL']
+    vxI = setting['FN_Computation']['Personalized_FN']['vxI']
+    ard = setting['FN_Computation']['Personalized_FN']['ard']
+    eta = setting['FN_Computation']['Personalized_FN']['eta']
+    solver = setting['FN_Computation']['Personalized_FN'].get('solver', 'mu')
+    dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+    Checkpoint = setting['FN_Computation']['Computation'].get('Checkpoint', {'Enable': False})
+    Warm_Start = setting['FN_Computation']['Personalized_FN'].get('Warm_Start', {'Enable': False})
+    Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+
+    # log file
+    logFile = os.path.join(dir_pnet_pFN_indv, 'Log.log')
+    # Checkpoints of U and V during a long run
+    file_checkpoint = os.path.join(dir_pnet_pFN_indv, 'Checkpoint.npz') if Checkpoint['Enable'] else None
+    checkpointInterval = Checkpoint.get('Interval', 600)
+    # Warm start from previous pFNs of this subject folder
+    initUV = None
+    if Warm_Start['Enable']:
+        file_warmStart = setup_warm_start_file(Warm_Start['dir_warmStart'], os.path.basename(os.path.normpath(dir_pnet_pFN_indv)), gFN)
+        initUV = load_warm_start(file_warmStart, setting['FN_Computation']['Personalized_FN'])
+    # load data
+    if Data is None:
+        Data = load_fmri_scan(os.path.join(dir_pnet_pFN_indv, 'Scan_List.txt'),
+                              dataType=dataType, dataFormat=dataFormat,
+                              Reshape=True, Brain_Mask=Brain_Mask, Cache=Cache, logFile=logFile)
+    # perform NMF
+    TC, pFN = pFN_NMF_torch(Data, gFN, gNb, maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio, error=error, normW=normW,
+                            Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, vxI=vxI, ard=ard, eta=eta,
+                            solver=solver, Laplacian=Laplacian, initUV=initUV,
+                            file_checkpoint=file_checkpoint, checkpointInterval=checkpointInterval, fingerprint='' if fingerprint is None else fingerprint,
+                            dataPrecision=dataPrecision, logFile=logFile)
+    pFN = pFN.numpy()
+    TC = TC.numpy()
+    if Warm_Start['Enable']:
+        save_warm_start(file_warmStart, TC, pFN, setting['FN_Computation']['Personalized_FN'])
+    # output
+    pFN = reshape_FN(pFN, dataType=dataType, Brain_Mask=Brain_Mask)
+    sio.savemat(os.path.join(dir_pnet_pFN_indv, 'FN.mat'), {"FN": pFN})
+    sio.savemat(os.path.join(dir_pnet_pFN_indv, 'TC.mat'), {"TC": TC})
+    # The checkpoint is no longer needed
+    if file_checkpoint is not None and os.path.isfile(file_checkpoint):
+        os.remove(file_checkpoint)
+
+
+def run_gFN_fusion_torch(dir_pnet_result: str, setting: dict, Brain_Mask=None):
+    """
+    Fuse gFNs of all bootstrap runs using NCut, and save them into FN.mat in Group_FN
+
+    :param dir_pnet_result: directory of pNet result folder
+    :param setting: a dict with settings of Data_Input and FN_Computation
+    :param Brain_Mask: None or a brain mask for volume data
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    _, dir_pnet_FNC, dir_pnet_gFN, _, _, _ = setup_result_folder(dir_pnet_result)
+    dir_pnet_BS = os.path.join(dir_pnet_FNC, 'BootStrapping')
+    dataType = setting['Data_Input']['Data_Type']
+    K = setting['FN_Computation']['K']
+    nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+
+    # load bootstrapped results, memory-mapped from the FN stack
+    # A copy-on-write memmap is writable, so it is shared with the tensor without a copy
+    gFN_BS = torch.from_numpy(load_FN_stack(dir_pnet_BS, nBS, K, dataType=dataType, Brain_Mask=Brain_Mask, mmapMode='c'))
+    # log
+    logFile = os.path.join(dir_pnet_gFN, 'Log.log')
+    # Fuse bootstrapped results
+    gFN = gFN_fusion_NCut_torch(gFN_BS, K, logFile=logFile)
+    del gFN_BS
+    # output
+    gFN = reshape_FN(gFN.numpy(), dataType=dataType, Brain_Mask=Brain_Mask)
+    sio.savemat(os.path.join(dir_pnet_gFN, 'FN.mat'), {"FN": gFN})
+
+
+def run_FN_Computation_torch(dir_pnet_result: str, shard=None, unitRange=None):
     """
     run the FN Computation module with settings ready in Data_Input and FN_Computation
+    With shard or unitRange, it runs one job of a job array, computing a slice of bootstrap runs, or a slice of subject folders once gFNs are ready
+    Jobs coordinate through a manifest of claimed and finished units in FN_Computation, and gather_FN_Computation_torch fuses bootstrap results and checks completeness
+    Finished units are recorded in the manifest with fingerprints of their inputs and settings. With Resume enabled in setting, or in shards, units finished with the same fingerprints are skipped
 
     :param dir_pnet_result: directory of pNet result folder
+    :param shard: None or [shardIndex, shardCount], to compute the shardIndex-th of shardCount interleaved slices, with shardIndex starting from 1
+    :param unitRange: None or [first, last], to compute bootstrap runs or subject folders from first to last, starting from 1
 
     Yuncong Ma, 10/2/2023
     """
 
+    # Worker processes of parallel computation import the main script again, and must not rerun FN computation
+    check_main_process()
+
     # get directories of sub-folders
     dir_pnet_dataInput, dir_pnet_FNC, dir_pnet_gFN, dir_pnet_pFN, _, _ = setup_result_folder(dir_pnet_result)
 
+    # shard spec
+    owner = setup_shard_owner(shard, unitRange)
+    flag_Shard = owner is not None
+    if not flag_Shard:
+        # A single job computes all units
+        owner = 'All'
+    dir_manifest = os.path.join(dir_pnet_FNC, 'Manifest')
+    os.makedirs(dir_manifest, exist_ok=True)
+
     # log file
-    logFile_FNC = os.path.join(dir_pnet_FNC, 'log.log')
-    logFile_FNC = open(logFile_FNC, 'w')
+    if flag_Shard:
+        # Each shard has its own log file
+        logFile_FNC = os.path.join(dir_pnet_FNC, f'log_{owner}.log')
+    else:
+        logFile_FNC = os.path.join(dir_pnet_FNC, 'log.log')
+    logFile_FNC = open(logFile_FNC, 'a' if flag_Shard else 'w')
     print('\nStart FN computation using PyTorch at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())) + '\n',
           file=logFile_FNC, flush=True)
 
@@ -996,13 +2639,20 @@ def run_FN_Computation_torch(dir_pnet_result: str):
     settingFNC = load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))
     setting = {'Data_Input': settingDataInput, 'FN_Computation': settingFNC}
     print('Settings are loaded from folder Data_Input and FN_Computation', file=logFile_FNC, flush=True)
+    # Skip units finished with the same inputs and settings. Shards skip units finished with the same fingerprints when claiming them, see claim_manifest_unit
+    Resume = setting['FN_Computation']['Computation'].get('Resume', False) and not flag_Shard
+    # A list of K runs a sweep of K, with a result folder for each K, see setup_K_sweep_folder
+    flag_Sweep = isinstance(setting['FN_Computation']['K'], list)
+    if flag_Sweep and (flag_Shard or setting['FN_Computation']['Group_FN']['file_gFN'] is not None):
+        raise ValueError('A sweep of K does not support shard, unitRange or file_gFN')
 
     # load basic settings
     dataType = setting['Data_Input']['Data_Type']
     dataFormat = setting['Data_Input']['Data_Format']
 
     # load Brain Template
-    Brain_Template = load_brain_template(os.path.join(dir_pnet_dataInput, 'Brain_Template.json'))
+    Brain_Template = load_brain_template(os.path.join(dir_pnet_dataInput, 'Brain_Template.json.zip'))
+
     if dataType == 'Volume':
         Brain_Mask = Brain_Template['Brain_Mask']
     else:
@@ -1014,7 +2664,11 @@ def run_FN_Computation_torch(dir_pnet_result: str):
     if setting['FN_Computation']['Method'] == 'SR-NMF':
         print('FN computation uses spatial-regularized non-negative matrix factorization method', file=logFile_FNC, flush=True)
 
-        if setting['FN_Computation']['Group_FN']['file_gFN'] is not None:
+        if flag_Shard and setting['FN_Computation']['Group_FN']['file_gFN'] is None and check_gathered_gFN(dir_pnet_FNC, dir_pnet_gFN, setting):
+            # gFNs have been gathered from bootstrap runs of all shards, with the same settings
+            print('Use gFNs gathered from bootstrap runs of all shards', file=logFile_FNC, flush=True)
+
+        elif setting['FN_Computation']['Group_FN']['file_gFN'] is None:
             # 2 steps
             # step 1 ============== bootstrap
             # sub-folder in FNC for storing bootstrapped results
@@ -1025,81 +2679,137 @@ def run_FN_Computation_torch(dir_pnet_result: str):
             # Log
             logFile = os.path.join(dir_pnet_BS, 'Log.log')
 
-            # Generate additional parameters
-            gNb = compute_gNb(Brain_Template)
-            scipy.io.savemat(os.path.join(dir_pnet_FNC, 'gNb.mat'), {'gNb': gNb})
             # Input files
             file_scan = os.path.join(dir_pnet_dataInput, 'Scan_List.txt')
             file_subject_ID = os.path.join(dir_pnet_dataInput, 'Subject_ID.txt')
             file_subject_folder = os.path.join(dir_pnet_dataInput, 'Subject_Folder.txt')
             file_group_ID = os.path.join(dir_pnet_dataInput, 'Group_ID.txt')
             if not os.path.exists(file_group_ID):
-                file_group = None
+                file_group_ID = None
             # Parameters
             combineScan = setting['FN_Computation']['Combine_Scan']
             samplingMethod = setting['FN_Computation']['Group_FN']['BootStrap']['samplingMethod']
             sampleSize = setting['FN_Computation']['Group_FN']['BootStrap']['sampleSize']
             nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+            # Settings for fingerprints of units
+            setting_gFN = setup_fingerprint_setting(setting, 'Group_FN')
+            fingerprint_setup = compute_unit_fingerprint(setting_gFN, [file_scan, file_subject_ID, file_subject_folder] + ([] if file_group_ID is None else [file_group_ID]))
+
+            # Bootstrap files are prepared once for all shards, and reused when resuming
+            if Resume and check_manifest_unit(dir_manifest, 'Setup_BootStrap', fingerprint_setup) and os.path.isfile(os.path.join(dir_pnet_FNC, 'gNb.mat')):
+                print('Resume with bootstrap files of a previous run', file=logFile_FNC, flush=True)
+                gNb = load_matlab_single_array(os.path.join(dir_pnet_FNC, 'gNb.mat'))
+            elif not flag_Shard or claim_manifest_unit(dir_manifest, 'Setup_BootStrap', owner, fingerprint_setup):
+                # Generate additional parameters
+                gNb = compute_gNb(Brain_Template)
+                scipy.io.savemat(os.path.join(dir_pnet_FNC, 'gNb.mat'), {'gNb': gNb})
+
+                # create scan lists for bootstrap
+                bootstrap_scan(dir_pnet_BS, file_scan, file_subject_ID, file_subject_folder,
+                                     file_group_ID=file_group_ID, combineScan=combineScan,
+                                     samplingMethod=samplingMethod, sampleSize=sampleSize, nBS=nBS, logFile=logFile)
+                finish_manifest_unit(dir_manifest, 'Setup_BootStrap', owner, fingerprint_setup)
+            else:
+                wait_manifest_unit(dir_manifest, 'Setup_BootStrap', logFile=logFile_FNC)
+                gNb = load_matlab_single_array(os.path.join(dir_pnet_FNC, 'gNb.mat'))
 
-            # create scan lists for bootstrap
-            bootstrap_scan(dir_pnet_BS, file_scan, file_subject_ID, file_subject_folder,
-                                 file_group_ID=file_group_ID, combineScan=combineScan,
-                                 samplingMethod=samplingMethod, sampleSize=sampleSize, nBS=nBS, logFile=logFile)
+            # Result folders of K values in a sweep of K, sharing bootstrap samples
+            sweepK = None
+            list_dir_BS = [dir_pnet_BS]
+            if flag_Sweep:
+                sweepK = {K: setup_K_sweep_folder(dir_pnet_result, K, setting) for K in sorted(setting['FN_Computation']['K'])}
+                list_dir_BS = [os.path.join(sweepK[K], 'FN_Computation', 'BootStrapping') for K in sweepK]
+                print('Run a sweep of K = ' + ', '.join([str(K) for K in sweepK]) + ', sharing data loading of bootstrap runs', file=logFile_FNC, flush=True)
 
             # Parameters
             K = setting['FN_Computation']['K']
-            maxIter = setting['FN_Computation']['Group_FN']['maxIter']
-            minIter = setting['FN_Computation']['Group_FN']['minIter']
-            error = setting['FN_Computation']['Group_FN']['error']
-            normW = setting['FN_Computation']['Group_FN']['normW']
-            Alpha = setting['FN_Computation']['Group_FN']['Alpha']
-            Beta = setting['FN_Computation']['Group_FN']['Beta']
-            alphaS = setting['FN_Computation']['Group_FN']['alphaS']
-            alphaL = setting['FN_Computation']['Group_FN']['alphaL']
-            vxI = setting['FN_Computation']['Group_FN']['vxI']
-            ard = setting['FN_Computation']['Group_FN']['ard']
-            eta = setting['FN_Computation']['Group_FN']['eta']
-            nRepeat = setting['FN_Computation']['Group_FN']['nRepeat']
-            dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+            Parallel = setting['FN_Computation']['Computation'].get('Parallel', False)
+            N_Thread = setting['FN_Computation']['Computation'].get('N_Thread', 1)
+            N_Process = setting['FN_Computation']['Computation'].get('N_Process', 'Automatic')
+            Prefetch = setting['FN_Computation']['Computation'].get('Prefetch', {'Enable': False})
+            Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+            Online = setting['FN_Computation']['Group_FN'].get('Online', {'Enable': False})
+            Compression = setting['FN_Computation']['Group_FN'].get('Compression', {'Enable': False})
+            # Bootstrap runs of this job
+            list_rep = list(range(1, 1+nBS)) if not flag_Shard else select_shard_unit(nBS, shard, unitRange)
+            list_fingerprint = {rep: compute_unit_fingerprint(setting_gFN, file_scan_list=os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')) for rep in list_rep}
+            if flag_Shard:
+                # Bootstrap runs finished with different inputs or settings are computed again
+                list_rep = [rep for rep in list_rep if claim_manifest_unit(dir_manifest, f'BootStrap_{rep}', owner, list_fingerprint[rep])]
+            if Resume:
+                list_rep = [rep for rep in list_rep if not (check_manifest_unit(dir_manifest, f'BootStrap_{rep}', list_fingerprint[rep])
+                                                            and all([os.path.isfile(os.path.join(dir_BS, str(rep), 'FN.mat')) for dir_BS in list_dir_BS]))]
+                print(f'Resume with {nBS - len(list_rep)} finished bootstrap runs', file=logFile_FNC, flush=True)
 
             # NMF on bootstrapped subsets
             print('Start to NMF for each bootstrap at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
-            for rep in range(1, 1+nBS):
-                # log file
-                logFile = os.path.join(dir_pnet_BS, str(rep), 'Log.log')
-                # load data
-                file_scan_list = os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')
-                Data = load_fmri_scan(file_scan_list, dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
-                                      Normalization='vp-vmax', logFile=logFile)
-                # perform NMF
-                FN_BS = gFN_NMF_torch(Data, K, gNb, maxIter=maxIter, minIter=minIter, error=error, normW=normW,
-                                      Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, vxI=vxI, ard=ard, eta=eta,
-                                      nRepeat=nRepeat, dataPrecision=dataPrecision, logFile=logFile)
-                # save results
-                FN_BS = reshape_FN(FN_BS.numpy(), dataType=dataType, Brain_Mask=Brain_Mask)
-                sio.savemat(os.path.join(dir_pnet_BS, str(rep), 'FN.mat'), {"FN": FN_BS})
+            if Parallel and len(list_rep) > 1:
+                # Bootstrap runs are dispatched to worker processes, and N_Thread threads are split among workers
+                nWorker, nThread_Worker = setup_parallel_worker(len(list_rep), N_Thread, N_Process)
+                print(f'Run {len(list_rep)} bootstraps using {nWorker} workers with {nThread_Worker} threads each', file=logFile_FNC, flush=True)
+                # Each bootstrap run builds its own Laplacian operator, as its size is known after loading data
+                with setup_process_pool(nWorker, nThread_Worker) as executor:
+                    list_future = {executor.submit(run_gFN_bootstrap_torch, dir_pnet_BS, rep, gNb, setting, Brain_Mask, None, nThread_Worker, sweepK): rep
+                                   for rep in list_rep}
+                    # FN.mat of each bootstrap run is saved once it finishes
+                    for future in concurrent.futures.as_completed(list_future):
+                        future.result()
+                        finish_manifest_unit(dir_manifest, f'BootStrap_{list_future[future]}', owner, list_fingerprint[list_future[future]])
+                        print(f'Finished {list_future[future]}-th bootstrap at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+            else:
+                # Laplacian operator shared by all bootstrap runs when it does not depend on data
+                Laplacian = None
+                # Data of next bootstrap runs are loaded in background threads, except in the online mode and the compression mode
+                Data_Source = None
+                if Prefetch['Enable'] and not ((Online['Enable'] or Compression['Enable']) and setting['FN_Computation']['Group_FN']['vxI'] == 0):
+                    Data_Source = prefetch_fmri_scan([os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt') for rep in list_rep],
+                                                     dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask, Normalization='vp-vmax',
+                                                     nPrefetch=Prefetch.get('nPrefetch', 2), maxMemory=Prefetch.get('maxMemory', None), Cache=Cache,
+                                                     list_logFile=[os.path.join(dir_pnet_BS, str(rep), 'Log.log') for rep in list_rep])
+                for rep in list_rep:
+                    Laplacian = run_gFN_bootstrap_torch(dir_pnet_BS, rep, gNb, setting, Brain_Mask=Brain_Mask, Laplacian=Laplacian, sweepK=sweepK,
+                                                  Data=None if Data_Source is None else next(Data_Source))
+                    finish_manifest_unit(dir_manifest, f'BootStrap_{rep}', owner, list_fingerprint[rep])
+
+            if flag_Shard:
+                # gFNs are fused by gather_FN_Computation after all shards finish
+                print('Finished bootstrap runs of this shard at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())) +
+                      '. Run gather_FN_Computation after all shards finish', file=logFile_FNC, flush=True)
+                return
+
+            if flag_Sweep:
+                # Each K resumes from bootstrap runs of the sweep in its own result folder
+                for K in sweepK:
+                    finish_K_sweep_folder(sweepK[K])
+                    print(f'Start FN computation of K = {K} in folder ' + sweepK[K] + ' at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+                    run_FN_Computation_torch(sweepK[K])
+                print('Finished FN computation at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+                return
 
             # step 2 ============== fuse results
             # Generate gFNs
-            print('Start to fuse bootstrapped results using NCut at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
-            FN_BS = np.empty(nBS, dtype=np.ndarray)
-            # load bootstrapped results
-            for rep in range(1, nBS+1):
-                FN_BS[rep-1] = np.array(reshape_FN(load_matlab_single_array(os.path.join(dir_pnet_BS, str(rep), 'FN.mat')), dataType=dataType, Brain_Mask=Brain_Mask))
-            gFN_BS = np.concatenate(FN_BS, axis=1)
-            # log
-            logFile = os.path.join(dir_pnet_gFN, 'Log.log')
-            # Fuse bootstrapped results
-            gFN = gFN_fusion_NCut_torch(gFN_BS, K, logFile=logFile)
-            # output
-            gFN = reshape_FN(gFN.numpy(), dataType=dataType, Brain_Mask=Brain_Mask)
-            sio.savemat(os.path.join(dir_pnet_gFN, 'FN.mat'), {"FN": gFN})
+            fingerprint_gFN = compute_unit_fingerprint(setting_gFN, [os.path.join(dir_pnet_BS, str(rep), 'FN.mat') for rep in range(1, 1+nBS)])
+            if Resume and check_manifest_unit(dir_manifest, 'Group_FN', fingerprint_gFN) and os.path.isfile(os.path.join(dir_pnet_gFN, 'FN.mat')):
+                print('Resume with gFNs of a previous run', file=logFile_FNC, flush=True)
+            else:
+                print('Start to fuse bootstrapped results using NCut at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+                run_gFN_fusion_torch(dir_pnet_result, setting, Brain_Mask=Brain_Mask)
+                finish_manifest_unit(dir_manifest, 'Group_FN', owner, fingerprint_gFN)
 
         else:  # use precomputed gFNs
-            file_gFN = setting['FN_Computation']['Group_FN']['file_gFN']
-            gFN = load_matlab_single_array(file_gFN, method=setting['FN_Computation']['Method'])
-            check_gFN(gFN)
-            sio.savemat(os.path.join(dir_pnet_gFN, 'FN.mat'), {"FN": gFN})
+            # Precomputed gFNs are copied once for all shards
+            if not flag_Shard or claim_manifest_unit(dir_manifest, 'Setup_gFN', owner):
+                file_gFN = setting['FN_Computation']['Group_FN']['file_gFN']
+                gFN = load_matlab_single_array(file_gFN)
+                check_gFN(gFN, method=setting['FN_Computation']['Method'])
+                sio.savemat(os.path.join(dir_pnet_gFN, 'FN.mat'), {"FN": gFN})
+                # gNb is required for pFNs
+                gNb = compute_gNb(Brain_Template)
+                scipy.io.savemat(os.path.join(dir_pnet_FNC, 'gNb.mat'), {'gNb': gNb})
+                if flag_Shard:
+                    finish_manifest_unit(dir_manifest, 'Setup_gFN', owner)
+            else:
+                wait_manifest_unit(dir_manifest, 'Setup_gFN', logFile=logFile_FNC)
             print('load precomputed gFNs', file=logFile_FNC, flush=True)
         # ============================================= #
 
@@ -1111,45 +2821,205 @@ def run_FN_Computation_torch(dir_pnet_result: str):
         gNb = load_matlab_single_array(os.path.join(dir_pnet_FNC, 'gNb.mat'))
         # reshape to 2D if required
         gFN = reshape_FN(gFN, dataType=dataType, Brain_Mask=Brain_Mask)
-        # setup folders in Personalized_FN
-        list_subject_folder = setup_pFN_folder(dir_pnet_result)
+        # setup folders in Personalized_FN, once for all shards
+        if not flag_Shard or claim_manifest_unit(dir_manifest, 'Setup_Personalized_FN', owner):
+            list_subject_folder = setup_pFN_folder(dir_pnet_result)
+            if flag_Shard:
+                finish_manifest_unit(dir_manifest, 'Setup_Personalized_FN', owner)
+        else:
+            wait_manifest_unit(dir_manifest, 'Setup_Personalized_FN', logFile=logFile_FNC)
+            list_subject_folder = setup_pFN_folder(dir_pnet_result, createFolder=False)
         N_Scan = len(list_subject_folder)
-        for i in range(1, N_Scan+1):
-            print(f'Start to compute pFNs for {i}-th folder: {list_subject_folder[i-1]}', file=logFile_FNC, flush=True)
-            dir_pnet_pFN_indv = os.path.join(dir_pnet_pFN, list_subject_folder[i-1])
-            # parameter
-            maxIter = setting['FN_Computation']['Personalized_FN']['maxIter']
-            minIter = setting['FN_Computation']['Personalized_FN']['minIter']
-            meanFitRatio = setting['FN_Computation']['Personalized_FN']['meanFitRatio']
-            error = setting['FN_Computation']['Personalized_FN']['error']
-            normW = setting['FN_Computation']['Personalized_FN']['normW']
-            Alpha = setting['FN_Computation']['Personalized_FN']['Alpha']
-            Beta = setting['FN_Computation']['Personalized_FN']['Beta']
-            alphaS = setting['FN_Computation']['Personalized_FN']['alphaS']
-            alphaL = setting['FN_Computation']['Personalized_FN']['alphaL']
-            vxI = setting['FN_Computation']['Personalized_FN']['vxI']
-            ard = setting['FN_Computation']['Personalized_FN']['ard']
-            eta = setting['FN_Computation']['Personalized_FN']['eta']
-            dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
-            # log file
-            logFile = os.path.join(dir_pnet_pFN_indv, 'Log.log')
-            # load data
-            Data = load_fmri_scan(os.path.join(dir_pnet_pFN_indv, 'Scan_List.txt'),
-                                  dataType=dataType, dataFormat=dataFormat,
-                                  Reshape=True, Brain_Mask=Brain_Mask, logFile=logFile)
-            # perform NMF
-            TC, pFN = pFN_NMF_torch(Data, gFN, gNb, maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio,
-                                    error=error, normW=normW,
-                                    Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL,
-                                    vxI=vxI,  ard=ard, eta=eta,
-                                    dataPrecision=dataPrecision, logFile=logFile)
-            pFN = pFN.numpy()
-            TC = TC.numpy()
-
-            # output
-            pFN = reshape_FN(pFN, dataType=dataType, Brain_Mask=Brain_Mask)
-            sio.savemat(os.path.join(dir_pnet_pFN_indv, 'FN.mat'), {"FN": pFN})
-            sio.savemat(os.path.join(dir_pnet_pFN_indv, 'TC.mat'), {"TC": TC})
+        # Subject folders of this job
+        list_index = list(range(1, N_Scan+1)) if not flag_Shard else select_shard_unit(N_Scan, shard, unitRange)
+        # Fingerprints of subject folders also depend on gFNs
+        setting_pFN = setup_fingerprint_setting(setting, 'Personalized_FN')
+        setting_pFN['gFN'] = compute_unit_fingerprint({}, list_array=[gFN])
+        list_fingerprint = {i: compute_unit_fingerprint(setting_pFN, file_scan_list=os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Scan_List.txt')) for i in list_index}
+        if flag_Shard:
+            # Subject folders finished with different inputs or settings are computed again
+            list_index = [i for i in list_index if claim_manifest_unit(dir_manifest, f'Personalized_FN_{i}', owner, list_fingerprint[i])]
+        if Resume:
+            list_index = [i for i in list_index if not (check_manifest_unit(dir_manifest, f'Personalized_FN_{i}', list_fingerprint[i])
+                                                        and os.path.isfile(os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'FN.mat'))
+                                                        and os.path.isfile(os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'TC.mat')))]
+            print(f'Resume with {N_Scan - len(list_index)} finished subject folders', file=logFile_FNC, flush=True)
+        # parameter
+        maxIter = setting['FN_Computation']['Personalized_FN']['maxIter']
+        minIter = setting['FN_Computation']['Personalized_FN']['minIter']
+        meanFitRatio = setting['FN_Computation']['Personalized_FN']['meanFitRatio']
+        error = setting['FN_Computation']['Personalized_FN']['error']
+        normW = setting['FN_Computation']['Personalized_FN']['normW']
+        Alpha = setting['FN_Computation']['Personalized_FN']['Alpha']
+        Beta = setting['FN_Computation']['Personalized_FN']['Beta']
+        alphaS = setting['FN_Computation']['Personalized_FN']['alphaS']
+        alphaL = setting['FN_Computation']['Personalized_FN']['alphaL']
+        vxI = setting['FN_Computation']['Personalized_FN']['vxI']
+        ard = setting['FN_Computation']['Personalized_FN']['ard']
+        eta = setting['FN_Computation']['Personalized_FN']['eta']
+        solver = setting['FN_Computation']['Personalized_FN'].get('solver', 'mu')
+        batchSize = setting['FN_Computation']['Personalized_FN'].get('batchSize', 1)
+        dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+        Parallel = setting['FN_Computation']['Computation'].get('Parallel', False)
+        N_Thread = setting['FN_Computation']['Computation'].get('N_Thread', 1)
+        N_Process = setting['FN_Computation']['Computation'].get('N_Process', 'Automatic')
+        Prefetch = setting['FN_Computation']['Computation'].get('Prefetch', {'Enable': False})
+        Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+        # Laplacian operator shared by all subjects when it does not depend on data
+        Laplacian = None
+        if vxI == 0:
+            Laplacian = setup_Laplacian_operator_torch(gNb, gFN.shape[0], normW=normW, dataPrecision=dataPrecision)
+
+        if Parallel and len(list_index) > 1:
+            # Subjects are dispatched to worker processes, and N_Thread threads are split among workers
+            nWorker, nThread_Worker = setup_parallel_worker(len(list_index), N_Thread, N_Process)
+            print(f'Run {len(list_index)} folders using {nWorker} workers with {nThread_Worker} threads each', file=logFile_FNC, flush=True)
+            with setup_process_pool(nWorker, nThread_Worker) as executor:
+                list_future = {executor.submit(run_pFN_subject_torch, os.path.join(dir_pnet_pFN, list_subject_folder[i-1]), gFN, gNb, setting, Brain_Mask, Laplacian, list_fingerprint[i]): i
+                               for i in list_index}
+                # FN.mat and TC.mat of each subject are saved once it finishes
+                for nFinished, future in enumerate(concurrent.futures.as_completed(list_future), 1):
+                    future.result()
+                    finish_manifest_unit(dir_manifest, f'Personalized_FN_{list_future[future]}', owner, list_fingerprint[list_future[future]])
+                    print(f'Finished pFNs ({nFinished}/{len(list_index)}) for {list_future[future]}-th folder: {list_subject_folder[list_future[future]-1]} at '
+                          + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+        else:
+            # Subjects with the same number of time points are computed in batches
+            # Batches are set up from file headers, so that data of a batch are loaded only when it runs
+            flag_Batch = batchSize > 1 and solver == 'mu' and vxI == 0
+            if flag_Batch:
+                list_batch = setup_pFN_batch([os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Scan_List.txt') for i in list_index], batchSize,
+                                             dataType=dataType, dataFormat=dataFormat, Brain_Mask=Brain_Mask)
+                list_batch = [[list_index[n] for n in batch] for batch in list_batch]
+            else:
+                list_batch = [[i] for i in list_index]
+            list_index = [i for batch in list_batch for i in batch]
+            # Data of next subject folders are loaded in background threads
+            Data_Source = None
+            if Prefetch['Enable']:
+                Data_Source = prefetch_fmri_scan([os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Scan_List.txt') for i in list_index],
+                                                 dataType=dataType, dataFormat=dataFormat, Reshape=True, Brain_Mask=Brain_Mask,
+                                                 nPrefetch=Prefetch.get('nPrefetch', 2), maxMemory=Prefetch.get('maxMemory', None), Cache=Cache,
+                                                 list_logFile=[os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Log.log') for i in list_index])
+            for list_index_batch in list_batch:
+                list_dir = []
+                list_Data = []
+                for i in list_index_batch:
+                    print(f'Start to compute pFNs for {i}-th folder: {list_subject_folder[i-1]}', file=logFile_FNC, flush=True)
+                    dir_pnet_pFN_indv = os.path.join(dir_pnet_pFN, list_subject_folder[i-1])
+                    Data = None if Data_Source is None else next(Data_Source)
+
+                    if not flag_Batch:
+                        run_pFN_subject_torch(dir_pnet_pFN_indv, gFN, gNb, setting, Brain_Mask=Brain_Mask, Laplacian=Laplacian, fingerprint=list_fingerprint[i], Data=Data)
+                        finish_manifest_unit(dir_manifest, f'Personalized_FN_{i}', owner, list_fingerprint[i])
+                        continue
+
+                    # load data
+                    if Data is None:
+                        Data = load_fmri_scan(os.path.join(dir_pnet_pFN_indv, 'Scan_List.txt'),
+                                              dataType=dataType, dataFormat=dataFormat,
+                                              Reshape=True, Brain_Mask=Brain_Mask, Cache=Cache, logFile=os.path.join(dir_pnet_pFN_indv, 'Log.log'))
+                    list_dir.append(dir_pnet_pFN_indv)
+                    list_Data.append(Data)
+                    del Data
+                if not flag_Batch:
+                    continue
+
+                TC_list, pFN_list = pFN_NMF_batch_torch(list_Data, gFN, gNb,
+                                                        maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio, error=error, normW=normW,
+                                                        Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL, ard=ard, eta=eta,
+                                                        Laplacian=Laplacian, dataPrecision=dataPrecision,
+                                                        logFile_list=[os.path.join(dir_indv, 'Log.log') for dir_indv in list_dir])
+                del list_Data
+                # output
+                for dir_indv, TC, pFN in zip(list_dir, TC_list, pFN_list):
+                    pFN = reshape_FN(pFN.numpy(), dataType=dataType, Brain_Mask=Brain_Mask)
+                    sio.savemat(os.path.join(dir_indv, 'FN.mat'), {"FN": pFN})
+                    sio.savemat(os.path.join(dir_indv, 'TC.mat'), {"TC": TC.numpy()})
+                for i_batch in list_index_batch:
+                    finish_manifest_unit(dir_manifest, f'Personalized_FN_{i_batch}', owner, list_fingerprint[i_batch])
         # ============================================= #
 
         print('Finished FN computation at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+
+
+def gather_FN_Computation_torch(dir_pnet_result: str):
+    """
+    Gather results of all shards of run_FN_Computation_torch, using the manifest in FN_Computation
+    Once all bootstrap runs are finished, gFNs are fused using NCut, and shards can be submitted again to compute pFNs
+    Once gFNs are ready, it checks whether pFNs of all subject folders are finished
+    Units finished with different inputs or settings, according to their fingerprints in the manifest, are not finished, and gFNs are fused again after their bootstrap runs are computed again
+
+    :param dir_pnet_result: directory of pNet result folder
+    :return: True if all units of the current stage are finished
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # get directories of sub-folders
+    dir_pnet_dataInput, dir_pnet_FNC, dir_pnet_gFN, dir_pnet_pFN, _, _ = setup_result_folder(dir_pnet_result)
+    dir_manifest = os.path.join(dir_pnet_FNC, 'Manifest')
+
+    # log file
+    logFile_FNC = os.path.join(dir_pnet_FNC, 'log.log')
+    logFile_FNC = open(logFile_FNC, 'a')
+    print('\nStart gathering shards of FN computation at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())) + '\n',
+          file=logFile_FNC, flush=True)
+
+    # load settings for data input and FN computation
+    if not os.path.isfile(os.path.join(dir_pnet_dataInput, 'Setting.json')):
+        raise ValueError('Cannot find the setting json file in folder Data_Input')
+    if not os.path.isfile(os.path.join(dir_pnet_FNC, 'Setting.json')):
+        raise ValueError('Cannot find the setting json file in folder FN_Computation')
+    settingDataInput = load_json_setting(os.path.join(dir_pnet_dataInput, 'Setting.json'))
+    settingFNC = load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))
+    setting = {'Data_Input': settingDataInput, 'FN_Computation': settingFNC}
+
+    # gFNs from bootstrap runs
+    if setting['FN_Computation']['Group_FN']['file_gFN'] is None and not check_gathered_gFN(dir_pnet_FNC, dir_pnet_gFN, setting):
+        nBS = setting['FN_Computation']['Group_FN']['BootStrap']['nBS']
+        dir_pnet_BS = os.path.join(dir_pnet_FNC, 'BootStrapping')
+        # Bootstrap runs finished with different inputs or settings are not finished
+        setting_gFN = setup_fingerprint_setting(setting, 'Group_FN')
+        list_fingerprint = [compute_unit_fingerprint(setting_gFN, file_scan_list=os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt'))
+                            if os.path.isfile(os.path.join(dir_pnet_BS, str(rep), 'Scan_List.txt')) else None for rep in range(1, nBS+1)]
+        list_missing = check_manifest(dir_manifest, [f'BootStrap_{rep}' for rep in range(1, nBS+1)], list_fingerprint)
+        if len(list_missing) > 0:
+            print(f'{len(list_missing)} of {nBS} bootstrap runs are not finished: ' + ', '.join(list_missing), file=logFile_FNC, flush=True)
+            return False
+
+        # load Brain Template
+        Brain_Template = load_brain_template(os.path.join(dir_pnet_dataInput, 'Brain_Template.json.zip'))
+        if setting['Data_Input']['Data_Type'] == 'Volume':
+            Brain_Mask = Brain_Template['Brain_Mask']
+        else:
+            Brain_Mask = None
+
+        print('Start to fuse bootstrapped results using NCut at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+        run_gFN_fusion_torch(dir_pnet_result, setting, Brain_Mask=Brain_Mask)
+        fingerprint_gFN = compute_unit_fingerprint(setting_gFN, [os.path.join(dir_pnet_BS, str(rep), 'FN.mat') for rep in range(1, 1+nBS)])
+        finish_manifest_unit(dir_manifest, 'Group_FN', 'Gather', fingerprint_gFN)
+        print('gFNs are ready, and shards can be submitted again to compute pFNs', file=logFile_FNC, flush=True)
+        return True
+
+    # pFNs
+    if not os.path.isfile(os.path.join(dir_manifest, 'Setup_Personalized_FN.finished')):
+        print('pFNs have not been started by any shard', file=logFile_FNC, flush=True)
+        return False
+    list_subject_folder = setup_pFN_folder(dir_pnet_result, createFolder=False)
+    N_Scan = len(list_subject_folder)
+    # Subject folders finished with different inputs, settings or gFNs are not finished
+    Brain_Mask = None
+    if setting['Data_Input']['Data_Type'] == 'Volume':
+        Brain_Mask = load_brain_template(os.path.join(dir_pnet_dataInput, 'Brain_Template.json.zip'))['Brain_Mask']
+    gFN = reshape_FN(load_matlab_single_array(os.path.join(dir_pnet_gFN, 'FN.mat')), dataType=setting['Data_Input']['Data_Type'], Brain_Mask=Brain_Mask)
+    setting_pFN = setup_fingerprint_setting(setting, 'Personalized_FN')
+    setting_pFN['gFN'] = compute_unit_fingerprint({}, list_array=[gFN])
+    list_fingerprint = [compute_unit_fingerprint(setting_pFN, file_scan_list=os.path.join(dir_pnet_pFN, list_subject_folder[i-1], 'Scan_List.txt')) for i in range(1, N_Scan+1)]
+    list_missing = check_manifest(dir_manifest, [f'Personalized_FN_{i}' for i in range(1, N_Scan+1)], list_fingerprint)
+    if len(list_missing) > 0:
+        print(f'{len(list_missing)} of {N_Scan} subject folders are not finished: ' + ', '.join(list_missing), file=logFile_FNC, flush=True)
+        return False
+
+    print('Finished FN computation of all shards at ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=logFile_FNC, flush=True)
+    return True
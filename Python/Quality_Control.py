@@ -8,10 +8,11 @@ import scipy
 import os
 import re
 import time
+import scipy.io as sio
 
 # other functions of pNet
 from Data_Input import load_json_setting, load_matlab_single_array, load_fmri_scan, reshape_FN, setup_result_folder, load_brain_template
-from FN_Computation import mat_corr, set_data_precision
+from FN_Computation import mat_corr, set_data_precision, pFN_NMF, setup_Laplacian_operator, setup_pFN_folder
 
 
 def print_description_QC(logFile: str):
@@ -68,6 +69,7 @@ def run_quality_control(dir_pnet_result: str):
     setting = load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))
     combineScan = setting['Combine_Scan']
     dataPrecision = setting['Computation']['dataPrecision']
+    Cache = setting['Computation'].get('Cache', {'Enable': False})
 
     # Information about scan list
     file_scan = os.path.join(dir_pnet_dataInput, 'Scan_List.txt')
@@ -109,15 +111,15 @@ def run_quality_control(dir_pnet_result: str):
 
         # Load the data
         if Data_Type == 'Surface':
-            scan_data = load_fmri_scan(file_scan_list, dataType=Data_Type, dataFormat=Data_Format, Reshape=True, Normalization=None).astype(np_float)
+            scan_data = load_fmri_scan(file_scan_list, dataType=Data_Type, dataFormat=Data_Format, Reshape=True, Normalization=None, Cache=Cache).astype(np_float)
 
         elif Data_Type == 'Volume':
             scan_data = load_fmri_scan(file_scan_list, dataType=Data_Type, dataFormat=Data_Format, Reshape=True,
-                                       Brain_Mask=Brain_Mask, Normalization=None).astype(np_float)
+                                       Brain_Mask=Brain_Mask, Normalization=None, Cache=Cache).astype(np_float)
 
         elif Data_Type == 'Surface-Volume':
             scan_data = load_fmri_scan(file_scan_list, dataType=Data_Type, dataFormat=Data_Format, Reshape=True,
-                                       Normalization=None)
+                                       Normalization=None, Cache=Cache)
 
         else:
             raise ValueError('Unknown data type: ' + Data_Type)
@@ -207,3 +209,161 @@ def compute_quality_control(scan_data: np.ndarray, gFN: np.ndarray, pFN: np.ndar
     Functional_Homogeneity_Control = np.sum(Corr_FH.T * gFN, axis=0) / np.sum(gFN, axis=0)
 
     return Spatial_Correspondence, Delta_Spatial_Correspondence, Miss_Match, Functional_Homogeneity, Functional_Homogeneity_Control
+
+
+def setup_hyperparameter_grid(list_Alpha, list_Beta):
+    """
+    setup_hyperparameter_grid(list_Alpha, list_Beta)
+    Setup a path through a grid of Alpha and Beta, in which each grid point is a neighbor of the previous one
+    The path goes along Beta in alternating directions for ascending Alpha, so that pFNs of each grid point can warm start the next one
+
+    :param list_Alpha: a list of Alpha values
+    :param list_Beta: a list of Beta values
+    :return: list_grid, a list of tuples (Alpha, Beta) in the order of the path
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    list_Beta = sorted(list_Beta)
+    list_grid = []
+    for i, Alpha in enumerate(sorted(list_Alpha)):
+        list_grid += [(Alpha, Beta) for Beta in (list_Beta if i % 2 == 0 else list_Beta[::-1])]
+
+    return list_grid
+
+
+def save_hyperparameter_grid(dir_pnet_QC: str, list_grid: list, list_subject_folder, Result: dict):
+    """
+    save_hyperparameter_grid(dir_pnet_QC: str, list_grid: list, list_subject_folder, Result: dict)
+    Save quality control results of a grid of Alpha and Beta
+    Hyperparameter_Grid.mat stores results of each grid point and subject folder, and Hyperparameter_Grid.txt is a table of their averages across subject folders
+
+    :param dir_pnet_QC: directory of the quality control folder
+    :param list_grid: a list of tuples (Alpha, Beta), see setup_hyperparameter_grid
+    :param list_subject_folder: subject folders in Personalized_FN used for the grid
+    :param Result: a dict of 2D matrices [N_Grid, N_Subject], with keys Spatial_Correspondence, Delta_Spatial_Correspondence, N_Miss_Match and Functional_Homogeneity
+    :return: Table, a dict of 1D vectors [N_Grid, ], sorted by Alpha and then Beta
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    order = sorted(range(len(list_grid)), key=lambda i: list_grid[i])
+    Table = {'Alpha': np.array([list_grid[i][0] for i in order]),
+             'Beta': np.array([list_grid[i][1] for i in order])}
+    for name in ('Spatial_Correspondence', 'Delta_Spatial_Correspondence', 'N_Miss_Match', 'Functional_Homogeneity'):
+        Table[name] = np.mean(Result[name][order, :], axis=1)
+
+    sio.savemat(os.path.join(dir_pnet_QC, 'Hyperparameter_Grid.mat'),
+                {'Result': dict(Result, Alpha=np.array([item[0] for item in list_grid]), Beta=np.array([item[1] for item in list_grid]),
+                                Subject_Folder=np.array(list_subject_folder, dtype=object))})
+    with open(os.path.join(dir_pnet_QC, 'Hyperparameter_Grid.txt'), 'w') as file:
+        print('\t'.join(Table.keys()), file=file)
+        for i in range(len(order)):
+            print('\t'.join([f'{Table[name][i]:g}' for name in Table.keys()]), file=file)
+
+    return Table
+
+
+def run_hyperparameter_grid(dir_pnet_result: str, list_Alpha, list_Beta, list_subject_folder=None, error=None):
+    """
+    run_hyperparameter_grid(dir_pnet_result: str, list_Alpha, list_Beta, list_subject_folder=None, error=None)
+    Compute pFNs of a subset of subject folders for a grid of Alpha and Beta, and quality control measurements of each grid point
+    It uses gFNs and settings of Personalized_FN in the pNet result folder, with alphaS and alphaL set by Alpha and Beta
+    Data of each subject folder are loaded once, and the Laplacian operator is built once
+    Grid points are computed along a path of neighbors, see setup_hyperparameter_grid, each starting from pFNs of the previous one mixed with gFNs
+    Results are saved into Hyperparameter_Grid.mat and Hyperparameter_Grid.txt in the quality control folder, without changing pFNs in Personalized_FN
+
+    :param dir_pnet_result: the directory of pNet result folder, with gFNs in Group_FN
+    :param list_Alpha: a list of Alpha values, hyper parameter for spatial sparsity
+    :param list_Beta: a list of Beta values, hyper parameter for Laplacian sparsity
+    :param list_subject_folder: None or a list of subject folders in Personalized_FN. None uses all subject folders
+    :param error: None or difference of cost function for convergence. None uses error in settings of Personalized_FN, and a larger one is faster for screening
+    :return: Table, a dict of 1D vectors with one element for each grid point, including Alpha, Beta, Spatial_Correspondence, Delta_Spatial_Correspondence, N_Miss_Match and Functional_Homogeneity
+    Spatial_Correspondence is the average spatial correlation between matched gFNs and pFNs
+    Delta_Spatial_Correspondence is the minimum difference of spatial correlation between matched and unmatched gFNs and pFNs
+    N_Miss_Match is the number of miss-matched pFNs
+    Functional_Homogeneity is the average functional homogeneity of pFNs
+    All are averaged across subject folders
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Setup sub-folders in pNet result
+    dir_pnet_dataInput, dir_pnet_FNC, dir_pnet_gFN, dir_pnet_pFN, dir_pnet_QC, _ = setup_result_folder(dir_pnet_result)
+
+    # Log file
+    logFile = os.path.join(dir_pnet_QC, 'Log_Hyperparameter_Grid.log')
+
+    setting = {'Data_Input': load_json_setting(os.path.join(dir_pnet_dataInput, 'Setting.json')),
+               'FN_Computation': load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))}
+    Data_Type = setting['Data_Input']['Data_Type']
+    Data_Format = setting['Data_Input']['Data_Format']
+    maxIter = setting['FN_Computation']['Personalized_FN']['maxIter']
+    minIter = setting['FN_Computation']['Personalized_FN']['minIter']
+    meanFitRatio = setting['FN_Computation']['Personalized_FN']['meanFitRatio']
+    if error is None:
+        error = setting['FN_Computation']['Personalized_FN']['error']
+    normW = setting['FN_Computation']['Personalized_FN']['normW']
+    vxI = setting['FN_Computation']['Personalized_FN']['vxI']
+    ard = setting['FN_Computation']['Personalized_FN']['ard']
+    eta = setting['FN_Computation']['Personalized_FN']['eta']
+    solver = setting['FN_Computation']['Personalized_FN'].get('solver', 'mu')
+    dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+    Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+
+    # data precision
+    np_float, np_eps = set_data_precision(dataPrecision)
+
+    # Load gFNs and gNb
+    Brain_Mask = None
+    if Data_Type == 'Volume':
+        Brain_Mask = load_brain_template(os.path.join(dir_pnet_dataInput, 'Brain_Template.json.zip'))['Brain_Mask']
+    gFN = reshape_FN(load_matlab_single_array(os.path.join(dir_pnet_gFN, 'FN.mat')), dataType=Data_Type, Brain_Mask=Brain_Mask)
+    gNb = load_matlab_single_array(os.path.join(dir_pnet_FNC, 'gNb.mat'))
+
+    # Subject folders
+    list_subject_folder_all = setup_pFN_folder(dir_pnet_result)
+    if list_subject_folder is None:
+        list_subject_folder = list_subject_folder_all
+    for subject_folder in list_subject_folder:
+        if subject_folder not in list_subject_folder_all:
+            raise ValueError('Cannot find the subject folder in Personalized_FN: ' + str(subject_folder))
+
+    # Laplacian operator shared by all subjects and grid points when it does not depend on data
+    Laplacian = None
+    if vxI == 0:
+        Laplacian = setup_Laplacian_operator(gNb, gFN.shape[0], normW=normW, dataPrecision=dataPrecision)
+
+    list_grid = setup_hyperparameter_grid(list_Alpha, list_Beta)
+    Result = {name: np.zeros((len(list_grid), len(list_subject_folder)))
+              for name in ('Spatial_Correspondence', 'Delta_Spatial_Correspondence', 'N_Miss_Match', 'Functional_Homogeneity')}
+    for j, subject_folder in enumerate(list_subject_folder):
+        with open(logFile, 'a') as file_log:
+            print(f'Start to compute a grid of {len(list_grid)} hyperparameters for subject folder: {subject_folder} at '
+                  + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=file_log, flush=True)
+        # load data
+        scan_data = load_fmri_scan(os.path.join(dir_pnet_pFN, subject_folder, 'Scan_List.txt'), dataType=Data_Type, dataFormat=Data_Format,
+                                   Reshape=True, Brain_Mask=Brain_Mask, Normalization=None, Cache=Cache, logFile=logFile).astype(np_float)
+        Laplacian_subject = Laplacian
+        if vxI > 0:
+            Laplacian_subject = setup_Laplacian_operator(gNb, scan_data.shape[1], vxI=vxI, X=scan_data, normW=normW, dataPrecision=dataPrecision)
+
+        # Each grid point starts from pFNs of the previous one
+        initUV = None
+        for i, (Alpha, Beta) in enumerate(list_grid):
+            TC, pFN = pFN_NMF(scan_data, gFN, gNb, maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio, error=error, normW=normW,
+                              Alpha=Alpha, Beta=Beta, alphaS=0, alphaL=0, vxI=vxI, ard=ard, eta=eta,
+                              solver=solver, Laplacian=Laplacian_subject, initUV=initUV,
+                              dataPrecision=dataPrecision, logFile=logFile)
+            # The next grid point starts from the average of pFNs and gFNs scaled to pFNs, so that entries shrunk to zero can grow back in multiplicative updates
+            initUV = (TC, (pFN + gFN / np.maximum(np.max(gFN, axis=0), np_eps) * np.max(pFN, axis=0)) / 2)
+
+            # Compute quality control measurement
+            Spatial_Correspondence, Delta_Spatial_Correspondence, Miss_Match, Functional_Homogeneity, _ =\
+                compute_quality_control(scan_data, gFN, pFN, dataPrecision=dataPrecision, logFile=None)
+            Result['Spatial_Correspondence'][i, j] = np.mean(np.diag(Spatial_Correspondence))
+            Result['Delta_Spatial_Correspondence'][i, j] = np.min(Delta_Spatial_Correspondence)
+            Result['N_Miss_Match'][i, j] = Miss_Match.shape[0]
+            Result['Functional_Homogeneity'][i, j] = np.mean(Functional_Homogeneity)
+
+    return save_hyperparameter_grid(dir_pnet_QC, list_grid, list_subject_folder, Result)
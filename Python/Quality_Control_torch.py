@@ -12,8 +12,9 @@ import torch
 
 # other functions of pNet
 from Data_Input import load_json_setting, load_matlab_single_array, load_fmri_scan, reshape_FN, setup_result_folder, load_brain_template
-from FN_Computation_torch import mat_corr_torch, set_data_precision_torch
-from Quality_Control import print_description_QC
+from FN_Computation import setup_pFN_folder
+from FN_Computation_torch import mat_corr_torch, set_data_precision_torch, pFN_NMF_torch, setup_Laplacian_operator_torch
+from Quality_Control import print_description_QC, setup_hyperparameter_grid, save_hyperparameter_grid
 
 
 def run_quality_control_torch(dir_pnet_result: str):
@@ -53,6 +54,7 @@ def run_quality_control_torch(dir_pnet_result: str):
     setting = load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))
     combineScan = setting['Combine_Scan']
     dataPrecision = setting['Computation']['dataPrecision']
+    Cache = setting['Computation'].get('Cache', {'Enable': False})
 
     # Information about scan list
     file_scan = os.path.join(dir_pnet_dataInput, 'Scan_List.txt')
@@ -94,15 +96,15 @@ def run_quality_control_torch(dir_pnet_result: str):
 
         # Load the data
         if Data_Type == 'Surface':
-            scan_data = load_fmri_scan(file_scan_list, dataType=Data_Type, dataFormat=Data_Format, Reshape=True, Normalization=None)
+            scan_data = load_fmri_scan(file_scan_list, dataType=Data_Type, dataFormat=Data_Format, Reshape=True, Normalization=None, Cache=Cache)
 
         elif Data_Type == 'Volume':
             scan_data = load_fmri_scan(file_scan_list, dataType=Data_Type, dataFormat=Data_Format, Reshape=True,
-                                       Brain_Mask=Brain_Mask, Normalization=None)
+                                       Brain_Mask=Brain_Mask, Normalization=None, Cache=Cache)
 
         elif Data_Type == 'Surface-Volume':
             scan_data = load_fmri_scan(file_scan_list, dataType=Data_Type, dataFormat=Data_Format, Reshape=True,
-                                       Normalization=None)
+                                       Normalization=None, Cache=Cache)
 
         else:
             raise ValueError('Unknown data type: ' + Data_Type)
@@ -217,3 +219,104 @@ def compute_quality_control_torch(scan_data, gFN, pFN, dataPrecision='double', l
     Functional_Homogeneity_Control = Functional_Homogeneity_Control.numpy()
 
     return Spatial_Correspondence, Delta_Spatial_Correspondence, Miss_Match, Functional_Homogeneity, Functional_Homogeneity_Control
+
+
+def run_hyperparameter_grid_torch(dir_pnet_result: str, list_Alpha, list_Beta, list_subject_folder=None, error=None):
+    """
+    Compute pFNs of a subset of subject folders for a grid of Alpha and Beta, and quality control measurements of each grid point
+    It uses gFNs and settings of Personalized_FN in the pNet result folder, with alphaS and alphaL set by Alpha and Beta
+    Data of each subject folder are loaded once, and the Laplacian operator is built once
+    Grid points are computed along a path of neighbors, see setup_hyperparameter_grid, each starting from pFNs of the previous one mixed with gFNs
+    Results are saved into Hyperparameter_Grid.mat and Hyperparameter_Grid.txt in the quality control folder, without changing pFNs in Personalized_FN
+
+    :param dir_pnet_result: the directory of pNet result folder, with gFNs in Group_FN
+    :param list_Alpha: a list of Alpha values, hyper parameter for spatial sparsity
+    :param list_Beta: a list of Beta values, hyper parameter for Laplacian sparsity
+    :param list_subject_folder: None or a list of subject folders in Personalized_FN. None uses all subject folders
+    :param error: None or difference of cost function for convergence. None uses error in settings of Personalized_FN, and a larger one is faster for screening
+    :return: Table, a dict of 1D vectors with one element for each grid point, see run_hyperparameter_grid
+
+    Yuncong Ma, 11/9/2023
+    """
+
+    # Setup sub-folders in pNet result
+    dir_pnet_dataInput, dir_pnet_FNC, dir_pnet_gFN, dir_pnet_pFN, dir_pnet_QC, _ = setup_result_folder(dir_pnet_result)
+
+    # Log file
+    logFile = os.path.join(dir_pnet_QC, 'Log_Hyperparameter_Grid.log')
+
+    setting = {'Data_Input': load_json_setting(os.path.join(dir_pnet_dataInput, 'Setting.json')),
+               'FN_Computation': load_json_setting(os.path.join(dir_pnet_FNC, 'Setting.json'))}
+    Data_Type = setting['Data_Input']['Data_Type']
+    Data_Format = setting['Data_Input']['Data_Format']
+    maxIter = setting['FN_Computation']['Personalized_FN']['maxIter']
+    minIter = setting['FN_Computation']['Personalized_FN']['minIter']
+    meanFitRatio = setting['FN_Computation']['Personalized_FN']['meanFitRatio']
+    if error is None:
+        error = setting['FN_Computation']['Personalized_FN']['error']
+    normW = setting['FN_Computation']['Personalized_FN']['normW']
+    vxI = setting['FN_Computation']['Personalized_FN']['vxI']
+    ard = setting['FN_Computation']['Personalized_FN']['ard']
+    eta = setting['FN_Computation']['Personalized_FN']['eta']
+    solver = setting['FN_Computation']['Personalized_FN'].get('solver', 'mu')
+    dataPrecision = setting['FN_Computation']['Computation']['dataPrecision']
+    Cache = setting['FN_Computation']['Computation'].get('Cache', {'Enable': False})
+
+    # data precision
+    torch_float, torch_eps = set_data_precision_torch(dataPrecision)
+
+    # Load gFNs and gNb
+    Brain_Mask = None
+    if Data_Type == 'Volume':
+        Brain_Mask = load_brain_template(os.path.join(dir_pnet_dataInput, 'Brain_Template.json.zip'))['Brain_Mask']
+    gFN = reshape_FN(load_matlab_single_array(os.path.join(dir_pnet_gFN, 'FN.mat')), dataType=Data_Type, Brain_Mask=Brain_Mask)
+    gNb = load_matlab_single_array(os.path.join(dir_pnet_FNC, 'gNb.mat'))
+    gFN_torch = torch.tensor(gFN, dtype=torch_float)
+
+    # Subject folders
+    list_subject_folder_all = setup_pFN_folder(dir_pnet_result)
+    if list_subject_folder is None:
+        list_subject_folder = list_subject_folder_all
+    for subject_folder in list_subject_folder:
+        if subject_folder not in list_subject_folder_all:
+            raise ValueError('Cannot find the subject folder in Personalized_FN: ' + str(subject_folder))
+
+    # Laplacian operator shared by all subjects and grid points when it does not depend on data
+    Laplacian = None
+    if vxI == 0:
+        Laplacian = setup_Laplacian_operator_torch(gNb, gFN.shape[0], normW=normW, dataPrecision=dataPrecision)
+
+    list_grid = setup_hyperparameter_grid(list_Alpha, list_Beta)
+    Result = {name: np.zeros((len(list_grid), len(list_subject_folder)))
+              for name in ('Spatial_Correspondence', 'Delta_Spatial_Correspondence', 'N_Miss_Match', 'Functional_Homogeneity')}
+    for j, subject_folder in enumerate(list_subject_folder):
+        with open(logFile, 'a') as file_log:
+            print(f'Start to compute a grid of {len(list_grid)} hyperparameters for subject folder: {subject_folder} at '
+                  + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())), file=file_log, flush=True)
+        # load data
+        scan_data = load_fmri_scan(os.path.join(dir_pnet_pFN, subject_folder, 'Scan_List.txt'), dataType=Data_Type, dataFormat=Data_Format,
+                                   Reshape=True, Brain_Mask=Brain_Mask, Normalization=None, Cache=Cache, logFile=logFile)
+        scan_data = torch.tensor(scan_data, dtype=torch_float)
+        Laplacian_subject = Laplacian
+        if vxI > 0:
+            Laplacian_subject = setup_Laplacian_operator_torch(gNb, scan_data.shape[1], vxI=vxI, X=scan_data, normW=normW, dataPrecision=dataPrecision)
+
+        # Each grid point starts from pFNs of the previous one
+        initUV = None
+        for i, (Alpha, Beta) in enumerate(list_grid):
+            TC, pFN = pFN_NMF_torch(scan_data, gFN, gNb, maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio, error=error, normW=normW,
+                                    Alpha=Alpha, Beta=Beta, alphaS=0, alphaL=0, vxI=vxI, ard=ard, eta=eta,
+                                    solver=solver, Laplacian=Laplacian_subject, initUV=initUV,
+                                    dataPrecision=dataPrecision, logFile=logFile)
+            # The next grid point starts from the average of pFNs and gFNs scaled to pFNs, so that entries shrunk to zero can grow back in multiplicative updates
+            initUV = (TC, (pFN + gFN_torch / torch.clamp(torch.max(gFN_torch, dim=0)[0], min=torch_eps) * torch.max(pFN, dim=0)[0]) / 2)
+
+            # Compute quality control measurement
+            Spatial_Correspondence, Delta_Spatial_Correspondence, Miss_Match, Functional_Homogeneity, _ =\
+                compute_quality_control_torch(scan_data, gFN, pFN, dataPrecision=dataPrecision, logFile=None)
+            Result['Spatial_Correspondence'][i, j] = np.mean(np.diag(Spatial_Correspondence))
+            Result['Delta_Spatial_Correspondence'][i, j] = np.min(Delta_Spatial_Correspondence)
+            Result['N_Miss_Match'][i, j] = Miss_Match.shape[0]
+            Result['Functional_Homogeneity'][i, j] = np.mean(Functional_Homogeneity)
+
+    return save_hyperparameter_grid(dir_pnet_QC, list_grid, list_subject_folder, Result)
@@ -7,13 +7,14 @@
 import pNet
 
 # setup and run a customized workflow
-pNet.workflow_simple(
-    dir_pnet_result='/Users/yuncongma/Documents/Document/fMRI/Myworks/pNet/Example/HCP_Surface/Data/Test',
-    dataType='Surface',
-    file_scan='/Users/yuncongma/Documents/Document/fMRI/Myworks/pNet/Example/HCP_Surface/Data/Scan_List.txt',
-    dataFormat='HCP Surface (*.cifti, *.mat)',
-    file_Brain_Template='/Users/yuncongma/Documents/Document/fMRI/Myworks/pNet/Brain_Template/HCP_Surface/Brain_Template.json',
-    K=17,
-    Combine_Scan=False
-)
+if __name__ == '__main__':
+    pNet.workflow_simple(
+        dir_pnet_result='/Users/yuncongma/Documents/Document/fMRI/Myworks/pNet/Example/HCP_Surface/Data/Test',
+        dataType='Surface',
+        file_scan='/Users/yuncongma/Documents/Document/fMRI/Myworks/pNet/Example/HCP_Surface/Data/Scan_List.txt',
+        dataFormat='HCP Surface (*.cifti, *.mat)',
+        file_Brain_Template='/Users/yuncongma/Documents/Document/fMRI/Myworks/pNet/Brain_Template/HCP_Surface/Brain_Template.json',
+        K=17,
+        Combine_Scan=False
+    )
 
@@ -34,8 +34,11 @@ def workflow(dir_pnet_result: str,
              file_gFN=None,
              samplingMethod='Subject', sampleSize=10, nBS=50,
              maxIter=1000, minIter=30, meanFitRatio=0.1, error=1e-8, normW=1,
-             Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5,
-             Parallel=False, Computation_Mode='CPU_Torch', N_Thread=1,
+             Alpha=2, Beta=30, alphaS=0, alphaL=0, vxI=0, ard=0, eta=0, nRepeat=5, solver='mu', batchSize=1, Compression=False, sketchSize='Automatic', Online=False, nScanBatch=1,
+             Parallel_Repeat=False, nParallelRepeat='Automatic', abandonRatio=0.05, Sweep_Warm_Start=False,
+             Parallel=False, Computation_Mode='CPU_Torch', N_Thread=1, N_Process='Automatic', Prefetch=False, nPrefetch=2, prefetchMemory=None,
+             Cache=False, dir_cache=None, cacheSize=100,
+             Resume=False, Checkpoint=False, checkpointInterval=600, Warm_Start=False, dir_warmStart=None,
              dataPrecision='double',
              outputFormat='Both'):
     """
@@ -62,7 +65,7 @@ def workflow(dir_pnet_result: str,
     :param file_overlayImage: file of a background image for visualizing volume-based results
     :param maskValue: 0 or 1, 0 means 0s in mask files are useful vertices, otherwise vice versa. maskValue=0 for medial wall in HCP data, and maskValue=1 for brain masks
 
-    :param K: number of FNs
+    :param K: number of FNs, or a list of numbers of FNs for a sweep of K, with results of each K in a result folder K_<K>
     :param Combine_Scan: False or True, whether to combine multiple scans for the same subject
 
     :param file_gFN: None or a directory of a precomputed gFN in .mat format
@@ -83,10 +86,32 @@ def workflow(dir_pnet_result: str,
     :param ard: 0 or 1, flat for combining similar clusters
     :param eta: a hyper parameter for the ard regularization term
     :param nRepeat: Any positive integer, the number of repetition to avoid poor initialization
-
-    :param Parallel: False or True, whether to enable parallel computation
+    :param solver: 'mu', 'accelerated_mu' or 'hals'. Multiplicative update, multiplicative update with inner loops, or hierarchical alternating least squares
+    :param batchSize: positive integer, number of subjects with the same number of time points computed together for pFNs. It requires solver='mu' and vxI=0. Batches are grouped by file headers, and data of at most batchSize subjects are loaded at a time
+    :param Compression: False or True, whether to compress bootstrapped data along the time dimension for gFNs, using a randomized sketch followed by a refinement on the original data. When vxI is 0, bootstrapped data are kept in a .npy file in each bootstrap folder instead of memory, and read in blocks
+    :param sketchSize: 'Automatic' or a positive integer, number of time points after compression. 'Automatic' uses max(20*K, 200)
+    :param Online: False or True, whether to compute gFNs of each bootstrap run by streaming scans from disk, without concatenating them in memory. It requires vxI=0
+    :param nScanBatch: positive integer, number of scans between two updates of gFNs in the online mode
+    :param Parallel_Repeat: False or True, whether to run the nRepeat repetitions of gFNs concurrently in threads and keep the best one
+    :param nParallelRepeat: 'Automatic' or a positive integer, number of concurrent repetitions. 'Automatic' uses the number of CPUs
+    :param abandonRatio: a concurrent repetition is abandoned if its objective function is larger than the best of other repetitions at the same iteration by this ratio
+    :param Sweep_Warm_Start: False or True, whether to start gFNs of each bootstrap run in a sweep of K from its gFNs of the previous K. It does not apply to the online mode
+
+    :param Parallel: False or True, whether to enable parallel computation. Bootstrap runs of gFNs and subject folders of pFNs are dispatched to worker processes. Workers import the main script again, so a script calling workflow must use the if __name__ == '__main__': guard
     :param Computation_Mode: 'CPU_Numpy', 'CPU_Torch'
-    :param N_Thread: positive integers, used for parallel computation
+    :param N_Thread: positive integers, used for parallel computation. It is the total number of threads, split among worker processes
+    :param N_Process: 'Automatic' or a positive integer, number of worker processes for bootstrap runs and subjects, each using N_Thread // N_Process threads. 'Automatic' uses one thread per process
+    :param Prefetch: False or True, whether to load data of next bootstrap runs and subject folders in background threads while computing the current one. It applies when Parallel is False
+    :param nPrefetch: positive integer, maximum number of bootstrap runs or subject folders loaded ahead
+    :param prefetchMemory: None or a positive number in GB, maximum memory of data loaded ahead
+    :param Cache: False or True, whether to keep masked and normalized scans in a scan cache, so that scans loaded again by bootstrap runs, pFNs and quality control are memory-mapped from the cache
+    :param dir_cache: None or directory of the scan cache, which can be shared by pNet result folders. None uses Scan_Cache in FN_Computation
+    :param cacheSize: None or a positive number in GB, maximum size of the scan cache. Least recently used scans are removed when it is exceeded
+    :param Resume: False or True, whether to skip bootstrap runs, gFNs and subject folders finished by a previous run with the same inputs and settings
+    :param Checkpoint: False or True, whether to save U and V periodically when computing pFNs of each subject folder, so that a stopped run resumes from the last checkpoint
+    :param checkpointInterval: minimum number of seconds between two checkpoints
+    :param Warm_Start: False or True, whether to start pFNs of each subject folder from its previous pFNs computed with the same gFNs and K, kept in a warm-start cache
+    :param dir_warmStart: None or directory of the warm-start cache, which can be shared by pNet result folders
 
     :param dataPrecision: 'double' or 'single'
 
@@ -95,6 +120,9 @@ def workflow(dir_pnet_result: str,
     Yuncong Ma, 11/8/2023
     """
 
+    # Worker processes of parallel computation import the main script again, and must not rerun the workflow
+    check_main_process()
+
     # Check setting
     check_data_type_format(dataType, dataFormat)
 
@@ -158,8 +186,11 @@ def workflow(dir_pnet_result: str,
         maxIter=maxIter, minIter=minIter, meanFitRatio=meanFitRatio, error=error, normW=normW,
         Alpha=Alpha, Beta=Beta, alphaS=alphaS, alphaL=alphaL,
         vxI=vxI, ard=ard, eta=eta,
-        nRepeat=nRepeat,
-        Parallel=Parallel, Computation_Mode=Computation_Mode, N_Thread=N_Thread,
+        nRepeat=nRepeat, solver=solver, batchSize=batchSize, Compression=Compression, sketchSize=sketchSize, Online=Online, nScanBatch=nScanBatch,
+        Parallel_Repeat=Parallel_Repeat, nParallelRepeat=nParallelRepeat, abandonRatio=abandonRatio, Sweep_Warm_Start=Sweep_Warm_Start,
+        Parallel=Parallel, Computation_Mode=Computation_Mode, N_Thread=N_Thread, N_Process=N_Process, Prefetch=Prefetch, nPrefetch=nPrefetch, prefetchMemory=prefetchMemory,
+        Cache=Cache, dir_cache=dir_cache, cacheSize=cacheSize,
+        Resume=Resume, Checkpoint=Checkpoint, checkpointInterval=checkpointInterval, Warm_Start=Warm_Start, dir_warmStart=dir_warmStart,
         dataPrecision=dataPrecision,
         outputFormat=outputFormat
     )
@@ -170,16 +201,24 @@ def workflow(dir_pnet_result: str,
         run_FN_Computation_torch(dir_pnet_result)
     # ============================================= #
 
+    # A sweep of K has a result folder for each K
+    if isinstance(K, list):
+        list_dir_pnet_result = [os.path.join(dir_pnet_result, f'K_{k}') for k in sorted(K)]
+    else:
+        list_dir_pnet_result = [dir_pnet_result]
+
     # ============== Quality Control ============== #
     # perform quality control
-    if Computation_Mode == 'CPU_Numpy':
-        run_quality_control(dir_pnet_result)
-    elif Computation_Mode == 'CPU_Torch':
-        run_quality_control_torch(dir_pnet_result)
+    for dir_pnet_result_K in list_dir_pnet_result:
+        if Computation_Mode == 'CPU_Numpy':
+            run_quality_control(dir_pnet_result_K)
+        elif Computation_Mode == 'CPU_Torch':
+            run_quality_control_torch(dir_pnet_result_K)
     # ============================================= #
 
     # ============== Quality Control ============== #
-    run_Visualization(dir_pnet_result)
+    for dir_pnet_result_K in list_dir_pnet_result:
+        run_Visualization(dir_pnet_result_K)
     # ============================================= #
 
 
@@ -206,6 +245,9 @@ def workflow_simple(dir_pnet_result: str,
     Yuncong Ma, 11/7/2023
     """
 
+    # Worker processes of parallel computation import the main script again, and must not rerun the workflow
+    check_main_process()
+
     # setup all sub-folders in the pNet result folder
     dir_pnet_dataInput, dir_pnet_FNC, dir_pnet_gFN, dir_pnet_pFN, dir_pnet_QC, dir_pnet_STAT = setup_result_folder(dir_pnet_result)
 
@@ -609,72 +651,74 @@ def workflow_guide():
     print('import pNet\n', file=file_script)
 
     print('# setup and run a customized workflow', file=file_script)
+    # Worker processes of parallel computation import this script again, so the workflow only runs in the main process
+    print("if __name__ == '__main__':", file=file_script)
     if Choice_simple == 'N' and file_Brain_Template is not None:
-        print(f"pNet.workflow_simple(", file=file_script)
-        print(f"    dir_pnet_result='{dir_pnet_result}',", file=file_script)
-        print(f"    dataType='{dataType}',", file=file_script)
-        print(f"    file_scan='{file_scan}',", file=file_script)
-        print(f"    dataFormat='{dataFormat}',", file=file_script)
-        print(f"    file_Brain_Template='{file_Brain_Template}',", file=file_script)
-        print(f"    K={K},", file=file_script)
-        print(f"    Combine_Scan={Combine_Scan}", file=file_script)  # True or False
-        print(")\n", file=file_script)
+        print(f"    pNet.workflow_simple(", file=file_script)
+        print(f"        dir_pnet_result='{dir_pnet_result}',", file=file_script)
+        print(f"        dataType='{dataType}',", file=file_script)
+        print(f"        file_scan='{file_scan}',", file=file_script)
+        print(f"        dataFormat='{dataFormat}',", file=file_script)
+        print(f"        file_Brain_Template='{file_Brain_Template}',", file=file_script)
+        print(f"        K={K},", file=file_script)
+        print(f"        Combine_Scan={Combine_Scan}", file=file_script)  # True or False
+        print("    )\n", file=file_script)
 
     else:
-        print(f"pNet.workflow(", file=file_script)
-        print(f"    dir_pnet_result='{dir_pnet_result}',", file=file_script)
-        print(f"    dataType='{dataType}',", file=file_script)
-        print(f"    dataFormat='{dataFormat}',", file=file_script)
-        print(f"    file_scan='{file_scan}',", file=file_script)
-        print(f"    file_subject_ID='{file_subject_ID}',", file=file_script)
-        print(f"    file_subject_folder='{file_subject_folder}',", file=file_script)
-        print(f"    file_group_ID='{file_group_ID}',", file=file_script)
+        print(f"    pNet.workflow(", file=file_script)
+        print(f"        dir_pnet_result='{dir_pnet_result}',", file=file_script)
+        print(f"        dataType='{dataType}',", file=file_script)
+        print(f"        dataFormat='{dataFormat}',", file=file_script)
+        print(f"        file_scan='{file_scan}',", file=file_script)
+        print(f"        file_subject_ID='{file_subject_ID}',", file=file_script)
+        print(f"        file_subject_folder='{file_subject_folder}',", file=file_script)
+        print(f"        file_group_ID='{file_group_ID}',", file=file_script)
         if file_Brain_Template is not None:
-            print(f"    file_Brain_Template='{file_Brain_Template}',", file=file_script)
+            print(f"        file_Brain_Template='{file_Brain_Template}',", file=file_script)
             if dataType == 'Surface':
-                print(f"    templateFormat='{templateFormat}',", file=file_script)
-                print(f"    file_surfL='{file_surfL}',", file=file_script)
-                print(f"    file_surfR='{file_surfR}',", file=file_script)
-                print(f"    file_maskL='{file_maskL}',", file=file_script)
-                print(f"    file_maskR='{file_maskR}',", file=file_script)
+                print(f"        templateFormat='{templateFormat}',", file=file_script)
+                print(f"        file_surfL='{file_surfL}',", file=file_script)
+                print(f"        file_surfR='{file_surfR}',", file=file_script)
+                print(f"        file_maskL='{file_maskL}',", file=file_script)
+                print(f"        file_maskR='{file_maskR}',", file=file_script)
                 if file_surfL_inflated is not None:
-                    print(f"    file_surfL_inflated='{file_surfL_inflated}',", file=file_script)
-                    print(f"    file_surfR_inflated='{file_surfR_inflated}',", file=file_script)
+                    print(f"        file_surfL_inflated='{file_surfL_inflated}',", file=file_script)
+                    print(f"        file_surfR_inflated='{file_surfR_inflated}',", file=file_script)
             elif dataType == 'Volume':
-                print(f"    templateFormat='{templateFormat}',", file=file_script)
-                print(f"    file_mask_vol='{file_mask_vol}',", file=file_script)
-                print(f"    file_overlayImage='{file_overlayImage}',", file=file_script)
+                print(f"        templateFormat='{templateFormat}',", file=file_script)
+                print(f"        file_mask_vol='{file_mask_vol}',", file=file_script)
+                print(f"        file_overlayImage='{file_overlayImage}',", file=file_script)
             elif dataType == 'Surface-Volume':
-                print(f"    templateFormat='{templateFormat}',", file=file_script)
-                print(f"    file_surfL='{file_surfL}',", file=file_script)
-                print(f"    file_surfR='{file_surfR}',", file=file_script)
-                print(f"    file_maskL='{file_maskL}',", file=file_script)
-                print(f"    file_maskR='{file_maskR}',", file=file_script)
+                print(f"        templateFormat='{templateFormat}',", file=file_script)
+                print(f"        file_surfL='{file_surfL}',", file=file_script)
+                print(f"        file_surfR='{file_surfR}',", file=file_script)
+                print(f"        file_maskL='{file_maskL}',", file=file_script)
+                print(f"        file_maskR='{file_maskR}',", file=file_script)
                 if file_surfL_inflated is not None:
-                    print(f"    file_surfL_inflated='{file_surfL_inflated}',", file=file_script)
-                    print(f"    file_surfR_inflated='{file_surfR_inflated}',", file=file_script)
-                print(f"    file_mask_vol='{file_mask_vol}',", file=file_script)
-                print(f"    file_overlayImage='{file_overlayImage}',", file=file_script)
-            print(f"    maskValue={maskValue},", file=file_script)
-        print(f"    K={K},", file=file_script)
-        print(f"    Combine_Scan={Combine_Scan},", file=file_script)  # True or False
+                    print(f"        file_surfL_inflated='{file_surfL_inflated}',", file=file_script)
+                    print(f"        file_surfR_inflated='{file_surfR_inflated}',", file=file_script)
+                print(f"        file_mask_vol='{file_mask_vol}',", file=file_script)
+                print(f"        file_overlayImage='{file_overlayImage}',", file=file_script)
+            print(f"        maskValue={maskValue},", file=file_script)
+        print(f"        K={K},", file=file_script)
+        print(f"        Combine_Scan={Combine_Scan},", file=file_script)  # True or False
         if file_gFN is not None:
-            print(f"    file_gFN='{file_gFN}',", file=file_script)
+            print(f"        file_gFN='{file_gFN}',", file=file_script)
         if Choice_simple == 'Y':
-            print(f"    samplingMethod='{samplingMethod}',", file=file_script)
-            print(f"    sampleSize={sampleSize},", file=file_script)
-            print(f"    nBS={nBS},", file=file_script)
-            print(f"    maxIter={maxIter},", file=file_script)
-            print(f"    minIter={minIter},", file=file_script)
-            print(f"    meanFitRatio={meanFitRatio},", file=file_script)
-            print(f"    error={error},", file=file_script)
-            print(f"    Alpha={Alpha},", file=file_script)
-            print(f"    Beta={Beta},", file=file_script)
-            print(f"    nRepeat={nRepeat},", file=file_script)
-            print(f"    Computation_Mode='{Computation_Mode}',", file=file_script)
-            print(f"    dataPrecision='{dataPrecision}'", file=file_script)
-        print(f"    outputFormat='{outputFormat}'", file=file_script)
-        print(")\n", file=file_script)
+            print(f"        samplingMethod='{samplingMethod}',", file=file_script)
+            print(f"        sampleSize={sampleSize},", file=file_script)
+            print(f"        nBS={nBS},", file=file_script)
+            print(f"        maxIter={maxIter},", file=file_script)
+            print(f"        minIter={minIter},", file=file_script)
+            print(f"        meanFitRatio={meanFitRatio},", file=file_script)
+            print(f"        error={error},", file=file_script)
+            print(f"        Alpha={Alpha},", file=file_script)
+            print(f"        Beta={Beta},", file=file_script)
+            print(f"        nRepeat={nRepeat},", file=file_script)
+            print(f"        Computation_Mode='{Computation_Mode}',", file=file_script)
+            print(f"        dataPrecision='{dataPrecision}',", file=file_script)
+        print(f"        outputFormat='{outputFormat}'", file=file_script)
+        print("    )\n", file=file_script)
 
     file_script.close()
     print('Customized workflow script is generated successfully, please open to check the details.')